@@ -1,8 +1,6 @@
 #!/usr/bin/env python3
 
-import os
 import sys
-import json
 import math
 
 import pandas as pd
@@ -103,19 +101,25 @@ def get_bcs_fragments(side='left', allow_both=True, fake=False, **kwargs):
     return bcs
 
 
-def walk_n_down_primary_neurite(node_id, n, nodes=None):
+def get_skeleton_graph(node_id, nodes=None):
+    #nodes can be a nodes table or a pymaid_utils.SkeletonGraph. Pass a SkeletonGraph when making many calls on the same neuron
     if nodes is None:
         nodes = pymaid.get_neuron(pymaid.get_skid_from_node(node_id)[node_id]).nodes
-    if nodes.index.name != 'node_id':
-        nodes = nodes.set_index('node_id')
-    for i in range(n):
-        node_id = nodes.index[(nodes.parent_id == node_id) & (nodes.radius == primary_neurite_radius)]
-        if len(node_id) is 0:
+    return pymaid_utils.as_skeleton_graph(nodes, primary_neurite_radius=primary_neurite_radius)
+
+
+def walk_n_down_primary_neurite(node_id, n, nodes=None):
+    graph = get_skeleton_graph(node_id, nodes)
+    i = graph.index(node_id)
+    for step in range(n):
+        children = graph.get_children(i)
+        children = children[(graph.flags[children] & pymaid_utils.PRIMARY_NEURITE_NODE) != 0]
+        if len(children) == 0:
             raise Exception('Main branch ends before {} steps could be taken!'.format(n))
-        if len(node_id) > 1:
+        if len(children) > 1:
             raise Exception('Main branch bifurcates! Can\'t handle this case yet')
-        node_id = node_id[0]
-    return node_id
+        i = children[0]
+    return int(graph.node_ids[i])
 
 
 def import_lT1mn_axon_areas(filename=mn_axon_areas_fn, neuronidcol=0, areacol=1):
@@ -126,40 +130,84 @@ def import_lT1mn_axon_areas(filename=mn_axon_areas_fn, neuronidcol=0, areacol=1)
     return areas_sorted
 
 
-def measure_distance_to_primary_neurite(node_id, nodes=None, scale=.001):
-    if nodes is None: #If the user has already pulled the nodes table, they can pass it to this function to prevent needing to re-pull the nodes
-        nodes = pymaid.get_neuron(pymaid.get_skid_from_node(node_id)[node_id]).nodes.set_index('node_id')
-    elif nodes.index.name != 'node_id':
-        nodes = nodes.set_index('node_id')
-    distance_to_primary_neurite = 0
-    while nodes.radius.at[node_id] != primary_neurite_radius:
-        parent_id = nodes.parent_id.at[node_id]
-        try:
-            distance_to_primary_neurite += np.linalg.norm(nodes.loc[parent_id, ['x', 'y', 'z']] - nodes.loc[node_id, ['x', 'y', 'z']])
-        except KeyError: #If walking up the tree reached the root before reaching a primary_neurite, return -1 and let the caller decide what to do with it
-            return -1, -1
-        node_id = parent_id
-    return distance_to_primary_neurite*scale, node_id
+def get_distance_to_primary_neurite_fields(skids):
+    """
+    For each skeleton, every node's distance (in nm) to the primary neurite
+    node it's attached to (the nearest one upstream of it), and that node's
+    id, along with each node's pymaid_utils.SkeletonGraph flags and number of
+    children. Returned as dicts of arrays sorted by node_id, with -1 distances
+    and attachment ids for nodes that have no primary neurite upstream.
+    Each field is stored with its skeleton in the pymaid_utils skeleton
+    store, so it's only computed again after the skeleton is edited.
+    Skeletons come from pymaid's global instance, like everywhere else in
+    this file.
+    """
+    skids = [int(skid) for skid in skids]
+    neurons = pymaid_utils.sync(skids, remote_instance='global', verbose=False)
+    store = pymaid_utils.get_store('global')
+    fields = {}
+    for skid, neuron in zip(skids, neurons):
+        field = store.load(skid).get('distance_to_primary_neurite', None)
+        if field is None or field['primary_neurite_radius'] != primary_neurite_radius:
+            graph = pymaid_utils.SkeletonGraph(neuron.nodes, primary_neurite_radius=primary_neurite_radius)
+            distance, attachment = graph.distance_to_primary_neurite()
+            order = np.argsort(graph.node_ids)
+            field = {
+                'primary_neurite_radius': primary_neurite_radius,
+                'node_id': graph.node_ids[order],
+                'distance': distance[order].astype(np.float32),
+                'attachment_node_id': np.where(attachment == -1, -1, graph.node_ids[attachment])[order],
+                'flags': graph.flags[order],
+                'n_children': graph.n_children[order]
+            }
+            store.update(skid, distance_to_primary_neurite=field)
+        fields[skid] = field
+    return fields
+
+
+def lookup_distances_to_primary_neurite(field, node_ids, scale=.001):
+    #Distances (scaled, -1 if there's no primary neurite upstream) and attachment node ids of the given nodes, from a field made by get_distance_to_primary_neurite_fields
+    rows = np.searchsorted(field['node_id'], node_ids)
+    if (rows >= len(field['node_id'])).any() or (field['node_id'][np.minimum(rows, len(field['node_id'])-1)] != node_ids).any():
+        raise KeyError('Some of nodes {} are not in this skeleton'.format(list(node_ids)))
+    distances = field['distance'][rows].astype(np.float64)
+    attachments = field['attachment_node_id'][rows]
+    return np.where(attachments == -1, -1, distances*scale), attachments
 
 
-#Because root is always upstream, can do a fast walk back to root instead of using dist_to which calls a shortest_path graph function which is presumably slower.
-#TODO time this versus pymaid.dist_to
+def measure_distance_to_primary_neurite(node_id, nodes=None, scale=.001):
+    #If the user has already pulled the nodes table (or built a SkeletonGraph from it), they can pass it to this function to prevent needing to re-pull the nodes.
+    #Otherwise the distance is looked up in the neuron's stored distance to primary neurite field
+    #If there's no primary neurite upstream of the node, returns -1, -1 and lets the caller decide what to do with it
+    if nodes is None:
+        skid = int(pymaid.get_skid_from_node(node_id)[node_id])
+        distances, attachments = lookup_distances_to_primary_neurite(
+            get_distance_to_primary_neurite_fields([skid])[skid], [node_id], scale=scale)
+        return (float(distances[0]), int(attachments[0])) if attachments[0] != -1 else (-1, -1)
+    graph = get_skeleton_graph(node_id, nodes)
+    distances, attachments = graph.distance_to_primary_neurite()
+    i = graph.index(node_id)
+    if attachments[i] == -1:
+        return -1, -1
+    return distances[i]*scale, int(graph.node_ids[attachments[i]])
+
+
+#Because root is always upstream, the distance to root of every node can be found in one pass down the tree from the root
+#(see SkeletonGraph.distance_from_root), after which each query is a lookup. Much faster than pymaid.dist_to, which calls a shortest_path graph function.
 def measure_distance_to_root(node_id, nodes=None, scale=.001):
-    if nodes is None: #If the user has already pulled the nodes table, they can pass it to this function to prevent needing to re-pull the nodes
-        nodes = pymaid.get_neuron(pymaid.get_skid_from_node(node_id)[node_id]).nodes.set_index('node_id')
-    elif nodes.index.name != 'node_id':
-        nodes = nodes.set_index('node_id')
-    distance_to_root = 0
-    while nodes.at[node_id, 'type'] != 'root':
-        parent_id = nodes.parent_id.at[node_id]
-        #try:
-        distance_to_root += np.linalg.norm(nodes.loc[parent_id, ['x', 'y', 'z']] - nodes.loc[node_id, ['x', 'y', 'z']])
-        #except KeyError: #If walking up the tree reached the root before reaching a primary_neurite, return -1 and let the caller decide what to do with it
-        #    return -1
-        node_id = parent_id
+    #If the user has already pulled the nodes table (or built a SkeletonGraph from it), they can pass it to this function to prevent needing to re-pull the nodes
+    graph = get_skeleton_graph(node_id, nodes)
+    i = graph.index(node_id)
+    return graph.distance_from_root(i)*scale, int(graph.node_ids[graph.root_index(i)])
 
-    #return distance_to_root
-    return distance_to_root*scale, node_id
+
+def measure_distances_to_root(node_ids, nodes=None, scale=.001):
+    #Same as measure_distance_to_root, but for many nodes of one neuron at once. Returns an array of distances
+    node_ids = np.asarray(node_ids)
+    if len(node_ids) == 0:
+        return np.zeros(0)
+    graph = get_skeleton_graph(int(node_ids[0]), nodes)
+    return graph.distance_from_root(graph.index(node_ids))*scale
 
 
 #-------FUNCTION DEFINITIONS: PULLING DATA-------#
@@ -263,9 +311,8 @@ def count_postsynaptic_motor_central_orphan(side='both'):
 
     postsynaptic_skids = set([skid for skids in connector_details.postsynaptic_to for skid in skids])
     postsynaptic_nodes = [node for node_list in connector_details.postsynaptic_to_node for node in node_list]  # Single nodes postsynaptic to two synapses are listed twice here
-    postsynaptic_nodes_and_skids = try_catch_network_error(
-        'pymaid.get_skid_from_node(postsynaptic_nodes)',
-        variables={'postsynaptic_nodes': postsynaptic_nodes, 'pymaid': pymaid}
+    postsynaptic_nodes_and_skids = pymaid_utils.retry(pymaid.get_skid_from_node)(
+        postsynaptic_nodes
     ) #Dict, so no duplicates
 
     #Validation, only needed to run this once to make sure the above code worked:
@@ -337,8 +384,8 @@ def count_T1bCS_to_lT1mn_synapses(side='both', prune_bcs_to_fragments=True, mn_s
         bcs = get_bcs_fragments(side=side)
     else:
         bcs = pymaid.get_neuron(bcs_skids)
-    mns = try_catch_network_error('pymaid.get_neuron(mn_skids)',
-                                  variables={'pymaid': pymaid, 'mn_skids': mn_skids})
+    # Only re-downloads motor neurons that were edited since the last run
+    mns = pymaid_utils.retry(pymaid_utils.sync)(mn_skids)
     connectivity = pymaid.adjacency_from_connectors(bcs, mns).astype('uint16')
     connectivity.insert(0, 'total', connectivity.sum(axis=1))
     connectivity = connectivity.T
@@ -372,14 +419,25 @@ def measure_bCS_synapse_to_MN_primary_neurite_distances(side='both', mn_skids='l
         mn_skids = mn_skids_left_T1_leg_nerve
     elif mn_skids == 'all_nerves':
         mn_skids = mn_skids_left_T1_all_nerves
-    mns = try_catch_network_error('pymaid.get_neuron(mn_skids)',
-                                  variables={'pymaid': pymaid, 'mn_skids': mn_skids})
+    # Only re-downloads motor neurons that were edited since the last run
+    mns = pymaid_utils.retry(pymaid_utils.sync)(mn_skids)
 
-    synapses = bcs.presynapses
+    return measure_synapse_to_primary_neurite_distances(bcs.presynapses, mns)
+
+
+def measure_synapse_to_primary_neurite_distances(synapses, mns, min_radius=primary_neurite_radius):
+    """
+    Minimum distance from each synapse to each motor neuron's primary neurite
+    (its nodes with radius >= min_radius, or all its nodes if min_radius is
+    None), with a mean column. Rows are motor neurons, columns are connectors.
+    """
     distances = pd.DataFrame()
     for i, synapse in tqdm(synapses.iterrows(), total=len(synapses), desc='Measuring synapse distances'):
         for mn in mns:
-            node_coords = mn.nodes.loc[mn.nodes.radius >= primary_neurite_radius, ['x', 'y', 'z']]
+            if min_radius is None:
+                node_coords = mn.nodes[['x', 'y', 'z']]
+            else:
+                node_coords = mn.nodes.loc[mn.nodes.radius >= min_radius, ['x', 'y', 'z']]
             min_dist = (((node_coords - synapse[['x', 'y', 'z']])**2).sum(axis=1)**0.5).min()
             distances.at[mn.skeleton_id, synapse.connector_id] = min_dist
 
@@ -388,6 +446,48 @@ def measure_bCS_synapse_to_MN_primary_neurite_distances(side='both', mn_skids='l
     return distances
 
 
+def count_bCS_to_MN_synapses_in_atlas(bcs, mn_names):
+    """
+    Count synapses from the bCS fragments bcs onto the motor neurons named
+    mn_names using the connectors in the atlas project itself, in the same
+    format as count_T1bCS_to_lT1mn_synapses(key_type='name'). Neurons are
+    uploaded to the atlas with reuse_existing_connectors=True, so a bCS neuron
+    and a motor neuron that were transformed with their connectors share the
+    atlas connector at a synapse between them. Several atlas neurons can have
+    the same name (e.g. a motor neuron and its pruned primary neurite), so
+    each name gets the most links to any one of its neurons at each connector.
+    Returns None if the bCS fragments have no synapses in the atlas project.
+    """
+    presynapses = bcs.presynapses
+    if presynapses is None or len(presynapses) == 0:
+        return None
+    details = pymaid.get_connector_details(presynapses.connector_id.unique().tolist())
+    links = details[['connector_id', 'presynaptic_to', 'postsynaptic_to']].explode('postsynaptic_to')
+    links = links.dropna(subset=['postsynaptic_to'])
+    links = links.groupby(['connector_id', 'presynaptic_to', 'postsynaptic_to']).size().rename('n').reset_index()
+
+    skid_to_name = pymaid.get_names(pd.unique(links[['presynaptic_to', 'postsynaptic_to']].values.ravel()).tolist())
+    def base_name(skid):
+        return skid_to_name[str(skid)].split(' -')[0].replace(
+            'leg bilateral campaniform sensillum neuron', 'bCS')
+    links['bcs'] = links.presynaptic_to.map(base_name)
+    links['mn'] = links.postsynaptic_to.map(base_name)
+    links = links[links.mn.isin(mn_names)]
+    links = links.groupby(['connector_id', 'bcs', 'mn']).n.max().reset_index()
+
+    connectivity = links.pivot_table(index='mn', columns='bcs', values='n',
+                                     aggfunc='sum', fill_value=0)
+    connectivity = connectivity.reindex(index=list(mn_names), fill_value=0).astype('uint16')
+    connectivity.insert(0, 'total', connectivity.sum(axis=1))
+    connectivity = connectivity.T
+    connectivity.insert(0, 'total', connectivity.sum(axis=1))
+    connectivity = connectivity.T
+    connectivity.sort_values(by='total', ascending=False, inplace=True)
+    connectivity.index.name = None
+    connectivity.columns.name = None
+    return connectivity
+
+
 def measure_bCS_axon_to_MN_primary_neurite_distances(side='both', mn_skids='leg nerve'):
     """
     Measure the distance between bCS neuron axons and motor neuron primary
@@ -398,12 +498,11 @@ def measure_bCS_axon_to_MN_primary_neurite_distances(side='both', mn_skids='leg
     want to perform the measurements in the atlas space.  Because of that, a
     bunch of default variables that work for other functions don't work here,
     and so atlas-project-specific variables are specified here.
+    Connectivity and synapse locations come from the atlas project, so the
+    bCS neurons need to have been transformed with import_connectors=True.
+    Returns the cable overlap, the connectivity, and the distances from each
+    bCS synapse to each motor neuron primary neurite.
     """
-    # Get connectivity from the EM-space project since connectors aren't in the
-    # atlas project currently. Use key_type=name so we can link to neurons in
-    # the atlas project, which have the same name (but different skids)
-    connectivity = count_T1bCS_to_lT1mn_synapses(key_type='name') #connMatrixLd
-
     leftT1bcsSkids = [512068, 510815]  # Atlas-project-specific parameter
     rightT1bcsSkids = [516184, 515577]  # Atlas-project-specific parameter
     if side is 'left':
@@ -432,8 +531,7 @@ def measure_bCS_axon_to_MN_primary_neurite_distances(side='both', mn_skids='leg
         elif mn_skids == 'all nerves':
             mn_skids = mn_skids_left_T1_all_nerves_primary_neurites
 
-        mns = try_catch_network_error('pymaid.get_neuron(mn_skids)',
-                                      variables={'pymaid': pymaid, 'mn_skids': mn_skids})
+        mns = pymaid_utils.retry(pymaid_utils.sync)(mn_skids, remote_instance='target')
         bcs = get_bcs_fragments(skids=bcs_skids)
         skid_to_name = pymaid.get_names(mn_skids + bcs_skids)
 
@@ -446,6 +544,22 @@ def measure_bCS_axon_to_MN_primary_neurite_distances(side='both', mn_skids='leg
         overlap.insert(0, 'total', overlap.sum(axis=1))
         overlap.sort_values(by='total', ascending=False, inplace=True)
 
+        # Connectivity from the atlas project's own connectors, if the bCS
+        # neurons were transformed with theirs (import_connectors=True).
+        # Otherwise get it from the EM-space project, using key_type=name to
+        # link to neurons in the atlas project, which have the same name (but
+        # different skids)
+        connectivity = count_bCS_to_MN_synapses_in_atlas(
+            bcs, [name for name in overlap.index if name != 'total'])
+        if connectivity is None:
+            print('No bCS synapses in the atlas project. Getting connectivity'
+                  ' from the EM project instead.')
+            pymaid_utils.source_project.make_global()
+            try:
+                connectivity = count_T1bCS_to_lT1mn_synapses(key_type='name') #connMatrixLd
+            finally:
+                pymaid_utils.target_project.make_global()
+
         # Re-order connectivity to have same order as overlap
         connectivity = connectivity.loc[overlap.index]
 
@@ -457,10 +571,18 @@ def measure_bCS_axon_to_MN_primary_neurite_distances(side='both', mn_skids='leg
         # I don't really like the analysis above. It's fine, but let's try this:
         # Take every synapse marked on the bCS synapse fragments, and calculate
         # the minimum distance to each motor neuron primary neurite. Average
-        # those distances for each motor neuron
-        synapses = bcs.synapses
-
-        #from scipy.spatial import distance
+        # those distances for each motor neuron. The atlas-space motor neurons
+        # are already pruned to their primary neurites, so use all their nodes
+        synapses = bcs.presynapses
+        if synapses is None or len(synapses) == 0:
+            print('No bCS synapses in the atlas project. Transform the bCS'
+                  ' neurons with import_connectors=True to measure their'
+                  ' distances.')
+            return overlap, connectivity, None
+        distances = measure_synapse_to_primary_neurite_distances(
+            synapses, mns, min_radius=None)
+        distances.index = [skid_to_name[str(i)].split(' -')[0] for i in distances.index]
+        return overlap, connectivity, distances
 
     finally:
         pymaid_utils.source_project.make_global()
@@ -474,80 +596,53 @@ def measure_bCS_axon_to_MN_primary_neurite_distances(side='both', mn_skids='leg
 #distances from the primary neurite at which branch points and leaf nodes are found. Then, the number of
 #different points on the skeleton at a given distance from the primary neurite is just the number of branches
 #closer to the primary neurite than the given distance minus the number of leaf nodes closer than the given distance.
-def build_distance_to_primary_neurite_distribution(skid, scale=.001, load_if_exists=True):
-    parameter_filename = ('.quantify_bcs_to_mn_synapses_cache/'
-                          'distance_to_primary_neurite_distribution_parameters/'
-                          'skid {}.json'.format(skid))
-
-    if load_if_exists and os.path.exists(parameter_filename):
-        print('Loading parameters from {}'.format(parameter_filename))
-        with open(parameter_filename, 'r') as parameter_file:
-            distribution_parameters = json.load(parameter_file)
-        return {skid: distribution_parameters}
-
-    nodes = pymaid.get_neuron(skid).nodes.set_index('node_id')
-    distribution_parameters = {"branch_distances": [], "leaf_distances": []}
-    branch_ids = nodes.loc[nodes.type == 'branch'].index
-    leaf_ids = nodes.loc[(nodes.type == 'end') & (nodes.radius != primary_neurite_radius)].index
-
-    #Here I'm using branch_order to mean number of children minus 1, aka how many more paths there are after the branch than before it
-    branch_order = {branch_id: sum(nodes.parent_id == branch_id)-1 for branch_id in branch_ids}
+#Distributions are cached by pymaid_utils.memoize until the neuron is edited. Bump version when changing how they're built.
+#Like the rest of this file they read pymaid's global instance, so they're cached per project (remote_instance='global')
+@pymaid_utils.memoize(version=1, skids=lambda skid, scale=.001: [skid], remote_instance='global')
+def build_distance_to_primary_neurite_distribution(skid, scale=.001):
+    #Every node's distance to the primary neurite is precomputed in the neuron's distance to primary neurite field,
+    #so this is just lookups. Nodes with no primary neurite upstream (the two lines coming out of the soma that aren't
+    #downstream of a primary neurite node) have attachment id -1, and are excluded.
+    field = get_distance_to_primary_neurite_fields([skid])[int(skid)]
+    flags = field['flags']
+    attached = field['attachment_node_id'] != -1
+    distances = field['distance'].astype(np.float64)*scale
+
+    #branch_order means number of children minus 1, aka how many more paths there are after the branch than before it.
+    #Each branch point's distance is counted branch_order times
     #TODO find branches for which more than 1 child path is a primary neurite (which occurs only for neurons that go out multiple nerves)
+    is_branch = ((flags & pymaid_utils.BRANCH_NODE) != 0) & attached
+    branch_distances = np.repeat(distances[is_branch], field['n_children'][is_branch] - 1)
 
-    #This is O(n^2) because for each branch node (of which there are O(n)), it traverses a fraction of the tree (which is O(n)).
-    #This could definitely be O(n) if I write a way to get the distance measurements I want using a single full-tree traversal.
-    #My guess is that this is the main time sink of this function, so worth doing if I use this code a lot.
-    #This takes 3-5 minutes for neuron 2714, so yea, might want to improve this.
-    print('Measuring branch distances')
-    for branch_id in branch_ids:
-        for i in range(branch_order[branch_id]):
-            distribution_parameters['branch_distances'].append(measure_distance_to_primary_neurite(branch_id, scale=scale, nodes=nodes)[0])
-
-    print('Measuring leaf distances')
-    for leaf_id in leaf_ids:
-        dist, primary_neurite_id = measure_distance_to_primary_neurite(leaf_id, scale=scale, nodes=nodes)
-        if primary_neurite_id == -1:
-            continue
-        #dist = measure_distance_to_primary_neurite(leaf_id, scale=scale, nodes=nodes)
-        if nodes.at[primary_neurite_id, 'type'] is not 'branch': #TODO check that this works
-            print('Leaf node {} is downstream of a non-branching radius {} node. Not counting it as a leaf node.'.format(leaf_id, primary_neurite_radius))
-            continue
-        distribution_parameters['leaf_distances'].append(measure_distance_to_primary_neurite(leaf_id, scale=scale, nodes=nodes)[0])
-
-    #For the two lines coming out of the soma that aren't downstream of a primary neurite node, I'll get a response of -1.
-    #I want to exclude those lines anyway, so just drop the -1 values from the lists.
-    distribution_parameters['branch_distances'] = [element for element in distribution_parameters['branch_distances'] if element != -1]
-    distribution_parameters['leaf_distances'] = [element for element in distribution_parameters['leaf_distances'] if element != -1]
+    is_leaf = (((flags & pymaid_utils.LEAF_NODE) != 0) & ((flags & pymaid_utils.PRIMARY_NEURITE_NODE) == 0) & attached)
+    attachment_rows = np.searchsorted(field['node_id'], field['attachment_node_id'][is_leaf])
+    attached_to_branch = (flags[attachment_rows] & pymaid_utils.BRANCH_NODE) != 0
+    for leaf_id in field['node_id'][is_leaf][~attached_to_branch]:
+        print('Leaf node {} is downstream of a non-branching radius {} node. Not counting it as a leaf node.'.format(leaf_id, primary_neurite_radius))
+    leaf_distances = distances[is_leaf][attached_to_branch]
+
+    distribution_parameters = {"branch_distances": branch_distances,
+                               "leaf_distances": leaf_distances}
 
     #This assertion should catch weird neuron morphologies that I haven't thought about yet
     assert len(distribution_parameters['branch_distances']) == len(distribution_parameters['leaf_distances']), "{} != {}".format(len(distribution_parameters['branch_distances']), len(distribution_parameters['leaf_distances']))
 
-    #This sort takes some time, but saves some time later when evaluating the distribution. Not clear if it saves time overall.
-    distribution_parameters['branch_distances'].sort()
-    distribution_parameters['leaf_distances'].sort()
+    #Evaluating the distribution needs these sorted
+    distribution_parameters['branch_distances'] = np.sort(distribution_parameters['branch_distances'])
+    distribution_parameters['leaf_distances'] = np.sort(distribution_parameters['leaf_distances'])
     
-    #Already taken care of by the scale=scale argument in measure_blah calls above
+    #Already taken care of by scaling the distances looked up above
     #distribution_parameters = scale_distance_distribution(distribution_parameters, scale)
 
-    parent_dir = os.path.dirname(parameter_filename)
-    os.makedirs(parent_dir, exist_ok=True)
-    with open(parameter_filename, 'w') as parameter_file:
-        json.dump(distribution_parameters, parameter_file, indent=4)
-
     return {skid: distribution_parameters}
 
 
-def build_distance_to_specified_node_distribution(node_id, nodes=None, prune_distal_to=False, prune_nucleus_branches=True, scale=.001, load_if_exists=True):
+#Calls that pass their own nodes aren't cached, since there's no neuron edition to tie the result to
+@pymaid_utils.memoize(version=1, skids=lambda node_id, nodes=None, **kwargs:
+                      [pymaid.get_skid_from_node(node_id)[node_id]] if nodes is None else None,
+                      remote_instance='global')
+def build_distance_to_specified_node_distribution(node_id, nodes=None, prune_distal_to=False, prune_nucleus_branches=True, scale=.001):
     skid = pymaid.get_skid_from_node(node_id)[node_id]
-    parameter_filename = ('.quantify_bcs_to_mn_synapses_cache/'
-                          'distance_to_specified_node_distribution_parameters/'
-                          'skid {} node {}.json'.format(skid, node_id))
-
-    if load_if_exists and os.path.exists(parameter_filename):
-        print('Loading parameters from {}'.format(parameter_filename))
-        with open(parameter_filename, 'r') as parameter_file:
-            distribution_parameters = json.load(parameter_file)
-        return {skid: distribution_parameters}
 
     if nodes is None: 
         #Pull neuron, optionally prune it, reroot it to the specified node, and re-index the nodes DataFrame by the node_id column
@@ -575,25 +670,17 @@ def build_distance_to_specified_node_distribution(node_id, nodes=None, prune_dis
     leaf_ids = nodes.loc[(nodes.type == 'end')].index
     #leaf_ids = nodes.loc[(nodes.type == 'end') & (nodes.radius != primary_neurite_radius)].index
 
+    graph = pymaid_utils.SkeletonGraph(nodes, primary_neurite_radius=primary_neurite_radius)
     #Here I'm using branch_order to mean number of children minus 1, aka how many more paths there are after the branch than before it
-    branch_order = {branch_id: sum(nodes.parent_id == branch_id)-1 for branch_id in branch_ids}
-    branch_order[root_id] = sum(nodes.parent_id == root_id)
+    branch_order = dict(zip(branch_ids, graph.n_children[graph.index(branch_ids)] - 1))
+    branch_order[root_id] = graph.n_children[graph.index(root_id)]
     #TODO find branches for which more than 1 child path is a primary neurite (which occurs only for neurons that go out multiple nerves)
 
-    #This is O(n^2) because for each branch and leaf node (of which there are O(n)), it traverses a fraction of the tree (which is O(n)).
-    #This could definitely be O(n) if I write a way to get the distance measurements I want using a single full-tree traversal.
-    #My guess is that this is the main time sink of this function, so would be worth doing if I use this code a lot.
-    print('Measuring branch distances')
-    for branch_id in branch_ids:
-        for i in range(branch_order[branch_id]):
-            distribution_parameters['branch_distances'].append(measure_distance_to_root(branch_id, scale=scale, nodes=nodes)[0])
-
-    print('Measuring leaf distances')
-    for leaf_id in leaf_ids:
-        #dist, primary_neurite_id = measure_distance_to_primary_neurite(leaf_id, scale=scale, nodes=nodes)
-        dist = measure_distance_to_primary_neurite(leaf_id, scale=scale, nodes=nodes)
-        #TODO check if the primary neurite id is a branch node. if it's not, weird geometry is going on
-        distribution_parameters['leaf_distances'].append(measure_distance_to_root(leaf_id, scale=scale, nodes=nodes)[0])
+    #Every node's distance to the root is computed in one pass over the tree (see SkeletonGraph.distance_from_root), so this is just lookups
+    branch_distances = graph.distance_from_root(graph.index(branch_ids))*scale
+    distribution_parameters['branch_distances'] = np.repeat(branch_distances, [branch_order[branch_id] for branch_id in branch_ids])
+    distribution_parameters['leaf_distances'] = graph.distance_from_root(graph.index(leaf_ids))*scale
+    #TODO check if the primary neurite id of each leaf is a branch node. if it's not, weird geometry is going on
 
     #distribution_parameters['branch_distances'] = [element for element in distribution_parameters['branch_distances'] if element != -1]
     #distribution_parameters['leaf_distances'] = [element for element in distribution_parameters['leaf_distances'] if element != -1]
@@ -601,101 +688,67 @@ def build_distance_to_specified_node_distribution(node_id, nodes=None, prune_dis
     #This assertion should catch weird neuron morphologies that I haven't thought about yet
     assert len(distribution_parameters['branch_distances']) == len(distribution_parameters['leaf_distances']), "{} != {}".format(len(distribution_parameters['branch_distances']), len(distribution_parameters['leaf_distances']))
 
-    #This sort takes some time, but saves some time later when evaluating the distribution. Not clear if it saves time overall.
-    distribution_parameters['branch_distances'].sort()
-    distribution_parameters['leaf_distances'].sort()
+    #Evaluating the distribution needs these sorted
+    distribution_parameters['branch_distances'] = np.sort(distribution_parameters['branch_distances'])
+    distribution_parameters['leaf_distances'] = np.sort(distribution_parameters['leaf_distances'])
 
     #distribution_parameters = scale_distance_distribution(distribution_parameters, scale) #Already taken care of by the scale=scale argument in measure_blah calls above
 
-    parent_dir = os.path.dirname(parameter_filename)
-    os.makedirs(parent_dir, exist_ok=True)
-    with open(parameter_filename, 'w') as parameter_file:
-        json.dump(distribution_parameters, parameter_file, indent=4)
-
     #print({skid: distribution_parameters})
     return {skid: distribution_parameters}
 
 
+#The number of paths at a distance d is the number of branch distances below d minus the number of leaf distances below d.
+#With the distances sorted, each count is a binary search (np.searchsorted), so a whole curve of distances is evaluated in one call.
 def eval_distance_distribution(distances, distribution_parameters):
-    try:
-        iterator = iter(distances)
-    except TypeError: #If input is a single value (instead of a list), this line makes sure to return a single value (instead of a list)
+    if np.ndim(distances) == 0: #If input is a single value (instead of a list), this line makes sure to return a single value (instead of a list)
         return eval_distance_distribution([distances], distribution_parameters)[0]
 
-    distribution_values = []
-    for distance in distances:
-        num_slabs_at_given_distance = 0
-
-        for branch_distance in distribution_parameters['branch_distances']:
-            if branch_distance < distance:
-                num_slabs_at_given_distance += 1
-            else: #Since the branch_distances are sorted, can break once the value gets higher than distance
-                break
-
-        for leaf_distance in distribution_parameters['leaf_distances']:
-            if leaf_distance < distance:
-                num_slabs_at_given_distance -= 1
-            else: #Since the branch_distances are sorted, can break once the value gets higher than distance
-                break
-
-        distribution_values.append(num_slabs_at_given_distance)
-
-    return distribution_values
+    distances = np.asarray(distances, dtype=np.float64)
+    branch_distances = np.sort(distribution_parameters['branch_distances'])
+    leaf_distances = np.sort(distribution_parameters['leaf_distances'])
+    return (np.searchsorted(branch_distances, distances, side='left')
+            - np.searchsorted(leaf_distances, distances, side='left'))
 
 
+#The cumulative distribution at d sums (d - b) over branch distances b below d, minus (d - l) over leaf distances l below d.
+#If k branch distances are below d, their sum is k*d minus the sum of the k smallest, which is a prefix sum of the sorted distances.
 def eval_cumulative_distance_distribution(distances, distribution_parameters):
-    try:
-        iterator = iter(distances)
-    except TypeError: #If input is a single value (instead of a list), this line makes sure to return a single value (instead of a list)
-        return eval_distance_distribution([distances], distribution_parameters)[0]
+    if np.ndim(distances) == 0: #If input is a single value (instead of a list), this line makes sure to return a single value (instead of a list)
+        return eval_cumulative_distance_distribution([distances], distribution_parameters)[0]
 
-    cumulative_distribution_values = []
-    distances = np.append(distances, distribution_parameters['leaf_distances'][-1]) #Make sure to evaluate at the largest leaf distance, which will be used to normalize
-    for distance in distances:
-        cumulative_distribution_value = 0
+    distances = np.asarray(distances, dtype=np.float64)
+    leaf_distances = np.sort(distribution_parameters['leaf_distances'])
+    distances = np.append(distances, leaf_distances[-1]) #Make sure to evaluate at the largest leaf distance, which will be used to normalize
 
-        for branch_distance in distribution_parameters['branch_distances']:
-            if branch_distance < distance:
-                cumulative_distribution_value += distance - branch_distance
-            else: #Since the branch_distances are sorted, can break once the value gets higher than distance
-                break
+    def summed_distances_below(sorted_distances):
+        prefix_sums = np.concatenate([[0], np.cumsum(sorted_distances)])
+        counts = np.searchsorted(sorted_distances, distances, side='left')
+        return counts*distances - prefix_sums[counts]
 
-        for leaf_distance in distribution_parameters['leaf_distances']:
-            if leaf_distance < distance:
-                cumulative_distribution_value -= distance - leaf_distance
-            else: #Since the branch_distances are sorted, can break once the value gets higher than distance
-                break
-
-        cumulative_distribution_values.append(cumulative_distribution_value)
-
-    return [value/cumulative_distribution_values[-1] for value in cumulative_distribution_values[:-1]]
+    cumulative_distribution_values = (summed_distances_below(np.sort(distribution_parameters['branch_distances']))
+                                      - summed_distances_below(leaf_distances))
+    return cumulative_distribution_values[:-1]/cumulative_distribution_values[-1]
 
 
 def merge_distance_distributions(distribution_parameters):
-    merged_parameters = {'leaf_distances': [], 'branch_distances': []}
-    for skid in distribution_parameters:
-        merged_parameters['leaf_distances'].extend(distribution_parameters[skid]['leaf_distances'])
-        merged_parameters['branch_distances'].extend(distribution_parameters[skid]['branch_distances'])
-
-    merged_parameters['leaf_distances'].sort()
-    merged_parameters['branch_distances'].sort()
-
-    return merged_parameters
+    return {'leaf_distances': np.sort(np.concatenate([distribution_parameters[skid]['leaf_distances'] for skid in distribution_parameters])),
+            'branch_distances': np.sort(np.concatenate([distribution_parameters[skid]['branch_distances'] for skid in distribution_parameters]))}
 
 
 def integrate_distance_distribution(distribution_parameters):
-    return {skid: sum(distribution_parameters[skid]['leaf_distances'])
-                  - sum(distribution_parameters[skid]['branch_distances'])
+    return {skid: np.sum(distribution_parameters[skid]['leaf_distances'])
+                  - np.sum(distribution_parameters[skid]['branch_distances'])
             for skid in distribution_parameters}
 
 
 def scale_distance_distribution(distribution_parameters, scale):
     if 'leaf_distances' in distribution_parameters:
-        return {'branch_distances': [value*scale for value in distribution_parameters['branch_distances']],
-                'leaf_distances': [value*scale for value in distribution_parameters['leaf_distances']]}
+        return {'branch_distances': np.asarray(distribution_parameters['branch_distances'])*scale,
+                'leaf_distances': np.asarray(distribution_parameters['leaf_distances'])*scale}
     else:
-        return {skid: {'branch_distances': [value*scale for value in distribution_parameters[skid]['branch_distances']],
-                       'leaf_distances': [value*scale for value in distribution_parameters[skid]['leaf_distances']]}
+        return {skid: {'branch_distances': np.asarray(distribution_parameters[skid]['branch_distances'])*scale,
+                       'leaf_distances': np.asarray(distribution_parameters[skid]['leaf_distances'])*scale}
                 for skid in distribution_parameters}
 
 
@@ -723,18 +776,15 @@ def plot_distance_distribution(distribution_parameters,
     xmax = math.ceil(max(params['leaf_distances'])/20)*20
     xvals = np.linspace(0, xmax, 2000)
 
-    #eval on a list walks down the parameters once per xval, so is O(len(params)*len(xvals))
-    #Could write a different way to walk down each only once, so O(len(params)+len(xvals))
-    #Not clear whether this eval step takes longer than the build step
-    #Nope, looks like eval is quite fast
+    #eval does a binary search into the sorted parameters per xval, so is O(len(xvals)*log(len(params)))
     if normalize == 'cumulative':
         yvals = eval_cumulative_distance_distribution(xvals, params)
     else: #Then normalize is 'percentage' or 'probability'
         yvals = eval_distance_distribution(xvals, params)
         integral = integrate_distance_distribution({'foo': params})['foo']
-        yvals = [val/integral for val in yvals]
+        yvals = yvals/integral
         if normalize == 'percentage':
-            yvals = [val*100 for val in yvals]
+            yvals = yvals*100
     #ymax = math.ceil(max(yvals)/10)*10
     ymax = max(yvals)
 
@@ -1220,42 +1270,65 @@ def plot_left_vs_right_bCS_partners(mn_skids='leg nerve'):
     return slope, intercept, r_value, p_value, std_err
 
 
+#The postsynaptic nodes on postsynaptic_skids of synapses made by the presynaptic_skids bCS neurons' fragments
+def get_bcs_postsynaptic_nodes(presynaptic_skids, postsynaptic_skids):
+    connectors = get_bcs_fragments(side=presynaptic_skids).presynapses
+    #connector_tags = pymaid.get_node_tags(connectors.connector_id.values, 'CONNECTOR')
+    #connector_tags = pd.Series({int(k): v for k, v in connector_tags.items()})
+    connector_details = pymaid.get_connector_details(connectors.connector_id).set_index('connector_id')
+    #connector_details['tags'] = connector_tags
+    #postsynaptic_skids_and_annotations = pymaid.get_annotations(set([skid for skids in connector_details.postsynaptic_to for skid in skids]))
+    return pd.DataFrame(
+        [(postsynaptic_node, postsynaptic_skid)
+         for details in connector_details.itertuples()
+         for postsynaptic_node, postsynaptic_skid in zip(details.postsynaptic_to_node, details.postsynaptic_to)
+         if postsynaptic_skid in postsynaptic_skids],
+        columns=['node_id', 'skeleton_id'])
+
+
+#Synapse distances are cached by pymaid_utils.memoize until any of the bCS or postsynaptic neurons is edited,
+#including adding or removing a synapse between them (connector_links=True)
+@pymaid_utils.memoize(version=1, skids=lambda presynaptic_skids, postsynaptic_skids:
+                      get_bcs_skids(side=presynaptic_skids) + list(postsynaptic_skids),
+                      connector_links=True, remote_instance='global')
+def measure_synapse_distances_to_siz(presynaptic_skids, postsynaptic_skids):
+    siz_tids = {skid: walk_n_down_primary_neurite(last_branch_node_ids[skid],1) for skid in postsynaptic_skids}
+    postsynaptic_neurons_nodes = {skid: pymaid.get_neuron(skid).reroot(siz_tids[skid], inplace=False).nodes for skid in postsynaptic_skids}
+    #Gather the postsynaptic nodes on each neuron first, then measure all of a neuron's distances in one pass over its skeleton
+    postsynaptic_nodes = get_bcs_postsynaptic_nodes(presynaptic_skids, postsynaptic_skids)
+    distances = np.zeros(len(postsynaptic_nodes))
+    for postsynaptic_skid, rows in postsynaptic_nodes.groupby('skeleton_id').indices.items():
+        print('Measuring distances from {} postsynaptic nodes on skeleton {}'.format(len(rows), postsynaptic_skid))
+        distances[rows] = measure_distances_to_root(
+            postsynaptic_nodes.node_id.values[rows],
+            nodes=postsynaptic_neurons_nodes[postsynaptic_skid]
+        )
+    print('Measured distances of {} postsynapses'.format(len(distances)))
+    return distances
+
+
+@pymaid_utils.memoize(version=1, skids=lambda presynaptic_skids, postsynaptic_skids:
+                      get_bcs_skids(side=presynaptic_skids) + list(postsynaptic_skids),
+                      connector_links=True, remote_instance='global')
+def measure_synapse_distances_to_primary_neurite(presynaptic_skids, postsynaptic_skids):
+    postsynaptic_nodes = get_bcs_postsynaptic_nodes(presynaptic_skids, postsynaptic_skids)
+    #Look up each postsynaptic node in its neuron's distance to primary neurite field
+    fields = get_distance_to_primary_neurite_fields(postsynaptic_nodes.skeleton_id.unique())
+    distances = np.zeros(len(postsynaptic_nodes))
+    for postsynaptic_skid, rows in postsynaptic_nodes.groupby('skeleton_id').indices.items():
+        print('Measuring distances from {} postsynaptic nodes on skeleton {}'.format(len(rows), postsynaptic_skid))
+        distances[rows], attachments = lookup_distances_to_primary_neurite(
+            fields[int(postsynaptic_skid)], postsynaptic_nodes.node_id.values[rows])
+        assert (attachments != -1).all()  # TODO deal with -1 responses better. Probably be like wtf how did that synapse get there.
+    print('Measured distances of {} postsynapses'.format(len(distances)))
+    return distances
+
+
 def plot_synapse_distance_to_siz(presynaptic_skids='both', postsynaptic_skids=None,
-                                 cumulative=True, title=None, ax=None, color='red', load_from_temp=True):
-    siz_tids = {skid: walk_n_down_primary_neurite(last_branch_node_ids[skid],1) for skid in last_branch_node_ids.index}
+                                 cumulative=True, title=None, ax=None, color='red'):
     if postsynaptic_skids is None:
-        postsynaptic_skids = list(siz_tids.keys())
-    distance_postsynapse_to_siz = []
-
-    distances_filename = '.quantify_bcs_to_mn_synapses_cache/cached_distances_siz.json'
-    if load_from_temp and os.path.exists(distances_filename):
-        print('Loading distances from {}'.format(distances_filename))
-        with open(distances_filename, 'r') as distances_file:
-            distance_postsynapse_to_siz = json.load(distances_file)
-        print('Loaded {} postsynapses'.format(len(distance_postsynapse_to_siz)))
-    else:
-        connectors = get_bcs_fragments(side=presynaptic_skids).presynapses
-        #connector_tags = pymaid.get_node_tags(connectors.connector_id.values, 'CONNECTOR')
-        #connector_tags = pd.Series({int(k): v for k, v in connector_tags.items()})
-        connector_details = pymaid.get_connector_details(connectors.connector_id).set_index('connector_id')
-        #connector_details['tags'] = connector_tags
-        #postsynaptic_skids_and_annotations = pymaid.get_annotations(set([skid for skids in connector_details.postsynaptic_to for skid in skids]))
-        postsynaptic_neurons_nodes = {skid: pymaid.get_neuron(skid).reroot(siz_tids[skid], inplace=False).nodes for skid in postsynaptic_skids}
-        for connector_id, details in connector_details.iterrows():
-            for postsynaptic_node, postsynaptic_skid in zip(details['postsynaptic_to_node'], details['postsynaptic_to']):
-                if postsynaptic_skid in postsynaptic_skids:
-                    print('Measuring distance from postsynaptic node {}'.format(postsynaptic_node))
-                    distance_postsynapse_to_siz.append(
-                        measure_distance_to_root(
-                            postsynaptic_node,
-                            nodes=postsynaptic_neurons_nodes[postsynaptic_skid]
-                        )[0]
-                    )
-        print('Measured distances of {} postsynapses'.format(len(distance_postsynapse_to_siz)))
-
-    if not os.path.exists(distances_filename):
-        with open(distances_filename, 'w') as distances_file:
-            json.dump(distance_postsynapse_to_siz, distances_file, indent=4)
+        postsynaptic_skids = list(last_branch_node_ids.index)
+    distance_postsynapse_to_siz = measure_synapse_distances_to_siz(presynaptic_skids, sorted(postsynaptic_skids))
 
     if title is not None:
         plt.title(title)
@@ -1293,33 +1366,10 @@ def plot_synapse_distance_to_siz(presynaptic_skids='both', postsynaptic_skids=No
 
 
 def plot_synapse_distance_to_primary_neurite(presynaptic_skids='both', postsynaptic_skids=mn_skids_left_T1_leg_nerve,
-                                             cumulative=True, title=None, ax=None, color='red', load_from_temp=True):
+                                             cumulative=True, title=None, ax=None, color='red'):
     if postsynaptic_skids is None:
-        siz_tids = {skid: walk_n_down_primary_neurite(last_branch_node_ids[skid],1) for skid in last_branch_node_ids.index}
-        postsynaptic_skids = list(siz_tids.keys())
-    distance_postsynapse_to_primary_neurite = []
-
-    distances_filename = '.quantify_bcs_to_mn_synapses_cache/cached_distances_primaryneurite.json'
-    if load_from_temp and os.path.exists(distances_filename):
-        print('Loading distances from {}'.format(distances_filename))
-        with open(distances_filename, 'r') as distances_file:
-            distance_postsynapse_to_primary_neurite = json.load(distances_file)
-        print('Loaded {} postsynapses'.format(len(distance_postsynapse_to_primary_neurite)))
-    else:
-        connectors = get_bcs_fragments(side=presynaptic_skids).presynapses
-        connector_details = pymaid.get_connector_details(connectors.connector_id).set_index('connector_id')
-        for connector_id, details in connector_details.iterrows():
-            for postsynaptic_node, postsynaptic_skid in zip(details['postsynaptic_to_node'], details['postsynaptic_to']):
-                if postsynaptic_skid in postsynaptic_skids:
-                    print('Measuring distance from postsynaptic node {}'.format(postsynaptic_node))
-                    distance = measure_distance_to_primary_neurite(postsynaptic_node)[0]
-                    assert distance != -1  # TODO deal with -1 responses better. Probably be like wtf how did that synapse get there.
-                    distance_postsynapse_to_primary_neurite.append(distance)
-        print('Measured distances of {} postsynapses'.format(len(distance_postsynapse_to_primary_neurite)))
-
-    if not os.path.exists(distances_filename):
-        with open(distances_filename, 'w') as distances_file:
-            json.dump(distance_postsynapse_to_primary_neurite, distances_file, indent=4)
+        postsynaptic_skids = list(last_branch_node_ids.index)
+    distance_postsynapse_to_primary_neurite = measure_synapse_distances_to_primary_neurite(presynaptic_skids, sorted(postsynaptic_skids))
 
     if title is not None:
         plt.title(title)
@@ -1447,24 +1497,6 @@ def prompt(m):
         print('Response not understood, assuming n')
         return False
 
-def try_catch_network_error(code, max_tries=5, variables=None):
-    success = False
-    tries = 1
-    while not success and tries < max_tries:
-        try:
-            ret = eval(code, variables)
-        except requests.exceptions.ConnectionError:
-            print('Network error on try {}, retrying...'.format(tries))
-            tries += 1
-        else:
-            success = True
-
-    if not success: #Last try, don't catch exception
-        ret = eval(code, variables)
-
-    return ret
-
-
 #-------MAIN CODE BODY-------#
 def main():
     print('')
@@ -1504,6 +1536,9 @@ def main():
     #    x_units = 'rank'  #'score'
     #    plot_nblast_score_vs_bcs_synapse_count(lm_neurons_to_plot=['81A07', '35C09'], x_units=x_units)
 
+    print('Analysis cache usage:')
+    print(pymaid_utils.get_analysis_cache_stats())
+
 if __name__ == '__main__':
     try:
         main()
@@ -1,11 +1,22 @@
+from .retries import *
 from .connections import *
 from .manipulate_and_reupload_catmaid_neurons import *
 from .make_3dViewer_json import *
+from .skeleton_store import *
+from .annotation_index import *
+from .linked_neurons import *
+from .policies import *
+from .skeleton_diff import *
+from .skeleton_graph import *
+from .analysis_cache import *
 
-def reset_connection():
-    # Open connections
-    print('Connecting to catmaid...')
-    source_project, target_project = connect_to_catmaid()
+def reset_connection(lazy=True, config_filename='catmaid_configs.json'):
+    # Set up connections. With lazy=True (the default), nothing is sent to the
+    # server until a project is first used, so importing this package is fast
+    # and works offline. Pass a different config_filename to connect
+    # somewhere else, e.g. 'catmaid_configs_local_fake_server.json'.
+    source_project, target_project = connect_to_catmaid(config_filename,
+                                                        lazy=lazy)
 
     # Allow each script read/write access to these project objects
     connections.source_project = source_project
@@ -14,6 +25,16 @@ def reset_connection():
     manipulate_and_reupload_catmaid_neurons.target_project = target_project
     make_3dViewer_json.source_project = source_project
     #make_3dViewer_json.target_project doesn't need to be shared
+    skeleton_store.source_project = source_project
+    skeleton_store.target_project = target_project
+    annotation_index.source_project = source_project
+    annotation_index.target_project = target_project
+    linked_neurons.source_project = source_project
+    linked_neurons.target_project = target_project
+    skeleton_diff.source_project = source_project
+    skeleton_diff.target_project = target_project
+    analysis_cache.source_project = source_project
+    analysis_cache.target_project = target_project
 
 
 def __getattr__(name):
@@ -23,5 +44,6 @@ def __getattr__(name):
     elif name == 'target_project':
         # target_project points to connections.target_project
         return connections.target_project
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
 
 reset_connection()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# Requires python 3.6+ for f-strings
+
+# An on-disk cache for the results of slow analysis functions that depend on
+# skeletons pulled from CATMAID. Decorate such a function with memoize:
+#
+#     @memoize(version=1, skids=lambda skid, **kwargs: [skid])
+#     def build_distribution(skid, scale=.001): ...
+#
+# Each call is stored under the function's name and its arguments, together
+# with the function's version and the edition state (see
+# skeleton_store.get_edition_states) of every skeleton that skids() says it
+# depends on. A call returns the stored result only if neither the version
+# nor any of those skeletons has changed since it was stored. Otherwise the
+# function runs again and its new result replaces the stale one, so editing
+# a skeleton (or bumping version after changing the function) is all it takes
+# to invalidate results. Checking the edition states takes up to five
+# requests per call (see get_edition_states), on top of reading the stored
+# result, so memoizing only pays off for functions that take much longer than
+# that. While the function runs, those edition states are reused (see
+# skeleton_store.reusing_edition_states), so a function that syncs the
+# skeletons it depends on doesn't ask for their states a second time.
+#
+# Results are stored per CATMAID server and project: the one given as
+# remote_instance, which must be the one the function reads its skeletons
+# from. Use remote_instance='global' for functions that read pymaid's global
+# instance, so a result computed while another project was made global isn't
+# mistaken for this one's.
+#
+# Skeleton edition states don't change when connector links are added or
+# removed. Functions whose results depend on which synapses the skeletons
+# make should pass connector_links=True, which adds a hash of those
+# skeletons' connector links (see skeleton_store.get_connector_links_state,
+# one more request per call) to the state.
+#
+# Results that are NumPy arrays, or dicts of them (nested dicts too), are
+# saved as .npz files. Anything else is pickled. Hits, misses and stale
+# results per function are counted in analysis_cache_stats.
+#
+# When this file is imported during package initialization (see __init__.py),
+# it's given access to the package's source_project and target_project.
+
+import os
+import json
+import pickle
+import hashlib
+import inspect
+import threading
+import functools
+
+import numpy as np
+import pandas as pd
+import pymaid
+
+try:
+    from .skeleton_store import (get_edition_states, get_connector_links_state,
+                                 reusing_edition_states)
+except:
+    from skeleton_store import (get_edition_states, get_connector_links_state,
+                                reusing_edition_states)
+
+
+# Set the environment variable PYMAID_UTILS_ANALYSIS_CACHE_DIR to put the
+# cache elsewhere
+ANALYSIS_CACHE_DIR = os.environ.get(
+    'PYMAID_UTILS_ANALYSIS_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'pymaid_utils', 'analysis')
+)
+
+
+class AnalysisCacheStats:
+    """Per-function counts of cache hits, misses and stale results."""
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, function_name, outcome):
+        with self._lock:
+            stats = self._stats.setdefault(function_name, {
+                'hits': 0, 'misses': 0, 'stale': 0, 'uncached': 0
+            })
+            stats[outcome] += 1
+
+    def to_dataframe(self):
+        with self._lock:
+            stats = pd.DataFrame.from_dict(self._stats, orient='index',
+                                           columns=['hits', 'misses', 'stale',
+                                                    'uncached'])
+        stats.index.name = 'function'
+        looked_up = stats.hits + stats.misses + stats.stale
+        stats['hit_rate'] = stats.hits / looked_up.where(looked_up > 0)
+        return stats
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+
+analysis_cache_stats = AnalysisCacheStats()
+
+
+def _jsonable(value):
+    # Argument values as json, so calls with equal arguments get equal keys
+    if isinstance(value, (set, frozenset)):
+        return sorted(_jsonable(v) for v in value)
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, np.ndarray):
+        return _jsonable(value.tolist())
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    raise TypeError(f'Can\'t use a {type(value).__name__} as part of a cache'
+                    ' key. Have skids() return None for such calls so they'
+                    ' aren\'t cached.')
+
+
+def _flatten_arrays(value, path=()):
+    # [(key path, array)] for an array or a (nested) dict of arrays with int
+    # or str keys, or None if value is anything else
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        return [(path, value)]
+    if isinstance(value, dict) and len(value) > 0:
+        flattened = []
+        for key, item in value.items():
+            if isinstance(key, np.integer):
+                key = int(key)
+            if not isinstance(key, (int, str)) or isinstance(key, bool):
+                return None
+            item_flattened = _flatten_arrays(item, path + (key,))
+            if item_flattened is None:
+                return None
+            flattened.extend(item_flattened)
+        return flattened
+    return None
+
+
+def _unflatten_arrays(flattened):
+    if len(flattened) == 1 and flattened[0][0] == ():
+        return flattened[0][1]
+    value = {}
+    for path, array in flattened:
+        d = value
+        for key in path[:-1]:
+            d = d.setdefault(key, {})
+        d[path[-1]] = array
+    return value
+
+
+class AnalysisCache:
+    """
+    Results stored in folder, one file per function and arguments. Each
+    file also holds the state (function version, server and project, and
+    skeleton edition states) its result was computed from.
+    """
+    def __init__(self, folder=ANALYSIS_CACHE_DIR):
+        self.folder = folder
+
+    def _path(self, function_name, arguments_key):
+        arguments_hash = hashlib.sha256(arguments_key.encode()).hexdigest()[:24]
+        return os.path.join(self.folder, function_name, arguments_hash)
+
+    def load(self, function_name, arguments_key, state):
+        """The stored result if it was computed from state, else None."""
+        path = self._path(function_name, arguments_key)
+        if os.path.exists(path + '.npz'):
+            with np.load(path + '.npz') as f:
+                meta = json.loads(str(f['__meta__']))
+                if meta['state'] != state or meta['arguments'] != arguments_key:
+                    return None
+                return (_unflatten_arrays([
+                    (tuple(key_path), f[f'array{i}'])
+                    for i, key_path in enumerate(meta['paths'])]),)
+        if os.path.exists(path + '.pkl'):
+            with open(path + '.pkl', 'rb') as f:
+                meta, result = pickle.load(f)
+            if meta['state'] != state or meta['arguments'] != arguments_key:
+                return None
+            return (result,)
+        return None
+
+    def has_entry(self, function_name, arguments_key):
+        path = self._path(function_name, arguments_key)
+        return os.path.exists(path + '.npz') or os.path.exists(path + '.pkl')
+
+    def save(self, function_name, arguments_key, state, result):
+        path = self._path(function_name, arguments_key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.remove(function_name, arguments_key)
+        meta = {'arguments': arguments_key, 'state': state}
+        flattened = _flatten_arrays(result)
+        tmp = path + f'.{os.getpid()}.tmp'
+        if flattened is not None:
+            meta['paths'] = [list(key_path) for key_path, array in flattened]
+            with open(tmp, 'wb') as f:
+                np.savez(f, __meta__=np.array(json.dumps(meta)),
+                         **{f'array{i}': array
+                            for i, (key_path, array) in enumerate(flattened)})
+            os.replace(tmp, path + '.npz')
+        else:
+            with open(tmp, 'wb') as f:
+                pickle.dump((meta, result), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path + '.pkl')
+
+    def remove(self, function_name, arguments_key):
+        path = self._path(function_name, arguments_key)
+        for extension in ('.npz', '.pkl'):
+            if os.path.exists(path + extension):
+                os.remove(path + extension)
+
+    def clear(self, function_name=None):
+        """Delete all stored results, or only those of function_name."""
+        folders = ([os.path.join(self.folder, function_name)]
+                   if function_name is not None else
+                   [os.path.join(self.folder, name)
+                    for name in (os.listdir(self.folder)
+                                 if os.path.exists(self.folder) else [])])
+        for folder in folders:
+            if os.path.isdir(folder):
+                for filename in os.listdir(folder):
+                    os.remove(os.path.join(folder, filename))
+
+
+def memoize(version=1, skids=None, connector_links=False, remote_instance=None,
+            cache_dir=ANALYSIS_CACHE_DIR):
+    """
+    Decorator that caches a function's results on disk (see the top of this
+    file). skids(*args, **kwargs) gets the same arguments as the function and
+    returns the IDs of the skeletons (in remote_instance, by default the
+    source project) that the result depends on, or None if this call
+    shouldn't be cached (e.g. because an argument can't be part of a key).
+    remote_instance must be the project the function reads them from; pass
+    'global' for functions that use pymaid's global instance, which is then
+    looked up at each call. Leave skids as None for functions that don't
+    depend on any skeletons. Set connector_links=True if the result also
+    depends on those skeletons' connector links. Change version whenever the
+    function changes in a way that changes its results.
+
+    The decorated function has .uncached (the original function, which
+    neither reads nor writes the cache) and .invalidate(*args, **kwargs)
+    (which deletes the stored result for those arguments).
+    """
+    def decorator(function):
+        function_name = f'{function.__module__}.{function.__qualname__}'
+        signature = inspect.signature(function)
+        cache = AnalysisCache(cache_dir)
+
+        def arguments_key(server, args, kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return json.dumps(_jsonable({
+                'project': [server.server, int(server.project_id)],
+                'arguments': dict(bound.arguments)
+            }), sort_keys=True)
+
+        def get_state(server, args, kwargs):
+            # The state and the skeletons' edition states, or None, None if
+            # this call isn't cached
+            state = {'version': version,
+                     'project': [server.server, int(server.project_id)],
+                     'skeletons': {}}
+            if skids is None:
+                return state, {}
+            depends_on = skids(*args, **kwargs)
+            if depends_on is None:
+                return None, None
+            depends_on = sorted(set(int(skid) for skid in depends_on))
+            edition_states = get_edition_states(depends_on, remote_instance=server)
+            state['skeletons'] = {str(skid): edition_states[skid]
+                                  for skid in depends_on}
+            if connector_links:
+                state['connector_links'] = get_connector_links_state(
+                    depends_on, remote_instance=server)
+            return json.loads(json.dumps(state)), edition_states
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            server = _eval_remote_instance(remote_instance)
+            state, edition_states = get_state(server, args, kwargs)
+            if state is None:
+                analysis_cache_stats.record(function_name, 'uncached')
+                return function(*args, **kwargs)
+            key = arguments_key(server, args, kwargs)
+            stored = cache.load(function_name, key, state)
+            if stored is not None:
+                analysis_cache_stats.record(function_name, 'hits')
+                return stored[0]
+            analysis_cache_stats.record(
+                function_name,
+                'stale' if cache.has_entry(function_name, key) else 'misses')
+            with reusing_edition_states(edition_states, remote_instance=server):
+                result = function(*args, **kwargs)
+            cache.save(function_name, key, state, result)
+            return result
+
+        def invalidate(*args, **kwargs):
+            cache.remove(function_name, arguments_key(
+                _eval_remote_instance(remote_instance), args, kwargs))
+
+        wrapper.uncached = function
+        wrapper.invalidate = invalidate
+        wrapper.cache_name = function_name
+        return wrapper
+    return decorator
+
+
+def get_analysis_cache_stats():
+    return analysis_cache_stats.to_dataframe()
+
+
+def reset_analysis_cache_stats():
+    analysis_cache_stats.reset()
+
+
+def clear_analysis_cache(function_name=None, cache_dir=ANALYSIS_CACHE_DIR):
+    """
+    Delete all stored analysis results, or only those of one function (give
+    its .cache_name).
+    """
+    AnalysisCache(cache_dir).clear(function_name)
+
+
+def _eval_remote_instance(remote_instance):
+    if remote_instance in [None, 'source']:
+        return source_project
+    elif remote_instance == 'target':
+        return target_project
+    elif remote_instance == 'global':  # Whichever one pymaid uses by default
+        return pymaid.utils._eval_remote_instance(None)
+    return remote_instance
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# Requires python 3.6+ for f-strings
+
+# A local, in-memory index of which neurons carry which annotations in a
+# CATMAID project. It's built from a single request that downloads every
+# neuron in the project along with its annotations, after which looking up
+# the skeletons with (or without) some annotations, or the annotations of some
+# skeletons, needs no more requests. Scripts that look up many annotations -
+# e.g. one "LINKED NEURON" annotation per neuron being pushed - do much better
+# with one bulk download than with a few requests per lookup.
+#
+# get_annotation_index() keeps one index per project for the whole session.
+# Annotations added or removed through this package make connections.py bump
+# the project's modification count, after which the index is rebuilt on next
+# use. Code that makes changes it can record itself (see AnnotationIndex.add)
+# counts its own requests with connections.counting_modifications(), so that
+# the index only skips the rebuild if those were the only changes. Changes
+# made by other people are only picked up when it's rebuilt, so use
+# get_annotation_index(..., rebuild=True) if that matters.
+#
+# When this file is imported during package initialization (see __init__.py),
+# it's given access to the package's source_project and target_project.
+
+import re
+import time
+
+try:
+    from . import connections
+    from .connections import response_cache
+except:
+    import connections
+    from connections import response_cache
+
+
+# (server, project_id) -> AnnotationIndex
+_indices = {}
+
+
+class AnnotationIndex:
+    """
+    Annotation -> skeleton IDs and skeleton ID -> annotations for every
+    neuron in one project, built from one bulk download.
+    """
+    def __init__(self, remote_instance):
+        self.server = remote_instance.server.rstrip('/')
+        self.project_id = remote_instance.project_id
+        self.skids_by_annotation = {}
+        self.annotations_by_skid = {}
+        self.names = {}
+        self.build(remote_instance)
+
+    def build(self, remote_instance):
+        # Note the count before downloading, so that a change made while the
+        # download is running causes a rebuild next time
+        self.modification_count = connections.get_modification_count(
+            self.server, self.project_id)
+        start = time.perf_counter()
+        with response_cache.bypassed():  # Must see the server's current state
+            entities = remote_instance.fetch(
+                remote_instance._get_annotated_url(),
+                post={'with_annotations': 'true', 'types[0]': 'neuron'},
+                desc='Get annotations'
+            )['entities']
+
+        self.skids_by_annotation = {}
+        self.annotations_by_skid = {}
+        self.names = {}
+        for entity in entities:
+            if entity.get('type', 'neuron') != 'neuron':
+                continue
+            annotations = {a['name'] for a in entity.get('annotations', [])}
+            for skid in entity['skeleton_ids']:
+                self.annotations_by_skid[skid] = set(annotations)
+                self.names[skid] = entity['name']
+                for annotation in annotations:
+                    self.skids_by_annotation.setdefault(annotation, set()).add(skid)
+        self.build_time = time.perf_counter() - start
+
+    @property
+    def is_current(self):
+        """False once this package has modified the project since the build."""
+        return self.modification_count == connections.get_modification_count(
+            self.server, self.project_id)
+
+    @property
+    def annotations(self):
+        return sorted(self.skids_by_annotation)
+
+    @property
+    def skids(self):
+        return set(self.annotations_by_skid)
+
+    def _skids_with(self, annotation, raise_not_found):
+        """
+        Skids with one annotation. Annotations starting with '/' are treated
+        as regular expressions, matching skids with any matching annotation.
+        """
+        if annotation.startswith('/'):
+            pattern = re.compile(annotation[1:])
+            found = [a for a in self.skids_by_annotation if pattern.search(a)]
+            skids = set().union(*[self.skids_by_annotation[a] for a in found])
+        elif annotation in self.skids_by_annotation:
+            found = [annotation]
+            skids = self.skids_by_annotation[annotation]
+        else:
+            # Accept annotations escaped for pymaid's regex search, e.g.
+            # 'pruned \(first entry, last exit\) by vol 109'
+            unescaped = re.sub(r'\\(.)', r'\1', annotation)
+            found = [unescaped] if unescaped in self.skids_by_annotation else []
+            skids = self.skids_by_annotation.get(unescaped, set())
+        if len(found) == 0 and raise_not_found:
+            raise ValueError(f'Annotation not found in project'
+                             f' {self.project_id}: "{annotation}"')
+        return skids
+
+    def get_skids(self, annotations, intersect=True, raise_not_found=True):
+        """
+        Skids of the neurons with the given annotation(s), like
+        pymaid.get_skids_by_annotation. Prefix an annotation with '~' to ask
+        for neurons WITHOUT it. With intersect=True (the default) the neurons
+        must match every given annotation, otherwise any of them.
+        Returns a sorted list of skids.
+        """
+        if isinstance(annotations, str):
+            annotations = [annotations]
+        matches = []
+        for annotation in annotations:
+            if annotation.startswith('~'):
+                skids = self._skids_with(annotation[1:], raise_not_found)
+                matches.append(self.skids - skids)
+            else:
+                matches.append(self._skids_with(annotation, raise_not_found))
+        if len(matches) == 0:
+            return []
+        if intersect:
+            # Start from the smallest set so each step is as cheap as possible
+            matches.sort(key=len)
+            skids = set(matches[0]).intersection(*matches[1:])
+        else:
+            skids = set().union(*matches)
+        return sorted(skids)
+
+    def get_annotations(self, skids):
+        """
+        Annotations of the given skeleton(s), as a dict of str(skid) -> list
+        of annotation names, like pymaid.get_annotations. Skeletons without
+        annotations are left out.
+        """
+        if isinstance(skids, (int, str)):
+            skids = [skids]
+        return {str(int(skid)): sorted(self.annotations_by_skid[int(skid)])
+                for skid in skids
+                if len(self.annotations_by_skid.get(int(skid), [])) > 0}
+
+    def add(self, skids, annotations, name=None, modifications=None):
+        """
+        Record annotations that were just added on the server through this
+        session. modifications is the Counter from the
+        connections.counting_modifications() block the annotations (and
+        anything else recorded here) were added in. The index stays current
+        without a rebuild only if those requests are the only ones that
+        modified the project since it was last current; without
+        modifications, it's rebuilt on next use.
+        """
+        if isinstance(skids, (int, str)):
+            skids = [skids]
+        if isinstance(annotations, str):
+            annotations = [annotations]
+        for skid in skids:
+            skid = int(skid)
+            self.annotations_by_skid.setdefault(skid, set()).update(annotations)
+            for annotation in annotations:
+                self.skids_by_annotation.setdefault(annotation, set()).add(skid)
+            if name is not None:
+                self.names[skid] = name
+        if modifications is not None:
+            self.modification_count += modifications[(self.server, self.project_id)]
+
+
+def get_annotation_index(remote_instance=None, rebuild=False):
+    """
+    The session's AnnotationIndex for a project (default: source project),
+    built on first use and rebuilt after this package modifies the project,
+    or when rebuild=True.
+    """
+    remote_instance = _eval_remote_instance(remote_instance)
+    key = (remote_instance.server.rstrip('/'), remote_instance.project_id)
+    index = _indices.get(key, None)
+    if index is None:
+        index = _indices[key] = AnnotationIndex(remote_instance)
+    elif rebuild or not index.is_current:
+        index.build(remote_instance)
+    return index
+
+
+def clear_annotation_indices():
+    """Forget all annotation indices, so they're rebuilt on next use."""
+    _indices.clear()
+
+
+def _eval_remote_instance(remote_instance):
+    if remote_instance in [None, 'source']:
+        return source_project
+    elif remote_instance == 'target':
+        return target_project
+    return remote_instance
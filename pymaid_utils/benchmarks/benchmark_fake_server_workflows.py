@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# Runs the main pymaid_utils workflows against the fake CATMAID server in
+# fake_catmaid_server.py, so they can be benchmarked offline and compared
+# between versions of the code. The server runs in its own process so that it
+# doesn't compete with the workflows for the CPU. Every request takes the same
+# (configurable) simulated network latency, the data and IDs served are always
+# the same, and the response cache and skeleton store start out empty, so the
+# number of requests each workflow sends is exactly reproducible and its
+# timing nearly so.
+#
+# Usage: python3 benchmark_fake_server_workflows.py [latency_in_ms] [repeats]
+# e.g.:  python3 benchmark_fake_server_workflows.py 20 3
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import contextlib
+
+# Keep the benchmark from reading or filling the user's own caches
+tmp_dir = tempfile.mkdtemp(prefix='pymaid_utils_benchmark_')
+os.environ['PYMAID_UTILS_CACHE_DIR'] = os.path.join(tmp_dir, 'responses')
+os.environ['PYMAID_UTILS_SKELETON_STORE_DIR'] = os.path.join(tmp_dir, 'skeletons')
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..'))
+import numpy as np
+import pandas as pd
+import pymaid
+import pymaid_utils as pu
+from pymaid_utils import fake_catmaid_server
+
+ANNOTATIONS = ['motor neuron', 'left soma', 'T1 leg motor neuron']
+N_NEURONS = 50
+
+
+def make_workflows(skids):
+    """(name, function) pairs, run in this order."""
+    store_dir = os.path.join(tmp_dir, 'skeletons')
+    json_dir = os.path.join(tmp_dir, 'json')
+    os.makedirs(json_dir, exist_ok=True)
+
+    def make_json():
+        cwd = os.getcwd()
+        os.chdir(json_dir)
+        try:
+            with contextlib.redirect_stdout(None):
+                pu.make_json_by_annotations({'blue': list(ANNOTATIONS)}, 'benchmark')
+        finally:
+            os.chdir(cwd)
+
+    def sync_cold():
+        shutil.rmtree(store_dir, ignore_errors=True)
+        with contextlib.redirect_stdout(None):
+            pu.sync(skids, store_dir=store_dir)
+
+    def sync_warm():
+        with contextlib.redirect_stdout(None):
+            pu.sync(skids, store_dir=store_dir)
+
+    def copy_neurons():
+        with contextlib.redirect_stdout(None):
+            pu.copy_neurons_by_skid(skids[:5], fake=False, import_connectors=True)
+
+    return [
+        ('get_annotation_index (rebuild)',
+         lambda: pu.get_annotation_index(rebuild=True)),
+        ('get_skids_by_annotation', lambda: pu.get_skids_by_annotation(ANNOTATIONS)),
+        ('get_names', lambda: pymaid.get_names(skids, remote_instance=pu.source_project)),
+        ('get_annotations', lambda: pymaid.get_annotations(
+            skids, remote_instance=pu.source_project)),
+        ('make_json_by_annotations', make_json),
+        ('fetch_neurons', lambda: pu.fetch_neurons(skids, verbose=False)),
+        ('sync (empty store)', sync_cold),
+        ('sync (up to date)', sync_warm),
+        ('get_volume', lambda: pymaid.get_volume(109, remote_instance=pu.source_project)),
+        ('find_unlinked_connectors', lambda: pu.find_unlinked_connectors(pu.target_project)),
+        ('copy_neurons_by_skid (5 neurons)', copy_neurons),
+    ]
+
+
+def main():
+    latency = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.02
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    server = subprocess.Popen(
+        [sys.executable, '-u', fake_catmaid_server.__file__, '0', str(latency)],
+        stdout=subprocess.PIPE, text=True)
+    line = server.stdout.readline()
+    print(line.strip())
+    server_url = re.search(r'running at (\S+)', line)[1]
+
+    # Connect to the server's port
+    with open(os.path.join(os.path.dirname(pu.connections.__file__), 'connection_configs',
+                           'catmaid_configs_local_fake_server.json'), 'r') as f:
+        configs = json.load(f)
+    configs['source_catmaid_url'] = configs['target_catmaid_url'] = server_url
+    config_fn = os.path.join(tmp_dir, 'catmaid_configs.json')
+    with open(config_fn, 'w') as f:
+        json.dump(configs, f)
+    pu.reset_connection(config_filename=config_fn)
+    pu.source_project.make_global()
+    pymaid.set_pbars(hide=True)
+    # The response cache would make every repeat after the first one instant
+    pu.response_cache.enabled = False
+
+    results = []
+    try:
+        skids = pu.get_skids_by_annotation(ANNOTATIONS)[:N_NEURONS]
+        print(f'Benchmarking with {len(skids)} neurons annotated {ANNOTATIONS},'
+              f' {latency * 1000:.0f} ms latency per request, {repeats} repeats')
+        for name, workflow in make_workflows(skids):
+            seconds = []
+            for i in range(repeats):
+                fake_catmaid_server.get_request_counts(server_url, reset=True)
+                start = time.perf_counter()
+                workflow()
+                seconds.append(time.perf_counter() - start)
+            request_counts = fake_catmaid_server.get_request_counts(server_url)
+            results.append({
+                'workflow': name,
+                'requests': sum(request_counts.values()),
+                'median_s': np.median(seconds),
+                'min_s': min(seconds),
+                'max_s': max(seconds),
+                'busiest_endpoint': (request_counts.most_common(1)[0][0]
+                                     if request_counts else None)
+            })
+    finally:
+        server.terminate()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    print(pd.DataFrame(results).set_index('workflow').round(3).to_string())
+
+
+if __name__ == '__main__':
+    main()
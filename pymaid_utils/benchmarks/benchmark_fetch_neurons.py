@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# Measures how fast fetch_neurons downloads a set of neurons from the source
+# project for different numbers of workers, and prints per-endpoint request
+# timings, to help choose workers and MAX_CONCURRENCY for a CATMAID server.
+#
+# Usage: python3 benchmark_fetch_neurons.py annotation [workers ...]
+# e.g.:  python3 benchmark_fetch_neurons.py 'T1 leg motor neuron' 1 2 4 8 16
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..'))
+import pymaid_utils as pu
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: python3 benchmark_fetch_neurons.py annotation'
+              ' [workers ...]')
+        sys.exit(1)
+    annotation = sys.argv[1]
+    worker_counts = [int(n) for n in sys.argv[2:]] or [1, 2, 4, 8, 16]
+
+    skids = pu.get_skids_by_annotation(annotation)
+    print(f'Benchmarking with {len(skids)} neurons annotated "{annotation}"')
+    pu.set_max_concurrency(max(worker_counts))
+
+    # The response cache would make every run after the first one instant.
+    # use_cache=False skips it in fetch_neurons' worker threads too (bypassed()
+    # only applies to the thread that enters it).
+    for workers in worker_counts:
+        pu.reset_request_metrics()
+        cache_hits = pu.response_cache.hits
+        start = time.perf_counter()
+        pu.fetch_neurons(skids, workers=workers, use_cache=False, verbose=False)
+        seconds = time.perf_counter() - start
+        assert pu.response_cache.hits == cache_hits, 'Some neurons came from the cache'
+        metrics = pu.get_request_metrics(summary=False)
+        print(f'\nworkers={workers:3d}: {seconds:6.1f}s,'
+              f' {len(skids) / seconds:6.1f} neurons/s,'
+              f' {len(metrics)} requests,'
+              f' {metrics.bytes.sum() / 1e6:.1f} MB')
+        print(pu.get_request_metrics().to_string())
+
+
+if __name__ == '__main__':
+    main()
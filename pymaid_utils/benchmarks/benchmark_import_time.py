@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# Measures how long 'import pymaid_utils' takes, with all network access
+# blocked, to make sure importing the package never waits on a CATMAID server.
+#
+# Usage: python3 benchmark_import_time.py [n_runs=5]
+#
+# pymaid itself takes a second or more to import (it pulls in navis,
+# matplotlib, etc.), which pymaid_utils can't do anything about. So pymaid is
+# imported and timed first, and the budget below applies only to the time
+# spent importing pymaid_utils on top of that.
+
+import os
+import sys
+import json
+import subprocess
+import statistics
+
+IMPORT_TIME_BUDGET_MS = 50
+
+repo_root = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+# Run in a fresh interpreter each time so nothing is already imported
+timing_code = '''
+import json
+import time
+import socket
+
+def refuse_connection(*args, **kwargs):
+    raise OSError('Network access attempted during import')
+socket.socket.connect = refuse_connection
+socket.create_connection = refuse_connection
+
+start = time.perf_counter()
+import pymaid
+pymaid_done = time.perf_counter()
+import pymaid_utils
+pymaid_utils_done = time.perf_counter()
+
+print(json.dumps({
+    'pymaid_ms': (pymaid_done - start) * 1000,
+    'pymaid_utils_ms': (pymaid_utils_done - pymaid_done) * 1000,
+    'source_connected': pymaid_utils.source_project.is_connected,
+    'target_connected': pymaid_utils.target_project.is_connected
+}))
+'''
+
+
+def time_import():
+    result = subprocess.run([sys.executable, '-c', timing_code],
+                            cwd=repo_root, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr)
+        raise Exception('Importing pymaid_utils failed, see output above')
+    # The last line of output is the json, anything before it is prints
+    return json.loads(result.stdout.strip().split('\n')[-1])
+
+
+def main():
+    n_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    runs = [time_import() for i in range(n_runs)]
+
+    if any([run['source_connected'] or run['target_connected'] for run in runs]):
+        raise Exception('A CATMAID connection was opened during import')
+
+    pymaid_ms = statistics.median([run['pymaid_ms'] for run in runs])
+    pymaid_utils_ms = statistics.median([run['pymaid_utils_ms'] for run in runs])
+    print(f'import pymaid:        {pymaid_ms:8.1f} ms (median of {n_runs})')
+    print(f'import pymaid_utils:  {pymaid_utils_ms:8.1f} ms (median of {n_runs}),'
+          f' budget {IMPORT_TIME_BUDGET_MS} ms')
+    if pymaid_utils_ms > IMPORT_TIME_BUDGET_MS:
+        print('FAIL: pymaid_utils import is over budget')
+        sys.exit(1)
+    print('OK: no network access, within budget')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Times how get_elastictransformed_neurons_by_skid writes transformed swc
+# coordinates back into each neuron's node table, on the largest motor neurons
+# in neuron_reconstructions/. Compares the old row-by-row loop (one .iloc read
+# and three .at writes per node) with gather_swc_coordinates, which looks up
+# all the nodes' swc rows at once, and checks that both give the same table.
+# Doesn't need a CATMAID server.
+#
+# Usage: python3 benchmark_swc_write_back.py [n_neurons=5]
+
+import os
+import sys
+import glob
+import time
+
+import numpy as np
+import pandas as pd
+
+repo_root = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+sys.path.append(repo_root)
+from pymaid_utils.manipulate_and_reupload_catmaid_neurons import gather_swc_coordinates
+
+MOTOR_NEURON_FOLDER = os.path.join(repo_root, 'neuron_reconstructions',
+                                   'skeletons_in_FANC_space', 'motor_neurons')
+
+
+def load_test_case(swc_filename, rng):
+    """
+    A node table like the one pymaid gives for the neuron in swc_filename,
+    the map from treenode id to swc node index that to_swc returns, and a
+    'transformed' swc array like the one read back after transforming. swc
+    node indices are assigned in a shuffled order, like to_swc does.
+    """
+    data = np.loadtxt(swc_filename, ndmin=2)
+    nodes = pd.DataFrame({'treenode_id': data[:, 0].astype(np.int64),
+                          'x': data[:, 2], 'y': data[:, 3], 'z': data[:, 4]})
+    swc_indices = rng.permutation(len(nodes)) + 1
+    treenode2index_map = dict(zip(nodes.treenode_id.tolist(), swc_indices.tolist()))
+    swc = np.zeros((len(nodes), 7))
+    swc[:, 0] = np.arange(1, len(nodes) + 1)
+    swc[swc_indices - 1, 2:5] = nodes[['x', 'y', 'z']].values * 1.1 + 5
+    return nodes, swc, treenode2index_map
+
+
+def write_back_by_row(nodes, final_swc, treenode2index_map):
+    # The loop build_transformed_neurons_from_file used to run
+    for row in np.arange(nodes.shape[0]):
+        treenode = nodes.iloc[row].treenode_id
+        index = treenode2index_map[treenode]
+        assert(final_swc[index-1, 0] == index)
+        nodes.at[row, 'x'] = final_swc[index-1, 2]
+        nodes.at[row, 'y'] = final_swc[index-1, 3]
+        nodes.at[row, 'z'] = final_swc[index-1, 4]
+
+
+def write_back_by_gather(nodes, final_swc, treenode2index_map):
+    nodes[['x', 'y', 'z']] = gather_swc_coordinates(
+        nodes.treenode_id.values, final_swc, treenode2index_map)
+
+
+def main():
+    n_neurons = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    swc_filenames = sorted(glob.glob(os.path.join(MOTOR_NEURON_FOLDER, '*.swc')),
+                           key=os.path.getsize, reverse=True)[:n_neurons]
+    rng = np.random.default_rng(0)
+
+    print(f'{"nodes":>8} {"by row (s)":>11} {"gather (s)":>11} {"speedup":>8}  neuron')
+    total_by_row = total_gather = 0
+    for swc_filename in swc_filenames:
+        nodes, swc, treenode2index_map = load_test_case(swc_filename, rng)
+
+        by_row = nodes.copy()
+        start = time.perf_counter()
+        write_back_by_row(by_row, swc, treenode2index_map)
+        seconds_by_row = time.perf_counter() - start
+
+        gathered = nodes.copy()
+        start = time.perf_counter()
+        write_back_by_gather(gathered, swc, treenode2index_map)
+        seconds_gather = time.perf_counter() - start
+
+        assert np.array_equal(by_row[['x', 'y', 'z']].values,
+                              gathered[['x', 'y', 'z']].values)
+        total_by_row += seconds_by_row
+        total_gather += seconds_gather
+        print(f'{len(nodes):8d} {seconds_by_row:11.3f} {seconds_gather:11.4f}'
+              f' {seconds_by_row / seconds_gather:7.0f}x'
+              f'  {os.path.basename(swc_filename)[:-4]}')
+    print(f'Total: {total_by_row:.2f}s by row, {total_gather:.4f}s with'
+          f' gather_swc_coordinates ({total_by_row / total_gather:.0f}x faster)')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,687 @@
 
 import os
 import json
+import time
+import hashlib
+import threading
+import weakref
+import functools
+import contextlib
+from collections import Counter, deque
+from urllib.parse import urlsplit, parse_qsl
 
+import pandas as pd
 import pymaid
 
+try:
+    from .retries import RetryingHTTPAdapter
+except:
+    from retries import RetryingHTTPAdapter
 
-def connect_to_catmaid(config_filename='catmaid_configs.json'):
+
+# ---Response cache settings--- #
+# Set the environment variable PYMAID_UTILS_CACHE_DIR to put the cache elsewhere
+RESPONSE_CACHE_DIR = os.environ.get(
+    'PYMAID_UTILS_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'pymaid_utils', 'responses')
+)
+RESPONSE_CACHE_TTL = 24 * 60 * 60  # seconds. None means entries never expire
+RESPONSE_CACHE_MAX_BYTES = 2 * 1024**3
+
+# CATMAID endpoints that are requested via POST but only read data. Responses
+# to GET requests and to POSTs to these endpoints are cached. A POST to any
+# other endpoint is assumed to modify data on the server, so it invalidates all
+# cached responses for that server and project.
+READ_ONLY_POST_ENDPOINTS = {
+    'annotations',
+    'annotations/query-targets',
+    'annotations/forskeletons',
+    'annotations/table-list',
+    'skeleton/neuronnames',
+    'skeleton/annotationlist',
+    'skeleton/connectivity_matrix',
+    'skeleton/contributor_statistics_multiple',
+    'skeletons',
+    'skeletons/compact-detail',
+    'skeletons/connectivity',
+    'skeletons/connectivity-counts',
+    'skeletons/cable-length',
+    'skeletons/review-status',
+    'skeletons/summary',
+    'skeletons/node-count',
+    'skeletons/in-bounding-box',
+    'skeletons/import-info',
+    'skeletons/origin',
+    'skeletons/from-origin',
+    'skeletons/change-history',
+    'skeletons/confidence-compartment-subgraph',
+    'treenodes/compact-detail',
+    'nodes/location',
+    'node/list',
+    'node/user-info',
+    'labels-for-nodes',
+    'neurons/from-models',
+    'connector/skeletons',
+    'connector/list/many_to_many',
+    'connectors',
+    'connectors/links',
+    'connectors/in-bounding-box',
+    'graph/dps',
+    'graph/circlesofhell',
+    'stats/user-history'
+}
+
+
+class ResponseCache:
+    """
+    Persistent on-disk cache of CATMAID responses. Each entry is keyed by a
+    hash of (server, project_id, endpoint, args, generation) and stored as two
+    files: the raw response content and a small json file of metadata. Entries
+    older than ttl seconds are treated as missing, and once the cache grows past
+    max_bytes the least recently used entries are evicted. Each project's
+    generation is a number kept in a small file, and invalidate_project
+    increments it, which leaves all of the project's entries behind at once
+    without reading them. Those are evicted first.
+    """
+    def __init__(self, cache_dir=RESPONSE_CACHE_DIR, ttl=RESPONSE_CACHE_TTL,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self._size = None  # Computed on first use, then kept up to date
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def active(self):
+        return self.enabled and not getattr(self._local, 'bypassed', False)
+
+    @contextlib.contextmanager
+    def bypassed(self):
+        """Requests made by this thread inside this block skip the cache."""
+        previous = getattr(self._local, 'bypassed', False)
+        self._local.bypassed = True
+        try:
+            yield
+        finally:
+            self._local.bypassed = previous
+
+    @staticmethod
+    def make_key(server, project_id, endpoint, args, generation=0):
+        description = [server, project_id, endpoint, args]
+        if generation != 0:
+            description.append(generation)
+        description = json.dumps(description, sort_keys=True, default=str)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def _generation_path(self, server, project_id):
+        if project_id is not None:
+            project_id = int(project_id)
+        name = hashlib.sha256(json.dumps([server.rstrip('/'), project_id]
+                                         ).encode()).hexdigest()
+        return os.path.join(self.cache_dir, 'generations', name[:16] + '.txt')
+
+    def generation(self, server, project_id):
+        """The number of times this project's entries have been invalidated."""
+        try:
+            with open(self._generation_path(server, project_id), 'r') as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def invalidate_project(self, server, project_id):
+        """
+        Make every entry for this server and project unreachable, by moving
+        the project to a new generation. Unlike invalidate, this doesn't look
+        at any entries, so it takes the same time however big the cache is.
+        """
+        path = self._generation_path(server, project_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        with self._lock:
+            generation = self.generation(server, project_id) + 1
+            with open(path + suffix, 'w') as f:
+                f.write(str(generation))
+            os.replace(path + suffix, path)
+        return generation
+
+    def _paths(self, key):
+        folder = os.path.join(self.cache_dir, key[:2])
+        return (os.path.join(folder, key + '.json'),
+                os.path.join(folder, key + '.bin'))
+
+    def _read_metadata(self, key):
+        meta_path, content_path = self._paths(key)
+        try:
+            with open(meta_path, 'r') as f:
+                metadata = json.load(f)
+            metadata['last_used'] = os.path.getmtime(meta_path)
+        except (OSError, ValueError):
+            # Missing, or removed by another thread or process just now
+            return None
+        metadata['key'] = key
+        return metadata
+
+    def get(self, key):
+        """Return the cached content for this key, or None if there is none."""
+        metadata = self._read_metadata(key)
+        if metadata is not None and self.ttl is not None:
+            if time.time() - metadata['created'] > self.ttl:
+                self.remove(key)
+                metadata = None
+        if metadata is None:
+            self.misses += 1
+            return None
+
+        meta_path, content_path = self._paths(key)
+        try:
+            with open(content_path, 'rb') as f:
+                content = f.read()
+            os.utime(meta_path)  # Mark as recently used, for LRU eviction
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return content
+
+    def put(self, key, content, server, project_id, endpoint, args, generation=0):
+        meta_path, content_path = self._paths(key)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        old = self._read_metadata(key)
+        metadata = {
+            'server': server,
+            'project_id': project_id,
+            'endpoint': endpoint,
+            'args': args,
+            'generation': generation,
+            'created': time.time(),
+            'bytes': len(content)
+        }
+        # Write to temporary files then rename, so that other processes
+        # reading the cache never see a partially written entry
+        suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(content_path + suffix, 'wb') as f:
+            f.write(content)
+        os.replace(content_path + suffix, content_path)
+        with open(meta_path + suffix, 'w') as f:
+            json.dump(metadata, f, default=str)
+        os.replace(meta_path + suffix, meta_path)
+
+        with self._lock:
+            if self._size is not None:
+                self._size += len(content) - (old['bytes'] if old else 0)
+        if self.max_bytes is not None and self.size() > self.max_bytes:
+            self.evict()
+
+    def remove(self, key):
+        metadata = self._read_metadata(key)
+        removed = False
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+                removed = True
+            except FileNotFoundError:
+                pass
+        # Only count the bytes once if several threads remove the same entry
+        with self._lock:
+            if removed and metadata is not None and self._size is not None:
+                self._size -= metadata['bytes']
+
+    def entries(self):
+        """Return a DataFrame describing every entry in the cache."""
+        metadata = []
+        if os.path.exists(self.cache_dir):
+            for folder in sorted(os.listdir(self.cache_dir)):
+                folder = os.path.join(self.cache_dir, folder)
+                if not os.path.isdir(folder) or folder.endswith('generations'):
+                    continue
+                for fn in os.listdir(folder):
+                    if fn.endswith('.json'):
+                        entry = self._read_metadata(fn[:-len('.json')])
+                        if entry is not None:
+                            metadata.append(entry)
+        entries = pd.DataFrame(metadata, columns=['key', 'server', 'project_id',
+                                                  'endpoint', 'args', 'generation',
+                                                  'created', 'last_used', 'bytes'])
+        entries['generation'] = entries.generation.fillna(0).astype(int)
+        return entries
+
+    def size(self):
+        """Total size in bytes of all cached responses."""
+        with self._lock:
+            size = self._size
+        if size is None:
+            size = int(self.entries().bytes.sum())
+            with self._lock:
+                self._size = size
+        return size
+
+    def evict(self, max_bytes=None):
+        """
+        Remove least recently used entries until the cache is no bigger than
+        max_bytes (defaults to self.max_bytes). Returns the number removed.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = self.entries()
+        # Entries left behind by invalidate_project first
+        generations = {project: self.generation(*project) for project in
+                       set(zip(entries.server, entries.project_id))}
+        entries['current'] = [generation == generations[project] for project,
+                              generation in zip(zip(entries.server, entries.project_id),
+                                                entries.generation)]
+        entries = entries.sort_values(['current', 'last_used'])
+        total = entries.bytes.sum()
+        n_removed = 0
+        for key, n_bytes in zip(entries.key, entries.bytes):
+            if total <= max_bytes:
+                break
+            self.remove(key)
+            total -= n_bytes
+            n_removed += 1
+        with self._lock:
+            self._size = None
+        return n_removed
+
+    def invalidate(self, server=None, project_id=None, endpoint=None):
+        """
+        Remove entries matching all of the given criteria. endpoint matches
+        any endpoint starting with the given string. With no criteria, the
+        whole cache is cleared. Returns the number of entries removed. This
+        reads every entry's metadata, so to drop a whole project's entries,
+        use invalidate_project instead.
+        """
+        entries = self.entries()
+        if server is not None:
+            entries = entries[entries.server == server.rstrip('/')]
+        if project_id is not None:
+            entries = entries[entries.project_id == project_id]
+        if endpoint is not None:
+            entries = entries[entries.endpoint.str.startswith(endpoint.strip('/'))]
+        for key in entries.key:
+            self.remove(key)
+        return len(entries)
+
+    def clear(self):
+        return self.invalidate()
+
+
+response_cache = ResponseCache()
+# (server, project_id) -> number of requests sent that may have modified data
+# in that project. Anything holding data derived from a project (e.g. an
+# annotation_index.AnnotationIndex) can compare counts to see if it's stale.
+_modification_counts = Counter()
+
+
+# Counters of the modifying requests sent by each thread, see
+# counting_modifications
+_thread_modification_counts = threading.local()
+
+
+def get_modification_count(server, project_id):
+    return _modification_counts[(server.rstrip('/'), int(project_id))]
+
+
+@contextlib.contextmanager
+def counting_modifications():
+    """
+    Count the requests that may modify data sent by this thread inside this
+    block. Yields a Counter of (server, project_id) -> count, filled in as the
+    requests are sent, so that whatever holds data derived from a project can
+    account for exactly the changes it made (see AnnotationIndex.add).
+    """
+    counts = Counter()
+    previous = getattr(_thread_modification_counts, 'counters', [])
+    _thread_modification_counts.counters = previous + [counts]
+    try:
+        yield counts
+    finally:
+        _thread_modification_counts.counters = previous
+
+
+# ---Connection pooling--- #
+# All CatmaidInstances made here that talk to the same host share one pool of
+# keep-alive connections, which holds at most MAX_CONCURRENCY connections.
+# Requests beyond that wait for a free connection instead of opening new ones,
+# so this caps how hard all threads together can hit the server. Requests
+# that fail for transient reasons are retried (see retries.py).
+MAX_CONCURRENCY = 10
+_http_adapters = {}
+_instances = weakref.WeakSet()
+
+
+def get_http_adapter(server):
+    """Return (host, adapter) for the connection pool shared by this host."""
+    host = '{0.scheme}://{0.netloc}'.format(urlsplit(server))
+    if host not in _http_adapters:
+        _http_adapters[host] = RetryingHTTPAdapter(
+            is_idempotent=_is_read_request,
+            pool_connections=1,
+            pool_maxsize=MAX_CONCURRENCY,
+            pool_block=True
+        )
+    return host, _http_adapters[host]
+
+
+def _is_read_request(request):
+    """Whether a prepared request only reads data from CATMAID."""
+    if request.method in ('GET', 'HEAD'):
+        return True
+    # The endpoint is whatever follows the project id, or the whole path for
+    # requests that aren't specific to a project
+    parts = urlsplit(request.url).path.strip('/').split('/')
+    for i, part in enumerate(parts):
+        if part.isdigit():
+            parts = parts[i+1:]
+            break
+    return '/'.join(parts) in READ_ONLY_POST_ENDPOINTS
+
+
+def set_max_concurrency(max_concurrency):
+    """
+    Set the maximum number of simultaneous connections to each CATMAID host,
+    and the number of threads each CatmaidInstance uses to send requests.
+    """
+    global MAX_CONCURRENCY
+    MAX_CONCURRENCY = max_concurrency
+    old_adapters = list(_http_adapters.values())
+    _http_adapters.clear()
+    for instance in list(_instances):
+        instance._mount_shared_adapter()
+        instance.max_threads = max_concurrency
+    for adapter in old_adapters:
+        adapter.close()
+
+
+# Number of most recent requests whose individual timings are kept. Counts,
+# totals and maxima per endpoint cover every request.
+REQUEST_METRICS_MAX_RECORDS = 10000
+
+
+class RequestMetrics:
+    """
+    Records how long each HTTP request sent to CATMAID took (from sending the
+    request to finishing downloading the response) and how big the response
+    was, so worker counts and MAX_CONCURRENCY can be tuned for a server.
+    Only the last max_records requests are kept one by one, so a long-running
+    session doesn't grow without bound. Their medians and 95th percentiles
+    are what summary() reports; the other columns count all requests.
+    """
+    def __init__(self, max_records=REQUEST_METRICS_MAX_RECORDS):
+        self.enabled = True
+        self._records = deque(maxlen=max_records)
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def record(self, server, response, seconds):
+        project_id, endpoint, query = _split_url(server, response.url)
+        # Group e.g. skeletons/123/compact-detail with the other skeletons
+        endpoint = '/'.join(['{id}' if part.isdigit() else part
+                             for part in endpoint.split('/')])
+        method, n_bytes = response.request.method, len(response.content)
+        with self._lock:
+            self._records.append({
+                'time': time.time(),
+                'server': server,
+                'project_id': project_id,
+                'method': method,
+                'endpoint': endpoint,
+                'status': response.status_code,
+                'seconds': seconds,
+                'bytes': n_bytes
+            })
+            totals = self._totals.setdefault((method, endpoint), {
+                'n_requests': 0, 'total_seconds': 0., 'max_seconds': 0.,
+                'total_bytes': 0
+            })
+            totals['n_requests'] += 1
+            totals['total_seconds'] += seconds
+            totals['max_seconds'] = max(totals['max_seconds'], seconds)
+            totals['total_bytes'] += n_bytes
+
+    def to_dataframe(self):
+        with self._lock:
+            records = list(self._records)
+        return pd.DataFrame(records, columns=['time', 'server', 'project_id',
+                                              'method', 'endpoint', 'status',
+                                              'seconds', 'bytes'])
+
+    def summary(self):
+        """Per-endpoint request counts, latencies and bytes transferred."""
+        records = self.to_dataframe()
+        with self._lock:
+            totals = pd.DataFrame.from_dict(
+                self._totals, orient='index',
+                columns=['n_requests', 'total_seconds', 'max_seconds',
+                         'total_bytes'])
+        totals.index = pd.MultiIndex.from_tuples(
+            totals.index, names=['method', 'endpoint'])
+        recent = records.groupby(['method', 'endpoint']).seconds.agg(
+            median_seconds='median',
+            p95_seconds=lambda x: x.quantile(0.95))
+        summary = totals.join(recent)
+        summary.insert(1, 'mean_seconds',
+                       summary.pop('total_seconds') / summary.n_requests)
+        summary = summary[['n_requests', 'mean_seconds', 'median_seconds',
+                           'p95_seconds', 'max_seconds', 'total_bytes']]
+        return summary.sort_values('n_requests', ascending=False)
+
+    def reset(self):
+        with self._lock:
+            self._records.clear()
+            self._totals = {}
+
+
+request_metrics = RequestMetrics()
+
+
+def _record_request_time(server, response, *args, **kwargs):
+    # requests response hook. This runs before the body has been downloaded,
+    # so download it here to include that in the timing.
+    if not request_metrics.enabled:
+        return
+    start = time.perf_counter()
+    response.content
+    seconds = response.elapsed.total_seconds() + time.perf_counter() - start
+    request_metrics.record(server, response, seconds)
+
+
+def get_request_metrics(summary=True):
+    """
+    Return timings of the HTTP requests sent so far, summarized per endpoint
+    (or one row per request if summary=False).
+    """
+    if summary:
+        return request_metrics.summary()
+    return request_metrics.to_dataframe()
+
+
+def reset_request_metrics():
+    request_metrics.reset()
+
+
+def _split_url(server, url):
+    """Split a CATMAID url into (project_id, endpoint, query)."""
+    parts = urlsplit(url)
+    path = parts.path[len(urlsplit(server).path):].strip('/')
+    project_id = None
+    first, _, rest = path.partition('/')
+    if first.isdigit():
+        project_id, path = int(first), rest
+    return project_id, path.strip('/'), sorted(parse_qsl(parts.query))
+
+
+class CachedCatmaidInstance(pymaid.CatmaidInstance):
+    """
+    A CatmaidInstance that stores responses to read requests in the on-disk
+    response_cache, so that repeated script runs reuse downloaded data. This
+    replaces pymaid's in-memory cache, which is turned off by default.
+    Its HTTP connections come from the pool shared by all instances talking
+    to the same host (see MAX_CONCURRENCY), and every request it sends is
+    timed in request_metrics.
+    """
+    def __init__(self, server, api_token, **kwargs):
+        kwargs.setdefault('caching', False)
+        kwargs.setdefault('max_threads', MAX_CONCURRENCY)
+        super().__init__(server, api_token, **kwargs)
+        self._session.hooks['response'].append(
+            functools.partial(_record_request_time, self.server))
+        _instances.add(self)
+
+    def update_credentials(self):
+        # Called by CatmaidInstance.__init__ right after the session is made,
+        # and before its first request (fetching a CSRF token if there's no
+        # api_token), so mount the shared adapter here
+        self._mount_shared_adapter()
+        super().update_credentials()
+
+    def _mount_shared_adapter(self):
+        host, adapter = get_http_adapter(self.server)
+        self._session.mount(host, adapter)
+
+    def _describe_request(self, url, post):
+        """Split a request into (server, project_id, endpoint, args)."""
+        server = self.server.rstrip('/')
+        project_id, endpoint, query = _split_url(server, url)
+        args = {'query': query, 'post': post}
+        return server, project_id, endpoint, args
+
+    def fetch(self, url, post=None, files=None, on_error='raise',
+              desc='Fetching', disable_pbar=False, leave_pbar=True,
+              return_type='json'):
+        was_single = isinstance(url, str)
+        urls = [url] if was_single else list(url)
+        if isinstance(post, (type(None), dict, bool)):
+            posts = [post] * len(urls)
+        else:
+            posts = list(post)
+        if len(urls) != len(posts):
+            raise ValueError('POST needs to be provided for each url.')
+
+        use_cache = (response_cache.active and files is None
+                     and return_type != 'request')
+        contents = [None] * len(urls)
+        to_send = []  # (index, key, description) of requests to send
+        modified_projects = set()
+        generations = {}  # (server, project_id) -> generation
+        for i, (u, p) in enumerate(zip(urls, posts)):
+            description = self._describe_request(u, p)
+            server, project_id, endpoint, args = description
+            if p is not None and endpoint not in READ_ONLY_POST_ENDPOINTS:
+                modified_projects.add((server, project_id))
+                to_send.append((i, None, description))
+                continue
+            key = None
+            if use_cache:
+                if (server, project_id) not in generations:
+                    generations[(server, project_id)] = response_cache.generation(
+                        server, project_id)
+                description += (generations[(server, project_id)],)
+                key = response_cache.make_key(*description)
+                contents[i] = response_cache.get(key)
+            if contents[i] is None:
+                to_send.append((i, key, description))
+
+        if to_send:
+            try:
+                responses = super().fetch(
+                    [urls[i] for i, key, description in to_send],
+                    post=[posts[i] for i, key, description in to_send],
+                    files=files,
+                    on_error=on_error,
+                    desc=desc,
+                    disable_pbar=disable_pbar,
+                    leave_pbar=leave_pbar,
+                    return_type='request'
+                )
+            finally:
+                # Don't serve stale data after a request that modifies data
+                for server, project_id in modified_projects:
+                    _modification_counts[(server, project_id)] += 1
+                    for counts in getattr(_thread_modification_counts, 'counters', []):
+                        counts[(server, project_id)] += 1
+                    response_cache.invalidate_project(server, project_id)
+            if return_type == 'request':
+                return responses[0] if was_single else responses
+            for (i, key, description), r in zip(to_send, responses):
+                contents[i] = r.content
+                if key is not None and r.status_code == 200:
+                    response_cache.put(key, r.content, *description)
+
+        if return_type == 'json':
+            parsed = []
+            for content in contents:
+                if isinstance(content, bytes):
+                    content = content.decode()
+                parsed.append(json.loads(content))
+        else:
+            parsed = contents
+        return parsed[0] if was_single else parsed
+
+
+class LazyCatmaidInstance(CachedCatmaidInstance):
+    """
+    A CatmaidInstance that doesn't talk to the server until it's first used.
+    server and project_id are available (and project_id can be changed)
+    without connecting. Any other attribute access, including the first call
+    to fetch() made by any pymaid function this instance is passed to, opens
+    the connection.
+    """
+    def __init__(self, server, api_token, project_id=1, title=None, **kwargs):
+        if server.endswith('/'):
+            server = server[:-1]
+        self.__dict__['_deferred_args'] = (api_token, title, kwargs)
+        self.__dict__['server'] = server
+        self.__dict__['project_id'] = project_id
+
+    # Held while connecting, so that threads sharing an instance that isn't
+    # connected yet don't all try to connect it at once
+    _connect_lock = threading.RLock()
+
+    @property
+    def is_connected(self):
+        return self.__dict__.get('_connected', False)
+
+    def connect(self):
+        with self._connect_lock:
+            if '_deferred_args' not in self.__dict__:
+                # Already connected, or being connected by this thread
+                return self
+            api_token, title, kwargs = self.__dict__.pop('_deferred_args')
+            # Keep any project_id change made before connecting
+            project_id = self.__dict__['project_id']
+            print(f'Connecting to catmaid at {self.server}...')
+            try:
+                super().__init__(self.server, api_token, project_id=project_id,
+                                 make_global=False, **kwargs)
+            except:
+                self.__dict__['_deferred_args'] = (api_token, title, kwargs)
+                raise
+            self.__dict__['_connected'] = True
+        if title is not None:
+            print(title, self.project_id)
+        return self
+
+    def __getattr__(self, name):
+        # Only called when normal attribute lookup fails, which before
+        # connecting is the case for everything CatmaidInstance.__init__ sets
+        if not (name.startswith('__') and name.endswith('__')):
+            self.connect()
+            if self.is_connected:
+                return object.__getattribute__(self, name)
+        raise AttributeError(f"'{type(self).__name__}' object has no"
+                             f" attribute '{name}'")
+
+
+def connect_to_catmaid(config_filename='catmaid_configs.json', lazy=False):
+    """
+    Read the given config file and return (source_project, target_project).
+    If lazy=True, the returned projects are LazyCatmaidInstances that don't
+    contact the server until they're first used.
+    """
     if not os.path.exists(config_filename):
         config_filename = os.path.join(os.path.dirname(__file__),
         'connection_configs', config_filename)
@@ -28,17 +704,17 @@ def connect_to_catmaid(config_filename='catmaid_configs.json'):
     if all([configs.get('source_catmaid_url', None),
             configs.get('source_catmaid_account_to_use', None),
             configs.get('source_project_id', None)]):
-        source_project = pymaid.CatmaidInstance(
+        source_project = _make_instance(
             configs['source_catmaid_url'],
             configs['catmaid_account_api_keys'][
                 configs['source_catmaid_account_to_use']
             ],
+            configs['source_project_id'],
+            'Source project:',
+            lazy,
             http_user=catmaid_http_username,
-            http_password=catmaid_http_password,
-            make_global=False
+            http_password=catmaid_http_password
         )
-        source_project.project_id = configs['source_project_id']
-        print_project_name(source_project, 'Source project:')
     else:
         raise ValueError('The following fields must appear in'
                          f' {config_filename} and not be null:'
@@ -54,17 +730,17 @@ def connect_to_catmaid(config_filename='catmaid_configs.json'):
     if all([configs.get('target_catmaid_url', None),
             configs.get('target_catmaid_account_to_use', None),
             configs.get('target_project_id', None)]):
-        target_project = pymaid.CatmaidInstance(
+        target_project = _make_instance(
             configs['target_catmaid_url'],
             configs['catmaid_account_api_keys'][
                 configs['target_catmaid_account_to_use']
             ],
+            configs['target_project_id'],
+            'Target project:',
+            lazy,
             http_user=catmaid_http_username,
-            http_password=catmaid_http_password,
-            make_global=False
+            http_password=catmaid_http_password
         )
-        target_project.project_id = configs['target_project_id']
-        print_project_name(target_project, 'Target project:')
 
     elif any([configs.get('target_catmaid_url', None),
               configs.get('target_catmaid_account_to_use', None),
@@ -81,6 +757,17 @@ def connect_to_catmaid(config_filename='catmaid_configs.json'):
         return source_project
 
 
+def _make_instance(server, api_token, project_id, title, lazy, **kwargs):
+    if lazy:
+        return LazyCatmaidInstance(server, api_token, project_id=project_id,
+                                   title=title, **kwargs)
+    project = CachedCatmaidInstance(server, api_token, make_global=False,
+                                    **kwargs)
+    project.project_id = project_id
+    print_project_name(project, title)
+    return project
+
+
 def print_project_name(project, title=None):
     print(
         title,
@@ -122,15 +809,45 @@ def get_project_ids():
     return get_source_project_id(), get_target_project_id()
 
 
-def clear_cache():
-    # I had a few instances where this didn't seem to work. (Namely, I pulled data,
-    # modified a neuron on catmaid, cleared cache, then re-pulled data,
-    # but the old neuron seemed to still be present in memory.)
-    # Maybe this doesn't work reliably, so try not to trust it.
-    # Calling reconnect_to_catmaid is a more reliable way to clear cached data.
-    source_project.clear_cache()
+def get_cache_info():
+    """Return a DataFrame describing every cached response."""
+    return response_cache.entries()
+
+
+def get_cache_size():
+    """Return the size in bytes of the on-disk response cache."""
+    return response_cache.size()
+
+
+def evict_cache(max_bytes=None):
+    """
+    Evict least recently used responses until the cache is no bigger than
+    max_bytes (defaults to RESPONSE_CACHE_MAX_BYTES).
+    """
+    return response_cache.evict(max_bytes)
+
+
+def invalidate_cache(server=None, project_id=None, endpoint=None):
+    """
+    Remove cached responses matching all the given criteria, e.g.
+    invalidate_cache(project_id=2, endpoint='annotations').
+    """
+    return response_cache.invalidate(server=server, project_id=project_id,
+                                     endpoint=endpoint)
+
+
+def clear_cache(everything=False):
+    """
+    Remove cached responses for the current source and target projects, so
+    the next requests re-download fresh data. With everything=True, empty the
+    whole on-disk cache instead.
+    """
+    if everything:
+        return response_cache.clear()
+    response_cache.invalidate_project(source_project.server,
+                                      source_project.project_id)
     try:
-        target_project.clear_cache()
+        response_cache.invalidate_project(target_project.server,
+                                          target_project.project_id)
     except NameError:
         pass
-
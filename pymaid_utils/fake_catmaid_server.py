@@ -0,0 +1,1116 @@
+#!/usr/bin/env python3
+# Requires python 3.6+ for f-strings
+
+# A stand-in for a CATMAID server that runs locally, without network access,
+# serving the neuron reconstructions saved in this repository. It implements
+# the parts of the CATMAID API that pymaid_utils and the analysis scripts use
+# (skeletons, names, annotations, tags, node details, connectors, volumes) and
+# the write endpoints used to upload and edit neurons and annotations, so every
+# pymaid_utils workflow can be run, tested and benchmarked on a laptop.
+#
+# Data served:
+#   Project 1: neuron_reconstructions/skeletons_in_FANC_space
+#   Project 2: neuron_reconstructions/skeletons_in_JRC2018_VNC_FEMALE_space
+# (the same project IDs as catmaid_configs_virtualflybrain.json). Each .swc
+# file becomes one skeleton, annotated with the annotations listed for it in
+# the matching *_annotations.json file plus 'motor neuron'/'sensory neuron'
+# according to its folder. Skeletons derived from another one (e.g.
+# "... - elastic transform - radius 500") get the 'LINKED NEURON - ...'
+# annotation that manipulate_and_reupload_catmaid_neurons.py would have given
+# them. The tissue outline meshes in volume_meshes are served as volume 109
+# (project 1) and 110 (project 2).
+#
+# IDs and timestamps are deterministic so that results are reproducible:
+# skeletons are numbered in sorted filename order, and node N of skeleton S has
+# node ID S * ID_STRIDE + N. The .swc files don't record synapses, so each
+# skeleton gets synthetic connectors (one every SYNTHETIC_CONNECTOR_SPACING
+# nodes, generated from a random number generator seeded with the skeleton ID)
+# so that connector workflows have something to work with. Don't use those for
+# analysis!
+#
+# Changes made through the write endpoints are kept in memory only, and are
+# lost when the server stops.
+#
+# Usage: python3 fake_catmaid_server.py [port] [latency_in_seconds]
+# then, in python:
+#   import pymaid_utils as pu
+#   pu.reset_connection(config_filename='catmaid_configs_local_fake_server.json')
+# Or start it from python with start_fake_catmaid_server().
+
+import os
+import re
+import sys
+import json
+import time
+import email
+import threading
+import urllib.request
+from collections import Counter
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT_FOLDERS = {
+    1: os.path.join(REPO_DIR, 'neuron_reconstructions', 'skeletons_in_FANC_space'),
+    2: os.path.join(REPO_DIR, 'neuron_reconstructions',
+                    'skeletons_in_JRC2018_VNC_FEMALE_space')
+}
+PROJECT_VOLUMES = {
+    1: {109: os.path.join(REPO_DIR, 'volume_meshes', 'in_EM_dataset_space',
+                          'tissueOutline_Aug2019_VNConly.stl')},
+    2: {110: os.path.join(REPO_DIR, 'volume_meshes', 'in_template_space',
+                          'tissueOutline_Aug2019_VNConly_toTemplate.stl')}
+}
+CELL_TYPE_ANNOTATIONS = {
+    'motor_neurons': 'motor neuron',
+    'sensory_neurons': 'sensory neuron',
+    'other_neurons': None
+}
+# Suffixes that manipulate_and_reupload_catmaid_neurons.py functions add to
+# neuron names, and the linking relation each one corresponds to. A skeleton
+# named "<parent> - <suffix>" is linked to the skeleton named "<parent>", which
+# for elastic transforms lives in project 1 and otherwise in the same project.
+LINK_SUFFIXES = {
+    ' - elastic transform': ('elastic transformation of', 1),
+    ' - elastic transform - flipped': ('elastic transformation and flipped of', 1),
+    ' - pruned by vol 109': ('pruned (first entry, last exit) by vol 109 of', None),
+    ' - radius 500': ('radius pruned of', None)
+}
+
+ID_STRIDE = 1000000  # Node and connector IDs of skeleton S start at S * ID_STRIDE
+CONNECTOR_ID_OFFSET = 900000  # Connector IDs of skeleton S start at S * ID_STRIDE + this
+NEURON_ID_OFFSET = 10000000  # Neuron ID of skeleton S is S + NEURON_ID_OFFSET
+ANNOTATION_ID_OFFSET = 20000000
+SYNTHETIC_CONNECTOR_SPACING = 50
+SEED_TIME = 1609459200  # 2021-01-01. Skeleton S was last edited at SEED_TIME + S
+SEED_UPDATE_TIME = '2021-01-02 12:00 AM'  # For 'UPDATED FROM LINKED NEURON'
+RELATIONS = {  # Connector link relation name -> (relation ID, connector type)
+    'presynaptic_to': (101, 0),
+    'postsynaptic_to': (102, 1),
+    'gapjunction_with': (103, 2),
+    'abutting': (104, 3)
+}
+USER = {'id': 1, 'login': 'fake_user', 'full_name': 'Fake User',
+        'first_name': 'Fake', 'last_name': 'User', 'color': [1, 1, 0, 1]}
+
+
+class FakeCatmaid:
+    """
+    The data held by the fake server: every project's skeletons, annotations,
+    connectors and volumes. Skeletons are read from their .swc files the first
+    time they're requested.
+    """
+    def __init__(self, server_url, project_folders=PROJECT_FOLDERS,
+                 project_volumes=PROJECT_VOLUMES):
+        self.server_url = server_url.rstrip('/')
+        self.lock = threading.RLock()
+        self.projects = {}
+        self.skeletons = {}  # skid -> dict, across all projects
+        self.annotation_names = {}  # annotation ID -> name, across all projects
+        self.volumes = {}  # volume ID -> dict
+        self._next_id = 10 ** 12  # For anything created through the API
+        self.request_counts = Counter()  # Per endpoint
+
+        skid = 0
+        for project_id, folder in sorted(project_folders.items()):
+            self.projects[project_id] = {
+                'title': os.path.basename(folder),
+                'annotations': {},
+                'free_connectors': {},  # ID -> [x, y, z] of unlinked connectors
+                'connector_table': None  # See get_connector_table
+            }
+            for cell_type in sorted(CELL_TYPE_ANNOTATIONS):
+                try:
+                    with open(os.path.join(folder, cell_type + '_annotations.json'), 'r') as f:
+                        annotations = json.load(f)
+                except FileNotFoundError:
+                    annotations = {}
+                swc_folder = os.path.join(folder, cell_type)
+                if not os.path.isdir(swc_folder):
+                    continue
+                for fn in sorted(os.listdir(swc_folder)):
+                    if not fn.endswith('.swc'):
+                        continue
+                    skid += 1
+                    name = fn[:-4]
+                    annots = list(annotations.get(name, []))
+                    if (CELL_TYPE_ANNOTATIONS[cell_type] is not None
+                            and CELL_TYPE_ANNOTATIONS[cell_type] not in annots):
+                        annots.append(CELL_TYPE_ANNOTATIONS[cell_type])
+                    self.skeletons[skid] = {
+                        'project_id': project_id,
+                        'name': name,
+                        'neuron_id': skid + NEURON_ID_OFFSET,
+                        'annotations': annots,
+                        'swc': os.path.join(swc_folder, fn),
+                        'nodes': None
+                    }
+        self._next_skid = skid + 1
+        self._add_linking_annotations()
+        for project_id in self.projects:
+            for skeleton in self.get_skeletons(project_id).values():
+                for annotation in skeleton['annotations']:
+                    self.get_annotation_id(project_id, annotation, create=True)
+
+        for project_id, volumes in project_volumes.items():
+            for volume_id, stl_fn in volumes.items():
+                self.volumes[volume_id] = {
+                    'project_id': project_id,
+                    'name': os.path.basename(stl_fn)[:-4],
+                    'stl': stl_fn,
+                    'mesh': None
+                }
+
+    def _add_linking_annotations(self):
+        by_name = {(s['project_id'], s['name']): skid
+                   for skid, s in self.skeletons.items()}
+        for skid, skeleton in self.skeletons.items():
+            for suffix, (relation, parent_project_id) in LINK_SUFFIXES.items():
+                if not skeleton['name'].endswith(suffix):
+                    continue
+                parent_project_id = parent_project_id or skeleton['project_id']
+                parent_name = skeleton['name'][:-len(suffix)]
+                parent_skid = by_name.get((parent_project_id, parent_name), None)
+                if parent_skid is None:
+                    continue
+                skeleton['annotations'].append(
+                    f'LINKED NEURON - {relation} skeleton id {parent_skid} in'
+                    f' project id {parent_project_id} on server {self.server_url}')
+                skeleton['annotations'].append(
+                    f'UPDATED FROM LINKED NEURON - {SEED_UPDATE_TIME}')
+                break
+
+    def new_id(self):
+        with self.lock:
+            self._next_id += 1
+            return self._next_id
+
+    # ---Skeletons--- #
+    def get_skeletons(self, project_id):
+        return {skid: s for skid, s in self.skeletons.items()
+                if s['project_id'] == project_id}
+
+    def get_skeleton(self, project_id, skid):
+        """The skeleton's dict with its nodes loaded, or None if it doesn't exist."""
+        skeleton = self.skeletons.get(int(skid), None)
+        if skeleton is None or skeleton['project_id'] != project_id:
+            return None
+        if skeleton['nodes'] is None:
+            with self.lock:
+                if skeleton['nodes'] is None:
+                    self._load_swc(int(skid), skeleton)
+        return skeleton
+
+    def _load_swc(self, skid, skeleton):
+        # Columns are PointNo Label X Y Z Radius Parent
+        swc = np.loadtxt(skeleton['swc'], comments='#', ndmin=2)
+        point_ids = swc[:, 0].astype(np.int64)
+        nodes = self._make_nodes(skid, point_ids, swc[:, 6].astype(np.int64),
+                                 swc[:, 2:5], swc[:, 5], SEED_TIME + skid)
+        tags = {}
+        somas = nodes['id'][swc[:, 1] == 1]
+        if len(somas) > 0:
+            tags['soma'] = somas.tolist()
+
+        # Synthetic connectors, see the top of this file
+        rng = np.random.default_rng(skid)
+        n_connectors = len(point_ids) // SYNTHETIC_CONNECTOR_SPACING
+        at_nodes = np.sort(rng.choice(len(point_ids), n_connectors, replace=False))
+        relations = rng.integers(0, 2, n_connectors)
+        offsets = rng.normal(0, 200, (n_connectors, 3)).round(1)
+        connectors = [
+            [skid * ID_STRIDE + CONNECTOR_ID_OFFSET + i, int(nodes['id'][node]),
+             int(relation), *(nodes['xyz'][node] + offset).tolist(),
+             float(SEED_TIME + skid)]
+            for i, (node, relation, offset) in enumerate(zip(at_nodes, relations, offsets))
+        ]
+        skeleton.update(nodes=nodes, tags=tags, connectors=connectors)
+
+    @staticmethod
+    def _make_nodes(skid, point_ids, parent_point_ids, xyz, radius, edition_time):
+        """Node table of a skeleton given in swc-style point IDs."""
+        node_ids = skid * ID_STRIDE + point_ids
+        parents = np.where(parent_point_ids < 0, -1,
+                           skid * ID_STRIDE + parent_point_ids)
+        return {
+            'id': node_ids,
+            'parent': parents,
+            'xyz': np.asarray(xyz, dtype=np.float64),
+            'radius': np.asarray(radius, dtype=np.float64),
+            'edition_time': np.full(len(node_ids), float(edition_time)),
+            'creation_time': np.full(len(node_ids), float(SEED_TIME))
+        }
+
+    def find_node(self, project_id, node_id):
+        """(skeleton, row index) of a node, or (None, None)."""
+        skeleton = self.get_skeleton(project_id, int(node_id) // ID_STRIDE)
+        if skeleton is None:
+            return None, None
+        rows = np.flatnonzero(skeleton['nodes']['id'] == int(node_id))
+        if len(rows) == 0:
+            return None, None
+        return skeleton, rows[0]
+
+    # ---Connectors--- #
+    def iter_connectors(self, project_id, skids=None):
+        """(connector row, skid) of every connector link in a project."""
+        if skids is None:
+            skids = self.get_skeletons(project_id)
+        for skid in skids:
+            skeleton = self.get_skeleton(project_id, skid)
+            if skeleton is None:
+                continue
+            for connector in skeleton['connectors']:
+                yield connector, int(skid)
+
+    def get_connector_table(self, project_id):
+        """
+        Arrays of the IDs and locations of every connector in a project,
+        linked or not. This is kept until a connector is added or removed.
+        """
+        project = self.projects[project_id]
+        with self.lock:
+            if project['connector_table'] is None:
+                locations = {c[0]: c[3:6] for c, skid in self.iter_connectors(project_id)}
+                locations.update(project['free_connectors'])
+                project['connector_table'] = (
+                    np.array(list(locations), dtype=np.int64),
+                    np.array(list(locations.values()), dtype=np.float64).reshape(-1, 3)
+                )
+            return project['connector_table']
+
+    def import_skeleton(self, project_id, swc_text, name=None, skid=None,
+                        neuron_id=None, force=False):
+        """Add or (with force=True) replace a skeleton, like skeletons/import."""
+        rows = [line.split() for line in swc_text.splitlines()
+                if line.strip() and not line.startswith('#')]
+        swc = np.array(rows, dtype=np.float64).reshape(-1, 7)
+        with self.lock:
+            if skid is not None and int(skid) in self.skeletons:
+                skid = int(skid)
+                if not force:
+                    raise ValueError(f'Skeleton {skid} already exists')
+                skeleton = self.skeletons[skid]
+                # New nodes get new IDs, after the ones used before
+                self.get_skeleton(project_id, skid)
+                first_point = int(skeleton['nodes']['id'].max()) % ID_STRIDE + 1
+            else:
+                skid = int(skid) if skid is not None else self._next_skid
+                self._next_skid = max(self._next_skid, skid + 1)
+                skeleton = self.skeletons[skid] = {
+                    'project_id': project_id,
+                    'name': name or f'neuron {skid}',
+                    'neuron_id': (int(neuron_id) if neuron_id is not None
+                                  else skid + NEURON_ID_OFFSET),
+                    'annotations': [],
+                    'swc': None
+                }
+                first_point = 1
+            # Like CATMAID, replacing a skeleton leaves connectors that were
+            # only linked to it unlinked
+            old_links = skeleton.get('connectors', None) or []
+            skeleton['connectors'] = []
+            swc_ids = swc[:, 0].astype(np.int64)
+            point_ids = np.arange(first_point, first_point + len(swc_ids))
+            id_map = dict(zip(swc_ids.tolist(), point_ids.tolist()))
+            parents = np.array([id_map.get(p, -1) for p in swc[:, 6].astype(np.int64)])
+            skeleton.update(
+                nodes=self._make_nodes(skid, point_ids, parents, swc[:, 2:5],
+                                       swc[:, 5], time.time()),
+                tags={},
+                connectors=[]
+            )
+            if name is not None:
+                skeleton['name'] = name
+            _free_unlinked_connectors(self, project_id, old_links)
+            return skid, {str(k): skid * ID_STRIDE + v for k, v in id_map.items()}
+
+    # ---Annotations--- #
+    def get_annotation_id(self, project_id, name, create=False):
+        annotations = self.projects[project_id]['annotations']
+        if name not in annotations and create:
+            with self.lock:
+                if name not in annotations:
+                    annotation_id = ANNOTATION_ID_OFFSET + len(self.annotation_names)
+                    annotations[name] = annotation_id
+                    self.annotation_names[annotation_id] = name
+        return annotations.get(name, None)
+
+    def get_skid_by_neuron_id(self, neuron_id):
+        for skid, skeleton in self.skeletons.items():
+            if skeleton['neuron_id'] == int(neuron_id):
+                return skid
+        return None
+
+    # ---Volumes--- #
+    def get_volume_mesh(self, volume_id):
+        """(vertices, faces) of a volume, read from its ASCII .stl file."""
+        volume = self.volumes[volume_id]
+        if volume['mesh'] is None:
+            with open(volume['stl'], 'r') as f:
+                vertices = [line.split()[1:4] for line in f
+                            if line.lstrip().startswith('vertex')]
+            vertices, faces = np.unique(np.array(vertices, dtype=np.float64),
+                                        axis=0, return_inverse=True)
+            volume['mesh'] = (vertices, faces.reshape(-1, 3))
+        return volume['mesh']
+
+
+class FakeCatmaidHandler(BaseHTTPRequestHandler):
+    """
+    Translates CATMAID API requests into reads and writes of a FakeCatmaid.
+    Each handler method receives the project ID, the regex match groups of its
+    URL and the request's parameters, and returns the object to send back as
+    json.
+    """
+    catmaid = None  # Set by make_fake_catmaid_server
+    latency = 0
+
+    def log_message(self, format, *args):
+        pass  # Don't print a line for every request
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        url = urlsplit(self.path)
+        params = parse_qsl(url.query, keep_blank_values=True)
+        if method == 'POST':
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            content_type = self.headers.get('Content-Type', '')
+            if content_type.startswith('multipart/form-data'):
+                params.extend(_parse_multipart(body, content_type).items())
+            else:
+                params.extend(parse_qsl(body.decode(), keep_blank_values=True))
+        params = dict(params)
+
+        path = url.path.strip('/')
+        match = re.match(r'(\d+)/(.*)', path)
+        project_id, endpoint = (int(match[1]), match[2]) if match else (None, path)
+        for route_method, pattern, handler in ROUTES:
+            route_match = re.fullmatch(pattern, endpoint)
+            if route_method == method and route_match:
+                break
+        else:
+            return self._respond(404, {'error': f'Unknown endpoint: {method} /{path}',
+                                       'type': 'FakeCatmaidError'})
+        if not endpoint.startswith('fake-server/'):
+            # Count requests per endpoint, e.g. 'GET skeletons/{id}/compact-detail'
+            endpoint_name = pattern.replace(r'(\d+)', '{id}')
+            self.catmaid.request_counts[f'{method} {endpoint_name}'] += 1
+        if project_id is not None and project_id not in self.catmaid.projects:
+            return self._respond(404, {'error': f'No project with ID {project_id}',
+                                       'type': 'FakeCatmaidError'})
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            response = handler(self.catmaid, project_id, route_match.groups(), params)
+        except Exception as e:
+            return self._respond(400, {'error': str(e), 'type': type(e).__name__})
+        self._respond(200, response)
+
+    def _respond(self, status, response):
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _parse_multipart(body, content_type):
+    message = email.message_from_bytes(
+        b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+    return {part.get_param('name', header='content-disposition'):
+            part.get_payload(decode=True).decode()
+            for part in message.get_payload()}
+
+
+def _get_list(params, key):
+    """Values sent as key[0], key[1], ... (or just key) in a request."""
+    if key in params:
+        return [params[key]]
+    values = {int(k[len(key) + 1:-1]): v for k, v in params.items()
+              if k.startswith(key + '[') and k.endswith(']')}
+    return [values[i] for i in sorted(values)]
+
+
+def _is_true(value):
+    return str(value).lower() in ('true', '1')
+
+
+def _iso(seconds, precise=False):
+    # precise=True keeps the microseconds
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat(
+        timespec='microseconds' if precise else 'seconds')
+
+
+def _request_counts(catmaid, project_id, groups, params):
+    # Not part of the CATMAID API, see get_request_counts
+    with catmaid.lock:
+        counts = dict(catmaid.request_counts)
+        if _is_true(params.get('reset', False)):
+            catmaid.request_counts.clear()
+    return counts
+
+
+# ---Read endpoints--- #
+def _root(catmaid, project_id, groups, params):
+    return {}
+
+
+def _projects(catmaid, project_id, groups, params):
+    return [{'id': pid, 'title': p['title'], 'stacks': []}
+            for pid, p in catmaid.projects.items()]
+
+
+def _user_list(catmaid, project_id, groups, params):
+    return [USER]
+
+
+def _annotation_list(catmaid, project_id, groups, params):
+    return {'annotations': [
+        {'id': annotation_id, 'name': name,
+         'users': [{'id': USER['id'], 'name': USER['login']}]}
+        for name, annotation_id in catmaid.projects[project_id]['annotations'].items()
+    ]}
+
+
+def _query_targets(catmaid, project_id, groups, params):
+    with_ids = {catmaid.annotation_names.get(int(i), None)
+                for i in _get_list(params, 'annotated_with')}
+    without_ids = {catmaid.annotation_names.get(int(i), None)
+                   for i in _get_list(params, 'not_annotated_with')}
+    name = params.get('name', None)
+    if name is not None and name.startswith('/'):
+        name_matches = lambda n: re.search(name[1:], n) is not None
+    elif name is not None and _is_true(params.get('name_exact', False)):
+        name_matches = lambda n: n == name
+    elif name is not None:
+        name_matches = lambda n: name.lower() in n.lower()
+
+    entities = []
+    for skid, skeleton in catmaid.get_skeletons(project_id).items():
+        annotations = set(skeleton['annotations'])
+        if not with_ids.issubset(annotations) or annotations & without_ids:
+            continue
+        if name is not None and not name_matches(skeleton['name']):
+            continue
+        entity = {'type': 'neuron', 'id': skeleton['neuron_id'],
+                  'name': skeleton['name'], 'skeleton_ids': [skid]}
+        if _is_true(params.get('with_annotations', False)):
+            entity['annotations'] = [
+                {'id': catmaid.get_annotation_id(project_id, a), 'name': a,
+                 'uid': USER['id']} for a in skeleton['annotations']]
+        entities.append(entity)
+    return {'entities': entities, 'totalRecords': len(entities)}
+
+
+def _skeleton_annotations(catmaid, project_id, groups, params):
+    skeletons = {}
+    annotation_names = {}
+    for skid in _get_list(params, 'skeleton_ids'):
+        skeleton = catmaid.skeletons.get(int(skid), None)
+        if skeleton is None or skeleton['project_id'] != project_id:
+            continue
+        ids = [catmaid.get_annotation_id(project_id, a)
+               for a in skeleton['annotations']]
+        skeletons[str(skid)] = {'annotations': [
+            {'id': i, 'uid': USER['id']} for i in ids]}
+        annotation_names.update({str(i): a for i, a in zip(ids, skeleton['annotations'])})
+    return {'skeletons': skeletons, 'annotations': annotation_names}
+
+
+def _neuron_names(catmaid, project_id, groups, params):
+    return {str(skid): catmaid.skeletons[int(skid)]['name']
+            for skid in _get_list(params, 'skids')
+            if int(skid) in catmaid.get_skeletons(project_id)}
+
+
+def _neuron_ids(catmaid, project_id, groups, params):
+    return {str(skid): catmaid.skeletons[int(skid)]['neuron_id']
+            for skid in _get_list(params, 'model_ids')
+            if int(skid) in catmaid.get_skeletons(project_id)}
+
+
+def _compact_detail(catmaid, project_id, groups, params):
+    skeleton = catmaid.get_skeleton(project_id, groups[0])
+    if skeleton is None:
+        return [[], [], {}]
+    nodes = skeleton['nodes']
+    with_history = _is_true(params.get('with_history', False))
+    parents = [None if p < 0 else p for p in nodes['parent'].tolist()]
+    node_rows = [
+        [node_id, parent, USER['id'], *xyz, radius, 5]
+        + ([edition_time, creation_time, True] if with_history else [])
+        for node_id, parent, xyz, radius, edition_time, creation_time in zip(
+            nodes['id'].tolist(), parents, nodes['xyz'].tolist(),
+            nodes['radius'].tolist(), nodes['edition_time'].tolist(),
+            nodes['creation_time'].tolist())
+    ]
+    connector_rows = []
+    if _is_true(params.get('with_connectors', True)):
+        connector_rows = [
+            [c[1], c[0], c[2], c[3], c[4], c[5]]
+            + ([c[6], c[6]] if with_history else [])
+            for c in skeleton['connectors']
+        ]
+    tags = skeleton['tags'] if _is_true(params.get('with_tags', True)) else {}
+    return [node_rows, connector_rows, tags]
+
+
+def _node_overview(catmaid, project_id, groups, params):
+    skeleton = catmaid.get_skeleton(project_id, groups[0])
+    if skeleton is None:
+        return [[], [], []]
+    nodes = skeleton['nodes']
+    parents = [None if p < 0 else p for p in nodes['parent'].tolist()]
+    node_rows = [
+        [node_id, parent, 5, *xyz, radius, USER['id'], edition_time]
+        for node_id, parent, xyz, radius, edition_time in zip(
+            nodes['id'].tolist(), parents, nodes['xyz'].tolist(),
+            nodes['radius'].tolist(), nodes['edition_time'].tolist())
+    ]
+    tags = [[node_id, tag] for tag, node_ids in skeleton['tags'].items()
+            for node_id in node_ids]
+    return [node_rows, [], tags]
+
+
+def _skeleton_summaries(catmaid, project_id, groups, params):
+    summaries = []
+    for skid in _get_list(params, 'skeleton_ids'):
+        skeleton = catmaid.get_skeleton(project_id, skid)
+        if skeleton is None:
+            continue
+        nodes = skeleton['nodes']
+        # Like CATMAID's skeleton summary, deleting a node counts as an edit
+        last_edition_time = max(nodes['edition_time'].max(initial=0),
+                                skeleton.get('deletion_time', 0))
+        summaries.append({
+            'skeleton_id': int(skid),
+            'last_edition_time': _iso(last_edition_time, precise=True),
+            'last_editor_id': USER['id'],
+            'num_nodes': len(nodes['id'])
+        })
+    return summaries
+
+
+def _label_list(catmaid, project_id, groups, params):
+    # Only skeletons that have been loaded are listed. The others' tags aren't
+    # known until their .swc file is read, and nothing can have asked about
+    # them yet.
+    rows = [[tag, skid, node_id]
+            for skid, skeleton in catmaid.get_skeletons(project_id).items()
+            if skeleton['nodes'] is not None
+            for tag, node_ids in skeleton['tags'].items() for node_id in node_ids]
+    label_ids = {tag: i + 1 for i, tag in enumerate(sorted({row[0] for row in rows}))}
+    return [[label_ids[row[0]], *row] for row in rows]
+
+
+def _label_names(catmaid, project_id, groups, params):
+    # As with _label_list, only loaded skeletons' tags are known
+    return sorted({tag for skeleton in catmaid.get_skeletons(project_id).values()
+                   if skeleton['nodes'] is not None for tag in skeleton['tags']})
+
+
+def _node_count(catmaid, project_id, groups, params):
+    skeleton, row = catmaid.find_node(project_id, groups[0])
+    if skeleton is None:
+        raise ValueError(f'No node with ID {groups[0]}')
+    return {'count': len(skeleton['nodes']['id']),
+            'skeleton_id': int(groups[0]) // ID_STRIDE}
+
+
+def _find_nodes(catmaid, project_id, groups, params):
+    labels = _get_list(params, 'label_names')
+    node_ids = {int(n) for n in _get_list(params, 'treenode_ids')}
+    skids = [int(s) for s in _get_list(params, 'skeleton_ids')]
+    if len(skids) == 0:
+        skids = sorted({n // ID_STRIDE for n in node_ids}) if node_ids else \
+            list(catmaid.get_skeletons(project_id))
+    rows = []
+    for skid in skids:
+        skeleton = catmaid.get_skeleton(project_id, skid)
+        if skeleton is None:
+            continue
+        nodes = skeleton['nodes']
+        keep = np.ones(len(nodes['id']), dtype=bool)
+        if labels:
+            tagged = [n for label in labels for n in skeleton['tags'].get(label, [])]
+            keep &= np.isin(nodes['id'], tagged)
+        if node_ids:
+            keep &= np.isin(nodes['id'], list(node_ids))
+        for i in np.flatnonzero(keep):
+            parent = int(nodes['parent'][i])
+            rows.append([int(nodes['id'][i]), None if parent < 0 else parent,
+                         *nodes['xyz'][i].tolist(), 5, float(nodes['radius'][i]),
+                         skid, float(nodes['edition_time'][i]), USER['id']])
+    return rows
+
+
+def _node_labels(catmaid, project_id, groups, params):
+    node_ids = [int(n) for n in params.get('treenode_ids', '').split(',') if n]
+    labels = {}
+    for node_id in node_ids:
+        skeleton, row = catmaid.find_node(project_id, node_id)
+        if skeleton is None:
+            continue
+        tags = [tag for tag, ids in skeleton['tags'].items() if node_id in ids]
+        if tags:
+            labels[str(node_id)] = tags
+    return labels
+
+
+def _node_details(catmaid, project_id, groups, params):
+    # Like CATMAID, this also accepts connector IDs
+    connector_times = {c[0]: c[6] for c, skid in catmaid.iter_connectors(
+        project_id, {int(n) // ID_STRIDE for n in _get_list(params, 'node_ids')})}
+    connector_times.update({cid: SEED_TIME for cid in
+                            catmaid.projects[project_id]['free_connectors']})
+    details = {}
+    for node_id in _get_list(params, 'node_ids'):
+        skeleton, row = catmaid.find_node(project_id, node_id)
+        if skeleton is not None:
+            creation_time = skeleton['nodes']['creation_time'][row]
+            edition_time = skeleton['nodes']['edition_time'][row]
+        elif int(node_id) in connector_times:
+            creation_time = edition_time = connector_times[int(node_id)]
+        else:
+            continue
+        details[str(node_id)] = {
+            'creation_time': _iso(creation_time),
+            'user': USER['id'],
+            'edition_time': _iso(edition_time),
+            'editor': USER['id'],
+            'reviewers': [],
+            'review_times': []
+        }
+    return details
+
+
+def _connectors(catmaid, project_id, groups, params):
+    skids = _get_list(params, 'skeleton_ids') or None
+    relation = params.get('relation_type', None)
+    relation_ids = {type_: relation_id for relation_id, type_ in RELATIONS.values()}
+    connectors, partners = {}, {}
+    for c, skid in catmaid.iter_connectors(project_id, skids):
+        if relation is not None and RELATIONS[relation][1] != c[2]:
+            continue
+        connectors[c[0]] = [c[0], c[3], c[4], c[5], 5, USER['id'], USER['id'], c[6], c[6]]
+        partners.setdefault(str(c[0]), []).append(
+            [c[0], c[1], skid, relation_ids[c[2]], 5, USER['id']])
+    if skids is None and relation is None:
+        for cid, xyz in catmaid.projects[project_id]['free_connectors'].items():
+            connectors[cid] = [cid, *xyz, 5, USER['id'], USER['id'], SEED_TIME, SEED_TIME]
+    return {'connectors': list(connectors.values()), 'tags': {},
+            'partners': partners}
+
+
+def _connector_types(catmaid, project_id, groups, params):
+    return [{'name': relation.split('_')[0].capitalize(), 'type': 'Synaptic',
+             'relation': relation, 'relation_id': relation_id}
+            for relation, (relation_id, type_) in RELATIONS.items()]
+
+
+def _connector_details(catmaid, project_id, groups, params):
+    connector_ids = {int(c) for c in _get_list(params, 'connector_ids')}
+    skids = {c // ID_STRIDE for c in connector_ids}
+    details = {}
+    for c, skid in catmaid.iter_connectors(project_id, skids):
+        if c[0] not in connector_ids:
+            continue
+        d = details.setdefault(c[0], {'presynaptic_to': None, 'postsynaptic_to': [],
+                                      'presynaptic_to_node': None,
+                                      'postsynaptic_to_node': []})
+        if c[2] == 0:
+            d['presynaptic_to'], d['presynaptic_to_node'] = skid, c[1]
+        else:
+            d['postsynaptic_to'].append(skid)
+            d['postsynaptic_to_node'].append(c[1])
+    return [[cid, d] for cid, d in details.items()]
+
+
+def _connectors_in_bbox(catmaid, project_id, groups, params):
+    lower = np.array([float(params[k]) for k in ('minx', 'miny', 'minz')])
+    upper = np.array([float(params[k]) for k in ('maxx', 'maxy', 'maxz')])
+    ids, xyz = catmaid.get_connector_table(project_id)
+    inside = np.all((lower <= xyz) & (xyz <= upper), axis=1)
+    if _is_true(params.get('with_locations', False)):
+        return [[cid, *location] for cid, location in
+                zip(ids[inside].tolist(), xyz[inside].tolist())]
+    return [[cid] for cid in ids[inside].tolist()]
+
+
+def _volume_list(catmaid, project_id, groups, params):
+    return {'columns': ['id', 'name', 'comment', 'user_id', 'project_id'],
+            'data': [[volume_id, v['name'], '', USER['id'], project_id]
+                     for volume_id, v in catmaid.volumes.items()
+                     if v['project_id'] == project_id]}
+
+
+def _volume_details(catmaid, project_id, groups, params):
+    volume_id = int(groups[0])
+    if catmaid.volumes.get(volume_id, {}).get('project_id', None) != project_id:
+        raise ValueError(f'No volume with ID {volume_id}')
+    vertices, faces = catmaid.get_volume_mesh(volume_id)
+    index = ' '.join(str(i) for i in faces.ravel())
+    points = ' '.join(repr(x) for x in vertices.ravel().tolist())
+    mesh = (f"<IndexedTriangleSet  ccw='false' index='{index}'>"
+            f"<Coordinate point='{points}'/></IndexedTriangleSet>")
+    return {'id': volume_id, 'name': catmaid.volumes[volume_id]['name'],
+            'mesh': mesh}
+
+
+# ---Write endpoints--- #
+def _import_skeleton(catmaid, project_id, groups, params):
+    skid = params.get('skeleton_id', None)
+    skid, node_id_map = catmaid.import_skeleton(
+        project_id,
+        params['file'],
+        name=params.get('name', None),
+        skid=skid if skid not in (None, '', 'None') else None,
+        neuron_id=params.get('neuron_id', None) or None,
+        force=_is_true(params.get('force', False))
+    )
+    return {'neuron_id': catmaid.skeletons[skid]['neuron_id'],
+            'skeleton_id': skid, 'node_id_map': node_id_map}
+
+
+def _add_annotations(catmaid, project_id, groups, params):
+    names = _get_list(params, 'annotations')
+    skids = [catmaid.get_skid_by_neuron_id(n) for n in _get_list(params, 'entity_ids')]
+    with catmaid.lock:
+        for skid in skids:
+            annotations = catmaid.skeletons[skid]['annotations']
+            annotations.extend([a for a in names if a not in annotations])
+        ids = [catmaid.get_annotation_id(project_id, a, create=True) for a in names]
+    return {'message': 'success',
+            'annotations': [{'name': a, 'id': i, 'entities': skids}
+                            for a, i in zip(names, ids)]}
+
+
+def _remove_annotations(catmaid, project_id, groups, params):
+    names = [catmaid.annotation_names[int(i)]
+             for i in _get_list(params, 'annotation_ids')]
+    skids = [catmaid.get_skid_by_neuron_id(n) for n in _get_list(params, 'entity_ids')]
+    with catmaid.lock:
+        for skid in skids:
+            skeleton = catmaid.skeletons[skid]
+            skeleton['annotations'] = [a for a in skeleton['annotations']
+                                       if a not in names]
+    return {'message': 'success', 'deleted_annotations': names}
+
+
+def _add_node_tags(catmaid, project_id, groups, params):
+    node_id = int(groups[0])
+    skeleton, row = catmaid.find_node(project_id, node_id)
+    if skeleton is None:
+        raise ValueError(f'No node with ID {node_id}')
+    tags = [t for t in params.get('tags', '').split(',') if t]
+    with catmaid.lock:
+        if _is_true(params.get('delete_existing', False)):
+            for ids in skeleton['tags'].values():
+                if node_id in ids:
+                    ids.remove(node_id)
+        for tag in tags:
+            ids = skeleton['tags'].setdefault(tag, [])
+            if node_id not in ids:
+                ids.append(node_id)
+        skeleton['tags'] = {t: ids for t, ids in skeleton['tags'].items() if ids}
+    return {'message': 'success', 'new_labels': tags}
+
+
+def _create_connector(catmaid, project_id, groups, params):
+    connector_id = catmaid.new_id()
+    with catmaid.lock:
+        project = catmaid.projects[project_id]
+        project['free_connectors'][connector_id] = [float(params[k]) for k in 'xyz']
+        project['connector_table'] = None
+    return {'connector_id': connector_id, 'connector_edition_time': _iso(time.time())}
+
+
+def _create_link(catmaid, project_id, groups, params):
+    node_id, connector_id = int(params['from_id']), int(params['to_id'])
+    skeleton, row = catmaid.find_node(project_id, node_id)
+    ids, xyz = catmaid.get_connector_table(project_id)
+    if skeleton is None or connector_id not in ids:
+        raise ValueError(f'Can not link node {node_id} to connector {connector_id}')
+    with catmaid.lock:
+        catmaid.projects[project_id]['free_connectors'].pop(connector_id, None)
+        skeleton['connectors'].append(
+            [connector_id, node_id, RELATIONS[params['link_type']][1],
+             *xyz[ids == connector_id][0].tolist(), time.time()])
+    return {'message': 'success', 'link_id': catmaid.new_id(),
+            'link_edition_time': _iso(time.time())}
+
+
+
+def _rename_neuron(catmaid, project_id, groups, params):
+    skid = catmaid.get_skid_by_neuron_id(groups[0])
+    if skid is None or catmaid.skeletons[skid]['project_id'] != project_id:
+        raise ValueError(f'No neuron with ID {groups[0]}')
+    with catmaid.lock:
+        old_name = catmaid.skeletons[skid]['name']
+        catmaid.skeletons[skid]['name'] = params['name']
+    return {'success': True, 'renamed_neuron': int(groups[0]),
+            'old_name': old_name}
+
+
+def _find_node_or_fail(catmaid, project_id, node_id):
+    skeleton, row = catmaid.find_node(project_id, node_id)
+    if skeleton is None:
+        raise ValueError(f'No node with ID {node_id}')
+    return skeleton, row
+
+
+def _create_treenode(catmaid, project_id, groups, params):
+    parent_id = int(params.get('parent_id', -1) or -1)
+    if parent_id < 0:
+        raise ValueError('Creating new skeletons node by node is not supported')
+    skeleton, parent_row = _find_node_or_fail(catmaid, project_id, parent_id)
+    with catmaid.lock:
+        nodes = skeleton['nodes']
+        node_id = int(nodes['id'].max()) + 1
+        now = time.time()
+        new_row = {'id': node_id, 'parent': parent_id,
+                   'xyz': [[float(params[k]) for k in 'xyz']],
+                   'radius': float(params.get('radius', -1) or -1),
+                   'edition_time': now, 'creation_time': now}
+        for key, value in new_row.items():
+            nodes[key] = np.concatenate([nodes[key], np.array(value, ndmin=nodes[key].ndim,
+                                                              dtype=nodes[key].dtype)])
+    return {'treenode_id': node_id, 'skeleton_id': parent_id // ID_STRIDE,
+            'edition_time': _iso(now), 'parent_edition_time': _iso(now)}
+
+
+def _update_nodes(catmaid, project_id, groups, params):
+    now = time.time()
+    n_rows = len({k.split(']')[0] for k in params if k[:2] in ('t[', 'c[')})
+    moved_nodes, moved_connectors = [], {}
+    for i in range(n_rows):
+        if f't[{i}][0]' in params:
+            node_id = int(params[f't[{i}][0]'])
+            moved_nodes.append((node_id, [float(params[f't[{i}][{k}]']) for k in (1, 2, 3)]))
+        elif f'c[{i}][0]' in params:
+            connector_id = int(params[f'c[{i}][0]'])
+            moved_connectors[connector_id] = [float(params[f'c[{i}][{k}]']) for k in (1, 2, 3)]
+    with catmaid.lock:
+        for node_id, xyz in moved_nodes:
+            skeleton, row = _find_node_or_fail(catmaid, project_id, node_id)
+            skeleton['nodes']['xyz'][row] = xyz
+            skeleton['nodes']['edition_time'][row] = now
+        if moved_connectors:
+            for connector in [c for skeleton in catmaid.get_skeletons(project_id).values()
+                              if skeleton['nodes'] is not None
+                              for c in skeleton['connectors']]:
+                if connector[0] in moved_connectors:
+                    connector[3:6] = moved_connectors[connector[0]]
+                    connector[6] = now
+            free_connectors = catmaid.projects[project_id]['free_connectors']
+            for connector_id, xyz in moved_connectors.items():
+                if connector_id in free_connectors:
+                    free_connectors[connector_id] = xyz
+            catmaid.projects[project_id]['connector_table'] = None
+    return {'updated': len(moved_nodes) + len(moved_connectors),
+            'old_treenodes': [], 'old_connectors': []}
+
+
+def _update_radii(catmaid, project_id, groups, params):
+    node_ids = _get_list(params, 'treenode_ids')
+    radii = _get_list(params, 'treenode_radii')
+    updated = {}
+    with catmaid.lock:
+        for node_id, radius in zip(node_ids, radii):
+            skeleton, row = _find_node_or_fail(catmaid, project_id, node_id)
+            updated[str(node_id)] = {'old': float(skeleton['nodes']['radius'][row]),
+                                     'new': float(radius)}
+            skeleton['nodes']['radius'][row] = float(radius)
+            skeleton['nodes']['edition_time'][row] = time.time()
+    return {'success': True, 'updated_nodes': updated}
+
+
+def _update_parent(catmaid, project_id, groups, params):
+    node_id, parent_id = int(groups[0]), int(params['parent_id'])
+    skeleton, row = _find_node_or_fail(catmaid, project_id, node_id)
+    parent_skeleton, parent_row = _find_node_or_fail(catmaid, project_id, parent_id)
+    if parent_skeleton is not skeleton:
+        raise ValueError('A node\'s parent must be in the same skeleton')
+    with catmaid.lock:
+        parents = dict(zip(skeleton['nodes']['id'].tolist(),
+                           skeleton['nodes']['parent'].tolist()))
+        ancestor = parent_id
+        while ancestor >= 0:
+            if ancestor == node_id:
+                raise ValueError(f'Making {parent_id} the parent of {node_id}'
+                                 ' would make a loop')
+            ancestor = parents[ancestor]
+        skeleton['nodes']['parent'][row] = parent_id
+        skeleton['nodes']['edition_time'][row] = time.time()
+    return {'success': True, 'node_id': node_id, 'parent_id': parent_id,
+            'edition_time': _iso(time.time())}
+
+
+def _delete_treenode(catmaid, project_id, groups, params):
+    node_id = int(params['treenode_id'])
+    skeleton, row = _find_node_or_fail(catmaid, project_id, node_id)
+    with catmaid.lock:
+        nodes = skeleton['nodes']
+        parent_id = int(nodes['parent'][row])
+        children = nodes['parent'] == node_id
+        if parent_id < 0 and children.any():
+            raise ValueError('Can\'t delete the root node of a skeleton'
+                             ' that has other nodes')
+        # Like CATMAID, attach the node's children to its parent
+        nodes['parent'][children] = parent_id
+        keep = nodes['id'] != node_id
+        for key in nodes:
+            nodes[key] = nodes[key][keep]
+        skeleton['tags'] = {tag: [n for n in ids if n != node_id]
+                            for tag, ids in skeleton['tags'].items()}
+        skeleton['tags'] = {tag: ids for tag, ids in skeleton['tags'].items() if ids}
+        skeleton['deletion_time'] = time.time()
+        removed_links = [c for c in skeleton['connectors'] if c[1] == node_id]
+        skeleton['connectors'] = [c for c in skeleton['connectors'] if c[1] != node_id]
+        _free_unlinked_connectors(catmaid, project_id, removed_links)
+    return {'success': 'Removed treenode successfully.', 'parent_id': parent_id,
+            'skeleton_id': node_id // ID_STRIDE, 'deleted_neuron': False}
+
+
+def _free_unlinked_connectors(catmaid, project_id, removed_links):
+    """Keep connectors that just lost their last link, like CATMAID does."""
+    # Skeletons that haven't been loaded yet haven't been changed either
+    linked = {c[0] for skeleton in catmaid.get_skeletons(project_id).values()
+              if skeleton['nodes'] is not None for c in skeleton['connectors']}
+    for c in removed_links:
+        if c[0] not in linked:
+            catmaid.projects[project_id]['free_connectors'][c[0]] = list(c[3:6])
+    catmaid.projects[project_id]['connector_table'] = None
+
+
+def _delete_link(catmaid, project_id, groups, params):
+    node_id, connector_id = int(params['treenode_id']), int(params['connector_id'])
+    skeleton, row = _find_node_or_fail(catmaid, project_id, node_id)
+    with catmaid.lock:
+        removed_links = [c for c in skeleton['connectors']
+                         if c[0] == connector_id and c[1] == node_id]
+        if len(removed_links) == 0:
+            raise ValueError(f'No link between node {node_id} and connector'
+                             f' {connector_id}')
+        skeleton['connectors'] = [c for c in skeleton['connectors']
+                                  if not (c[0] == connector_id and c[1] == node_id)]
+        _free_unlinked_connectors(catmaid, project_id, removed_links)
+    return {'link_id': catmaid.new_id(),
+            'result': 'Removed treenode to connector link'}
+
+
+def _delete_connector(catmaid, project_id, groups, params):
+    connector_id = int(params['connector_id'])
+    with catmaid.lock:
+        for skeleton in catmaid.get_skeletons(project_id).values():
+            if skeleton['nodes'] is not None:
+                skeleton['connectors'] = [c for c in skeleton['connectors']
+                                          if c[0] != connector_id]
+        catmaid.projects[project_id]['free_connectors'].pop(connector_id, None)
+        catmaid.projects[project_id]['connector_table'] = None
+    return {'message': 'Removed connector and class_instances',
+            'connector_id': connector_id}
+
+
+ROUTES = [  # (method, endpoint regex, handler). Endpoints follow the project ID.
+    ('GET', r'', _root),
+    ('GET', r'projects', _projects),
+    ('GET', r'user-list', _user_list),
+    ('GET', r'annotations', _annotation_list),
+    ('POST', r'annotations/query-targets', _query_targets),
+    ('POST', r'skeleton/annotationlist', _skeleton_annotations),
+    ('POST', r'skeleton/neuronnames', _neuron_names),
+    ('POST', r'neurons/from-models', _neuron_ids),
+    ('GET', r'skeletons/(\d+)/compact-detail', _compact_detail),
+    ('GET', r'skeletons/(\d+)/node-overview', _node_overview),
+    ('POST', r'skeletons/summary', _skeleton_summaries),
+    ('GET', r'labels/stats', _label_list),
+    ('GET', r'labels', _label_names),
+    ('GET', r'skeleton/node/(\d+)/node_count', _node_count),
+    ('POST', r'treenodes/compact-detail', _find_nodes),
+    ('POST', r'labels-for-nodes', _node_labels),
+    ('POST', r'node/user-info', _node_details),
+    ('POST', r'connectors', _connectors),
+    ('GET', r'connectors/types', _connector_types),
+    ('POST', r'connector/skeletons', _connector_details),
+    ('POST', r'connectors/in-bounding-box', _connectors_in_bbox),
+    ('GET', r'volumes', _volume_list),
+    ('GET', r'volumes/(\d+)', _volume_details),
+    ('POST', r'skeletons/import', _import_skeleton),
+    ('POST', r'annotations/add', _add_annotations),
+    ('POST', r'annotations/remove', _remove_annotations),
+    ('POST', r'label/(?:treenode|connector)/(\d+)/update', _add_node_tags),
+    ('POST', r'connector/create', _create_connector),
+    ('POST', r'link/create', _create_link),
+    ('POST', r'link/delete', _delete_link),
+    ('POST', r'connector/delete', _delete_connector),
+    ('POST', r'neurons/(\d+)/rename', _rename_neuron),
+    ('POST', r'treenode/create', _create_treenode),
+    ('POST', r'treenode/delete', _delete_treenode),
+    ('POST', r'node/update', _update_nodes),
+    ('POST', r'treenodes/radius', _update_radii),
+    ('POST', r'treenodes/(\d+)/parent', _update_parent),
+    ('GET', r'fake-server/request-counts', _request_counts),
+]
+
+
+def make_fake_catmaid_server(port=8000, host='127.0.0.1', latency=0):
+    """
+    Make (but don't start) a fake CATMAID server. latency is a delay in
+    seconds added to every request, to mimic the round trip to a real server.
+    """
+    server = ThreadingHTTPServer((host, port), FakeCatmaidHandler)
+    server.daemon_threads = True
+    server.server_url = f'http://{host}:{server.server_address[1]}'
+    server.catmaid = FakeCatmaid(server.server_url)
+    server.RequestHandlerClass = type('Handler', (FakeCatmaidHandler,), {
+        'catmaid': server.catmaid, 'latency': latency})
+    return server
+
+
+def start_fake_catmaid_server(port=8000, host='127.0.0.1', latency=0):
+    """
+    Start a fake CATMAID server in a background thread and return it. Call
+    server.shutdown() to stop it. Use port=0 to pick any free port, then find
+    the address to connect to in server.server_url.
+    """
+    server = make_fake_catmaid_server(port=port, host=host, latency=latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    n_skeletons = {pid: len(server.catmaid.get_skeletons(pid))
+                   for pid in server.catmaid.projects}
+    print(f'Fake CATMAID server running at {server.server_url} with'
+          f' {n_skeletons} skeletons per project', flush=True)
+    return server
+
+
+def get_request_counts(server_url, reset=False):
+    """
+    Number of requests a fake CATMAID server has received for each endpoint
+    (since the last reset=True call). Works for servers running in another
+    process too.
+    """
+    url = f"{server_url.rstrip('/')}/fake-server/request-counts?reset={reset}"
+    with urllib.request.urlopen(url) as response:
+        return Counter(json.load(response))
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+    server = start_fake_catmaid_server(port=port, latency=latency)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
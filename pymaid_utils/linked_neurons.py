@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# Requires python 3.6+ for f-strings
+
+# Finds the neurons linked to each other by the 'LINKED NEURON - ...'
+# annotations that manipulate_and_reupload_catmaid_neurons.py gives to every
+# neuron it uploads. Such an annotation on a neuron in the target project
+# records which source neuron it was made from and how:
+#   LINKED NEURON - {relation} skeleton id {skid} in project id {pid} on server {server}
+# Every linking annotation in a project is parsed in one go from the
+# project's annotation index (see annotation_index.py), so resolving the
+# linked neurons of any number of source neurons takes at most the single
+# request needed to build that index.
+#
+# Links can chain - e.g. a neuron is elastically transformed to the target
+# project, and that transformed neuron is then pruned within the target
+# project - so the links form a graph. plan_updates(skids) walks that graph
+# from some source neurons and works out which linked neurons need updating,
+# and in which order, so that every neuron is updated after the neuron it's
+# made from.
+#
+# When this file is imported during package initialization (see __init__.py),
+# it's given access to the package's source_project and target_project.
+
+import time
+
+import pandas as pd
+
+try:
+    from .annotation_index import get_annotation_index
+    from .skeleton_store import get_edition_states
+except:
+    from annotation_index import get_annotation_index
+    from skeleton_store import get_edition_states
+
+
+LINKING_ANNOTATION_PATTERN = (r'^LINKED NEURON - (?:(?P<relation>.+?) )?'
+                              r'skeleton id (?P<source_skid>\d+) in project id'
+                              r' (?P<source_project_id>\d+) on server'
+                              r' (?P<source_server>.+)$')
+LINK_COLUMNS = ['annotation', 'relation', 'source_skid', 'source_project_id',
+                'source_server', 'skid']
+UPDATE_ANNOTATION_PREFIX = 'UPDATED FROM LINKED NEURON - '
+UPDATE_ANNOTATION_TIME_FORMAT = '%Y-%m-%d %I:%M %p'
+# Rough number of requests that updating one linked neuron sends, counted
+# with benchmarks/benchmark_fake_server_workflows.py, plus extra requests
+# for relations that download more (e.g. the volume to prune by)
+REQUESTS_PER_UPDATE = 12
+EXTRA_REQUESTS_PER_RELATION = {
+    'pruned (first entry, last exit) by vol 109 of': 2
+}
+
+
+def parse_linking_annotations(annotations):
+    """
+    Parse 'LINKED NEURON - ...' annotations into a DataFrame with columns
+    annotation, relation, source_skid, source_project_id and source_server.
+    Other annotations are left out. relation is '' for links made without
+    one.
+    """
+    annotations = pd.Series(list(annotations), dtype=object)
+    annotations = annotations[annotations.str.startswith('LINKED NEURON - ')]
+    links = annotations.str.extract(LINKING_ANNOTATION_PATTERN)
+    links.insert(0, 'annotation', annotations)
+    links = links.dropna(subset=['source_skid']).reset_index(drop=True)
+    links['relation'] = links.relation.fillna('')
+    links['source_skid'] = links.source_skid.astype(int)
+    links['source_project_id'] = links.source_project_id.astype(int)
+    return links
+
+
+def get_links(remote_instance='target'):
+    """
+    Every link into the given project (default: target project), as a
+    DataFrame with one row per linked neuron in that project: the linking
+    annotation, its parsed fields, and the linked neuron's skid.
+    """
+    index = get_annotation_index(_eval_remote_instance(remote_instance))
+    links = parse_linking_annotations(index.annotations)
+    skids = [sorted(index.skids_by_annotation[annot])
+             for annot in links.annotation]
+    links['skid'] = pd.Series(skids, index=links.index, dtype=object)
+    links = links.explode('skid').dropna(subset=['skid'])
+    links['skid'] = links.skid.astype(int)
+    return links[LINK_COLUMNS].reset_index(drop=True)
+
+
+def find_linked_neurons(source_skids, source_project_id=None,
+                        remote_instance='target'):
+    """
+    The neurons in remote_instance (default: target project) linked to any of
+    the given skeletons in the source project (or in source_project_id, if
+    given), as a DataFrame like get_links returns. Like the linking
+    annotations themselves, this doesn't check which server the source
+    project is on.
+    """
+    if isinstance(source_skids, (int, str)):
+        source_skids = [source_skids]
+    if source_project_id is None:
+        source_project_id = source_project.project_id
+    links = get_links(remote_instance)
+    is_requested = (links.source_skid.isin([int(skid) for skid in source_skids])
+                    & (links.source_project_id == int(source_project_id)))
+    return links[is_requested].reset_index(drop=True)
+
+
+def get_last_update_times(skids, remote_instance='target'):
+    """
+    The time (in seconds since the epoch) of each skeleton's most recent
+    'UPDATED FROM LINKED NEURON' annotation, as a dict of skid -> time, or
+    skid -> None for skeletons that have none.
+    """
+    annots = get_annotation_index(_eval_remote_instance(remote_instance)
+                                  ).get_annotations(skids)
+    update_times = {}
+    for skid in skids:
+        times = []
+        for annot in annots.get(str(int(skid)), []):
+            if annot.startswith(UPDATE_ANNOTATION_PREFIX):
+                try:
+                    times.append(time.mktime(time.strptime(
+                        annot[len(UPDATE_ANNOTATION_PREFIX):],
+                        UPDATE_ANNOTATION_TIME_FORMAT)))
+                except ValueError:
+                    pass
+        update_times[int(skid)] = max(times) if len(times) > 0 else None
+    return update_times
+
+
+def plan_updates(skids, relations=None, skip_unchanged=True, verbose=True):
+    """
+    Work out how pushing updates from the given source project skeletons
+    propagates through the neurons linked to them in the target project,
+    including neurons linked to those linked neurons, and so on.
+
+    Returns a DataFrame with one row per link to follow, sorted by depth: 0
+    for neurons linked directly to the given skeletons, 1 for neurons linked
+    to those, etc. Updating all rows of one depth before moving on to the
+    next means every neuron is updated after the neuron it's made from,
+    including when it's reachable along paths of different lengths. Its
+    action column is one of:
+      'update'
+      'skip (unchanged)' - with skip_unchanged=True, the neuron it's made
+        from wasn't edited since it was last updated, and isn't being
+        updated itself. Edition times only reflect skeleton edits, so use
+        skip_unchanged=False when pushing annotation changes.
+      'skip (unknown relation)' - the relation isn't in relations
+      'skip (multiple linked neurons)' - the linking annotation is on more
+        than one neuron, which needs fixing by hand
+    and estimated_requests is roughly how many requests the update sends.
+    Neurons downstream of a skipped neuron can still need updating.
+    """
+    if isinstance(skids, (int, str)):
+        skids = [skids]
+    source_pid = int(source_project.project_id)
+    target_pid = int(target_project.project_id)
+    links = get_links(target_project)
+    n_linked = links.groupby('annotation').skid.transform('size')
+    links = links.assign(n_linked=n_linked.values)
+    # The links out of each neuron, keyed by (project id, skid)
+    links_by_source = {key: group for key, group in
+                       links.groupby(['source_project_id', 'source_skid'])}
+
+    # Find every neuron downstream of the given skeletons, and give each one
+    # the depth of the longest path to it, so it comes after all its sources
+    roots = [(source_pid, int(skid)) for skid in skids]
+    depths = {}
+    queue = [(root, -1) for root in roots]
+    while len(queue) > 0:
+        next_queue = []
+        for (pid, skid), depth in queue:
+            for i, link in links_by_source.get((pid, skid), links.iloc[:0]).iterrows():
+                child = (target_pid, int(link.skid))
+                if child in roots:
+                    continue
+                if depth + 1 > depths.get(child, -1):
+                    depths[child] = depth + 1
+                    if depths[child] > len(links):
+                        raise ValueError('The linking annotations form a cycle'
+                                         f' through skeleton {child[1]}')
+                    next_queue.append((child, depth + 1))
+        queue = next_queue
+    rows = []
+    for key, group in links_by_source.items():
+        if key in roots or key in depths:
+            for i, link in group.iterrows():
+                if (target_pid, int(link.skid)) in depths:
+                    rows.append(link.to_dict())
+                    rows[-1]['depth'] = depths[(target_pid, int(link.skid))]
+    plan = pd.DataFrame(rows, columns=['depth'] + LINK_COLUMNS + ['n_linked'])
+    plan = plan.sort_values(['depth', 'source_project_id', 'source_skid']
+                            ).reset_index(drop=True)
+
+    plan['action'] = 'update'
+    if relations is not None:
+        plan.loc[~plan.relation.isin(relations), 'action'] = 'skip (unknown relation)'
+    plan.loc[plan.n_linked != 1, 'action'] = 'skip (multiple linked neurons)'
+    plan = plan.drop(columns='n_linked')
+
+    if skip_unchanged:
+        # Level by level, compare the last edit of each source neuron that
+        # isn't itself being updated with the last update of its linked neuron
+        last_updates = get_last_update_times(plan.skid, target_project)
+        updated = set()
+        for depth in plan.depth.unique():
+            level = plan[(plan.depth == depth) & (plan.action == 'update')]
+            sources = set(zip(level.source_project_id, level.source_skid))
+            unknown = [key for key in sources if key not in updated]
+            last_edits = {}
+            for pid in set(pid for pid, skid in unknown):
+                instance = source_project if pid == source_pid else target_project
+                states = get_edition_states([skid for p, skid in unknown if p == pid],
+                                            remote_instance=instance)
+                last_edits.update({(pid, skid): state['last_edited'] if state else None
+                                   for skid, state in states.items()})
+            for i, link in level.iterrows():
+                source = (link.source_project_id, link.source_skid)
+                last_edit = last_edits.get(source, None)
+                last_update = last_updates[int(link.skid)]
+                if (source not in updated and last_edit is not None
+                        and last_update is not None and last_edit < last_update):
+                    plan.loc[i, 'action'] = 'skip (unchanged)'
+                else:
+                    updated.add((target_pid, int(link.skid)))
+
+    plan['estimated_requests'] = [
+        REQUESTS_PER_UPDATE + EXTRA_REQUESTS_PER_RELATION.get(relation, 0)
+        if action == 'update' else 0
+        for relation, action in zip(plan.relation, plan.action)
+    ]
+    if verbose:
+        print_update_plan(plan)
+    return plan
+
+
+def print_update_plan(plan):
+    """Summarize a plan from plan_updates, depth by depth."""
+    print(f'Update plan: {(plan.action == "update").sum()} of {len(plan)}'
+          f' linked neurons to update, in {plan.depth.nunique()} steps,'
+          f' ~{plan.estimated_requests.sum()} requests')
+    for depth, level in plan.groupby('depth'):
+        actions = ', '.join([f'{n} {action}' for action, n in
+                             level.action.value_counts().items()])
+        relations = ', '.join([f"{n} '{relation}'" for relation, n in
+                               level[level.action == 'update'].relation.value_counts().items()])
+        print(f'  Step {depth + 1}: {actions} (~{level.estimated_requests.sum()}'
+              f' requests){": " + relations if relations else ""}')
+
+
+def _eval_remote_instance(remote_instance):
+    if remote_instance in [None, 'source']:
+        return source_project
+    elif remote_instance == 'target':
+        return target_project
+    return remote_instance
@@ -7,6 +7,11 @@ import numpy as np
 import pandas as pd
 import pymaid
 
+try:
+    from .annotation_index import get_annotation_index
+except:
+    from annotation_index import get_annotation_index
+
 
 def write_catmaid_json(skids_to_colors, filename):
     """
@@ -90,10 +95,9 @@ def make_json_by_annotations(annotations_to_colors, filename,
         for annotation_list in annotation_lists:
             annotation_list.extend(always_include)
             print(annotation_list)
-            skids = pymaid.get_skids_by_annotation(
-                annotations=annotation_list,
-                intersect=True,
-                remote_instance=source_project
+            skids = get_annotation_index(source_project).get_skids(
+                annotation_list,
+                intersect=True
             )
             print('Found {} neurons'.format(len(skids)))
             for skid in skids:
@@ -142,10 +146,9 @@ def make_rainbow_json_by_position(annotations,
     if 'neurons' in kwargs:
         neurons = kwargs['neurons']
     else:
-        skids = pymaid.get_skids_by_annotation(
+        skids = get_annotation_index(source_project).get_skids(
                     annotations,
-                    intersect=True,
-                    remote_instance=source_project
+                    intersect=True
                 )
         # TODO can I avoid pulling all this neuron data if I only need the root
         # position? Is there a way to pull less data even if I need the nodes?
@@ -438,10 +441,9 @@ def makejson_T1bCS_near_lProLN_MNs(kind=None,
     elif flipped is True:
         always_include.append('left-right flipped')
 
-    lT1mn_skids = pymaid.get_skids_by_annotation(
+    lT1mn_skids = get_annotation_index(source_project).get_skids(
         ['left T1 leg nerve', 'motor neuron'] + always_include,
-        intersect=True,
-        remote_instance=source_project
+        intersect=True
     )
     addons = {skid: ('#b7b7b7', 0.6) for skid in lT1mn_skids}
     return make_json_by_annotations(
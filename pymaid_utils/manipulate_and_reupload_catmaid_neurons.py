@@ -10,46 +10,110 @@
 # 'manipulate_and_reupload_catmaid_neurons.source_project = your_instance'
 
 import os
+import re
 import time
 import json
-import subprocess
+import shutil
+import tempfile
+import threading
+import sys
+import contextlib
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pandas as pd
 import numpy as np
 
 try:
     from .connections import connect_to_catmaid
-    from .connections import clear_cache
+    from .connections import clear_cache, response_cache
+    from .connections import counting_modifications
+    from .skeleton_store import sync, get_edition_states, _to_seconds
+    from .annotation_index import get_annotation_index
+    from .linked_neurons import find_linked_neurons, plan_updates
+    from .linked_neurons import get_last_update_times
+    from .policies import get_policy, PolicyAbort
+    from .skeleton_diff import diff_skeletons, apply_skeleton_diff
+    from .skeleton_diff import parse_node_overview, get_live_connectors
+    from .skeleton_graph import SkeletonGraph, BRANCH_NODE, SLAB_NODE
+    from .skeleton_graph import PRIMARY_NEURITE_NODE
 except:
     from connections import connect_to_catmaid
-    from connections import clear_cache
+    from connections import clear_cache, response_cache
+    from connections import counting_modifications
+    from skeleton_store import sync, get_edition_states, _to_seconds
+    from annotation_index import get_annotation_index
+    from linked_neurons import find_linked_neurons, plan_updates
+    from linked_neurons import get_last_update_times
+    from policies import get_policy, PolicyAbort
+    from skeleton_diff import diff_skeletons, apply_skeleton_diff
+    from skeleton_diff import parse_node_overview, get_live_connectors
+    from skeleton_graph import SkeletonGraph, BRANCH_NODE, SLAB_NODE
+    from skeleton_graph import PRIMARY_NEURITE_NODE
 import pymaid
 from pymaid import morpho
+import navis  # pymaid's neurons are navis neurons
 pymaid.set_loggers(40)
 # Default logger level is 20, INFO. Changed to 40, ERROR, to suppress cached
 # data notices and annotation-not-found warnings, which are handled explicitly
 # here. See https://docs.python.org/3/library/logging.html#levels
 
 
+def _load_transform_chain():
+    # Chains elastix transforms (applied without running transformix) with the
+    # other steps between coordinate spaces. template_registration_pipeline
+    # isn't a package, so transform_chain.py is loaded by its file path rather
+    # than by adding its folder to sys.path. It's registered in sys.modules
+    # like a normal import, so scripts that import it the usual way (e.g.
+    # warp_points_between_FANC_and_template.py) share its TransformChain class
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'template_registration_pipeline', 'transform_chain.py')
+    module = sys.modules.get('transform_chain', None)
+    if module is not None and os.path.abspath(getattr(module, '__file__', '')) == path:
+        return module
+    spec = importlib.util.spec_from_file_location('transform_chain', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['transform_chain'] = module
+    try:
+        spec.loader.exec_module(module)
+    except:
+        del sys.modules['transform_chain']
+        raise
+    return module
+
+
+transform_chain = _load_transform_chain()
+
+
 # ---Constants--- #
 PRIMARY_NEURITE_RADIUS = 500
+# The transform chains in template_registration_pipeline/register_EM_dataset_to_template/transform_chains.json
+# that elastix_parameter_file='V3' and 'V2' stand for
+ELASTIX_TRANSFORM_CHAINS = {'V3': 'FANC_to_template',
+                            'V2': 'FANC_to_template_V2'}
 
 
 # -------pymaid wrappers------- #
 def get_skids_by_annotation(annotations, remote_instance=None):
+    # Looked up in the session's annotation index (see annotation_index.py)
+    # instead of asking the server each time
     if remote_instance in [None, 'source']:
         remote_instance = source_project
     elif remote_instance == 'target':
         remote_instance = target_project
 
-    return pymaid.get_skids_by_annotation(
+    return get_annotation_index(remote_instance).get_skids(
         annotations,
-        intersect=True,
-        remote_instance=remote_instance
+        intersect=True
     )
 
 
-def find_unlinked_connectors(remote_instance=None):
+def find_unlinked_connectors(remote_instance=None, connector_ids=None):
+    """
+    IDs of the connectors in a project that have no links. With
+    connector_ids, only those connectors are checked, which takes one or two
+    requests however big the project is.
+    """
     if remote_instance is None:
         try:
             remote_instance = target_project
@@ -58,6 +122,24 @@ def find_unlinked_connectors(remote_instance=None):
             remote_instance = source_project
             print('Searching for unlinked connectors in source project.')
 
+    if connector_ids is not None:
+        connector_ids = sorted({int(c) for c in connector_ids})
+        if len(connector_ids) == 0:
+            return []
+        with response_cache.bypassed():  # Must see the server's current state
+            details = pymaid.get_connector_details(connector_ids,
+                                                   remote_instance=remote_instance)
+            linked = set(details.connector_id.astype(int)) if len(details) > 0 else set()
+            unlinked = [c for c in connector_ids if c not in linked]
+            # Deleted connectors have no links either, so only keep the ones
+            # that still exist
+            if len(unlinked) > 0:
+                existing = pymaid.get_node_details(unlinked,
+                                                   remote_instance=remote_instance)
+                existing = set(existing.node_id.astype(int)) if len(existing) > 0 else set()
+                unlinked = [c for c in unlinked if c in existing]
+        return unlinked
+
     all_connectors = pymaid.get_connectors(None, remote_instance=remote_instance)
     # A connector's type being null seems to indicate it is unlinked.
     # I'm not confident this will always be true in future versions of pymaid
@@ -78,18 +160,14 @@ def push_all_updates_by_annotations(annotations, fake=True, **kwargs):
     """
     kwargs['fake'] = fake
     skids = get_skids_by_annotation(annotations)
-    try:
-        user_input = input(f'Found {len(skids)} source project neurons.'
-            ' Continue? [Y/n] ')
-    except:
-        skids = [skids]
-        user_input = input('Found 1 source project neuron. Continue? [Y/n] ')
-    if user_input not in ('y', 'Y'):
+    if get_policy(kwargs.get('policy')).decide(
+            'confirm_batch', f'Found {len(skids)} source project neurons.') == 'skip':
         return
     push_all_updates_by_skid(skids, **kwargs)
 
 
-def push_all_updates_by_skid(skids, recurse=False, fake=True, **kwargs):
+def push_all_updates_by_skid(skids, recurse=False, fake=True,
+                             skip_unchanged=False, **kwargs):
     """
     For each neuron in the source project with one of the given skids,
     search in the target project for neurons that are linked to it, and
@@ -97,13 +175,21 @@ def push_all_updates_by_skid(skids, recurse=False, fake=True, **kwargs):
     manipulate_and_reupload_catmaid_neuron function as specified by the
     linking relation in the "LINKED NEURON" annotation.
 
-    If recurse=True and this function succeeds in performing an update, it
-    will then push_all_updates on that updated neuron to try to
-    propagate changes through any chains of linked neurons. This
-    recursion only happens within the target project. If you need to
-    push the updated neuron to a different project, do that manually.
+    If recurse=True, updates are also propagated through any chains of
+    linked neurons in the target project, following the plan from
+    linked_neurons.plan_updates: all neurons at the same distance from the
+    source neurons are updated together, in order of distance. With
+    skip_unchanged=True, linked neurons whose source neuron wasn't edited
+    since their last update are skipped. With recurse=True and fake=True,
+    nothing is updated and the plan is returned instead. This recursion only
+    happens within the target project. If you need to push the updated
+    neuron to a different project, do that manually.
+
+    Pass policy=policies.Policy(...) to decide in advance what to do
+    instead of prompting (see policies.py). It's passed on to every upload.
     """
     kwargs['fake'] = fake
+    policy = kwargs['policy'] = get_policy(kwargs.get('policy'))
     kwargs['refuse_to_update'] = False  # Since this function only does
                                         # updates, refusing to update is
                                         # redundant with 'fake'
@@ -114,7 +200,7 @@ def push_all_updates_by_skid(skids, recurse=False, fake=True, **kwargs):
             lambda skids: elastictransform_neurons_by_skid(skids, **kwargs),
         'elastic transformation and flipped of':
             lambda skids: elastictransform_neurons_by_skid(skids, left_right_flip=True, **kwargs),
-        'pruned \(first entry, last exit\) by vol 109 of':  # Note that the \ MUST be included
+        'pruned (first entry, last exit) by vol 109 of':
             lambda skids: volume_prune_neurons_by_skid(skids, 109, **kwargs),
         'radius pruned of':
             lambda skids: radius_prune_neurons_by_skid(skids, **kwargs)
@@ -130,56 +216,132 @@ def push_all_updates_by_skid(skids, recurse=False, fake=True, **kwargs):
     else:
         skip_dates = []
 
-    all_target_annots = pymaid.get_annotation_list(remote_instance=target_project)
-
-    original_source_project_id = source_project.project_id
     server_responses = []
-    new_skids = skids
-    while len(new_skids) > 0:
-        new_skids = []
-        for source_skid in skids:  # For each skeleton that needs to be pushed
-            target_annots = [add_escapes(annot) for annot in all_target_annots.name
-                             if 'skeleton id '+str(source_skid)+' ' in annot
-                             and 'project id '+str(source_project.project_id)+' 'in annot]
-            #print(target_annots)
-            # For each annotation that indicates a link to the source skid
-            for target_annot in target_annots:
-                target_skids = get_skids_by_annotation(target_annot, remote_instance='target')
-                if len(target_skids) == 0:
-                    continue
-                elif len(target_skids) != 1:
-                    input('WARNING: Multiple neurons in the target project'
+    if recurse:
+        plan = plan_updates(skids, relations=list(link_types),
+                            skip_unchanged=skip_unchanged)
+        if len(skip_dates) > 0:
+            target_skid_annots = get_annotation_index(
+                target_project).get_annotations(plan.skid)
+            recent = pd.Series([any([date in annot for date in skip_dates
+                                     for annot in target_skid_annots.get(str(skid), [])])
+                                for skid in plan.skid], index=plan.index, dtype=bool)
+            plan.loc[recent & (plan.action == 'update'),
+                     'action'] = 'skip (updated recently)'
+        for annot in plan[plan.action == 'skip (multiple linked neurons)'
+                          ].annotation.unique():
+            policy.decide('duplicate_links',
+                          'WARNING: Multiple neurons in the target project'
                           ' with the same linking annotation??? Skipping this'
-                          f' push: {target_annot}')
-                    continue
-                if len(skip_dates) > 0:
-                    this_target_skid_annots = pymaid.get_annotations(
-                            target_skids, remote_instance=target_project)
-                # Check what type of link is indicated by this linking annotation
-                for linking_relation in link_types:
-                    if linking_relation in target_annot:
-                        resp = [f'Skipped: {target_annot}']
-                        print('Found in project id '
-                              f"{target_project.project_id}: '{target_annot}'")
-                        if (len(skip_dates) == 0 or not any([any([date in annot for date in skip_dates]) for
-                            annot in list(this_target_skid_annots.values())[0]])):
-                                resp = link_types[linking_relation](source_skid)
-                        else:
-                            print(f'Skipping upload because was already updated recently')
-                        if recurse and not fake:
-                            #new_skids.append(resp[0]['skeleton_id']) # old
-                            new_skids.append(target_skids[0])
-                        server_responses.extend(resp)
-        if recurse and not fake:
-            source_project.project_id = target_project.project_id
-            skids = new_skids
-            print(f'Recursing - now pushing updates to skids {new_skids}')
-    if recurse and not fake:
-        source_project.project_id = original_source_project_id
-
+                          f' push: {annot}')
+        if fake:
+            print('fake was set to True, so nothing was updated. Set'
+                  ' fake=False to carry out the plan above.')
+            return plan
+        for depth, level in plan[plan.action == 'update'].groupby('depth'):
+            print(f'Pushing updates to {len(level)} neurons at depth {depth}')
+            for (source_pid, linking_relation), links in level.groupby(
+                    ['source_project_id', 'relation'], sort=False):
+                with _source_project_id(source_pid):
+                    server_responses.extend(link_types[linking_relation](
+                        links.source_skid.tolist()))
+        policy.print_summary()
+        return server_responses
+
+    # Resolve every neuron linked to any of the skids at once
+    if skip_unchanged:
+        kwargs['skip_unedited'] = True
+    links = find_linked_neurons(skids, source_project.project_id,
+                                remote_instance=target_project)
+    if len(skip_dates) > 0:
+        target_skid_annots = get_annotation_index(
+            target_project).get_annotations(links.skid)
+    links_by_skid = dict(tuple(links.groupby('source_skid')))
+    for source_skid in skids:  # For each skeleton that needs to be pushed
+        if int(source_skid) not in links_by_skid:
+            continue
+        # For each annotation that indicates a link to the source skid
+        for target_annot, annot_links in links_by_skid[int(source_skid)].groupby(
+                'annotation', sort=False):
+            if len(annot_links) != 1:
+                policy.decide('duplicate_links',
+                              'WARNING: Multiple neurons in the target project'
+                              ' with the same linking annotation??? Skipping'
+                              f' this push: {target_annot}')
+                continue
+            target_skid = int(annot_links.skid.iloc[0])
+            linking_relation = annot_links.relation.iloc[0]
+            # Check what type of link is indicated by this linking annotation
+            if linking_relation not in link_types:
+                continue
+            resp = [f'Skipped: {target_annot}']
+            print('Found in project id '
+                  f"{target_project.project_id}: '{target_annot}'")
+            if (len(skip_dates) == 0 or not any([any([date in annot for date in skip_dates]) for
+                annot in target_skid_annots.get(str(target_skid), [])])):
+                    resp = link_types[linking_relation](source_skid)
+            else:
+                print(f'Skipping upload because was already updated recently')
+            server_responses.extend(resp)
+    policy.print_summary()
     return server_responses
 
 
+class _PerThreadTempfile:
+    """The tempfile module, but each thread gets its own gettempdir()."""
+    def __init__(self):
+        self._local = threading.local()
+        self._dirs = []
+
+    def gettempdir(self):
+        if not hasattr(self._local, 'dir'):
+            self._local.dir = tempfile.mkdtemp(prefix='pymaid_utils_upload_')
+            self._dirs.append(self._local.dir)
+        return self._local.dir
+
+    def __getattr__(self, name):
+        return getattr(tempfile, name)
+
+
+@contextlib.contextmanager
+def _separate_upload_temp_files(workers):
+    """
+    pymaid.upload_neuron writes each neuron to the same temp.swc file before
+    sending it, so uploads running in parallel threads would overwrite each
+    other's files. Give each thread its own temp folder while this is active.
+    Yields the number of workers that can safely be used: 1 if this pymaid
+    doesn't get its temp folder in a way that can be separated.
+    """
+    workers = max(1, workers)
+    upload_module = getattr(pymaid, 'upload', None)
+    if getattr(upload_module, 'tempfile', None) is not tempfile:
+        if workers > 1:
+            print('WARNING: Can\'t give each upload its own temp file with this'
+                  ' version of pymaid, so uploading one neuron at a time'
+                  f' instead of with {workers} workers.')
+        yield 1
+        return
+    per_thread_tempfile = _PerThreadTempfile()
+    upload_module.tempfile = per_thread_tempfile
+    try:
+        yield workers
+    finally:
+        upload_module.tempfile = tempfile
+        for folder in per_thread_tempfile._dirs:
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def _source_project_id(project_id):
+    """Temporarily point source_project at another project."""
+    original_project_id = source_project.project_id
+    source_project.project_id = project_id
+    try:
+        yield
+    finally:
+        source_project.project_id = original_project_id
+
+
 def pull_all_updates_by_annotations(annotations, fake=True):
     """
     For each neuron IN THE TARGET PROJECT that has the given annotations and a
@@ -191,7 +353,7 @@ def pull_all_updates_by_annotations(annotations, fake=True):
 
 
 def pull_all_updates_by_skid(skids, **kwargs):
-    annots = pymaid.get_annotations(skids, remote_instance=target_project)
+    annots = get_annotation_index(target_project).get_annotations(skids)
     link_types = {
         'copy of': lambda skids: copy_neurons_by_skid(skids, **kwargs),
         'translation of': lambda skids: translate_neurons_by_skid(skids, **kwargs),
@@ -227,54 +389,143 @@ def upload_or_update_neurons(neurons,
                              import_connectors=False,
                              reuse_existing_connectors=True,
                              refuse_to_update=True,
+                             skip_unedited=False,
+                             differential=True,
+                             workers=1,
+                             policy=None,
                              verbose=False,
                              fake=True):
+    """
+    Upload each neuron to the target project, or update its linked neuron if
+    it has one. With skip_unedited=True, a linked neuron is only updated if
+    the source skeleton was edited after the linked neuron's last update.
+    This looks at skeleton edits only, so leave it False when pushing
+    annotation changes.
+
+    Everything the checks before each upload need (linked neurons, their
+    nodes' edition times, neuron IDs, the user list) is looked up for all
+    neurons at once before any checks are made. The uploads themselves then
+    run on up to workers threads, with progress reported as they finish.
+    Uploads to the same project at once can race when creating a new
+    annotation, so only raise workers when that isn't a concern.
+
+    With differential=True (the default), a linked neuron is updated by
+    editing only the nodes, tags and (with import_connectors) connector links
+    that differ from the source neuron, as worked out by
+    skeleton_diff.diff_skeletons, instead of replacing its whole skeleton.
+    Updates the diff can't handle well fall back to a full re-upload.
+
+    Whenever a human would need to decide something (e.g. whether to throw
+    away hand edits to a linked neuron), policy (a policies.Policy, or by
+    default policies.default_policy) says what to do, and records the
+    decision in its report.
+    """
+    policy = get_policy(policy)
     server_responses = []
     start_day = time.strftime('%Y-%m-%d')
-    start_time = time.strftime('%Y-%m-%d %I:%M %p')
+    phase_times = {}
+    phase_start = time.perf_counter()
 
     if type(neurons) is pymaid.core.CatmaidNeuron:
         neurons = pymaid.core.CatmaidNeuronList(neurons)
 
-    # There are some pesky corner cases where updates will unintentionally create unlinked
-    # connectors. When that occurs, the user is warned and asked to investigate manually.
-    unlinked_connectors_start = find_unlinked_connectors(remote_instance=target_project)
-
-    for source_neuron in neurons:
-        clear_cache()
+    if linking_relation is '':
+        linking_annotation_template = 'LINKED NEURON - skeleton id {skid} in project id {pid} on server {server}'
+    else:
+        linking_annotation_template = 'LINKED NEURON - {relation} skeleton id {skid} in project id {pid} on server {server}'
+
+    # ---Pre-flight: bulk lookups for all neurons--- #
+    # Neurons download their own annotations, one request each, when first
+    # asked for them, so look them all up at once instead
+    not_loaded = [neuron for neuron in neurons
+                  if '_annotations' not in neuron.__dict__]
+    if len(not_loaded) > 0:
+        source_annots = get_annotation_index(source_project).get_annotations(
+            [neuron.skeleton_id for neuron in not_loaded])
+        for neuron in not_loaded:
+            neuron.annotations = source_annots.get(str(neuron.skeleton_id), [])
+
+    # Check if a neuron/skeleton with each neuron's linking annotation already
+    # exists in the target project. If so, replace that neuron/skeleton's data
+    # with this neuron's data.
+    target_index = get_annotation_index(target_project)
+    linking_annotations = [linking_annotation_template.format(
+        relation=linking_relation,
+        skid=source_neuron.skeleton_id,
+        name=source_neuron.neuron_name, #Not used currently
+        pid=source_project.project_id,
+        server=source_project.server
+    ) for source_neuron in neurons]
+    linked_neuron_skids = [target_index.get_skids(annot, raise_not_found=False)
+                           for annot in linking_annotations]
+    linked_skids = [skids[0] for skids in linked_neuron_skids if len(skids) == 1]
+
+    linked_names, neuron_ids, edited_nodes = {}, {}, {}
+    live_skeletons, live_connectors = {}, {}
+    last_updates, source_states = {}, {}
+    if len(linked_skids) > 0:
+        with response_cache.bypassed():  # Must see the server's current state
+            linked_names = pymaid.get_names(linked_skids,
+                                            remote_instance=target_project)
+    if len(linked_skids) > 0 and not refuse_to_update:
+        with response_cache.bypassed():
+            neuron_ids = pymaid.get_neuron_id(linked_skids,
+                                              remote_instance=target_project)
+            node_overviews = target_project.fetch(
+                [target_project._get_skeleton_nodes_url(skid) for skid in linked_skids],
+                desc='Get linked neurons'
+            )
+        last_updates = get_last_update_times(linked_skids, target_project)
+        # Node rows are [id, parent_id, confidence, x, y, z, radius, creator,
+        # edition_time]. Nodes edited after the neuron was first uploaded
+        # were edited by hand, unless an update made the edit: updates are
+        # annotated once they're done, to the minute.
+        edited_node_skids = {}
+        for skid, node_overview in zip(linked_skids, node_overviews):
+            nodes = node_overview[0]
+            if differential:
+                live_skeletons[skid] = parse_node_overview(node_overview)
+            if len(nodes) == 0:
+                continue
+            first_edition = min([node[8] for node in nodes])
+            last_update = last_updates[skid]
+            edited_node_skids.update({
+                node[0]: skid for node in nodes if node[8] != first_edition
+                and (last_update is None or _to_seconds(node[8]) > last_update + 60)
+            })
+        if len(edited_node_skids) > 0:
+            with response_cache.bypassed():
+                node_details = pymaid.get_node_details(
+                    list(edited_node_skids), remote_instance=target_project)
+                users = pymaid.get_user_list(remote_instance=target_project).set_index('id')
+            node_details = node_details[['node_id', 'edition_time', 'editor']].copy()
+            node_details['editor'] = [users.loc[user_id, 'login'] for
+                                      user_id in node_details.editor]
+            node_details['skid'] = node_details.node_id.astype(int).map(edited_node_skids)
+            edited_nodes = {skid: nodes.drop(columns='skid') for skid, nodes
+                            in node_details.groupby('skid')}
+        if differential and import_connectors:
+            with response_cache.bypassed():
+                live_connectors = {skid: get_live_connectors(skid, target_project)
+                                   for skid in linked_skids}
+        if skip_unedited:
+            source_states = get_edition_states(
+                [neuron.skeleton_id for neuron, skids in
+                 zip(neurons, linked_neuron_skids) if len(skids) == 1],
+                remote_instance=source_project
+            )
+    phase_times['pre-flight'] = time.perf_counter() - phase_start
+    phase_start = time.perf_counter()
 
-        # Check if a neuron/skeleton with this neuron's name already exists in the target project
-        # If so, replace that neuron/skeleton's data with this neuron's data.
+    # ---Checks, one neuron at a time--- #
+    uploads = []  # (source_neuron, skid_to_update, nid_to_update, force_id, diff)
+    for source_neuron, linking_annotation_target, linked_neuron_skid in zip(
+            neurons, linking_annotations, linked_neuron_skids):
         skid_to_update = None
         nid_to_update = None
         force_id = False
-
-        if linking_relation is '':
-            linking_annotation_template = 'LINKED NEURON - skeleton id {skid} in project id {pid} on server {server}'
-        else:
-            linking_annotation_template = 'LINKED NEURON - {relation} skeleton id {skid} in project id {pid} on server {server}'
-
-        linking_annotation_target = linking_annotation_template.format(
-            relation=linking_relation,
-            skid=source_neuron.skeleton_id,
-            name=source_neuron.neuron_name, #Not used currently
-            pid=source_project.project_id,
-            server=source_project.server
-        )
-        if verbose: print("Linking annotation is: '{linking_annotation_target}'")
-
-        try:
-            linked_neuron_skid = pymaid.get_skids_by_annotation(
-                add_escapes(linking_annotation_target),
-                raise_not_found=False,
-                remote_instance=target_project
-            )
-        except Exception as e:
-            # There appears to be a bug in get_skids_by_annotation where it still
-            # raises exceptions sometimes even with raise_not_found=False, so
-            # use this block to continue through any of those cases without raising.
-            #print(e)
-            linked_neuron_skid = []
+        diff = None
+        if verbose: print(f"Linking annotation is: '{linking_annotation_target}'")
 
         source_neuron.annotations = [annot for annot in
             source_neuron.annotations if 'LINKED NEURON' not in annot]
@@ -283,18 +534,16 @@ def upload_or_update_neurons(neurons,
             print(f'Uploading "{source_neuron.neuron_name}" to project'
                   f' {target_project.project_id} as a new skeleton.')
             source_neuron.annotations.append(linking_annotation_target)
-            source_neuron.annotations.append(
-                f'UPDATED FROM LINKED NEURON - {start_time}')
         elif len(linked_neuron_skid) is not 1:
             print('Found multiple neurons annotated with'
                   f' "{linking_annotation_target}" in target project.'
                   ' Go fix that! Skipping upload for this neuron.')
         else:  # Prepare to update the linked neuron
-            linked_neuron = pymaid.get_neuron(linked_neuron_skid[0],
-                                              remote_instance=target_project)
+            linked_skid = linked_neuron_skid[0]
+            linked_name = linked_names.get(str(linked_skid), None)
             m = ', connectors,' if import_connectors else ''
             print(f'{source_neuron.neuron_name}: Found linked neuron with '
-                  f'skeleton ID {linked_neuron.skeleton_id} in target project.'
+                  f'skeleton ID {linked_skid} in target project.'
                   f' Updating its treenodes{m} and annotations to match the'
                   ' source neuron.')
             if refuse_to_update:
@@ -302,118 +551,242 @@ def upload_or_update_neurons(neurons,
                 continue
 
             # Check whether names match
-            if not source_neuron.neuron_name == linked_neuron.neuron_name:
-                user_input = input(
-                    'WARNING: The linked neuron\'s name is'
-                    f' "{linked_neuron.neuron_name}" but was expected to be'
-                    f' "{source_neuron.neuron_name}". Continuing will rename'
-                    ' the linked neuron to the expected name. Proceed? [Y/n]')
-                if user_input not in ('y', 'Y'):
+            if not source_neuron.neuron_name == linked_name:
+                if policy.decide(
+                        'name_mismatch',
+                        'WARNING: The linked neuron\'s name is'
+                        f' "{linked_name}" but was expected to be'
+                        f' "{source_neuron.neuron_name}". Continuing will rename'
+                        ' the linked neuron to the expected name.',
+                        neuron=source_neuron.neuron_name) == 'skip':
                     continue
 
-            # TODO
-            # Check whether there are any nodes or connectors in the source
-            # neuron with edition dates after the previous upload date. If not,
-            # skip the upload and tell the user.  
+            # Check whether there are any nodes in the source neuron with
+            # edition dates after the previous upload date. If not, skip the
+            # upload and tell the user.
+            if skip_unedited:
+                last_update = last_updates[linked_skid]
+                source_state = source_states[int(source_neuron.skeleton_id)]
+                if (last_update is not None and source_state is not None
+                        and source_state['last_edited'] < last_update):
+                    print(f'{source_neuron.neuron_name}: Not edited since the'
+                          ' linked neuron was last updated'
+                          f" ({time.strftime('%Y-%m-%d %I:%M %p', time.localtime(last_update))})."
+                          ' Skipping.\n')
+                    continue
 
             # Check whether any edited nodes will be overwritten
-            linked_node_details = pymaid.get_node_details(linked_neuron, remote_instance=target_project)
-            is_edited = linked_node_details.edition_time != min(linked_node_details.edition_time)
-            if is_edited.any():
-                edited_nodes = linked_node_details.loc[is_edited, ['node_id', 'edition_time', 'editor']]
-                users = pymaid.get_user_list(remote_instance=target_project).set_index('id')
-                edited_nodes.loc[:, 'editor'] = [users.loc[user_id, 'login'] for
-                                                 user_id in edited_nodes.editor]
-                print('WARNING: The linked neuron has been manually edited,'
-                      f' with {len(edited_nodes)} nodes modified. Those'
-                      ' changes will get thrown away if this update is allowed'
-                      ' to continue.')
-                print(edited_nodes)
-                user_input = input('OK to proceed and throw away the above changes? [Y/n] ')
-                if user_input not in ('y', 'Y'):
+            if linked_skid in edited_nodes:
+                if policy.decide(
+                        'edited_nodes',
+                        'WARNING: The linked neuron has been manually edited,'
+                        f' with {len(edited_nodes[linked_skid])} nodes modified.'
+                        ' Those changes will get thrown away if this update is'
+                        ' allowed to continue.',
+                        neuron=source_neuron.neuron_name,
+                        details=edited_nodes[linked_skid]) == 'skip':
                     print(f'Skipping update for "{source_neuron.neuron_name}"')
                     continue
 
-            # This does NOT annotate the source neuron on the server,
-            # it only appends to the object in memory
-            source_neuron.annotations.append(f'UPDATED FROM LINKED NEURON - {start_time}')
-
-            skid_to_update = linked_neuron.skeleton_id
-            nid_to_update = pymaid.get_neuron_id(
-                linked_neuron.skeleton_id,
-                remote_instance=target_project
-            )[str(linked_neuron.skeleton_id)]
+            skid_to_update = linked_skid
+            nid_to_update = neuron_ids[str(linked_skid)]
             force_id = True
 
-        if not fake:
-            # Actually do the upload/update:
-            server_responses.append(pymaid.upload_neuron(
-                source_neuron,
-                skeleton_id=skid_to_update,
-                neuron_id=nid_to_update,
-                force_id=force_id,
-                import_tags=True,
-                import_annotations=True,
-                import_connectors=import_connectors,
-                reuse_existing_connectors=reuse_existing_connectors,
-                remote_instance=target_project
-            ))
+            if differential:
+                live_nodes, live_tags = live_skeletons[linked_skid]
+                diff = diff_skeletons(
+                    source_neuron.nodes, live_nodes,
+                    new_tags=source_neuron.tags, live_tags=live_tags,
+                    new_connectors=source_neuron.connectors if import_connectors else None,
+                    live_connectors=live_connectors.get(linked_skid, None)
+                )
+                if diff.fallback_reason is None:
+                    print(f'{source_neuron.neuron_name}: Changes to make:'
+                          f' {diff.summary()} (~{diff.estimated_requests} requests)')
+                else:
+                    print(f'{source_neuron.neuron_name}: Re-uploading the whole'
+                          f' skeleton, because {diff.fallback_reason}.')
+                    diff = None
+        uploads.append((source_neuron, skid_to_update, nid_to_update, force_id, diff))
+        print(' ')
+    phase_times['checks'] = time.perf_counter() - phase_start
+    phase_start = time.perf_counter()
+
+    if fake:
+        print('fake was set to True. Set fake=False to actually run'
+              ' upload_or_update_neurons with settings:\n'
+              f'annotate_source_neuron={annotate_source_neuron}\n'
+              f'import_connectors={import_connectors},\n'
+              f'reuse_existing_connectors={reuse_existing_connectors},\n'
+              f'refuse_to_update={refuse_to_update}')
+        return server_responses
+
+    # There are some pesky corner cases where updates will unintentionally
+    # create unlinked connectors. Only connectors linked to the skeletons
+    # being updated, or created or unlinked by the uploads, can end up that
+    # way, so note the former now and collect the latter from the upload
+    # responses, and check just those afterwards.
+    skids_to_update = [args[1] for args in uploads if args[1] is not None]
+    touched_connectors, deleted_connectors = set(), set()
+    for skid in skids_to_update:
+        if skid in live_connectors:
+            touched_connectors.update(live_connectors[skid].connector_id.astype(int))
+    skids_to_fetch = [skid for skid in skids_to_update if skid not in live_connectors]
+    if len(skids_to_fetch) > 0:
+        with response_cache.bypassed():
+            connectors = pymaid.get_connectors(skids_to_fetch,
+                                               remote_instance=target_project)
+        if connectors is not None and len(connectors) > 0:
+            touched_connectors.update(connectors.connector_id.astype(int))
+
+    # ---Uploads--- #
+    def update_annotation():
+        # Taken once a neuron's skeleton has been changed, so that the next
+        # update can tell the changes it made from later hand edits.
+        # This does NOT annotate the neuron on the server, it only appends to
+        # the object in memory
+        return f"UPDATED FROM LINKED NEURON - {time.strftime('%Y-%m-%d %I:%M %p')}"
+
+    def upload(source_neuron, skid_to_update, nid_to_update, force_id, diff):
+        # Returns the server's response and the requests that modified data
+        with counting_modifications() as modifications:
+            if diff is not None:
+                response = update_by_diff(source_neuron, skid_to_update,
+                                          nid_to_update, diff)
+            else:
+                # Actually do the upload/update:
+                response = pymaid.upload_neuron(
+                    source_neuron,
+                    skeleton_id=skid_to_update,
+                    neuron_id=nid_to_update,
+                    force_id=force_id,
+                    import_tags=True,
+                    import_annotations=True,
+                    import_connectors=import_connectors,
+                    reuse_existing_connectors=reuse_existing_connectors,
+                    remote_instance=target_project
+                )
+                if 'skeleton_id' in response:
+                    source_neuron.annotations.append(update_annotation())
+                    pymaid.add_annotations(response['skeleton_id'],
+                                           source_neuron.annotations[-1],
+                                           remote_instance=target_project)
+        return response, modifications
+
+    def update_by_diff(source_neuron, skid, nid, diff):
+        response = apply_skeleton_diff(diff, skid, remote_instance=target_project)
+        source_neuron.annotations.append(update_annotation())
+        # Also do what upload_neuron does besides replacing the skeleton
+        if linked_names.get(str(skid), None) != source_neuron.neuron_name:
+            pymaid.rename_neurons(skid, source_neuron.neuron_name, no_prompt=True,
+                                  remote_instance=target_project)
+        existing_annotations = target_index.get_annotations(skid).get(str(skid), [])
+        new_annotations = [annot for annot in source_neuron.annotations
+                           if annot not in existing_annotations]
+        if len(new_annotations) > 0:
+            pymaid.add_annotations(skid, new_annotations,
+                                   remote_instance=target_project)
+        response.update(skeleton_id=skid, neuron_id=nid)
+        return response
+
+    server_responses = [None] * len(uploads)
+    with _separate_upload_temp_files(workers) as workers, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(upload, *args): i for i, args in enumerate(uploads)}
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            i = futures[future]
+            source_neuron = uploads[i][0]
+            server_responses[i], modifications = future.result()
+            touched_connectors.update(
+                server_responses[i].get('connector_id_map', {}).values())
+            touched_connectors.update(server_responses[i].get('connector_ids', []))
+            deleted_connectors.update(
+                server_responses[i].get('deleted_connector_ids', []))
+            if 'skeleton_id' in server_responses[i]:
+                # Record the new annotations rather than rebuilding the index
+                target_index.add(
+                    server_responses[i]['skeleton_id'],
+                    source_neuron.annotations,
+                    name=source_neuron.neuron_name,
+                    modifications=modifications
+                )
 
             if annotate_source_neuron:
                 try:
-                    upload_skid = server_responses[-1]['skeleton_id']
+                    upload_skid = server_responses[i]['skeleton_id']
                     source_annotation = linking_annotation_template.format(
                         relation=linking_relation,
-                        skid=server_responses[-1]['skeleton_id'],
+                        skid=server_responses[i]['skeleton_id'],
                         name=source_neuron.neuron_name, #Not used currently
                         pid=target_project.project_id,
                         server=target_project.server
                     )
                     try:
-                        server_responses[-1]['source_annotation'] = pymaid.add_annotations(
-                            source_neuron.skeleton_id,
-                            source_annotation,
-                            remote_instance=source_project
-                        )
+                        with counting_modifications() as modifications:
+                            server_responses[i]['source_annotation'] = pymaid.add_annotations(
+                                source_neuron.skeleton_id,
+                                source_annotation,
+                                remote_instance=source_project
+                            )
+                        get_annotation_index(source_project).add(
+                            source_neuron.skeleton_id, source_annotation,
+                            modifications=modifications)
                     except:
                         m = ('WARNING: annotate_source_neuron was requested,'
                              ' but failed. You may not have permissions to'
                              ' annotate the source project through the API')
-                        print(m)
-                        input('(Press enter to acknowledge and continue.)')
-                        server_responses[-1]['source_annotation'] = m
+                        server_responses[i]['source_annotation'] = m
+                        policy.decide('annotate_source_failed', m,
+                                      neuron=source_neuron.neuron_name)
+                except PolicyAbort:
+                    raise
                 except:
-                    print('WARNING: upload was not successful,'
-                          ' so could not annotate source neuron.')
-                    input('(Press enter to acknowledge and continue.)')
-
-            print(f'{source_neuron.neuron_name}: Done with upload or update.')
-        print(' ')
-    if fake:
-        print('fake was set to True. Set fake=False to actually run'
-              ' upload_or_update_neurons with settings:\n'
-              f'annotate_source_neuron={annotate_source_neuron}\n'
-              f'import_connectors={import_connectors},\n'
-              f'reuse_existing_connectors={reuse_existing_connectors},\n'
-              f'refuse_to_update={refuse_to_update}')
-    else:
-        # There are some pesky corner cases where updates will unintentionally
-        # create unlinked connectors. When that occurs, the user is warned and
-        # asked to investigate manually. Note that if a human tracer is
-        # annotating in catmaid and happens to make an unlinked connector that
-        # exists when the following lines are run, this will throw an warning
-        # despite there being nothing to worry about. Not much I can do there.
-        clear_cache()
-        unlinked_connectors_end = find_unlinked_connectors(remote_instance=target_project)
-        if len(unlinked_connectors_end) != len(unlinked_connectors_start):
-            print("WARNING: This upload created new unlinked connectors. This may be "
-                  "a bug or an un-addressed corner case. Go investigate these connectors:")
-            print(set(unlinked_connectors_end).difference(set(unlinked_connectors_start)))
-            input('(Press enter to acknowledge warning and continue.)')
+                    policy.decide('annotate_source_failed',
+                                  'WARNING: upload was not successful,'
+                                  ' so could not annotate source neuron.',
+                                  neuron=source_neuron.neuron_name)
+
+            elapsed = time.perf_counter() - phase_start
+            eta = elapsed / n_done * (len(uploads) - n_done)
+            print(f'[{n_done}/{len(uploads)}] {source_neuron.neuron_name}:'
+                  f' Done with upload or update. ({elapsed:.0f}s elapsed,'
+                  f' ~{eta:.0f}s left)')
+    phase_times['uploads'] = time.perf_counter() - phase_start
+    phase_start = time.perf_counter()
+
+    # When an upload leaves unlinked connectors, the user is warned and
+    # asked to investigate manually
+    unlinked_connectors = find_unlinked_connectors(
+        remote_instance=target_project,
+        connector_ids=touched_connectors - deleted_connectors
+    )
+    if len(unlinked_connectors) > 0:
+        policy.decide(
+            'unlinked_connectors',
+            "WARNING: This upload created new unlinked connectors. This may be "
+            "a bug or an un-addressed corner case. Go investigate these connectors:",
+            details=set(unlinked_connectors)
+        )
+    phase_times['unlinked connector check'] = time.perf_counter() - phase_start
+    print('Time spent: ' + ', '.join([f'{phase} {seconds:.1f}s' for
+                                      phase, seconds in phase_times.items()]))
 
     return server_responses
 
 
+def get_last_update_time(skid, remote_instance=None):
+    """
+    Return the time (in seconds since the epoch) of the most recent 'UPDATED
+    FROM LINKED NEURON' annotation on the given skeleton, or None if it has
+    none.
+    """
+    if remote_instance in [None, 'target']:
+        remote_instance = target_project
+    elif remote_instance == 'source':
+        remote_instance = source_project
+    return get_last_update_times([skid], remote_instance)[int(skid)]
+
+
 def replace_skeleton_from_swc(skid, swc_file, remote_instance=None,
                               fake=True):
     assert isinstance(skid, int)
@@ -469,13 +842,8 @@ def copy_neurons_by_annotations(annotations, **kwargs):
     See upload_or_update_neurons for all keyword argument options.
     """
     skids = get_skids_by_annotation(annotations)
-    try:
-        user_input = input(f'Duplicating {len(skids)} neurons.'
-            ' Continue? [Y/n] ')
-    except:
-        skids = [skids]
-        user_input = input('Duplicating 1 neuron. Continue? [Y/n] ')
-    if user_input not in ('y', 'Y'):
+    if get_policy(kwargs.get('policy')).decide(
+            'confirm_batch', f'Duplicating {len(skids)} neurons.') == 'skip':
         return
 
     return copy_neurons_by_skid(skids, **kwargs)
@@ -485,7 +853,7 @@ def copy_neurons_by_skid(skids, **kwargs):
     """
     See upload_or_update_neurons for all keyword argument options.
     """
-    neurons=pymaid.get_neuron(skids, remote_instance=source_project)
+    neurons = sync(skids, remote_instance=source_project)
     kwargs['linking_relation'] = 'copy of'
     return upload_or_update_neurons(neurons, **kwargs)
 
@@ -500,13 +868,8 @@ def translate_neurons_by_annotations(annotations,
     See upload_or_update_neurons for all keyword argument options.
     """
     skids = get_skids_by_annotation(annotations)
-    try:
-        user_input = input(f'Translating {len(skids)} neurons.'
-            ' Continue? [Y/n] ')
-    except:
-        skids = [skids]
-        user_input = input('Translating 1 neuron. Continue? [Y/n] ')
-    if user_input not in ('y', 'Y'):
+    if get_policy(kwargs.get('policy')).decide(
+            'confirm_batch', f'Translating {len(skids)} neurons.') == 'skip':
         return
 
     return translate_neurons_by_skid(
@@ -570,7 +933,7 @@ def get_translated_neurons_by_skid(skids,
                        translation[1]*pixel_size[1],
                        translation[2]*pixel_size[2])
 
-    neurons = pymaid.get_neuron(skids, remote_instance=source_project)
+    neurons = sync(skids, remote_instance=source_project)
     if type(neurons) is pymaid.core.CatmaidNeuron:
         neurons = pymaid.core.CatmaidNeuronList(neurons)
 
@@ -606,13 +969,8 @@ def affinetransform_neurons_by_annotations(annotations,
     See upload_or_update_neurons for all keyword argument options.
     """
     skids = get_skids_by_annotation(annotations)
-    try:
-        user_input = input(f'Applying affine transformation to {len(skids)}'
-            ' neurons. Continue? [Y/n] ')
-    except:
-        skids = [skids]
-        user_input = input('Applying affine transformation to 1 neuron. Continue? [Y/n] ')
-    if user_input not in ('y', 'Y'):
+    if get_policy(kwargs.get('policy')).decide(
+            'confirm_batch', f'Applying affine transformation to {len(skids)} neurons.') == 'skip':
         return
 
     return affinetransform_neurons_by_skid(
@@ -644,7 +1002,7 @@ def get_affinetransformed_neurons_by_annotations(annotations,
 
 def get_affinetransformed_neurons_by_skid(skids,
                                           transform_file):
-    neurons = pymaid.get_neuron(skids, remote_instance=source_project)
+    neurons = sync(skids, remote_instance=source_project)
     if type(neurons) is pymaid.core.CatmaidNeuron: 
         neurons = pymaid.core.CatmaidNeuronList(neurons)
 
@@ -684,13 +1042,8 @@ def elastictransform_neurons_by_annotations(annotations,
     See upload_or_update_neurons for all keyword argument options.
     """
     skids = get_skids_by_annotation(annotations)
-    try:
-        user_input = input(f'Elastically transforming {len(skids)} neurons.'
-            ' Continue? [Y/n] ')
-    except:
-        skids = [skids]
-        user_input = input('Elastically transforming 1 neuron. Continue? [Y/n] ')
-    if user_input not in ('y', 'Y'):
+    if get_policy(kwargs.get('policy')).decide(
+            'confirm_batch', f'Elastically transforming {len(skids)} neurons.') == 'skip':
         return
 
     return elastictransform_neurons_by_skid(
@@ -717,7 +1070,8 @@ def elastictransform_neurons_by_skid(skids,
         get_elastictransformed_neurons_by_skid(skids,
             elastix_parameter_file=elastix_parameter_file,
             left_right_flip=left_right_flip,
-            include_connectors=include_connectors),
+            include_connectors=include_connectors,
+            policy=kwargs.get('policy')),
         **kwargs
     )
 
@@ -725,7 +1079,7 @@ def elastictransform_neurons_by_skid(skids,
 def get_elastictransformed_neurons_by_annotations(annotations,
                                                   elastix_parameter_file='V3',
                                                   left_right_flip=False,
-                                                  include_connectors=False):  # TODO Change this later once implemented
+                                                  include_connectors=False):
 
     return get_elastictransformed_neurons_by_skid(
         get_skids_by_annotation(annotations),
@@ -735,74 +1089,80 @@ def get_elastictransformed_neurons_by_annotations(annotations,
     )
 
 
+def gather_swc_coordinates(treenode_ids, swc, treenode2index_map):
+    """
+    The x, y, z columns of the swc rows (as an array loaded from an swc file
+    written by CatmaidNeuron.to_swc) for the given treenode ids, in the same
+    order. treenode2index_map is the treenode id -> swc node index map that
+    to_swc returned. swc node indices start at 1, so node index i is row i-1.
+    """
+    treenode_ids = np.asarray(treenode_ids)
+    indices = pd.Series(treenode2index_map)
+    indices.index = indices.index.astype(treenode_ids.dtype)
+    indices = indices.reindex(treenode_ids).values
+    missing = pd.isnull(indices)
+    if missing.any():
+        raise KeyError(f'Treenodes {treenode_ids[missing].tolist()} are not in'
+                       ' the swc file')
+    rows = indices.astype(np.int64) - 1
+    assert (swc[rows, 0] == rows + 1).all(), ('swc node index is not 1 more'
+        ' than its array index! Something went wrong!')
+    return swc[rows, 2:5]
+
+
 def get_elastictransformed_neurons_by_skid(skids,
                                            elastix_parameter_file='V3',
                                            left_right_flip=False,
-                                           include_connectors=False):  # TODO Change this later once implemented
+                                           include_connectors=False,
+                                           policy=None,
+                                           use_transformix_binary=False):
     """
     Apply an elastic transformation to a neuron.
     Currently only supports transforms generated by the program elastix.
-    elastix's function transformix must be installed on the user's shell PATH.
+    The transform is applied in-process, so elastix's function transformix
+    doesn't need to be installed. All neurons are transformed together in one
+    batch. Set use_transformix_binary=True to run that batch through
+    transformix instead (which must then be on the user's shell PATH).
     This function supports situations where the alignment was performed on a
     volume that has an offset and/or rescaling relative to the space that the
-    neuron's coordinates are provided in. See code for details.
+    neuron's coordinates are provided in. Those steps are described by a
+    transform chain: elastix_parameter_file can be 'V3' or 'V2' (the chains
+    for those alignments of the EM dataset to the VNC template), the name of
+    any chain in transform_chains.json, or a TransformChain.
+    With include_connectors=True, the neurons' connectors are transformed in
+    the same batch as their nodes, so uploading the results with
+    import_connectors=True gives synapses in the target project's space.
     """
-    y_coordinate_cutoff = None
-    if elastix_parameter_file == 'V3':
-        # Parameters for the synapsesV3 alignment
-        elastix_parameter_file = os.path.join(
-            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
-            'template_registration_pipeline/register_EM_dataset_to_template',
-            'TransformParameters.FixedFANC.txt'
-        )
-        y_coordinate_cutoff = 322500  # 300000 * 4.3/4. In nm
-
-        #offset_of_downsampled_alignment_volume = [496, 496, 840]  # in nm
-        offset_of_downsampled_alignment_volume = [533.2, 533.2, 945]  # in nm
-        scaling_of_downsampled_alignment_volume = np.array([1.0/430,
-                                                            1.0/430,
-                                                            1.0/450]) # in vox / nm
-        downsampled_alignment_volume_fake_voxel_size = [0.30, 0.30, 0.40] # in microns
-
-        max_z_index_of_downsampled_volume_for_z_flip = 435
-
-        unit_conversion_for_catmaid = 1000  # converts microns to nm
-
-        # The VNC atlas' plane of symmetry is at x=329,
-        # and voxel size is 400nm (in catmaid scaling)
-        plane_of_symmetry_x_coordinate = 329 * 400
-
-    elif elastix_parameter_file == 'V2':
-        # Parameters for the synapsesV2 alignment
-        elastix_parameter_file = os.path.join(
-            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
-            'template_registration_pipeline/register_EM_dataset_to_template',
-            'old',
-            'TransformParameters.vnc1synapsesV2_to_JRC2018VNCatlas.txt'
-        )
-
-        y_coordinate_cutoff = 344000  # 320k * 4.3/4. In nm
-
-        offset_of_downsampled_alignment_volume = [0, 344000, 0]  # in nm
-        scaling_of_downsampled_alignment_volume = np.array([1.0/430,
-                                                            1.0/430,
-                                                            1.0/450]) # in vox / nm
-        downsampled_alignment_volume_fake_voxel_size = [0.30, 0.30, 0.32] # in microns
-
-        max_z_index_of_downsampled_volume_for_z_flip = 439
-
-        unit_conversion_for_catmaid = 1000  # converts microns to nm
-
-        # The VNC atlas' plane of symmetry is at x=329,
-        # and voxel size is 400nm (in catmaid scaling)
-        plane_of_symmetry_x_coordinate = 329 * 400
-
+    # The steps from the source project's coordinates to the target
+    # project's: offsets and rescalings between the neurons' coordinates and
+    # the volume that was aligned, z flips, the elastix transform, and
+    # mirroring. See template_registration_pipeline/transform_chain.py
+    if isinstance(elastix_parameter_file, transform_chain.TransformChain):
+        chain = elastix_parameter_file
+    elif elastix_parameter_file in ELASTIX_TRANSFORM_CHAINS:
+        chain = transform_chain.load_transform_chain(
+            ELASTIX_TRANSFORM_CHAINS[elastix_parameter_file])
+    elif elastix_parameter_file in transform_chain.get_transform_chain_names():
+        chain = transform_chain.load_transform_chain(elastix_parameter_file)
     elif os.path.exists(elastix_parameter_file):
-        print('Assuming no scaling or offsets. Scaling and offsets with custom'
-              ' parameter files not yet implemented.')
+        print('Assuming no scaling or offsets. To use scaling and offsets with'
+              ' custom parameter files, give a TransformChain instead.')
+        chain = transform_chain.TransformChain([{
+            'type': 'elastix',
+            'parameter_file': os.path.abspath(elastix_parameter_file)
+        }])
     else:
         raise ValueError("elastix_parameter_file must be either 'V2', 'V3',"
-                         " or point to a parameter file")
+                         ' the name of a chain in transform_chains.json, a'
+                         ' TransformChain, or point to a parameter file')
+    # Because of the z flip that occurs between the EM dataset and the
+    # atlas, also flipping across the x-axis midplane results in a neuron
+    # that is NOT flipped relative to the original. So if the user does NOT
+    # request a flipped neuron, do the flip across the x-axis midplane (which
+    # the chain ends with). Otherwise don't.
+    if left_right_flip:
+        chain = chain.without('mirror')
+    y_coordinate_cutoff = chain.info.get('y_coordinate_cutoff', None)
 
     # Temporary folder to store neuron skeleton files
     if os.path.exists('/dev/shm'): #Linux
@@ -830,41 +1190,50 @@ def get_elastictransformed_neurons_by_skid(skids,
         f'pymaid.{skid}_remapped_transformixOutput_'
         f'inTargetProjectUnits{flip_name_modifier}.swc'
     ) for skid in skids]
+    # Transformed connector locations, as lines of 'connector_id x y z'
+    final_connector_filenames = [os.path.join(
+        temp_folder, subfolder,
+        f'pymaid.{skid}_remapped_transformixOutput_connectors_'
+        f'inTargetProjectUnits{flip_name_modifier}.txt'
+    ) for skid in skids]
+    if not include_connectors:
+        final_connector_filenames = []
 
     load_existing = ''
-    if all([os.path.exists(f) for f in final_swc_filenames]):
-        load_existing = input(
+    if all([os.path.exists(f) for f in
+            final_swc_filenames + final_connector_filenames]):
+        action = get_policy(policy).decide(
+            'reuse_transform_files',
             f'Transformed coordinates already exist in {base_folder} for the'
             ' requested neurons. These can be loaded [l] to save time, but'
             ' only do this if the neurons on catmaid have not been modified'
             ' since the creation of these files. You can play it safe and'
-            ' redo [r] the transformation. [l/r] '
+            ' redo [r] the transformation.'
         )
-        assert load_existing.lower() in ('l', 'r'), 'You must respond with l or r.'
+        load_existing = 'l' if action == 'skip' else 'r'
 
     print('Pulling source neuron data from catmaid')
     clear_cache()
-    neurons = pymaid.get_neuron(skids, remote_instance=source_project)
+    neurons = sync(skids, remote_instance=source_project)
     if type(neurons) is pymaid.core.CatmaidNeuron:
         neurons = pymaid.core.CatmaidNeuronList(neurons)
     if y_coordinate_cutoff is not None:
         for neuron in neurons:
             kept_rows = neuron.nodes.y >= y_coordinate_cutoff
-            kept_treenode_ids = neuron.nodes[kept_rows].treenode_id.values
-            pymaid.subset_neuron(neuron, kept_treenode_ids, inplace=True)
+            kept_node_ids = neuron.nodes[kept_rows].node_id.values
+            navis.subset_neuron(neuron, kept_node_ids, inplace=True)
             if neuron.n_skeletons > 1:
                 print(f'{neuron.neuron_name} is fragmented. Healing before continuing.')
-                pymaid.heal_fragmented_neuron(neuron, inplace=True)
+                navis.heal_skeleton(neuron, inplace=True)
 
-    # pymaid.to_swc and CatmaidNeuron.to_swc both output swc files with the
-    # nodes re-indexed from 1 to len(nodes). These functions are both supposed
-    # to return a dict mapping original treenode id to new node id. Seems like this
-    # dict is made and returned properly for CatmaidNeuron.to_swc but is broken
-    # for pymaid.to_swc
+    # CatmaidNeuron.to_swc outputs swc files with the nodes re-indexed from 1
+    # to len(nodes), and with return_node_map=True returns a dict mapping
+    # original node id to new node id
     treenode2index_maps = {}
     for neuron in neurons:
         treenode2index_maps[neuron.skeleton_id] = neuron.to_swc(os.path.join(
-            temp_folder, subfolder, f'pymaid.{neuron.skeleton_id}.swc'))
+            temp_folder, subfolder, f'pymaid.{neuron.skeleton_id}.swc'),
+            return_node_map=True)
 
 
     def build_transformed_neurons_from_file():
@@ -886,26 +1255,33 @@ def get_elastictransformed_neurons_by_skid(skids,
                 f'inTargetProjectUnits{flip_name_modifier}.swc'
             ))
 
-            treenode2index_map = treenode2index_maps[neuron.skeleton_id]
-            for row in np.arange(transformed_neuron.nodes.shape[0]):
-                treenode = transformed_neuron.nodes.iloc[row].treenode_id
-                try:
-                    index = treenode2index_map[treenode]
-                except KeyError as e:
-                    print(e)
-                    print(treenode2index_map)
-                    raise
-                #print('Treenode', treenode, 'Index', index)
-                assert(final_swc[index-1, 0] == index), ('swc node index is'
-                    'not 1 more than its array index! Something went wrong!')
-                transformed_neuron.nodes.at[row, 'x'] = final_swc[index-1, 2]
-                transformed_neuron.nodes.at[row, 'y'] = final_swc[index-1, 3]
-                transformed_neuron.nodes.at[row, 'z'] = final_swc[index-1, 4]
+            transformed_neuron.nodes[['x', 'y', 'z']] = gather_swc_coordinates(
+                transformed_neuron.nodes.node_id.values,
+                final_swc,
+                treenode2index_maps[neuron.skeleton_id]
+            )
+
+            if include_connectors and len(transformed_neuron.connectors) > 0:
+                final_connectors = np.loadtxt(os.path.join(
+                    temp_folder, subfolder,
+                    f'pymaid.{neuron.skeleton_id}_remapped_transformixOutput_'
+                    f'connectors_inTargetProjectUnits{flip_name_modifier}.txt'
+                ), ndmin=2)
+                # A connector is listed once per link, so look up each row's
+                # connector in the file
+                final_connectors = pd.DataFrame(
+                    final_connectors[:, 1:4], columns=['x', 'y', 'z'],
+                    index=final_connectors[:, 0].astype(np.int64))
+                connector_ids = transformed_neuron.connectors.connector_id.astype(np.int64)
+                transformed_neuron.connectors[['x', 'y', 'z']] = \
+                    final_connectors.loc[connector_ids.values].values
             transformed_neurons.append(transformed_neuron)
 
-        if '/.tmp' in base_folder and len(os.listdir(base_folder) > 5000):
-            input('WARNING: There are over 5000 temporary files cluttering up'
-                  f' {base_folder}. Feel free to go delete them all.')
+        if '/.tmp' in base_folder and len(os.listdir(base_folder)) > 5000:
+            get_policy(policy).decide(
+                'temp_files',
+                'WARNING: There are over 5000 temporary files cluttering up'
+                f' {base_folder}. Feel free to go delete them all.')
 
         print('Done building neurons\n')
         return pymaid.CatmaidNeuronList(transformed_neurons)
@@ -913,96 +1289,43 @@ def get_elastictransformed_neurons_by_skid(skids,
     if load_existing.lower() == 'l':
         return build_transformed_neurons_from_file()
 
-
-    # TODO TODO TODO: IMPLEMENT TRANSFORMIX-ING OF CONNECTOR LOCATIONS
-    # but skip it if include_connectors=False
-
-    # Transform skeleton from CATMAID project space coordinates to downsampled
-    # alignment volume space
-    print('\nDownsampling')
-    for skeleton_id in skids:
-        print(f'Downsample skeleton {skeleton_id}')
-        input_fname = os.path.join(
-            temp_folder, subfolder, f'pymaid.{skeleton_id}.swc')
-        output_fname_remapped = os.path.join(
-            temp_folder, subfolder, f'pymaid.{skeleton_id}_remapped.swc')
-        data = np.genfromtxt(input_fname)
-
-
-        data[:, 2:5] -= offset_of_downsampled_alignment_volume
-        data[:, 2:5] *= scaling_of_downsampled_alignment_volume
-        data[:, 2:5] *= downsampled_alignment_volume_fake_voxel_size
-        # Flip the z index to account for a flip that was performed in Fiji
-        # on the downsampled volume before aligning it to the template.
-        if max_z_index_of_downsampled_volume_for_z_flip not in [0, None]:
-            data[:, 4] = (max_z_index_of_downsampled_volume_for_z_flip
-                         * downsampled_alignment_volume_fake_voxel_size[2]
-                         - data[:, 4])
-        with open(output_fname_remapped, 'w') as f_out:
-            for a, b, c, d, e, f, g in data:
-                f_out.write('%d %d %f %f %f %d %d\n'%(a, b, c, d, e, f, g))
-    print('Done')
-
-    # Convert skeleton to transformix compatible version
-    print('Reformatting for transformix')
+    print('\nTransforming')
+    swc_data = {}
     for skeleton_id in skids:
-        print(f'Reformat skeleton {skeleton_id}')
         data = np.genfromtxt(os.path.join(
-            temp_folder, subfolder, f'pymaid.{skeleton_id}_remapped.swc'))
+            temp_folder, subfolder, f'pymaid.{skeleton_id}.swc'))
         if len(data[:, 2:5]) == 0:
             print(f'Skeleton {skeleton_id} is empty')
-            Continue
-        output_fname_remapped = os.path.join(temp_folder, subfolder,
-            f'pymaid.{skeleton_id}_remapped_transformixInput.swc')
-        with open(output_fname_remapped, 'w') as f_out:
-            f_out.write(f'point\n{len(data)}\n')
-            for a, b, c, d, e, f, g in data:
-                f_out.write('%f %f %f\n'%(c, d, e))
-
-    # Apply transformix
-    print('\nRunning transformix')
-    for skeleton_id in skids:
-        print(f'Apply transformix to skeleton {skeleton_id}')
-        call_fmt = 'transformix -out {} -tp {} -def {}'.format(
-            base_folder,
-            elastix_parameter_file,
-            os.path.join(temp_folder, subfolder,
-                         f'pymaid.{skeleton_id}_remapped_transformixInput.swc')
-        )
-            
-        #print(call_fmt)
-        subprocess.run(call_fmt.split(' '))
-        f = open(os.path.join(temp_folder, subfolder, 'outputpoints.txt'), 'r')
-        fout = open(os.path.join(
-            temp_folder, subfolder,
-            f'pymaid.{skeleton_id}_remapped_transformixOutput.swc'), 'w')
-        for data in f.readlines():
-            output = data.split('OutputPoint = [ ')[1].split(' ]')[0]
-            fout.write(output + '\n')
-        f.close()
-        fout.close()
-    print('Done')
-
-    for skeleton_id in skids:
-        print(f'Rescale skeleton {skeleton_id}')
-        data = np.genfromtxt(os.path.join(temp_folder, subfolder,
-            f'pymaid.{skeleton_id}_remapped.swc'))
-
-        data_transformed = np.genfromtxt(os.path.join(
-            temp_folder, subfolder,
-            f'pymaid.{skeleton_id}_remapped_transformixOutput.swc'))
-
-        data[:, 2:5] = data_transformed
-        data[:, 2:5] *= unit_conversion_for_catmaid  # converts microns to nm
-
-        # Because of the z flip that occurs between the EM dataset and the
-        # atlas, also flipping across the x-axis midplane results in a neuron
-        # that is NOT flipped relative to the original. So if the user does NOT
-        # request a flipped neuron, do the flip across the x-axis midplane.
-        # Otherwise don't.
-        if not left_right_flip:
-            data[:, 2] = plane_of_symmetry_x_coordinate * 2 - data[:, 2]
+            continue
+        swc_data[skeleton_id] = data
 
+    # Each connector once, even if it's linked to a neuron more than once
+    connector_data = {}
+    if include_connectors:
+        for neuron in neurons:
+            connectors = neuron.connectors.drop_duplicates('connector_id')
+            connector_data[neuron.skeleton_id] = np.column_stack([
+                connectors.connector_id.values.astype(np.float64),
+                connectors[['x', 'y', 'z']].values.astype(np.float64)
+            ]).reshape(-1, 4)
+
+    # Apply the whole chain to all skeletons at once. Its elastix transform
+    # is done in-process (see template_registration_pipeline/elastix_transform.py)
+    # and gives the same result as running transformix. With
+    # use_transformix_binary=True, transformix is run once on all skeletons.
+    # Connectors go in the same batch as the nodes.
+    print(f'Transforming {sum(len(data) for data in swc_data.values())}'
+          f' nodes and {sum(len(data) for data in connector_data.values())}'
+          f' connectors of {len(swc_data)} skeletons')
+    point_arrays = {(skeleton_id, 'nodes'): data[:, 2:5]
+                    for skeleton_id, data in swc_data.items()}
+    point_arrays.update({(skeleton_id, 'connectors'): data[:, 1:4]
+                         for skeleton_id, data in connector_data.items()})
+    transformed_points = chain.transform_many(
+        point_arrays, use_binary=use_transformix_binary)
+
+    for skeleton_id, data in swc_data.items():
+        data[:, 2:5] = transformed_points[(skeleton_id, 'nodes')]
         output_fname = os.path.join(
             temp_folder, subfolder,
             f'pymaid.{skeleton_id}_remapped_transformixOutput_'
@@ -1010,6 +1333,13 @@ def get_elastictransformed_neurons_by_skid(skids,
         with open(output_fname, 'w') as f_out:
             for a, b, c, d, e, f, g in data:
                 f_out.write('%d %d %f %f %f %d %d\n'%(a, b, c, d, e, f, g))
+    for skeleton_id, data in connector_data.items():
+        data[:, 1:4] = transformed_points[(skeleton_id, 'connectors')]
+        output_fname = os.path.join(
+            temp_folder, subfolder,
+            f'pymaid.{skeleton_id}_remapped_transformixOutput_connectors_'
+            f'inTargetProjectUnits{flip_name_modifier}.txt')
+        np.savetxt(output_fname, data, fmt=['%d', '%f', '%f', '%f'])
     print('Done')
 
     return build_transformed_neurons_from_file()
@@ -1037,14 +1367,8 @@ def volume_prune_neurons_by_annotations(annotations,
     See upload_or_update_neurons for all keyword argument options.
     """
     skids = get_skids_by_annotation(annotations)
-    try:
-        len(skids)
-        user_input = input(f'Volume pruning {len(skids)} neurons.'
-                           ' Continue? [Y/n] ')
-    except:
-        skids = [skids]
-        user_input = input('Volume pruning 1 neuron. Continue? [Y/n] ')
-    if user_input not in ('y', 'Y'):
+    if get_policy(kwargs.get('policy')).decide(
+            'confirm_batch', f'Volume pruning {len(skids)} neurons.') == 'skip':
         return
 
     return volume_prune_neurons_by_skid(
@@ -1084,6 +1408,7 @@ def volume_prune_neurons_by_skid(skids,
         get_nrn_kwargs = {'verbose': kwargs['verbose']}
     else:
         get_nrn_kwargs = {}
+    get_nrn_kwargs['policy'] = kwargs.get('policy')
 
     return upload_or_update_neurons(
         get_volume_pruned_neurons_by_skid(
@@ -1128,7 +1453,8 @@ def get_volume_pruned_neurons_by_skid(skids,
                                       resample=0,
                                       only_keep_largest_fragment=False,
                                       verbose=False,
-                                      remote_instance=None):
+                                      remote_instance=None,
+                                      policy=None):
     """
     mode : 'fele' -   Keep all parts of the neuron between its primary
                       neurite's First Entry to and Last Exit from the volume.
@@ -1147,7 +1473,7 @@ def get_volume_pruned_neurons_by_skid(skids,
     #if exit_volume_id is None:
     #    exit_volume_id = entry_volume_id
 
-    neurons = pymaid.get_neuron(skids, remote_instance=source_project)
+    neurons = sync(skids, remote_instance=source_project)
     if volume_id not in volumes:
         try:
             print(f'Pulling volume {volume_id} from project'
@@ -1187,51 +1513,51 @@ def get_volume_pruned_neurons_by_skid(skids,
             soma node, and walk forward (how?) until finding a node within the
             volume or a branch point. Prune proximal to that.
             """
-            nodes = neuron.nodes.set_index('treenode_id')
+            graph = SkeletonGraph(neuron.nodes,
+                                  primary_neurite_radius=PRIMARY_NEURITE_RADIUS)
             # Find end of the primary neurite
-            nodes['has_fat_child'] = False
-            for tid in nodes.index:
-                if nodes.at[tid, 'radius'] == PRIMARY_NEURITE_RADIUS:
-                    parent = nodes.at[tid, 'parent_id']
-                    nodes.at[parent, 'has_fat_child'] = True
-            is_prim_neurite_end = (~nodes['has_fat_child']) & (nodes['radius']
-                    == PRIMARY_NEURITE_RADIUS)
-            prim_neurite_end = nodes.index[is_prim_neurite_end]
-            if len(prim_neurite_end) is 0:
+            is_prim_neurite = graph.has_flag(PRIMARY_NEURITE_NODE)
+            has_fat_child = np.zeros(len(graph), dtype=bool)
+            has_fat_child[graph.parent[is_prim_neurite & (graph.parent >= 0)]] = True
+            prim_neurite_end = np.nonzero(is_prim_neurite & ~has_fat_child)[0]
+            if len(prim_neurite_end) == 0:
                 raise ValueError(f"{neuron.neuron_name} doesn't look like a"
                                  "  motor neuron. Exiting.")
-            elif len(prim_neurite_end) is not 1:
+            elif len(prim_neurite_end) != 1:
                 raise ValueError('Multiple primary neurite ends for'
-                                 f' {neuron.neuron_name}: {prim_neurite_end}.'
+                                 f' {neuron.neuron_name}:'
+                                 f' {graph.node_ids[prim_neurite_end].tolist()}.'
                                  '\nExiting.')
-            
-            nodes['is_in_vol'] = pymaid.in_volume(nodes, volume)
+
+            is_in_vol = np.asarray(pymaid.in_volume(neuron.nodes, volume), dtype=bool)
 
             # Walk backwards until at a point inside the volume, or at a branch
             # point
-            current_node = prim_neurite_end[0]
-            parent_node = nodes.at[current_node, 'parent_id']
-            while (nodes.at[parent_node, 'type'] != 'branch'
-                    and not nodes.at[parent_node, 'is_in_vol']):
-                current_node = parent_node
-                if verbose: print(f'Walk back to {current_node}')
-                parent_node = nodes.at[parent_node, 'parent_id']
+            current = prim_neurite_end[0]
+            parent = graph.parent[current]
+            while (parent != -1 and not graph.flags[parent] & BRANCH_NODE
+                    and not is_in_vol[parent]):
+                current = parent
+                if verbose: print(f'Walk back to {graph.node_ids[current]}')
+                parent = graph.parent[parent]
+            current_node = int(graph.node_ids[current])
             if verbose: print(f'Pruning distal to {current_node}')
             neuron.prune_distal_to(current_node, inplace=True)
 
             # Start at the first primary neurite node downstream of root
-            current_node = nodes.index[(nodes.parent_id == neuron.root[0])
-                    #& (nodes.radius == PRIMARY_NEURITE_RADIUS)][0]
-                    & (nodes.radius > 0)][0]
-            #Walking downstream is a bit slow, but probably acceptable
-            while (not nodes.at[current_node, 'is_in_vol'] and
-                    nodes.at[current_node, 'type'] == 'slab'):
-                current_node = nodes.index[nodes.parent_id == current_node][0]
-                if verbose: print(f'Walk forward to {current_node}')
-            if not nodes.at[current_node, 'is_in_vol']:
-                input('WARNING: Hit a branch before hitting the volume for'
-                      f' neuron {neuron.neuron_name}. This is unusual.'
-                      ' Press enter to acknowledge.')
+            root_children = graph.get_children(np.nonzero(graph.parent == -1)[0][0])
+            current = root_children[graph.radius[root_children] > 0][0]
+            while (not is_in_vol[current] and
+                    graph.flags[current] & SLAB_NODE):
+                current = graph.get_children(current)[0]
+                if verbose: print(f'Walk forward to {graph.node_ids[current]}')
+            current_node = int(graph.node_ids[current])
+            if not is_in_vol[current]:
+                get_policy(policy).decide(
+                    'branch_before_volume',
+                    'WARNING: Hit a branch before hitting the volume for'
+                    f' neuron {neuron.neuron_name}. This is unusual.',
+                    neuron=neuron.neuron_name)
 
             if verbose: print(f'Pruning proximal to {current_node}')
             neuron.prune_proximal_to(current_node, inplace=True)
@@ -1270,13 +1596,8 @@ def radius_prune_neurons_by_annotations(annotations,
     See upload_or_update_neurons for all keyword argument options.
     """
     skids = get_skids_by_annotation(annotations)
-    try:
-        len(skids)
-        user_input = input(f'Radius pruning {len(skids)} neurons. Continue? [Y/n] ')
-    except:
-        skids = [skids]
-        user_input = input('Radius pruning 1 neuron. Continue? [Y/n] ')
-    if user_input not in ('y', 'Y'):
+    if get_policy(kwargs.get('policy')).decide(
+            'confirm_batch', f'Radius pruning {len(skids)} neurons.') == 'skip':
         return
 
     return radius_prune_neurons_by_skid(
@@ -1321,7 +1642,7 @@ def get_radius_pruned_neurons_by_skid(skids,
                                       radius_to_keep=PRIMARY_NEURITE_RADIUS,
                                       keep_larger_radii=True):
 
-    neurons = pymaid.get_neuron(skids, remote_instance=source_project)
+    neurons = sync(skids, remote_instance=source_project)
     if type(neurons) is pymaid.core.CatmaidNeuron: 
         neurons = pymaid.core.CatmaidNeuronList(neurons)
 
@@ -1393,10 +1714,7 @@ def get_pruned_by_hardcoded_dict(prune_params=default_prune_params,
 #manually, as they're not (yet) integrated into the functions above.
 def add_dummy_nodes_by_annotations(annotations, fake=True, remote_instance=None):
     return add_dummy_nodes_by_skid(
-        pymaid.get_skids_by_annotation(
-            annotations,
-            intersect=True,
-            remote_instance=remote_instance),
+        get_annotation_index(remote_instance).get_skids(annotations),
         fake=fake,
         remote_instance=remote_instance
     )
@@ -1433,10 +1751,7 @@ def delete_dummy_nodes_by_annotations(annotations,
                                       fake=True,
                                       remote_instance=None):
     return delete_dummy_nodes_by_skid(
-        pymaid.get_skids_by_annotation(
-            annotations,
-            intersect=True,
-            remote_instance=remote_instance),
+        get_annotation_index(remote_instance).get_skids(annotations),
         dummy_coords=dummy_coords,
         fake=fake,
         remote_instance=remote_instance
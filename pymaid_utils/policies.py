@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# Requires python 3.6+ for f-strings
+
+# What to do when the upload functions in
+# manipulate_and_reupload_catmaid_neurons.py run into something a human
+# would normally be asked about, e.g. a linked neuron that was edited by hand
+# and would lose those edits. By default every such condition is put to the
+# user with input(), as it always has been. A Policy can instead say up
+# front what to do for each condition, so that long batch runs don't sit
+# waiting at a prompt. Every decision made, by the policy or by the user, is
+# recorded, and policy.report() lists them afterwards.
+#
+# Typical unattended use:
+#   policy = pu.Policy.unattended(name_mismatch='overwrite')
+#   pu.push_all_updates_by_skid(skids, fake=False, policy=policy)
+#   policy.report()
+# or pu.set_default_policy(policy) to use it everywhere.
+
+import time
+
+import pandas as pd
+
+
+# Conditions that need a decision: go ahead ('overwrite'), leave this neuron
+# alone ('skip'), or stop everything ('abort')
+DECISIONS = {
+    'confirm_batch': 'About to run a manipulation on a batch of neurons',
+    'name_mismatch': 'A linked neuron has a different name than expected,'
+                     ' and will be renamed',
+    'edited_nodes': 'A linked neuron was edited by hand, and those edits will'
+                    ' be overwritten',
+    'reuse_transform_files': 'Transformed coordinates from an earlier run'
+                             " exist. 'overwrite' redoes the transformation,"
+                             " 'skip' loads the existing files, which may be"
+                             ' out of date'
+}
+# The question each decision is asked with when the policy is 'ask', and the
+# answers meaning 'overwrite' and 'skip'. Anything else means 'skip', except
+# where no answer is given for 'skip', in which case the question is repeated.
+PROMPTS = {
+    'confirm_batch': ('Continue? [Y/n] ', ('y', 'Y'), None),
+    'name_mismatch': ('Proceed? [Y/n] ', ('y', 'Y'), None),
+    'edited_nodes': ('OK to proceed and throw away the above changes? [Y/n] ',
+                     ('y', 'Y'), None),
+    'reuse_transform_files': ('Load [l] or redo [r]? [l/r] ', ('r', 'R'),
+                              ('l', 'L'))
+}
+# Conditions that are warnings: note them and carry on ('log'), or stop
+# everything ('abort')
+WARNINGS = {
+    'duplicate_links': 'Several neurons in the target project have the same'
+                       ' linking annotation (their update is skipped)',
+    'annotate_source_failed': 'The source neuron could not be annotated with'
+                              ' a link to its uploaded copy',
+    'unlinked_connectors': 'An upload left connectors without any links',
+    'branch_before_volume': 'Volume pruning hit a branch before reaching the'
+                            ' volume',
+    'temp_files': 'Lots of temporary files have piled up'
+}
+CONDITIONS = dict(DECISIONS, **WARNINGS)
+DECISION_ACTIONS = ('ask', 'overwrite', 'skip', 'abort')
+WARNING_ACTIONS = ('ask', 'log', 'abort')
+
+
+class PolicyAbort(Exception):
+    """Raised when a Policy says to abort."""
+    pass
+
+
+class Policy:
+    """
+    What to do for each condition listed in CONDITIONS: 'ask' (the default)
+    prompts the user, anything else is done without asking. Decisions can be
+    'overwrite', 'skip' or 'abort', warnings can be 'log' or 'abort'.
+    """
+    def __init__(self, **actions):
+        self.actions = {condition: 'ask' for condition in CONDITIONS}
+        for condition, action in actions.items():
+            if condition not in CONDITIONS:
+                raise ValueError(f'Unknown condition "{condition}". Choose'
+                                 f' from {list(CONDITIONS)}')
+            allowed = DECISION_ACTIONS if condition in DECISIONS else WARNING_ACTIONS
+            if action not in allowed:
+                raise ValueError(f'"{condition}" can only be one of {allowed},'
+                                 f' not "{action}"')
+            self.actions[condition] = action
+        self.decisions = []
+
+    @classmethod
+    def unattended(cls, **actions):
+        """
+        A policy that never asks: conditions needing a decision are skipped
+        and warnings are logged, unless actions says otherwise. The
+        exceptions are confirm_batch, which goes ahead, and
+        reuse_transform_files, which redoes the transformation rather than
+        trusting files that may be out of date.
+        """
+        defaults = {condition: 'skip' for condition in DECISIONS}
+        defaults.update({condition: 'log' for condition in WARNINGS})
+        defaults['confirm_batch'] = 'overwrite'
+        defaults['reuse_transform_files'] = 'overwrite'
+        defaults.update(actions)
+        return cls(**defaults)
+
+    def to_dict(self):
+        """The action for each condition, e.g. to save as json."""
+        return dict(self.actions)
+
+    def decide(self, condition, message, neuron=None, details=None):
+        """
+        Return what to do about condition ('overwrite' or 'skip' for
+        decisions, 'log' for warnings), asking the user if the policy says
+        to. Raises PolicyAbort if the answer is 'abort'.
+        """
+        action = self.actions[condition]
+        asked = action == 'ask'
+        print(message)
+        if details is not None:
+            print(details)
+        if asked and condition in DECISIONS:
+            action = self._ask(condition)
+        elif asked:
+            input('(Press enter to acknowledge and continue.)')
+            action = 'log'
+        elif action != 'abort':
+            print(f'Policy for "{condition}": {action}')
+        self.decisions.append({
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'condition': condition,
+            'action': action,
+            'asked': asked,
+            'neuron': neuron,
+            'message': message
+        })
+        if action == 'abort':
+            raise PolicyAbort(f'Aborted by policy for "{condition}": {message}')
+        return action
+
+    @staticmethod
+    def _ask(condition):
+        question, overwrite_answers, skip_answers = PROMPTS[condition]
+        while True:
+            user_input = input(question)
+            if user_input in overwrite_answers:
+                return 'overwrite'
+            if skip_answers is None or user_input in skip_answers:
+                return 'skip'
+
+    def report(self):
+        """Every decision made so far, as a DataFrame."""
+        return pd.DataFrame(self.decisions, columns=['time', 'condition',
+                                                     'action', 'asked',
+                                                     'neuron', 'message'])
+
+    def print_summary(self):
+        if len(self.decisions) == 0:
+            return
+        counts = self.report().groupby(['condition', 'action']).size()
+        print('Decisions made: ' + ', '.join([
+            f'{n}x {condition} -> {action}'
+            for (condition, action), n in counts.items()]))
+
+    def clear(self):
+        self.decisions = []
+
+
+# Used by every function that isn't given a policy
+default_policy = Policy()
+
+
+def set_default_policy(policy):
+    global default_policy
+    default_policy = policy
+
+
+def get_policy(policy=None):
+    """policy, or the default policy if it's None."""
+    return default_policy if policy is None else policy
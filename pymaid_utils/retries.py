@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# Requires python 3.6+ for f-strings
+
+# Retrying of network requests that fail for transient reasons (connection
+# errors, timeouts, 502/503/504/429 responses), with exponential backoff and
+# jitter. Every request sent by a CatmaidInstance made in connections.py goes
+# through RetryingHTTPAdapter, so all pymaid calls using those instances are
+# retried according to the current RetryPolicy. Other code can use the
+# retry() decorator, and retry_policy() temporarily changes the policy:
+#
+#     @retry
+#     def flaky_function(): ...
+#
+#     with retry_policy(max_tries=10, timeout=(10, 300)):
+#         neurons = pymaid.get_neuron(skids)
+#
+# A shared RetryBudget limits how many retries can happen when many requests
+# are failing at once, so that long batch jobs fail fast during an outage
+# instead of hammering the server. Retry counts and latencies per endpoint are
+# kept in retry_stats.
+
+import time
+import random
+import threading
+import functools
+import contextlib
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class RetryPolicy:
+    """
+    max_tries: total attempts, including the first one
+    base_delay, max_delay: the wait before retry n is base_delay * 2**(n-1)
+        seconds, capped at max_delay
+    jitter: if True, wait a random time between 0 and that delay instead
+    timeout: (connect, read) timeout in seconds for requests that don't
+        specify one
+    retry_statuses: HTTP status codes that are worth retrying
+    """
+    def __init__(self, max_tries=5, base_delay=0.5, max_delay=30, jitter=True,
+                 timeout=(10, 120), retry_statuses=(429, 502, 503, 504)):
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.timeout = timeout
+        self.retry_statuses = tuple(retry_statuses)
+
+    def copy(self, **changes):
+        policy = RetryPolicy(**self.__dict__)
+        for name, value in changes.items():
+            if not hasattr(policy, name):
+                raise TypeError(f'RetryPolicy has no setting {name}')
+            setattr(policy, name, value)
+        return policy
+
+    def get_delay(self, attempt, retry_after=None):
+        """Seconds to wait after the given (1-indexed) failed attempt."""
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.max_delay)
+            except ValueError:
+                pass  # Retry-After can also be a date. Just ignore it.
+        delay = min(self.base_delay * 2**(attempt - 1), self.max_delay)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+
+class RetryBudget:
+    """
+    A token bucket shared by all retries. Each retry spends a token and each
+    request that succeeds without retrying earns back tokens_per_success, so
+    occasional failures are always retried but a burst of failures quickly
+    runs the budget dry and further failures are raised immediately.
+    """
+    def __init__(self, max_tokens=50, tokens_per_success=0.1):
+        self.max_tokens = max_tokens
+        self.tokens_per_success = tokens_per_success
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def spend(self):
+        """Take a token if one is available. Returns whether one was."""
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens,
+                              self.tokens + self.tokens_per_success)
+
+    def reset(self):
+        with self._lock:
+            self.tokens = self.max_tokens
+
+
+class RetryStats:
+    """Per-endpoint counts of requests, retries and failures, and latencies."""
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, n_tries, seconds, failed):
+        with self._lock:
+            stats = self._stats.setdefault(endpoint, {
+                'requests': 0, 'retries': 0, 'failures': 0,
+                'total_seconds': 0.0, 'max_seconds': 0.0
+            })
+            stats['requests'] += 1
+            stats['retries'] += n_tries - 1
+            stats['failures'] += int(failed)
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    def to_dataframe(self):
+        with self._lock:
+            stats = pd.DataFrame.from_dict(self._stats, orient='index',
+                                           columns=['requests', 'retries',
+                                                    'failures', 'total_seconds',
+                                                    'max_seconds'])
+        stats.index.name = 'endpoint'
+        stats['mean_seconds'] = stats.total_seconds / stats.requests
+        return stats.sort_values('retries', ascending=False)
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+
+default_policy = RetryPolicy()
+retry_budget = RetryBudget()
+retry_stats = RetryStats()
+_policy_overrides = []
+
+
+def get_retry_policy():
+    if len(_policy_overrides) > 0:
+        return _policy_overrides[-1]
+    return default_policy
+
+
+@contextlib.contextmanager
+def retry_policy(policy=None, **changes):
+    """
+    Use a different retry policy for all requests made inside this block, e.g.
+    with retry_policy(max_tries=1): ... to turn retrying off. This applies to
+    every thread, not just the one that entered the block.
+    """
+    if policy is None:
+        policy = get_retry_policy().copy(**changes)
+    _policy_overrides.append(policy)
+    try:
+        yield policy
+    finally:
+        _policy_overrides.remove(policy)
+
+
+def get_retry_stats():
+    return retry_stats.to_dataframe()
+
+
+def reset_retry_stats():
+    retry_stats.reset()
+    retry_budget.reset()
+
+
+def endpoint_name(url):
+    """A url's path, with ids replaced by {id} so similar requests group."""
+    path = requests.utils.urlparse(url).path.strip('/')
+    return '/'.join(['{id}' if part.isdigit() else part
+                     for part in path.split('/')])
+
+
+def is_transient_error(error, request_was_idempotent=True):
+    """
+    Whether an exception raised while sending a request is worth retrying.
+    Requests that aren't idempotent (ones that modify data on the server) are
+    only retried if the connection couldn't be opened, since otherwise the
+    server may have already acted on the first attempt.
+    """
+    if getattr(error, 'retries_exhausted', False):
+        return False  # Already retried as much as the policy allows
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not request_was_idempotent:
+        return False
+    return isinstance(error, (requests.exceptions.ConnectionError,
+                              requests.exceptions.Timeout,
+                              requests.exceptions.ChunkedEncodingError))
+
+
+def _give_up(error, endpoint, attempt, start):
+    retry_stats.record(endpoint, attempt, time.perf_counter() - start, True)
+    try:
+        error.retries_exhausted = True
+    except AttributeError:
+        pass
+
+
+def retry(function=None, policy=None, endpoint=None):
+    """
+    Decorator that calls the function again, with backoff, when it raises a
+    transient network error. Can be used as @retry, or with arguments like
+    @retry(policy=RetryPolicy(max_tries=10)). Unless a policy is given, the
+    current policy (see retry_policy) is used at call time.
+    """
+    if function is None:
+        return lambda function: retry(function, policy=policy,
+                                      endpoint=endpoint)
+    name = endpoint if endpoint is not None else function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        current_policy = policy if policy is not None else get_retry_policy()
+        start = time.perf_counter()
+        attempt = 1
+        while True:
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                if (not is_transient_error(e)
+                        or attempt >= current_policy.max_tries
+                        or not retry_budget.spend()):
+                    _give_up(e, name, attempt, start)
+                    raise
+                delay = current_policy.get_delay(attempt)
+                print(f'{type(e).__name__} in {name} on try {attempt},'
+                      f' retrying in {delay:.1f}s...')
+                time.sleep(delay)
+                attempt += 1
+            else:
+                if attempt == 1:
+                    retry_budget.record_success()
+                retry_stats.record(name, attempt, time.perf_counter() - start,
+                                   False)
+                return result
+    return wrapper
+
+
+class RetryingHTTPAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter that applies the current retry policy to every request it
+    sends: it fills in the policy's timeout and retries transient errors and
+    retryable status codes. is_idempotent(request) says whether a request only
+    reads data and so is safe to resend after it may have reached the server.
+    """
+    def __init__(self, is_idempotent=None, **kwargs):
+        if is_idempotent is None:
+            is_idempotent = lambda request: request.method in ('GET', 'HEAD')
+        self.is_idempotent = is_idempotent
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        policy = get_retry_policy()
+        if kwargs.get('timeout', None) is None:
+            kwargs['timeout'] = policy.timeout
+        endpoint = endpoint_name(request.url)
+        idempotent = self.is_idempotent(request)
+        start = time.perf_counter()
+        attempt = 1
+        while True:
+            try:
+                response = super().send(request, **kwargs)
+            except Exception as e:
+                if (not is_transient_error(e, idempotent)
+                        or attempt >= policy.max_tries
+                        or not retry_budget.spend()):
+                    _give_up(e, endpoint, attempt, start)
+                    raise
+                delay = policy.get_delay(attempt)
+                reason = type(e).__name__
+            else:
+                if (response.status_code not in policy.retry_statuses
+                        or not idempotent
+                        or attempt >= policy.max_tries
+                        or not retry_budget.spend()):
+                    failed = response.status_code in policy.retry_statuses
+                    if attempt == 1 and not failed:
+                        retry_budget.record_success()
+                    retry_stats.record(endpoint, attempt,
+                                       time.perf_counter() - start, failed)
+                    return response
+                delay = policy.get_delay(attempt,
+                                         response.headers.get('Retry-After'))
+                reason = f'HTTP {response.status_code}'
+                response.close()
+            print(f'{reason} from {endpoint} on try {attempt},'
+                  f' retrying in {delay:.1f}s...')
+            time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,554 @@
+#!/usr/bin/env python3
+# Requires python 3.6+ for f-strings
+
+# Updates a linked neuron on CATMAID by changing only what's different,
+# instead of replacing the whole skeleton. diff_skeletons() compares a new
+# version of a neuron (e.g. its source neuron, freshly transformed) against the
+# live linked neuron on the server, node by node, and works out the smallest
+# set of edits that turns the live neuron into the new one: nodes to move, add
+# or delete, nodes whose parent or radius changed, tags to change, and (if
+# connectors are compared) connector links to add or remove and connectors to
+# move. apply_skeleton_diff() then makes those edits through the CATMAID API.
+#
+# The new neuron's nodes usually have different IDs than the live neuron's
+# (they're the source neuron's node IDs), so nodes are matched up first: nodes
+# with the same ID, parent and position are matched, then nodes at a position
+# no other node is at, then the matching spreads along the two trees from each
+# matched pair to its unmatched parent and children, so nodes that moved or
+# that share a position with another node are matched by where they sit in
+# the tree. When a source neuron has only been edited a little since the last
+# update, nearly every node is matched at its old position and the diff is
+# tiny. All moves are sent in one request, but added, deleted or re-parented
+# nodes take a request each, so diffs that would need more than
+# MAX_DIFF_REQUESTS requests (or whose roots don't match) are better done as
+# a full re-upload - see diff.fallback_reason.
+#
+# When this file is imported during package initialization (see __init__.py),
+# it's given access to the package's source_project and target_project.
+
+import json
+from collections import deque
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+import pymaid
+
+
+# Nodes closer than this (in nm) count as being at the same position
+POSITION_TOLERANCE = 1
+# Diffs needing more requests than this are better done as a full re-upload
+MAX_DIFF_REQUESTS = 100
+# Connector link types in pymaid's connector tables -> CATMAID relation names
+CONNECTOR_RELATIONS = {0: 'presynaptic_to', 1: 'postsynaptic_to',
+                       2: 'gapjunction_with', 3: 'abutting'}
+# Sent as the state of every edit. CATMAID uses states to refuse edits to
+# nodes that changed since they were downloaded, but the only such changes
+# here would be hand edits, which upload_or_update_neurons already checks for
+# (and which an update overwrites anyway), so skip the check.
+NOCHECK_STATE = json.dumps({'nocheck': True})
+
+
+class SkeletonDiff:
+    """
+    The edits that turn a live skeleton into a new version of it. Nodes are
+    referred to by their IDs in the new neuron, except for nodes that only
+    exist in the live neuron (deletions, removed links). node_map maps every
+    matched new node ID to its live node ID.
+    """
+    def __init__(self):
+        self.node_map = {}
+        self.moves = pd.DataFrame(columns=['node_id', 'x', 'y', 'z'])
+        self.additions = pd.DataFrame(columns=['node_id', 'parent_id', 'x',
+                                               'y', 'z', 'radius'])
+        self.reparents = pd.DataFrame(columns=['node_id', 'parent_id'])
+        self.deletions = []  # Live node IDs, leaves first
+        self.radii = {}
+        self.tags = {}  # New node ID -> its complete list of tags
+        self.links_to_add = pd.DataFrame(columns=['node_id', 'connector_id',
+                                                  'relation', 'x', 'y', 'z'])
+        self.links_to_remove = pd.DataFrame(columns=['node_id', 'connector_id',
+                                                     'relation'])
+        self.connector_moves = pd.DataFrame(columns=['connector_id', 'x', 'y', 'z'])
+        self.fallback_reason = None
+
+    @property
+    def n_changes(self):
+        return (len(self.moves) + len(self.additions) + len(self.reparents)
+                + len(self.deletions) + len(self.radii) + len(self.tags)
+                + len(self.links_to_add) + len(self.links_to_remove)
+                + len(self.connector_moves))
+
+    @property
+    def estimated_requests(self):
+        """Number of requests apply_skeleton_diff will send."""
+        return (int(len(self.moves) > 0) + int(len(self.radii) > 0)
+                + int(len(self.connector_moves) > 0)
+                + len(self.additions) + len(self.reparents)
+                + len(self.deletions) + len(self.tags)
+                + len(self.links_to_add) + len(self.links_to_remove)
+                + int(self.links_to_add.connector_id.isnull().sum())
+                + int(len(self.links_to_remove) > 0))
+
+    def summary(self):
+        if self.n_changes == 0:
+            return 'no changes'
+        counts = {
+            'moved': len(self.moves), 'added': len(self.additions),
+            're-parented': len(self.reparents), 'deleted': len(self.deletions),
+            'with new radius': len(self.radii), 'with new tags': len(self.tags),
+        }
+        changes = [f'{n} nodes {change}' for change, n in counts.items() if n > 0]
+        connector_counts = {
+            'links added': len(self.links_to_add),
+            'links removed': len(self.links_to_remove),
+            'connectors moved': len(self.connector_moves)
+        }
+        changes += [f'{n} {change}' for change, n in connector_counts.items() if n > 0]
+        return ', '.join(changes)
+
+
+def _get_parents(nodes):
+    """dict of node ID -> parent ID, with None for the root."""
+    parents = pd.to_numeric(nodes.parent_id, errors='coerce')
+    return {int(node): (int(parent) if parent >= 0 else None)
+            for node, parent in zip(nodes.node_id, parents.fillna(-1))}
+
+
+def _get_children(parents):
+    children = {node: [] for node in parents}
+    for node, parent in parents.items():
+        if parent is not None:
+            children[parent].append(node)
+    return children
+
+
+def _pair_nearest(a, b, xyz_a, xyz_b):
+    """Greedily pair up the nodes in a with the nodes in b, nearest first."""
+    if len(a) == 0 or len(b) == 0:
+        return []
+    distances = np.linalg.norm(np.array([xyz_a[n] for n in a])[:, None, :]
+                               - np.array([xyz_b[n] for n in b])[None, :, :],
+                               axis=2)
+    pairs = []
+    for flat_index in np.argsort(distances, axis=None, kind='stable'):
+        i, j = np.unravel_index(flat_index, distances.shape)
+        if a[i] is not None and b[j] is not None:
+            pairs.append((a[i], b[j]))
+            a[i] = b[j] = None
+    return pairs
+
+
+def match_nodes(new_nodes, live_nodes, tolerance=POSITION_TOLERANCE):
+    """
+    Match the nodes of two versions of a skeleton. Returns a dict of new node
+    ID -> live node ID. See the top of this file for how.
+    """
+    new_parents, live_parents = _get_parents(new_nodes), _get_parents(live_nodes)
+    new_children, live_children = _get_children(new_parents), _get_children(live_parents)
+    new_xyz = dict(zip(new_nodes.node_id.astype(int),
+                       new_nodes[['x', 'y', 'z']].values.astype(np.float64)))
+    live_xyz = dict(zip(live_nodes.node_id.astype(int),
+                        live_nodes[['x', 'y', 'z']].values.astype(np.float64)))
+    node_map, matched_live = {}, set()
+
+    # Nodes with the same ID, parent and position, e.g. when a skeleton is
+    # compared with an earlier copy of itself
+    for node, parent in new_parents.items():
+        if (node in live_parents and live_parents[node] == parent
+                and np.linalg.norm(new_xyz[node] - live_xyz[node]) <= tolerance):
+            node_map[node] = node
+            matched_live.add(node)
+
+    # Nodes at a position that no other node of either skeleton is at.
+    # Several nodes at the same position can't be told apart by position, so
+    # they're left for the tree to sort out
+    new_ids = [n for n in new_xyz if n not in node_map]
+    live_ids = [n for n in live_xyz if n not in matched_live]
+    if len(new_ids) > 0 and len(live_ids) > 0:
+        new_points = np.array([new_xyz[n] for n in new_ids])
+        live_points = np.array([live_xyz[n] for n in live_ids])
+        new_tree, live_tree = cKDTree(new_points), cKDTree(live_points)
+        n_new_near_new = new_tree.query_ball_point(new_points, tolerance,
+                                                   return_length=True)
+        n_live_near_live = live_tree.query_ball_point(live_points, tolerance,
+                                                      return_length=True)
+        n_new_near_live = new_tree.query_ball_point(live_points, tolerance,
+                                                    return_length=True)
+        live_near_new = live_tree.query_ball_point(new_points, tolerance)
+        for i, nearby in enumerate(live_near_new):
+            if (len(nearby) == 1 and n_new_near_new[i] == 1
+                    and n_live_near_live[nearby[0]] == 1
+                    and n_new_near_live[nearby[0]] == 1):
+                node_map[new_ids[i]] = live_ids[nearby[0]]
+                matched_live.add(live_ids[nearby[0]])
+
+    # Then spread out along the trees from each matched pair, starting with
+    # the roots
+    new_roots = [n for n, p in new_parents.items() if p is None]
+    live_roots = [n for n, p in live_parents.items() if p is None]
+    if (len(new_roots) == 1 and len(live_roots) == 1
+            and new_roots[0] not in node_map and live_roots[0] not in matched_live):
+        node_map[new_roots[0]] = live_roots[0]
+        matched_live.add(live_roots[0])
+    queue = deque(node_map.items())
+    while len(queue) > 0:
+        new_id, live_id = queue.popleft()
+        pairs = []
+        new_parent, live_parent = new_parents[new_id], live_parents[live_id]
+        if (new_parent is not None and live_parent is not None
+                and new_parent not in node_map and live_parent not in matched_live):
+            pairs.append((new_parent, live_parent))
+        pairs += _pair_nearest(
+            [n for n in new_children[new_id] if n not in node_map],
+            [n for n in live_children[live_id] if n not in matched_live],
+            new_xyz, live_xyz)
+        for pair in pairs:
+            node_map[pair[0]] = pair[1]
+            matched_live.add(pair[1])
+            queue.append(pair)
+    return node_map
+
+
+def diff_skeletons(new_nodes, live_nodes, new_tags=None, live_tags=None,
+                   new_connectors=None, live_connectors=None,
+                   tolerance=POSITION_TOLERANCE,
+                   max_requests=MAX_DIFF_REQUESTS):
+    """
+    Work out the edits that turn the live skeleton into the new one. Nodes
+    are given as pymaid node tables (node_id, parent_id, x, y, z, radius),
+    tags as {tag: [node IDs]} and connectors as pymaid connector tables
+    (node_id, connector_id, type, x, y, z). Connectors are only compared if
+    both new_connectors and live_connectors are given. Returns a
+    SkeletonDiff.
+    """
+    diff = SkeletonDiff()
+    new_nodes = new_nodes.drop_duplicates('node_id')
+    node_map = diff.node_map = match_nodes(new_nodes, live_nodes, tolerance)
+    live_by_id = live_nodes.set_index(live_nodes.node_id.astype(int))
+    new_parents, live_parents = _get_parents(new_nodes), _get_parents(live_nodes)
+
+    new_root = [n for n, p in new_parents.items() if p is None]
+    live_root = [n for n, p in live_parents.items() if p is None]
+    if len(new_root) != 1 or len(live_root) != 1:
+        diff.fallback_reason = 'skeletons must have exactly one root each'
+        return diff
+    if node_map.get(new_root[0], None) != live_root[0]:
+        diff.fallback_reason = 'the roots don\'t match'
+        return diff
+
+    # Visit the new skeleton from its root, so that every node comes after
+    # its parent, and nodes can be created and re-parented in that order
+    new_children = _get_children(new_parents)
+    order, queue = [], deque(new_root)
+    while len(queue) > 0:
+        node = queue.popleft()
+        order.append(node)
+        queue.extend(new_children[node])
+    new_by_id = new_nodes.set_index(new_nodes.node_id.astype(int)).loc[order]
+
+    is_matched = new_by_id.index.isin(list(node_map))
+    added = new_by_id[~is_matched]
+    diff.additions = pd.DataFrame({
+        'node_id': added.index.values,
+        'parent_id': [new_parents[n] for n in added.index],
+        'x': added.x.values, 'y': added.y.values, 'z': added.z.values,
+        'radius': added.radius.values
+    }, columns=diff.additions.columns)
+
+    matched = new_by_id[is_matched]
+    live_ids = [node_map[n] for n in matched.index]
+    live_matched = live_by_id.loc[live_ids]
+    distances = np.linalg.norm(matched[['x', 'y', 'z']].values.astype(np.float64)
+                               - live_matched[['x', 'y', 'z']].values.astype(np.float64),
+                               axis=1)
+    moved = matched[distances > tolerance]
+    diff.moves = pd.DataFrame({'node_id': moved.index.values, 'x': moved.x.values,
+                               'y': moved.y.values, 'z': moved.z.values},
+                              columns=diff.moves.columns)
+    changed_radius = ~np.isclose(matched.radius.values.astype(np.float64),
+                                 live_matched.radius.values.astype(np.float64))
+    diff.radii = dict(zip(matched.index[changed_radius],
+                          matched.radius.values[changed_radius].astype(float)))
+    reparented = [n for n, live_id in zip(matched.index, live_ids)
+                  if new_parents[n] is not None
+                  and node_map.get(new_parents[n], None) != live_parents[live_id]]
+    diff.reparents = pd.DataFrame({'node_id': reparented,
+                                   'parent_id': [new_parents[n] for n in reparented]},
+                                  columns=diff.reparents.columns)
+
+    # Delete the deepest nodes first, so each one is a leaf when it's deleted
+    deleted = set(live_parents) - set(node_map.values())
+    depths = {}
+    for node in deleted:
+        depth, parent = 0, live_parents[node]
+        while parent is not None:
+            depth, parent = depth + 1, live_parents[parent]
+        depths[node] = depth
+    diff.deletions = sorted(deleted, key=lambda n: -depths[n])
+
+    # Tags, as each node's complete set of tags
+    new_node_tags, live_node_tags = {}, {}
+    for tag, nodes in (new_tags or {}).items():
+        for node in nodes:
+            new_node_tags.setdefault(int(node), set()).add(tag)
+    for tag, nodes in (live_tags or {}).items():
+        for node in nodes:
+            live_node_tags.setdefault(int(node), set()).add(tag)
+    for node in order:
+        tags = new_node_tags.get(node, set())
+        live_node = node_map.get(node, None)
+        if tags != live_node_tags.get(live_node, set()):
+            diff.tags[node] = sorted(tags)
+
+    if new_connectors is not None and live_connectors is not None:
+        _diff_connectors(diff, new_connectors, live_connectors, tolerance)
+
+    if diff.estimated_requests > max_requests:
+        diff.fallback_reason = (f'the diff needs ~{diff.estimated_requests}'
+                                f' requests (more than {max_requests})')
+    return diff
+
+
+def _diff_connectors(diff, new_connectors, live_connectors, tolerance):
+    """
+    Pair up the new and live neuron's connector links by node and relation,
+    nearest first. Paired links whose connector moved become connector moves,
+    the rest are added or removed.
+    """
+    live_by_node = {}
+    for link in live_connectors.itertuples():
+        key = (int(link.node_id), int(link.type))
+        live_by_node.setdefault(key, []).append(link)
+    live_xyz = {int(link.connector_id): np.array([link.x, link.y, link.z], dtype=np.float64)
+                for link in live_connectors.itertuples()}
+    reverse_map = {live_id: new_id for new_id, live_id in diff.node_map.items()}
+
+    to_add, moves, kept = [], {}, set()
+    new_by_node = {}
+    for link in new_connectors.itertuples():
+        new_by_node.setdefault((int(link.node_id), int(link.type)), []).append(link)
+    for (node, relation), new_links in new_by_node.items():
+        live_links = live_by_node.get((diff.node_map.get(node, None), relation), [])
+        xyz_new = {i: np.array([l.x, l.y, l.z], dtype=np.float64)
+                   for i, l in enumerate(new_links)}
+        xyz_live = {i: live_xyz[int(l.connector_id)] for i, l in enumerate(live_links)}
+        pairs = _pair_nearest(list(xyz_new), list(xyz_live), xyz_new, xyz_live)
+        for i, j in pairs:
+            connector_id = int(live_links[j].connector_id)
+            kept.add((connector_id, int(live_links[j].node_id)))
+            if np.linalg.norm(xyz_new[i] - xyz_live[j]) > tolerance:
+                moves[connector_id] = xyz_new[i]
+        paired = {i for i, j in pairs}
+        to_add += [l for i, l in enumerate(new_links) if i not in paired]
+
+    removed = [link for link in live_connectors.itertuples()
+               if (int(link.connector_id), int(link.node_id)) not in kept]
+    diff.links_to_remove = pd.DataFrame({
+        'node_id': [int(l.node_id) for l in removed],
+        'connector_id': [int(l.connector_id) for l in removed],
+        'relation': [CONNECTOR_RELATIONS[int(l.type)] for l in removed]
+    }, columns=diff.links_to_remove.columns)
+    diff.connector_moves = pd.DataFrame(
+        [[c, *xyz] for c, xyz in moves.items()], columns=diff.connector_moves.columns)
+
+    # Link new links to a live connector at the same position if there is
+    # one (e.g. the other side of a synapse between two uploaded neurons),
+    # otherwise to a new connector
+    known_connectors = {c: xyz for c, xyz in live_xyz.items() if c not in moves}
+    known_connectors.update(moves)
+    tree_ids = list(known_connectors)
+    tree = cKDTree(np.array(list(known_connectors.values()))) if tree_ids else None
+    connector_ids = []
+    for link in to_add:
+        connector_id = None
+        if tree is not None:
+            distance, i = tree.query([link.x, link.y, link.z],
+                                     distance_upper_bound=tolerance)
+            if np.isfinite(distance):
+                connector_id = tree_ids[i]
+        connector_ids.append(connector_id)
+    diff.links_to_add = pd.DataFrame({
+        'node_id': [int(l.node_id) for l in to_add],
+        'connector_id': pd.array(connector_ids, dtype='Int64'),
+        'relation': [CONNECTOR_RELATIONS[int(l.type)] for l in to_add],
+        'x': [float(l.x) for l in to_add], 'y': [float(l.y) for l in to_add],
+        'z': [float(l.z) for l in to_add]
+    }, columns=diff.links_to_add.columns)
+
+
+def parse_node_overview(node_overview):
+    """
+    The node table (pymaid columns plus edition_time) and tags of a skeleton
+    from its skeletons/{skid}/node-overview response, so that a skeleton
+    downloaded that way can be diffed without downloading it again.
+    """
+    nodes, reviews, tags = node_overview
+    nodes = pd.DataFrame(nodes, columns=['node_id', 'parent_id', 'confidence',
+                                         'x', 'y', 'z', 'radius', 'creator_id',
+                                         'edition_time'])
+    nodes['parent_id'] = nodes.parent_id.fillna(-1).astype(int)
+    node_tags = {}
+    for node_id, tag in tags:
+        node_tags.setdefault(tag, []).append(node_id)
+    return nodes, node_tags
+
+
+def get_live_connectors(skid, remote_instance=None):
+    """A skeleton's connector links as they are on the server right now."""
+    remote_instance = _eval_remote_instance(remote_instance)
+    nodes, connectors, tags = remote_instance.fetch(
+        remote_instance._get_compact_details_url(
+            skid, with_connectors='true', with_tags='false'),
+        desc='Get connectors'
+    )[:3]
+    return pd.DataFrame([c[:6] for c in connectors],
+                        columns=['node_id', 'connector_id', 'type', 'x', 'y', 'z'])
+
+
+def _check_diff(diff):
+    """
+    Raise a ValueError if any edit in diff refers to a node that won't exist
+    when the edit is made, so that a diff that would fail partway through is
+    refused before anything on the server is changed.
+    """
+    deleted = set(diff.deletions)
+    known = set(diff.node_map)
+    problems = []
+    kept_deleted = deleted.intersection(diff.node_map.values())
+    if len(kept_deleted) > 0:
+        problems.append(f'nodes {sorted(kept_deleted)} are both matched and deleted')
+    for node, parent in zip(diff.additions.node_id, diff.additions.parent_id):
+        if int(parent) not in known:
+            problems.append(f'added node {node} has an unknown parent {parent}')
+        known.add(int(node))
+    referenced = {
+        're-parented': list(diff.reparents.node_id) + list(diff.reparents.parent_id),
+        'moved': list(diff.moves.node_id),
+        'given a new radius': list(diff.radii),
+        'given new tags': list(diff.tags),
+        'linked to a connector': list(diff.links_to_add.node_id)
+    }
+    for edit, nodes in referenced.items():
+        unknown = sorted({int(n) for n in nodes} - known)
+        if len(unknown) > 0:
+            problems.append(f'unknown nodes {unknown} would be {edit}')
+    if len(problems) > 0:
+        raise ValueError('This diff can\'t be applied: ' + '; '.join(problems))
+
+
+def apply_skeleton_diff(diff, skid, remote_instance=None):
+    """
+    Make the edits in diff to skeleton skid on the server. Returns a dict
+    with the number of each kind of edit made, the IDs given to added nodes
+    (new node ID -> live node ID), the IDs of the connectors whose links were
+    changed and of the connectors deleted because they lost their last link.
+    Raises a ValueError before making any edit if the diff can't be applied.
+    """
+    if diff.fallback_reason is not None:
+        raise ValueError(f'This diff should not be applied: {diff.fallback_reason}')
+    _check_diff(diff)
+    remote_instance = _eval_remote_instance(remote_instance)
+    pid = remote_instance.project_id
+    node_map = dict(diff.node_map)
+
+    # Drop links first, while all the nodes they're on still exist
+    for link in diff.links_to_remove.itertuples():
+        remote_instance.fetch(
+            remote_instance.make_url(pid, 'link', 'delete'),
+            post={'connector_id': link.connector_id, 'treenode_id': link.node_id,
+                  'state': NOCHECK_STATE})
+
+    # Add nodes, then re-parent nodes, parents first in both cases so that
+    # no edit can make a loop
+    additions = diff.additions.set_index('node_id')
+    reparents = diff.reparents.set_index('node_id').parent_id.to_dict()
+    for node, row in additions.iterrows():
+        response = remote_instance.fetch(
+            remote_instance._create_node_url(),
+            post={'x': row.x, 'y': row.y, 'z': row.z, 'radius': row.radius,
+                  'confidence': 5, 'parent_id': node_map[int(row.parent_id)],
+                  'useneuron': -1, 'state': NOCHECK_STATE})
+        node_map[int(node)] = int(response['treenode_id'])
+    for node, parent in reparents.items():
+        remote_instance.fetch(
+            remote_instance.make_url(pid, 'treenodes', node_map[node], 'parent'),
+            post={'parent_id': node_map[int(parent)], 'state': NOCHECK_STATE})
+
+    if len(diff.moves) > 0:
+        post = {f't[{i}][{k}]': v for i, row in enumerate(diff.moves.itertuples())
+                for k, v in enumerate([node_map[int(row.node_id)],
+                                       float(row.x), float(row.y), float(row.z)])}
+        post['state'] = NOCHECK_STATE
+        remote_instance.fetch(remote_instance._update_node_url(), post=post)
+    if len(diff.radii) > 0:
+        post = {f'treenode_ids[{i}]': node_map[node] for i, node in enumerate(diff.radii)}
+        post.update({f'treenode_radii[{i}]': radius for i, radius in
+                     enumerate(diff.radii.values())})
+        post['state'] = NOCHECK_STATE
+        remote_instance.fetch(remote_instance._update_node_radii(), post=post)
+
+    for node in diff.deletions:
+        remote_instance.fetch(remote_instance._delete_node_url(),
+                              post={'treenode_id': node, 'state': NOCHECK_STATE})
+
+    for node, tags in diff.tags.items():
+        remote_instance.fetch(remote_instance._node_add_tag_url(node_map[node]),
+                              post={'tags': ','.join(tags), 'delete_existing': 'true'})
+
+    # Connectors: move connectors, add links
+    if len(diff.connector_moves) > 0:
+        post = {f'c[{i}][{k}]': v for i, row in enumerate(diff.connector_moves.itertuples())
+                for k, v in enumerate([int(row.connector_id), float(row.x),
+                                       float(row.y), float(row.z)])}
+        post['state'] = NOCHECK_STATE
+        remote_instance.fetch(remote_instance._update_node_url(), post=post)
+    connector_ids = set(diff.links_to_remove.connector_id.astype(int))
+    deleted_connector_ids = []
+    for link in diff.links_to_add.itertuples():
+        connector_id = link.connector_id
+        if pd.isnull(connector_id):
+            connector_id = remote_instance.fetch(
+                remote_instance._create_connector_url(),
+                post={'x': link.x, 'y': link.y, 'z': link.z, 'confidence': 5}
+            )['connector_id']
+        connector_ids.add(int(connector_id))
+        remote_instance.fetch(
+            remote_instance._create_link_url(),
+            post={'from_id': node_map[link.node_id], 'to_id': int(connector_id),
+                  'link_type': link.relation, 'state': NOCHECK_STATE})
+    # Connectors whose last link was removed would be left unlinked
+    if len(diff.links_to_remove) > 0:
+        still_linked = {int(c) for c in diff.links_to_add.connector_id.dropna()}
+        candidates = [int(c) for c in diff.links_to_remove.connector_id.unique()
+                      if int(c) not in still_linked]
+        if len(candidates) > 0:
+            details = pymaid.get_connector_details(candidates,
+                                                   remote_instance=remote_instance)
+            linked = set(details.connector_id.astype(int)) if len(details) > 0 else set()
+            for connector_id in candidates:
+                if connector_id not in linked:
+                    remote_instance.fetch(
+                        remote_instance._delete_connector_url(),
+                        post={'connector_id': connector_id, 'state': NOCHECK_STATE})
+                    deleted_connector_ids.append(connector_id)
+
+    return {
+        'moved': len(diff.moves), 'added': len(diff.additions),
+        'reparented': len(diff.reparents), 'deleted': len(diff.deletions),
+        'radii': len(diff.radii), 'tags': len(diff.tags),
+        'links_added': len(diff.links_to_add),
+        'links_removed': len(diff.links_to_remove),
+        'connectors_moved': len(diff.connector_moves),
+        'added_node_id_map': {n: node_map[n] for n in additions.index},
+        'connector_ids': sorted(connector_ids),
+        'deleted_connector_ids': deleted_connector_ids
+    }
+
+
+def _eval_remote_instance(remote_instance):
+    if remote_instance in [None, 'target']:
+        return target_project
+    elif remote_instance == 'source':
+        return source_project
+    return remote_instance
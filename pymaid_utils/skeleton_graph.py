@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# Requires python 3.6+ for f-strings
+
+# A compact, array-based copy of a skeleton's tree for walking it quickly.
+# pymaid's node tables are pandas DataFrames, where looking up one node's
+# parent or children costs a .at/.loc lookup or a mask over the whole table,
+# so walking a tree one node at a time takes milliseconds per step.
+# SkeletonGraph instead numbers the nodes 0..n-1 (in node table order) and
+# keeps:
+#   node_ids       int64 node ID of each node
+#   parent         int32 index of each node's parent, -1 for the root
+#   xyz            float32 (n, 3) node positions
+#   radius         float32 node radii
+#   child_offsets  int32, children[child_offsets[i]:child_offsets[i+1]] are
+#   children       the indices of node i's children, in node table order
+#   edge_length    float32 distance from each node to its parent (0 for root)
+#   flags          uint8 bit flags per node: ROOT_NODE, LEAF_NODE,
+#                  BRANCH_NODE, SLAB_NODE (matching pymaid's node types) and
+#                  PRIMARY_NEURITE_NODE
+# so a parent or child lookup is one array access. Functions that walk
+# skeletons take a node table or a SkeletonGraph, so a graph built once can
+# be reused across many walks.
+#
+# Quantities that accumulate down the tree, like the cable length from the
+# root to every node, are computed for all nodes in one pass over the tree
+# from the roots outwards (see levels()), one vectorized step per depth, and
+# kept on the graph so that any number of queries after that are lookups.
+# The same goes for each node's distance to the primary neurite node it
+# branches off of (see distance_to_primary_neurite()).
+
+import numpy as np
+import pandas as pd
+
+
+# Motor neuron primary neurites are marked by giving their nodes this radius
+PRIMARY_NEURITE_RADIUS = 500
+
+ROOT_NODE = 1
+LEAF_NODE = 2
+BRANCH_NODE = 4
+SLAB_NODE = 8
+PRIMARY_NEURITE_NODE = 16
+
+
+class SkeletonGraph:
+    """
+    The tree of a pymaid node table (see the top of this file). Node IDs are
+    read from the 'node_id' or 'treenode_id' column, or from the index if it
+    has one of those names. Nodes whose radius is primary_neurite_radius get
+    the PRIMARY_NEURITE_NODE flag.
+    """
+    def __init__(self, nodes, primary_neurite_radius=PRIMARY_NEURITE_RADIUS):
+        if nodes.index.name in ('node_id', 'treenode_id'):
+            nodes = nodes.reset_index()
+        id_column = 'node_id' if 'node_id' in nodes.columns else 'treenode_id'
+        self.node_ids = nodes[id_column].values.astype(np.int64)
+        self._id_index = pd.Index(self.node_ids)
+        n = len(self.node_ids)
+
+        parent_ids = pd.to_numeric(nodes.parent_id, errors='coerce').values
+        has_parent = ~np.isnan(parent_ids) & (parent_ids >= 0)
+        parent = np.full(n, -1, dtype=np.int32)
+        parent[has_parent] = self._id_index.get_indexer(
+            parent_ids[has_parent].astype(np.int64))
+        if (parent[has_parent] == -1).any():
+            raise ValueError('Some nodes have parents that are not in the'
+                             ' node table')
+        self.parent = parent
+
+        self.xyz = nodes[['x', 'y', 'z']].values.astype(np.float32)
+        self.radius = nodes.radius.values.astype(np.float32)
+
+        # Children in CSR form, each node's children in node table order
+        child_indices = np.nonzero(parent >= 0)[0]
+        order = np.argsort(parent[child_indices], kind='stable')
+        self.children = child_indices[order].astype(np.int32)
+        n_children = np.bincount(parent[child_indices], minlength=n)
+        self.child_offsets = np.zeros(n + 1, dtype=np.int32)
+        np.cumsum(n_children, out=self.child_offsets[1:])
+        self.n_children = n_children.astype(np.int32)
+
+        self.edge_length = np.zeros(n, dtype=np.float32)
+        self.edge_length[child_indices] = np.linalg.norm(
+            self.xyz[child_indices] - self.xyz[parent[child_indices]], axis=1)
+
+        is_root = parent == -1
+        flags = np.zeros(n, dtype=np.uint8)
+        flags[is_root] |= ROOT_NODE
+        flags[~is_root & (n_children == 0)] |= LEAF_NODE
+        flags[~is_root & (n_children > 1)] |= BRANCH_NODE
+        flags[~is_root & (n_children == 1)] |= SLAB_NODE
+        flags[self.radius == primary_neurite_radius] |= PRIMARY_NEURITE_NODE
+        self.flags = flags
+
+        self._levels = None
+        self._distance_from_root = None
+        self._root_index = None
+        self._distance_to_primary_neurite = None
+        self._primary_neurite_attachment = None
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def index(self, node_ids):
+        """Indices of the given node IDs (a single ID gives a single index)."""
+        if np.ndim(node_ids) == 0:
+            return int(self.index([node_ids])[0])
+        indices = self._id_index.get_indexer(np.asarray(node_ids, dtype=np.int64))
+        if (indices == -1).any():
+            raise KeyError(f'Nodes {np.asarray(node_ids)[indices == -1].tolist()}'
+                           ' are not in this skeleton')
+        return indices
+
+    def get_children(self, i):
+        return self.children[self.child_offsets[i]:self.child_offsets[i+1]]
+
+    def has_flag(self, flag):
+        """Boolean array of which nodes have the given flag."""
+        return (self.flags & flag) != 0
+
+    def path_up(self, i, stop_flag=ROOT_NODE):
+        """
+        Indices of the nodes from node i up to and including its first
+        ancestor (or i itself) with stop_flag. Returns None if the root is
+        passed without finding one.
+        """
+        parent = self.parent
+        flags = self.flags
+        path = [i]
+        while not flags[i] & stop_flag:
+            i = parent[i]
+            if i == -1:
+                return None
+            path.append(i)
+        return np.array(path, dtype=np.int32)
+
+    def path_length(self, path):
+        """Cable length along a path of node indices going up the tree."""
+        return float(self.edge_length[path[:-1]].sum(dtype=np.float64))
+
+    def levels(self):
+        """
+        Node indices grouped by depth: the roots, then their children, then
+        their children's children, and so on. Every node's parent is in the
+        level before it.
+        """
+        if self._levels is None:
+            levels = []
+            level = np.nonzero(self.parent == -1)[0].astype(np.int32)
+            while len(level) > 0:
+                levels.append(level)
+                starts = self.child_offsets[level]
+                counts = self.child_offsets[level + 1] - starts
+                # The children of all nodes in this level, gathered at once
+                offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+                level = self.children[offsets + np.arange(counts.sum())]
+            self._levels = levels
+        return self._levels
+
+    def _accumulate_from_root(self):
+        distance = np.zeros(len(self), dtype=np.float64)
+        root_index = np.zeros(len(self), dtype=np.int32)
+        levels = self.levels()
+        if len(levels) > 0:
+            root_index[levels[0]] = levels[0]
+        for level in levels[1:]:
+            parents = self.parent[level]
+            distance[level] = distance[parents] + self.edge_length[level]
+            root_index[level] = root_index[parents]
+        self._distance_from_root = distance
+        self._root_index = root_index
+
+    def distance_from_root(self, indices=None):
+        """
+        Cable length from the root to each node (or to the nodes at the given
+        indices). All nodes' distances are computed together the first time
+        and kept.
+        """
+        if self._distance_from_root is None:
+            self._accumulate_from_root()
+        if indices is None:
+            return self._distance_from_root
+        return self._distance_from_root[indices]
+
+    def distance_to_primary_neurite(self):
+        """
+        For every node, the cable length up the tree to the nearest node with
+        the PRIMARY_NEURITE_NODE flag (0 for primary neurite nodes
+        themselves), and the index of that node. Nodes with no primary
+        neurite node above them get a distance of -1 and an index of -1.
+        Computed in one pass down the tree and kept.
+        """
+        if self._distance_to_primary_neurite is None:
+            is_prim_neurite = self.has_flag(PRIMARY_NEURITE_NODE)
+            distance = np.full(len(self), -1, dtype=np.float64)
+            attachment = np.full(len(self), -1, dtype=np.int32)
+            for depth, level in enumerate(self.levels()):
+                if depth > 0:
+                    parents = self.parent[level]
+                    attached = attachment[parents] != -1
+                    distance[level[attached]] = (distance[parents[attached]]
+                                                 + self.edge_length[level[attached]])
+                    attachment[level[attached]] = attachment[parents[attached]]
+                on_prim_neurite = level[is_prim_neurite[level]]
+                distance[on_prim_neurite] = 0
+                attachment[on_prim_neurite] = on_prim_neurite
+            self._distance_to_primary_neurite = distance
+            self._primary_neurite_attachment = attachment
+        return self._distance_to_primary_neurite, self._primary_neurite_attachment
+
+    def root_index(self, indices=None):
+        """Index of the root of each node's tree (or of the given nodes')."""
+        if self._root_index is None:
+            self._accumulate_from_root()
+        if indices is None:
+            return self._root_index
+        return self._root_index[indices]
+
+
+def as_skeleton_graph(nodes, primary_neurite_radius=PRIMARY_NEURITE_RADIUS):
+    """
+    nodes as a SkeletonGraph. nodes can already be one, or be a node table or
+    a CatmaidNeuron.
+    """
+    if isinstance(nodes, SkeletonGraph):
+        return nodes
+    if hasattr(nodes, 'nodes'):
+        nodes = nodes.nodes
+    return SkeletonGraph(nodes, primary_neurite_radius=primary_neurite_radius)
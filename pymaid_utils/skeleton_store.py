@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+# Requires python 3.6+ for f-strings
+
+# A local, on-disk store of skeletons pulled from CATMAID. Along with each
+# skeleton, the store records the skeleton's "edition state" (the time its
+# most recently edited node was changed, its number of nodes, its tags and its
+# name) at the time it was downloaded. sync(skids) asks the server for the
+# current edition state of each skeleton and only re-downloads the skeletons
+# whose state changed. The edition states of any number of skeletons take
+# at most five requests (see get_edition_states), none of which download any
+# nodes other than tagged ones, so checking an up-to-date store costs next to
+# nothing compared to downloading it again.
+#
+# When this file is imported during package initialization (see __init__.py),
+# it's given access to the package's source_project and target_project.
+
+import os
+import json
+import time
+import pickle
+import hashlib
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pymaid
+from requests.exceptions import HTTPError
+
+try:
+    from . import connections
+    from .connections import response_cache
+except:
+    import connections
+    from connections import response_cache
+
+
+# Set the environment variable PYMAID_UTILS_SKELETON_STORE_DIR to put the
+# store elsewhere
+SKELETON_STORE_DIR = os.environ.get(
+    'PYMAID_UTILS_SKELETON_STORE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'pymaid_utils', 'skeletons')
+)
+# Number of skeletons requested per pymaid.get_neuron call by fetch_neurons
+NEURON_CHUNK_SIZE = 25
+
+# Edition states each thread was told to reuse (see reusing_edition_states)
+_reused_edition_states = threading.local()
+
+
+class SkeletonStore:
+    """
+    Skeletons from one project on one CATMAID server. Each skeleton is stored
+    as a pickle file holding the same fields pymaid.get_neuron returns
+    (neuron_name, skeleton_id, nodes, connectors, tags), and index.json holds
+    the edition state of every stored skeleton.
+    """
+    def __init__(self, server, project_id, store_dir=SKELETON_STORE_DIR):
+        self.server = server.rstrip('/')
+        self.project_id = project_id
+        server_hash = hashlib.sha256(self.server.encode()).hexdigest()[:16]
+        self.folder = os.path.join(store_dir, server_hash, str(project_id))
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            try:
+                with open(os.path.join(self.folder, 'index.json'), 'r') as f:
+                    self._index = json.load(f)
+            except FileNotFoundError:
+                self._index = {}
+        return self._index
+
+    def save_index(self):
+        os.makedirs(self.folder, exist_ok=True)
+        index_fn = os.path.join(self.folder, 'index.json')
+        with open(index_fn + f'.{os.getpid()}.tmp', 'w') as f:
+            json.dump(self.index, f, indent=0)
+        os.replace(index_fn + f'.{os.getpid()}.tmp', index_fn)
+
+    def _path(self, skid):
+        return os.path.join(self.folder, f'{int(skid)}.pkl')
+
+    def __contains__(self, skid):
+        return (str(int(skid)) in self.index
+                and os.path.exists(self._path(skid)))
+
+    def get_edition_state(self, skid):
+        """The edition state recorded when skid was stored, or None."""
+        return self.index.get(str(int(skid)), None)
+
+    def load(self, skid):
+        with open(self._path(skid), 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, skid, data, edition_state, save_index=True):
+        """
+        Store a skeleton. When saving many, pass save_index=False and call
+        save_index() once at the end instead of rewriting index.json for
+        each one.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        with open(self._path(skid), 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.index[str(int(skid))] = edition_state
+        if save_index:
+            self.save_index()
+
+    def update(self, skid, **fields):
+        """
+        Add or replace extra fields stored alongside a skeleton (e.g. results
+        precomputed from it). They're thrown away when the skeleton changes.
+        """
+        data = self.load(skid)
+        data.update(fields)
+        with open(self._path(skid), 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def fetch_neurons(skids, workers=None, chunk_size=NEURON_CHUNK_SIZE,
+                  remote_instance=None, return_df=False, use_cache=True,
+                  verbose=True, **kwargs):
+    """
+    Download neurons in chunks of chunk_size skeletons, with up to workers
+    chunks (default connections.MAX_CONCURRENCY) in flight at once. Each chunk
+    is one pymaid.get_neuron call, so while some chunks are downloading others
+    are being parsed. The total number of simultaneous requests is still
+    capped by the shared connection pool (connections.MAX_CONCURRENCY); see
+    connections.get_request_metrics() for per-request timings when tuning
+    workers and chunk_size. kwargs are passed to pymaid.get_neuron. With
+    use_cache=False the response cache is skipped.
+    Returns a CatmaidNeuronList in the order of skids, or a DataFrame if
+    return_df=True.
+    """
+    remote_instance = _eval_remote_instance(remote_instance)
+    if isinstance(skids, (int, str)):
+        skids = [skids]
+    skids = list(dict.fromkeys([int(skid) for skid in skids]))
+    if workers is None:
+        workers = connections.MAX_CONCURRENCY
+    if len(skids) == 0:
+        return pd.DataFrame() if return_df else pymaid.CatmaidNeuronList([])
+
+    def fetch_chunk(chunk):
+        if use_cache:
+            return pymaid.get_neuron(chunk, return_df=True,
+                                     remote_instance=remote_instance, **kwargs)
+        with response_cache.bypassed():
+            return pymaid.get_neuron(chunk, return_df=True,
+                                     remote_instance=remote_instance, **kwargs)
+
+    chunks = [skids[i:i+chunk_size] for i in range(0, len(skids), chunk_size)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        neurons = pd.concat(list(pool.map(fetch_chunk, chunks)),
+                            ignore_index=True)
+    seconds = time.perf_counter() - start
+    if verbose:
+        print(f'Fetched {len(neurons)} neurons in {len(chunks)} chunks with'
+              f' {min(workers, len(chunks))} workers in {seconds:.1f}s'
+              f' ({len(neurons) / seconds:.1f} neurons/s)')
+
+    if return_df:
+        return neurons
+    return pymaid.CatmaidNeuronList(neurons, remote_instance=remote_instance)
+
+
+def get_store(remote_instance=None, store_dir=SKELETON_STORE_DIR):
+    remote_instance = _eval_remote_instance(remote_instance)
+    return SkeletonStore(remote_instance.server, remote_instance.project_id,
+                         store_dir=store_dir)
+
+
+@contextlib.contextmanager
+def reusing_edition_states(edition_states, remote_instance=None):
+    """
+    Inside this block, get_edition_states answers requests by this thread
+    for skeletons in edition_states (a dict returned by get_edition_states
+    for remote_instance) from that dict instead of asking the server again.
+    Only use it for blocks that run right after edition_states was fetched,
+    e.g. to let a function sync skeletons whose states its caller just
+    checked.
+    """
+    remote_instance = _eval_remote_instance(remote_instance)
+    project = (remote_instance.server, int(remote_instance.project_id))
+    previous = getattr(_reused_edition_states, 'projects', {})
+    _reused_edition_states.projects = {
+        **previous, project: {**previous.get(project, {}), **edition_states}}
+    try:
+        yield
+    finally:
+        _reused_edition_states.projects = previous
+
+
+def get_edition_states(skids, remote_instance=None):
+    """
+    Ask the server for the current edition state of each skeleton. Returns a
+    dict of skid -> {'last_edited', 'n_nodes', 'tags', 'name'}, or skid ->
+    None for skeletons that don't exist. 'last_edited' is in seconds since the
+    epoch.
+
+    This takes at most five requests however many skeletons there are:
+    CATMAID's skeleton summaries (each skeleton's last edition time and node
+    count, kept up to date by the server whenever a node is added, changed or
+    deleted), the skeletons' tags (see _get_tags) and the neurons' names.
+    Servers too old to have skeletons/summary get one node-overview request
+    per skeleton instead, which downloads every node. Edits that only add or
+    remove connector links don't change a skeleton's edition time, so they
+    aren't detected - use sync(..., force=True) after such edits, or see
+    get_connector_links_state. Inside a reusing_edition_states block, the
+    states given to it are returned without asking the server.
+    """
+    remote_instance = _eval_remote_instance(remote_instance)
+    skids = [int(skid) for skid in skids]
+    if len(skids) == 0:
+        return {}
+    reused = getattr(_reused_edition_states, 'projects', {}).get(
+        (remote_instance.server, int(remote_instance.project_id)), {})
+    if all(skid in reused for skid in skids):
+        return {skid: reused[skid] for skid in skids}
+    with response_cache.bypassed():  # Must see the server's current state
+        try:
+            summaries = _get_skeleton_summaries(skids, remote_instance)
+        except HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            print('This server has no skeletons/summary endpoint. Getting'
+                  ' edition states from each skeleton\'s nodes instead.')
+            return _get_edition_states_from_nodes(skids, remote_instance)
+        tags = _get_tags(skids, remote_instance)
+        names = pymaid.get_names(skids, remote_instance=remote_instance)
+
+    edition_states = {}
+    for skid in skids:
+        summary = summaries.get(skid, None)
+        if summary is None or summary['num_nodes'] == 0:
+            edition_states[skid] = None
+            continue
+        edition_states[skid] = {
+            'last_edited': _to_seconds(summary['last_edition_time']),
+            'n_nodes': int(summary['num_nodes']),
+            'tags': _hash_tags(tags.get(skid, [])),
+            'name': names.get(str(skid), None)
+        }
+    return edition_states
+
+
+def get_connector_links_state(skids, remote_instance=None):
+    """
+    A hash of every connector link of the given skeletons, with each linked
+    connector's position, that changes whenever a link is added or removed or
+    a connector is moved. get_edition_states doesn't see those edits. Takes
+    one request.
+    """
+    remote_instance = _eval_remote_instance(remote_instance)
+    post = {f'skeleton_ids[{i}]': int(skid) for i, skid in enumerate(skids)}
+    post.update(with_partners='true', with_tags='false')
+    with response_cache.bypassed():  # Must see the server's current state
+        response = remote_instance.fetch(remote_instance._get_connectors_url(),
+                                         post=post, desc='Get connector links')
+    positions = {int(c[0]): [float(v) for v in c[1:4]]
+                 for c in response['connectors']}
+    # Partner rows are [link ID, node ID, skid, relation ID, confidence, user]
+    links = sorted([int(connector_id), *positions.get(int(connector_id), []),
+                    int(link[1]), int(link[2]), int(link[3])]
+                   for connector_id, partners in response['partners'].items()
+                   for link in partners)
+    return hashlib.sha256(json.dumps(links).encode()).hexdigest()
+
+
+def _get_skeleton_summaries(skids, remote_instance):
+    """dict of skid -> CATMAID's summary of that skeleton, in one request."""
+    post = {f'skeleton_ids[{i}]': skid for i, skid in enumerate(skids)}
+    summaries = remote_instance.fetch(
+        remote_instance.make_url(remote_instance.project_id, 'skeletons',
+                                 'summary'),
+        post=post, desc='Get edition times')
+    return {int(summary['skeleton_id']): summary for summary in summaries}
+
+
+def _get_tags(skids, remote_instance):
+    """
+    dict of skid -> sorted list of (node ID, tag), for skeletons with tags.
+    Takes up to three requests, which only return the given skeletons' tagged
+    nodes: the project's label names, the skeletons' nodes that have any of
+    them and those nodes' labels.
+    """
+    label_names = remote_instance.fetch(
+        remote_instance.make_url(remote_instance.project_id, 'labels/'),
+        desc='Get label names')
+    if len(label_names) == 0:
+        return {}
+    tagged_nodes = pymaid.find_nodes(tags=label_names, skeleton_ids=skids,
+                                     remote_instance=remote_instance)
+    if tagged_nodes is None or len(tagged_nodes) == 0:
+        return {}
+    node_skids = dict(zip(tagged_nodes.node_id.astype(int),
+                          tagged_nodes.skeleton_id.astype(int)))
+    node_tags = pymaid.get_node_tags(list(node_skids), 'TREENODE',
+                                     remote_instance=remote_instance)
+    tags = {}
+    for node_id, node_labels in node_tags.items():
+        tags.setdefault(node_skids[int(node_id)], []).extend(
+            (int(node_id), tag) for tag in node_labels)
+    return {skid: sorted(skid_tags) for skid, skid_tags in tags.items()}
+
+
+def _get_edition_states_from_nodes(skids, remote_instance):
+    urls = [remote_instance._get_skeleton_nodes_url(skid) for skid in skids]
+    with response_cache.bypassed():
+        node_overviews = remote_instance.fetch(urls,
+                                               desc='Get edition times')
+        names = pymaid.get_names(skids, remote_instance=remote_instance)
+
+    edition_states = {}
+    for skid, (nodes, reviews, tags) in zip(skids, node_overviews):
+        if len(nodes) == 0:
+            edition_states[skid] = None
+            continue
+        # Node rows are [id, parent_id, confidence, x, y, z, radius, creator,
+        # edition_time]
+        edition_states[skid] = {
+            'last_edited': max([_to_seconds(node[8]) for node in nodes]),
+            'n_nodes': len(nodes),
+            'tags': _hash_tags(sorted((int(node), tag) for node, tag in tags)),
+            'name': names.get(str(skid), None)
+        }
+    return edition_states
+
+
+def _hash_tags(tags):
+    # tags is a sorted list of (node ID, tag)
+    tags = json.dumps([[node, tag] for node, tag in tags])
+    return hashlib.sha256(tags.encode()).hexdigest()
+
+
+def _to_seconds(timestamp):
+    # CATMAID sends times as ISO 8601 strings or as seconds since the epoch
+    if isinstance(timestamp, str):
+        return pd.Timestamp(timestamp).timestamp()
+    return float(timestamp)
+
+
+def find_changed_skeletons(skids, remote_instance=None,
+                           store_dir=SKELETON_STORE_DIR):
+    """
+    Return the skids whose skeletons on the server differ from (or are missing
+    from) the local store.
+    """
+    store = get_store(remote_instance, store_dir=store_dir)
+    edition_states = get_edition_states(skids, remote_instance)
+    return [skid for skid, state in edition_states.items()
+            if skid not in store or store.get_edition_state(skid) != state]
+
+
+def sync(skids, remote_instance=None, force=False, workers=None,
+         store_dir=SKELETON_STORE_DIR, verbose=True):
+    """
+    Return a CatmaidNeuronList of the requested skeletons, re-downloading only
+    the ones that have been edited since they were last stored locally (or
+    all of them, if force=True). Downloads go through fetch_neurons with the
+    given number of workers.
+    Unlike pymaid.get_neuron, this always returns a CatmaidNeuronList, even
+    for a single skid.
+    """
+    remote_instance = _eval_remote_instance(remote_instance)
+    if isinstance(skids, (int, str)):
+        skids = [skids]
+    skids = list(dict.fromkeys([int(skid) for skid in skids]))
+    store = get_store(remote_instance, store_dir=store_dir)
+
+    edition_states = get_edition_states(skids, remote_instance)
+    missing = [skid for skid in skids if edition_states[skid] is None]
+    if len(missing) > 0:
+        raise ValueError('The following skeleton ID(s) could not be found in'
+                         f' project {remote_instance.project_id}: {missing}')
+    to_download = [skid for skid in skids if force or skid not in store
+                   or store.get_edition_state(skid) != edition_states[skid]]
+
+    if len(to_download) > 0:
+        # The store replaces the response cache for these
+        downloaded = fetch_neurons(to_download, workers=workers,
+                                   remote_instance=remote_instance,
+                                   return_df=True, use_cache=False,
+                                   verbose=verbose)
+        for i, row in downloaded.iterrows():
+            skid = int(row.skeleton_id)
+            store.save(skid, row.to_dict(), edition_states[skid], save_index=False)
+        store.save_index()
+    if verbose:
+        print(f'Synced {len(skids)} skeletons from project'
+              f' {remote_instance.project_id}: downloaded {len(to_download)},'
+              f' {len(skids) - len(to_download)} unchanged since last sync')
+
+    neurons = pd.DataFrame([store.load(skid) for skid in skids])
+    return pymaid.CatmaidNeuronList(
+        neurons[['neuron_name', 'skeleton_id', 'nodes', 'connectors', 'tags']],
+        remote_instance=remote_instance
+    )
+
+
+def _eval_remote_instance(remote_instance):
+    if remote_instance in [None, 'source']:
+        return source_project
+    elif remote_instance == 'target':
+        return target_project
+    elif remote_instance == 'global':  # Whichever one pymaid uses by default
+        return pymaid.utils._eval_remote_instance(None)
+    return remote_instance
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# Shared fixtures for the pymaid_utils tests. The tests that talk to CATMAID
+# run against the fake server in fake_catmaid_server.py, started once per test
+# session, so they work offline. The response cache, skeleton store and
+# analysis cache are kept in a temporary folder instead of the user's own.
+#
+# Run with: python3 -m pytest pymaid_utils/tests
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+import pytest
+
+tmp_dir = tempfile.mkdtemp(prefix='pymaid_utils_tests_')
+os.environ['PYMAID_UTILS_CACHE_DIR'] = os.path.join(tmp_dir, 'responses')
+os.environ['PYMAID_UTILS_SKELETON_STORE_DIR'] = os.path.join(tmp_dir, 'skeletons')
+os.environ['PYMAID_UTILS_ANALYSIS_CACHE_DIR'] = os.path.join(tmp_dir, 'analysis')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+import pymaid
+import pymaid_utils as pu
+from pymaid_utils import fake_catmaid_server
+
+
+@pytest.fixture(scope='session')
+def fake_server():
+    """A fake CATMAID server that source_project and target_project point to."""
+    server = fake_catmaid_server.start_fake_catmaid_server(port=0)
+    with open(os.path.join(os.path.dirname(pu.connections.__file__), 'connection_configs',
+                           'catmaid_configs_local_fake_server.json'), 'r') as f:
+        configs = json.load(f)
+    configs['source_catmaid_url'] = configs['target_catmaid_url'] = server.server_url
+    config_fn = os.path.join(tmp_dir, 'catmaid_configs.json')
+    with open(config_fn, 'w') as f:
+        json.dump(configs, f)
+    pu.reset_connection(config_filename=config_fn)
+    pymaid.set_pbars(hide=True)
+    yield server
+    server.shutdown()
+    pu.reset_connection()
+
+
+@pytest.fixture
+def request_counts(fake_server):
+    """The fake server's per-endpoint request counts, reset for this test."""
+    fake_server.catmaid.request_counts.clear()
+    return fake_server.catmaid.request_counts
+
+
+@pytest.fixture
+def store_dir(tmp_path):
+    return str(tmp_path / 'skeletons')
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+import pymaid
+
+import pymaid_utils as pu
+
+
+def get_skid():
+    return pu.get_skids_by_annotation(['motor neuron', 'left soma'])[5]
+
+
+def move_node(node_id, xyz):
+    pu.source_project.fetch(pu.source_project._update_node_url(),
+                            post={'t[0][0]': node_id, 't[0][1]': xyz[0],
+                                  't[0][2]': xyz[1], 't[0][3]': xyz[2]})
+
+
+def make_counted(tmp_path, result, **memoize_kwargs):
+    """A memoized function returning result, that counts its calls."""
+    calls = []
+
+    @pu.memoize(skids=lambda skid: [skid], cache_dir=str(tmp_path),
+                **memoize_kwargs)
+    def function(skid):
+        calls.append(skid)
+        return result
+    return function, calls
+
+
+def test_hit_after_miss(fake_server, request_counts, tmp_path):
+    result = {'distances': np.arange(5.), 'counts': {3: np.ones(2, dtype=int)}}
+    function, calls = make_counted(tmp_path, result)
+    skid = get_skid()
+    function(skid)
+    request_counts.clear()
+    cached = function(skid)
+    assert len(calls) == 1
+    assert sum(request_counts.values()) == 5
+    np.testing.assert_array_equal(cached['distances'], result['distances'])
+    np.testing.assert_array_equal(cached['counts'][3], result['counts'][3])
+    assert list((tmp_path / function.cache_name).glob('*.npz'))
+
+
+def test_other_results_are_pickled(fake_server, tmp_path):
+    result = pd.DataFrame({'skid': [1, 2], 'distance': [.5, 1.5]})
+    function, calls = make_counted(tmp_path, result)
+    skid = get_skid()
+    function(skid)
+    pd.testing.assert_frame_equal(function(skid), result)
+    assert len(calls) == 1
+    assert list((tmp_path / function.cache_name).glob('*.pkl'))
+
+
+def test_editing_the_skeleton_makes_the_result_stale(fake_server, tmp_path):
+    function, calls = make_counted(tmp_path, np.zeros(3))
+    skid = get_skid()
+    function(skid)
+    node = pymaid.get_neuron(skid, remote_instance=pu.source_project).nodes.iloc[2]
+    move_node(int(node.node_id), [node.x + 100, node.y, node.z])
+    try:
+        pu.reset_analysis_cache_stats()
+        function(skid)
+        function(skid)
+        assert len(calls) == 2
+        stats = pu.get_analysis_cache_stats().loc[function.cache_name]
+        assert (stats.stale, stats.hits) == (1, 1)
+    finally:
+        move_node(int(node.node_id), [node.x, node.y, node.z])
+
+
+def test_changing_the_version_makes_the_result_stale(fake_server, tmp_path):
+    skid = get_skid()
+    function, calls = make_counted(tmp_path, np.zeros(3), version=1)
+    function(skid)
+    function, calls = make_counted(tmp_path, np.zeros(3), version=2)
+    function(skid)
+    assert len(calls) == 1
+
+
+def test_connector_links_make_the_result_stale(fake_server, request_counts, tmp_path):
+    skid = get_skid()
+    with_links, with_links_calls = make_counted(tmp_path / 'links', np.zeros(3),
+                                                connector_links=True)
+    without_links, without_links_calls = make_counted(tmp_path / 'nodes', np.zeros(3))
+    with_links(skid)
+    without_links(skid)
+    request_counts.clear()
+    with_links(skid)
+    assert sum(request_counts.values()) == 6
+
+    # Link a node to a new connector, which doesn't change the skeleton's
+    # edition state
+    node = pymaid.get_neuron(skid, remote_instance=pu.source_project).nodes.iloc[4]
+    connector_id = pu.source_project.fetch(
+        pu.source_project._create_connector_url(),
+        post={'x': node.x, 'y': node.y, 'z': node.z, 'confidence': 5})['connector_id']
+    pu.source_project.fetch(
+        pu.source_project._create_link_url(),
+        post={'from_id': int(node.node_id), 'to_id': connector_id,
+              'link_type': 'postsynaptic_to'})
+    try:
+        with_links(skid)
+        without_links(skid)
+        assert len(with_links_calls) == 2
+        assert len(without_links_calls) == 1
+    finally:
+        pu.source_project.fetch(pu.source_project._delete_connector_url(),
+                                post={'connector_id': connector_id})
+
+
+def test_syncing_inside_reuses_the_edition_states(fake_server, request_counts,
+                                                  tmp_path, store_dir):
+    @pu.memoize(skids=lambda skid: [skid], cache_dir=str(tmp_path))
+    def count_nodes(skid):
+        return pu.sync([skid], store_dir=store_dir, verbose=False)[0].n_nodes
+
+    skid = get_skid()
+    request_counts.clear()
+    n_nodes = count_nodes(skid)
+    assert n_nodes > 0
+    assert request_counts['POST skeletons/summary'] == 1
+    assert request_counts['GET skeletons/{id}/compact-detail'] == 1
+
+    # Outside the memoized call the states are asked for again
+    request_counts.clear()
+    pu.sync([skid], store_dir=store_dir, verbose=False)
+    assert request_counts['POST skeletons/summary'] == 1
+
+
+def test_results_are_stored_per_project(fake_server, tmp_path):
+    calls = []
+
+    @pu.memoize(cache_dir=str(tmp_path), remote_instance='global')
+    def project_name():
+        calls.append(pymaid.utils._eval_remote_instance(None).project_id)
+        return calls[-1]
+
+    try:
+        pu.source_project.make_global()
+        assert project_name() == pu.source_project.project_id
+        pu.target_project.make_global()
+        assert project_name() == pu.target_project.project_id
+        pu.source_project.make_global()
+        assert project_name() == pu.source_project.project_id
+        assert calls == [pu.source_project.project_id,
+                         pu.target_project.project_id]
+    finally:
+        pu.source_project.make_global()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import pymaid
+import pymaid_utils as pu
+
+
+def add_annotation(skid, annotation):
+    pymaid.add_annotations(skid, annotation, remote_instance=pu.target_project)
+
+
+def test_add_keeps_index_current_after_its_own_write(fake_server):
+    index = pu.get_annotation_index('target', rebuild=True)
+    skid = sorted(index.skids)[0]
+    with pu.counting_modifications() as modifications:
+        add_annotation(skid, 'test own write')
+    index.add(skid, 'test own write', modifications=modifications)
+    assert index.is_current
+    assert skid in index.get_skids('test own write')
+
+
+def test_add_doesnt_hide_other_writes(fake_server):
+    index = pu.get_annotation_index('target', rebuild=True)
+    skids = sorted(index.skids)[:2]
+    # A write this index is never told about, then one it records
+    add_annotation(skids[1], 'test other write')
+    with pu.counting_modifications() as modifications:
+        add_annotation(skids[0], 'test recorded write')
+    index.add(skids[0], 'test recorded write', modifications=modifications)
+    assert not index.is_current
+    index = pu.get_annotation_index('target')
+    assert skids[1] in index.get_skids('test other write')
+
+
+def test_add_without_modifications_leaves_index_stale(fake_server):
+    index = pu.get_annotation_index('target', rebuild=True)
+    skid = sorted(index.skids)[0]
+    add_annotation(skid, 'test uncounted write')
+    index.add(skid, 'test uncounted write')
+    assert not index.is_current
+
+
+def test_counting_modifications_ignores_reads_and_other_threads(fake_server):
+    from concurrent.futures import ThreadPoolExecutor
+    index = pu.get_annotation_index('target', rebuild=True)
+    skid = sorted(index.skids)[0]
+    with pu.counting_modifications() as modifications:
+        pymaid.get_names(skid, remote_instance=pu.target_project)
+        with ThreadPoolExecutor(1) as pool:
+            pool.submit(add_annotation, skid, 'test other thread').result()
+    assert sum(modifications.values()) == 0
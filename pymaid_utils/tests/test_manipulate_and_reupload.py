@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+import subprocess
+import threading
+import contextlib
+
+import numpy as np
+import pymaid
+import pymaid_utils as pu
+from pymaid_utils import manipulate_and_reupload_catmaid_neurons as mr
+
+
+def test_upload_temp_files_are_separate_per_thread():
+    with mr._separate_upload_temp_files(4) as workers:
+        assert workers == 4
+        dirs = [pymaid.upload.tempfile.gettempdir()]
+        thread = threading.Thread(
+            target=lambda: dirs.append(pymaid.upload.tempfile.gettempdir()))
+        thread.start()
+        thread.join()
+        assert len(set(dirs)) == 2
+    assert pymaid.upload.tempfile is tempfile
+
+
+def test_upload_falls_back_to_one_worker(monkeypatch, capsys):
+    monkeypatch.setattr(pymaid.upload, 'tempfile', object())
+    with mr._separate_upload_temp_files(4) as workers:
+        assert workers == 1
+    assert 'one neuron at a time' in capsys.readouterr().out
+
+
+def copy_neuron(skid, policy, **kwargs):
+    with contextlib.redirect_stdout(None):
+        responses = pu.copy_neurons_by_skid([skid], fake=False, refuse_to_update=False,
+                                            policy=policy, **kwargs)
+    return [int(response['skeleton_id']) for response in responses]
+
+
+def move_node(remote_instance, node, dx):
+    remote_instance.fetch(remote_instance._update_node_url(),
+                          post={'t[0][0]': int(node.node_id), 't[0][1]': node.x + dx,
+                                't[0][2]': node.y, 't[0][3]': node.z})
+
+
+def test_hand_edits_to_a_linked_neuron_are_detected(fake_server, monkeypatch):
+    skid = pu.get_skids_by_annotation(['motor neuron', 'left soma'])[10]
+    copy_skid, = copy_neuron(skid, pu.Policy.unattended())
+    node = pymaid.get_neuron(copy_skid, remote_instance=pu.target_project).nodes.iloc[3]
+    move_node(pu.target_project, node, 200)
+    # Update annotations are to the minute, so make the edit look later
+    get_last_update_times = mr.get_last_update_times
+    monkeypatch.setattr(mr, 'get_last_update_times', lambda *args: {
+        skid: t - 120 for skid, t in get_last_update_times(*args).items()})
+    policy = pu.Policy.unattended()
+    assert copy_neuron(skid, policy) == []
+    decisions = policy.report()
+    assert decisions.condition.tolist() == ['edited_nodes']
+    assert decisions.action.tolist() == ['skip']
+
+
+def test_edits_made_by_differential_updates_are_not_hand_edits(fake_server):
+    skid = pu.get_skids_by_annotation(['motor neuron', 'left soma'])[11]
+    copy_skid, = copy_neuron(skid, pu.Policy.unattended())
+    node = pymaid.get_neuron(skid, remote_instance=pu.source_project).nodes.iloc[5]
+    for i in range(2):
+        move_node(pu.source_project, node, 100 * (i + 1))
+        policy = pu.Policy.unattended()
+        assert copy_neuron(skid, policy) == [copy_skid]
+        assert len(policy.report()) == 0
+        copy = pymaid.get_neuron(copy_skid, remote_instance=pu.target_project)
+        assert (copy.nodes.x == node.x + 100 * (i + 1)).sum() == 1
+
+
+AFFINE_PARAMETERS = '''(Transform "AffineTransform")
+(NumberOfParameters 12)
+(TransformParameters 0.9 0.1 0 -0.1 1.1 0 0 0 1 500 -300 200)
+(CenterOfRotationPoint 100000 200000 50000)
+(InitialTransformParametersFileName "NoInitialTransform")
+(HowToCombineTransforms "Compose")
+(FixedImageDimension 3)
+'''
+
+
+def test_elastic_transform_moves_nodes_and_connectors(fake_server, tmp_path):
+    (tmp_path / 'TransformParameters.txt').write_text(AFFINE_PARAMETERS)
+    skid = pu.get_skids_by_annotation(['motor neuron', 'left soma'])[12]
+    neuron = pymaid.get_neuron(skid, remote_instance=pu.source_project)
+    chain = mr.transform_chain.TransformChain([
+        {'type': 'translate', 'offset': [1000, 0, 0]},
+        {'type': 'elastix', 'parameter_file': 'TransformParameters.txt'},
+        {'type': 'mirror', 'axis': 0, 'plane': 300000}
+    ], base_dir=str(tmp_path), y_coordinate_cutoff=neuron.nodes.y.quantile(0.2))
+
+    with contextlib.redirect_stdout(None):
+        transformed, = pu.get_elastictransformed_neurons_by_skid(
+            skid, elastix_parameter_file=chain, include_connectors=True,
+            policy=pu.Policy.unattended())
+    nodes = neuron.nodes[neuron.nodes.y >= chain.info['y_coordinate_cutoff']
+                         ].set_index('node_id')
+    transformed_nodes = transformed.nodes.set_index('node_id')
+    assert sorted(transformed_nodes.index) == sorted(nodes.index)
+    expected = chain.transform_points(nodes[['x', 'y', 'z']].values)
+    assert np.allclose(transformed_nodes.loc[nodes.index, ['x', 'y', 'z']].values,
+                       expected, atol=1e-3)
+    x, y, z = nodes[['x', 'y', 'z']].values[0]
+    x, y = (0.9 * (x + 1000 - 100000) + 0.1 * (y - 200000) + 100000 + 500,
+            -0.1 * (x + 1000 - 100000) + 1.1 * (y - 200000) + 200000 - 300)
+    assert np.allclose(transformed_nodes.loc[nodes.index[0], ['x', 'y', 'z']].values,
+                       [600000 - x, y, z + 200], atol=1e-3)
+
+    # Connectors on the nodes that were cut off go with them
+    connectors = transformed.connectors.merge(
+        neuron.connectors, on=['connector_id', 'node_id'], suffixes=('', '_source'))
+    assert len(connectors) == len(transformed.connectors) > 0
+    assert np.allclose(connectors[['x', 'y', 'z']].values,
+                       chain.transform_points(connectors[['x_source', 'y_source', 'z_source']].values),
+                       atol=1e-3)
+
+
+def test_transform_chain_is_loaded_without_changing_sys_path():
+    assert sys.modules['transform_chain'] is mr.transform_chain
+    assert sys.modules['elastix_transform'] is mr.transform_chain.elastix_transform
+    # Other tests may change sys.path, so import the package in a fresh process
+    changed = subprocess.run(
+        [sys.executable, '-c', 'import sys; before = list(sys.path);'
+         ' import pymaid_utils; print(sys.path != before)'],
+        cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'),
+        capture_output=True, text=True, check=True).stdout.split()[-1]
+    assert changed == 'False'
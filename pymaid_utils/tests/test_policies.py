@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import pymaid_utils as pu
+from pymaid_utils import policies
+
+
+def answer(monkeypatch, *answers):
+    answers = list(answers)
+    monkeypatch.setattr('builtins.input', lambda prompt: answers.pop(0))
+
+
+def test_unknown_condition_or_action_is_rejected():
+    with pytest.raises(ValueError):
+        pu.Policy(not_a_condition='skip')
+    with pytest.raises(ValueError):
+        pu.Policy(name_mismatch='log')
+    with pytest.raises(ValueError):
+        pu.Policy(duplicate_links='overwrite')
+
+
+def test_unattended_never_asks(monkeypatch):
+    monkeypatch.setattr('builtins.input', lambda prompt: pytest.fail(prompt))
+    policy = pu.Policy.unattended(edited_nodes='overwrite')
+    assert 'ask' not in policy.to_dict().values()
+    assert policy.decide('confirm_batch', '') == 'overwrite'
+    assert policy.decide('name_mismatch', '') == 'skip'
+    assert policy.decide('edited_nodes', '') == 'overwrite'
+    assert policy.decide('duplicate_links', '') == 'log'
+    assert policy.report().asked.sum() == 0
+
+
+def test_unattended_redoes_transforms():
+    policy = pu.Policy.unattended()
+    assert policy.decide('reuse_transform_files', '') == 'overwrite'
+
+
+def test_ask_uses_each_decisions_own_answers(monkeypatch):
+    policy = pu.Policy()
+    answer(monkeypatch, 'y', 'n', 'l', 'x', 'r')
+    assert policy.decide('edited_nodes', '') == 'overwrite'
+    assert policy.decide('edited_nodes', '') == 'skip'
+    assert policy.decide('reuse_transform_files', '') == 'skip'
+    # An answer that isn't l or r is asked again
+    assert policy.decide('reuse_transform_files', '') == 'overwrite'
+    assert policy.report().asked.all()
+
+
+def test_every_decision_has_a_prompt():
+    assert set(policies.PROMPTS) == set(policies.DECISIONS)
+
+
+def test_abort_raises_and_is_recorded():
+    policy = pu.Policy(unlinked_connectors='abort')
+    with pytest.raises(pu.PolicyAbort):
+        policy.decide('unlinked_connectors', 'connectors left unlinked')
+    assert policy.report().action.tolist() == ['abort']
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# Tests of the distance distributions in
+# figures_and_analysis/Fig5-bCS_neuron_characterization/bCS_to_motor_neuron_synapse_analysis/quantify_bcs_to_mn_synapses.py.
+# The script finds its imports relative to its own folder and reads motor
+# neuron annotations when it's imported, so it's loaded from there with the
+# fake server running.
+
+import os
+import importlib.util
+from types import SimpleNamespace
+
+import pytest
+import numpy as np
+import pandas as pd
+import matplotlib
+
+import pymaid_utils as pu
+
+SCRIPT_FOLDER = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..',
+    'figures_and_analysis', 'Fig5-bCS_neuron_characterization',
+    'bCS_to_motor_neuron_synapse_analysis')
+
+
+@pytest.fixture(scope='module')
+def quantify(fake_server):
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        # The script picks a Qt backend for interactive use. Nothing is drawn here
+        monkeypatch.setattr(matplotlib, 'use', lambda *args, **kwargs: None)
+        monkeypatch.chdir(SCRIPT_FOLDER)
+        spec = importlib.util.spec_from_file_location(
+            'quantify_bcs_to_mn_synapses',
+            os.path.join(SCRIPT_FOLDER, 'quantify_bcs_to_mn_synapses.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    return module
+
+
+def motor_neuron(end):
+    """
+    A small motor neuron: a soma (node 0) with a primary neurite (radius
+    500, nodes 1-4) and a branch off of it at node 2 that forks at node 11
+    into leaves 12 and 13, plus a twig (30-31) off the soma that isn't
+    downstream of the primary neurite. With end='leaf' the primary neurite
+    ends at node 4. With end='twig' node 4 instead has a thin child, leaf
+    21, which isn't off a branch point.
+    """
+    rows = [
+        (0, None, (0, 0, 0), 100),
+        (30, 0, (0, -10, 0), 50), (31, 30, (0, -20, 0), 50),
+        (1, 0, (10, 0, 0), 500), (2, 1, (20, 0, 0), 500),
+        (3, 2, (30, 0, 0), 500), (4, 3, (40, 0, 0), 500),
+        (10, 2, (20, 10, 0), 50), (11, 10, (20, 20, 0), 50),
+        (12, 11, (20, 30, 0), 50), (13, 11, (25, 20, 0), 50)
+    ]
+    if end == 'twig':
+        rows.append((21, 4, (40, 5, 0), 50))
+    return pd.DataFrame([(node_id, parent_id, *xyz, radius)
+                         for node_id, parent_id, xyz, radius in rows],
+                        columns=['node_id', 'parent_id', 'x', 'y', 'z', 'radius'])
+
+
+@pytest.mark.parametrize('end', ['leaf', 'twig'])
+def test_distribution_counts_only_leaves_off_branches(quantify, monkeypatch,
+                                                      capsys, end):
+    nodes = motor_neuron(end)
+    monkeypatch.setattr(quantify.pymaid_utils, 'sync', lambda skids, **kwargs:
+                        [SimpleNamespace(nodes=nodes)])
+    monkeypatch.setattr(quantify.pymaid_utils, 'get_store', lambda *args: SimpleNamespace(
+        load=lambda skid: {}, update=lambda skid, **fields: None))
+
+    distribution = quantify.build_distance_to_primary_neurite_distribution.uncached(
+        7, scale=1)[7]
+    # Branch points 2 (on the primary neurite) and 11, and leaves 12 and 13.
+    # The soma's twig and the primary neurite's own end don't count
+    np.testing.assert_allclose(distribution['branch_distances'], [0, 20])
+    np.testing.assert_allclose(distribution['leaf_distances'], [25, 30])
+    assert ('Leaf node 21 is downstream' in capsys.readouterr().out) == (end == 'twig')
+
+
+def looped_distance_distribution(distances, distribution_parameters):
+    # The loops eval_distance_distribution replaced
+    values = []
+    for distance in distances:
+        n_paths = 0
+        for branch_distance in distribution_parameters['branch_distances']:
+            if branch_distance < distance:
+                n_paths += 1
+            else:
+                break
+        for leaf_distance in distribution_parameters['leaf_distances']:
+            if leaf_distance < distance:
+                n_paths -= 1
+            else:
+                break
+        values.append(n_paths)
+    return values
+
+
+def looped_cumulative_distance_distribution(distances, distribution_parameters):
+    # The loops eval_cumulative_distance_distribution replaced
+    values = []
+    distances = np.append(distances, distribution_parameters['leaf_distances'][-1])
+    for distance in distances:
+        value = 0
+        for branch_distance in distribution_parameters['branch_distances']:
+            if branch_distance < distance:
+                value += distance - branch_distance
+            else:
+                break
+        for leaf_distance in distribution_parameters['leaf_distances']:
+            if leaf_distance < distance:
+                value -= distance - leaf_distance
+            else:
+                break
+        values.append(value)
+    return [value/values[-1] for value in values[:-1]]
+
+
+def random_distribution(seed):
+    # Distances on a coarse grid, so that many are tied with each other and
+    # with the distances the distribution is evaluated at
+    rng = np.random.default_rng(seed)
+    branch_distances = np.sort(rng.integers(0, 20, 30).astype(float))
+    leaf_distances = np.sort(branch_distances + rng.integers(0, 10, 30))
+    return {'branch_distances': branch_distances, 'leaf_distances': leaf_distances}
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_distributions_match_the_looped_versions(quantify, seed):
+    distribution = random_distribution(seed)
+    distances = np.concatenate([np.arange(-1, 31), np.linspace(0, 30, 101)])
+    np.testing.assert_array_equal(
+        quantify.eval_distance_distribution(distances, distribution),
+        looped_distance_distribution(distances, distribution))
+    np.testing.assert_allclose(
+        quantify.eval_cumulative_distance_distribution(distances, distribution),
+        looped_cumulative_distance_distribution(distances, distribution))
+
+
+def test_distributions_at_tied_distances(quantify):
+    # Branch points and leaves exactly at d aren't counted yet
+    distribution = {'branch_distances': np.array([0., 2, 2]),
+                    'leaf_distances': np.array([2., 3, 5])}
+    assert list(quantify.eval_distance_distribution([0, 1, 2, 2.5, 3, 5, 6],
+                                                    distribution)) == [0, 1, 1, 2, 2, 1, 0]
+    assert quantify.eval_distance_distribution(2, distribution) == 1
+    np.testing.assert_allclose(
+        quantify.eval_cumulative_distance_distribution([0, 1, 2, 3, 5], distribution),
+        looped_cumulative_distance_distribution([0, 1, 2, 3, 5], distribution))
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+from types import SimpleNamespace
+
+from pymaid_utils.connections import RequestMetrics
+
+SERVER = 'https://catmaid.example.org'
+
+
+def fake_response(endpoint, method='GET', n_bytes=10):
+    return SimpleNamespace(url=f'{SERVER}/1/{endpoint}', status_code=200,
+                           request=SimpleNamespace(method=method),
+                           content=b'x' * n_bytes)
+
+
+def test_only_recent_requests_are_kept():
+    metrics = RequestMetrics(max_records=3)
+    for i in range(10):
+        metrics.record(SERVER, fake_response(f'skeletons/{i}/compact-detail'),
+                       float(i))
+    metrics.record(SERVER, fake_response('skeletons/summary', 'POST'), 1.)
+    assert len(metrics.to_dataframe()) == 3
+
+    # Counts and totals still cover every request
+    summary = metrics.summary().loc['GET', 'skeletons/{id}/compact-detail']
+    assert summary.n_requests == 10
+    assert summary.mean_seconds == 4.5
+    assert summary.max_seconds == 9
+    assert summary.total_bytes == 100
+    assert summary.median_seconds == 8.5
+
+    metrics.reset()
+    assert len(metrics.to_dataframe()) == 0
+    assert len(metrics.summary()) == 0
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import pymaid
+import pymaid_utils as pu
+from pymaid_utils.connections import ResponseCache
+
+SERVER = 'https://catmaid.example.org'
+
+
+def fill(cache, project_id, n=3):
+    keys = []
+    for i in range(n):
+        args = {'query': [], 'post': {'i': i}}
+        description = (SERVER, project_id, 'skeletons/summary', args,
+                       cache.generation(SERVER, project_id))
+        keys.append(cache.make_key(*description))
+        cache.put(keys[-1], b'x' * 10, *description)
+    return keys
+
+
+def test_invalidate_project_doesnt_read_entries(tmp_path, monkeypatch):
+    cache = ResponseCache(str(tmp_path))
+    fill(cache, 1)
+    other_keys = fill(cache, 2)
+
+    def fail(*args):
+        raise AssertionError('Entries were read')
+    monkeypatch.setattr(cache, '_read_metadata', fail)
+    monkeypatch.setattr(cache, 'entries', fail)
+    assert cache.invalidate_project(SERVER + '/', '1') == 1
+    monkeypatch.undo()
+
+    # Project 1's requests now have new keys, and project 2's are untouched
+    assert [cache.get(key) for key in other_keys] == [b'x' * 10] * 3
+    args = {'query': [], 'post': {'i': 0}}
+    assert cache.get(cache.make_key(SERVER, 1, 'skeletons/summary', args,
+                                    cache.generation(SERVER, 1))) is None
+
+
+def test_eviction_starts_with_invalidated_entries(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=None)
+    current = fill(cache, 2)
+    fill(cache, 1)
+    cache.invalidate_project(SERVER, 1)
+    assert cache.evict(max_bytes=30) == 3
+    assert set(cache.entries().key) == set(current)
+
+
+def test_writes_invalidate_cached_reads(fake_server, request_counts):
+    skid = pu.get_skids_by_annotation('motor neuron',
+                                      remote_instance=pu.target_project)[0]
+    pymaid.get_names(skid, remote_instance=pu.target_project)
+    request_counts.clear()
+    pymaid.get_names(skid, remote_instance=pu.target_project)
+    assert sum(request_counts.values()) == 0
+
+    pymaid.add_annotations(skid, 'test cache invalidation',
+                           remote_instance=pu.target_project)
+    request_counts.clear()
+    pymaid.get_names(skid, remote_instance=pu.target_project)
+    assert request_counts['POST skeleton/neuronnames'] == 1
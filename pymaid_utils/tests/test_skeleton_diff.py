@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+import pymaid
+import pytest
+
+import pymaid_utils as pu
+
+# A small skeleton: a trunk 1-2-3-4 branching at 3 into 5-6, with node 7 at
+# the same position as its parent 6, and 8 and 9 both at the same position
+# as their parent 4
+NODES = pd.DataFrame(
+    [[1, -1, 0, 0, 0], [2, 1, 100, 0, 0], [3, 2, 200, 0, 0],
+     [4, 3, 300, 0, 0], [5, 3, 200, 100, 0], [6, 5, 200, 200, 0],
+     [7, 6, 200, 200, 0], [8, 4, 300, 0, 0], [9, 4, 300, 0, 0]],
+    columns=['node_id', 'parent_id', 'x', 'y', 'z'])
+NODES['radius'] = -1.0
+
+
+def renumbered(nodes, offset=1000):
+    """The same skeleton with different node IDs, like an uploaded copy."""
+    nodes = nodes.copy()
+    nodes['node_id'] = nodes.node_id + offset
+    nodes['parent_id'] = nodes.parent_id.where(nodes.parent_id < 0,
+                                               nodes.parent_id + offset)
+    return nodes
+
+
+def test_self_diff_is_empty():
+    diff = pu.diff_skeletons(NODES, NODES)
+    assert diff.fallback_reason is None
+    assert diff.n_changes == 0
+    assert diff.node_map == {n: n for n in NODES.node_id}
+
+
+def test_copies_with_duplicate_positions_match():
+    diff = pu.diff_skeletons(NODES, renumbered(NODES))
+    assert diff.fallback_reason is None
+    assert diff.summary() == 'no changes'
+    assert diff.node_map == {n: n + 1000 for n in NODES.node_id}
+
+
+def test_single_move():
+    new = NODES.copy()
+    new.loc[new.node_id == 2, 'y'] = 50
+    diff = pu.diff_skeletons(new, renumbered(NODES))
+    assert diff.moves.node_id.tolist() == [2]
+    assert diff.n_changes == 1
+
+
+def test_single_reparent():
+    new = NODES.copy()
+    new.loc[new.node_id == 5, 'parent_id'] = 2
+    diff = pu.diff_skeletons(new, renumbered(NODES))
+    assert diff.reparents.values.tolist() == [[5, 2]]
+    assert diff.n_changes == 1
+
+
+def test_single_deletion():
+    new = NODES[NODES.node_id != 8]
+    diff = pu.diff_skeletons(new, renumbered(NODES))
+    # 8 and 9 are interchangeable, so either may be the one deleted
+    assert len(diff.deletions) == 1 and diff.deletions[0] in (1008, 1009)
+    assert diff.n_changes == 1
+
+
+def test_deletion_with_a_child_at_the_same_position():
+    # Deleting 6 attaches 7, which is at the same position, to 5. Keeping 6
+    # in 7's place and deleting 7 does the same in one edit
+    new = NODES[NODES.node_id != 6].copy()
+    new.loc[new.node_id == 7, 'parent_id'] = 5
+    diff = pu.diff_skeletons(new, renumbered(NODES))
+    assert diff.deletions == [1007]
+    assert diff.n_changes == 1
+
+
+def test_single_addition():
+    new = pd.concat([NODES, pd.DataFrame([[10, 9, 300, 0, 40, -1.0]],
+                                         columns=NODES.columns)])
+    diff = pu.diff_skeletons(new, renumbered(NODES))
+    assert diff.additions.node_id.tolist() == [10]
+    assert diff.n_changes == 1
+
+
+def test_summary_of_connector_changes_only():
+    diff = pu.diff_skeletons(NODES, NODES)
+    diff.connector_moves = pd.DataFrame([[1, 0, 0, 0]],
+                                        columns=diff.connector_moves.columns)
+    assert diff.summary() == '1 connectors moved'
+
+
+# Larger than any node ID on the fake server
+OFFSET = 10 ** 12
+
+
+def test_real_skeletons_with_duplicate_positions_match(fake_server):
+    skids = pu.get_skids_by_annotation('motor neuron',
+                                       remote_instance=pu.target_project)[:40]
+    neurons = pymaid.get_neuron(skids, with_connectors=True,
+                                remote_instance=pu.target_project)
+    assert sum(n.nodes.duplicated(['x', 'y', 'z']).sum() for n in neurons) > 0
+    for neuron in neurons:
+        copy = renumbered(neuron.nodes, OFFSET)
+        copy_tags = {tag: [n + OFFSET for n in nodes]
+                     for tag, nodes in neuron.tags.items()}
+        copy_connectors = neuron.connectors.copy()
+        copy_connectors['node_id'] = copy_connectors.node_id + OFFSET
+        for live, live_tags, live_connectors in [
+                (neuron.nodes, neuron.tags, neuron.connectors),
+                (copy, copy_tags, copy_connectors)]:
+            diff = pu.diff_skeletons(neuron.nodes, live, neuron.tags, live_tags,
+                                     neuron.connectors, live_connectors)
+            assert diff.fallback_reason is None
+            assert diff.n_changes == 0, f'{neuron.skeleton_id}: {diff.summary()}'
+
+
+def get_live(skid):
+    return pymaid.get_neuron(skid, with_connectors=True,
+                             remote_instance=pu.target_project)
+
+
+def test_apply_diff(fake_server):
+    # Other tests upload copies of motor neurons, so pick an original one
+    skid = sorted(pu.get_skids_by_annotation('motor neuron',
+                                             remote_instance=pu.target_project))[40]
+    live = get_live(skid)
+    nodes, connectors = live.nodes.copy(), live.connectors
+    parents = nodes.set_index('node_id').parent_id
+    root = int(nodes.node_id[nodes.parent_id < 0].iloc[0])
+    # Delete a node with a connector link, move another and add a third
+    deleted = int(connectors.node_id[connectors.node_id != root].iloc[0])
+    nodes.loc[nodes.parent_id == deleted, 'parent_id'] = parents[deleted]
+    nodes = nodes[nodes.node_id != deleted]
+    moved = int(nodes.node_id.iloc[len(nodes) // 2])
+    nodes.loc[nodes.node_id == moved, 'x'] += 500
+    leaf = int(nodes.node_id[~nodes.node_id.isin(nodes.parent_id)].iloc[0])
+    added = pd.DataFrame([[-5, leaf, *nodes.loc[nodes.node_id == leaf, ['x', 'y']].values[0],
+                           nodes.loc[nodes.node_id == leaf, 'z'].values[0] + 400, -1.0]],
+                         columns=['node_id', 'parent_id', 'x', 'y', 'z', 'radius'])
+    nodes = pd.concat([nodes[added.columns], added], ignore_index=True)
+    tags = dict(live.tags, **{'test tag': [moved]})
+    connectors = connectors[connectors.node_id != deleted]
+
+    diff = pu.diff_skeletons(nodes, live.nodes, tags, live.tags,
+                             connectors, live.connectors)
+    assert diff.fallback_reason is None
+    assert diff.deletions == [deleted]
+    assert deleted in diff.links_to_remove.node_id.tolist()
+    assert diff.moves.node_id.tolist() == [moved]
+    assert diff.additions.node_id.tolist() == [-5]
+    pu.apply_skeleton_diff(diff, skid, remote_instance=pu.target_project)
+
+    after = get_live(skid)
+    diff = pu.diff_skeletons(nodes, after.nodes, tags, after.tags,
+                             connectors, after.connectors)
+    assert diff.summary() == 'no changes'
+
+
+def test_diff_that_cant_be_applied_changes_nothing(fake_server, request_counts):
+    diff = pu.diff_skeletons(NODES, renumbered(NODES))
+    diff.additions = pd.DataFrame([[10, 11, 0, 0, 0, -1.0]],
+                                  columns=diff.additions.columns)
+    diff.moves = pd.DataFrame([[1, 0, 0, 40]], columns=diff.moves.columns)
+    with pytest.raises(ValueError):
+        pu.apply_skeleton_diff(diff, 1, remote_instance=pu.target_project)
+    assert sum(request_counts.values()) == 0
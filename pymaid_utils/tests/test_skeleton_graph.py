@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+
+import pymaid_utils as pu
+
+
+def random_forest(n_nodes=200, n_roots=3, seed=0):
+    """
+    A node table of n_roots random trees, in shuffled order so that parents
+    often come after their children. About a fifth of the nodes are on a
+    primary neurite.
+    """
+    rng = np.random.default_rng(seed)
+    node_ids = rng.choice(np.arange(1000, 100000), n_nodes, replace=False)
+    parents = [-1 if i < n_roots else rng.integers(i) for i in range(n_nodes)]
+    nodes = pd.DataFrame({
+        'node_id': node_ids,
+        'parent_id': [None if p == -1 else node_ids[p] for p in parents],
+        'x': rng.uniform(0, 1000, n_nodes),
+        'y': rng.uniform(0, 1000, n_nodes),
+        'z': rng.uniform(0, 1000, n_nodes),
+        'radius': np.where(rng.uniform(size=n_nodes) < 0.2,
+                           pu.PRIMARY_NEURITE_RADIUS, -1)
+    })
+    return nodes.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def naive_walk_up(nodes, node_id, stop=lambda row: False):
+    """
+    The node IDs from node_id up to its root, or up to the first node for
+    which stop(row) is true, and the cable length along them, walking the
+    node table one parent at a time.
+    """
+    rows = nodes.set_index('node_id')
+    path, length = [node_id], 0.
+    while not stop(rows.loc[path[-1]]):
+        parent_id = rows.loc[path[-1]].parent_id
+        if pd.isnull(parent_id):
+            break
+        length += np.linalg.norm(
+            rows.loc[path[-1], ['x', 'y', 'z']].values.astype(float)
+            - rows.loc[int(parent_id), ['x', 'y', 'z']].values.astype(float))
+        path.append(int(parent_id))
+    return path, length
+
+
+def test_levels_of_a_forest():
+    nodes = random_forest()
+    graph = pu.SkeletonGraph(nodes)
+    levels = graph.levels()
+
+    assert sorted(levels[0]) == sorted(np.nonzero(graph.parent == -1)[0])
+    assert len(levels[0]) == 3
+    all_indices = np.concatenate(levels)
+    assert sorted(all_indices) == list(range(len(nodes)))
+    for depth, level in enumerate(levels):
+        for i in level:
+            path, _ = naive_walk_up(nodes, graph.node_ids[i])
+            assert len(path) - 1 == depth
+
+
+def test_levels_of_single_nodes_and_an_empty_table():
+    nodes = pd.DataFrame({'node_id': [5, 3, 8], 'parent_id': [None, None, 3],
+                          'x': [0, 1, 2], 'y': 0, 'z': 0, 'radius': -1})
+    levels = pu.SkeletonGraph(nodes).levels()
+    assert [sorted(level) for level in levels] == [[0, 1], [2]]
+
+    empty = pu.SkeletonGraph(nodes.iloc[:0])
+    assert empty.levels() == []
+    assert len(empty.distance_from_root()) == 0
+
+
+def test_distance_from_root_matches_a_naive_walk():
+    nodes = random_forest(seed=1)
+    graph = pu.SkeletonGraph(nodes)
+    for node_id in nodes.node_id.values[::7]:
+        path, length = naive_walk_up(nodes, node_id)
+        i = graph.index(node_id)
+        np.testing.assert_allclose(graph.distance_from_root(i), length, rtol=1e-5)
+        assert graph.node_ids[graph.root_index(i)] == path[-1]
+    np.testing.assert_array_equal(
+        graph.distance_from_root(graph.index(nodes.node_id.values[:5])),
+        graph.distance_from_root()[graph.index(nodes.node_id.values[:5])])
+
+
+def test_distance_to_primary_neurite_matches_a_naive_walk():
+    nodes = random_forest(seed=2)
+    graph = pu.SkeletonGraph(nodes)
+    distance, attachment = graph.distance_to_primary_neurite()
+    on_primary_neurite = lambda row: row.radius == pu.PRIMARY_NEURITE_RADIUS
+    n_unattached = 0
+    for node_id in nodes.node_id.values:
+        path, length = naive_walk_up(nodes, node_id, stop=on_primary_neurite)
+        end = nodes.set_index('node_id').loc[path[-1]]
+        i = graph.index(node_id)
+        if on_primary_neurite(end):
+            assert graph.node_ids[attachment[i]] == path[-1]
+            np.testing.assert_allclose(distance[i], length, rtol=1e-5)
+        else:
+            assert attachment[i] == -1 and distance[i] == -1
+            n_unattached += 1
+    assert 0 < n_unattached < len(nodes)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import pytest
+import pymaid
+from requests import HTTPError, Response
+import pymaid_utils as pu
+from pymaid_utils import skeleton_store
+
+
+def get_skids(n=5):
+    return pu.get_skids_by_annotation(['motor neuron', 'left soma'])[:n]
+
+
+def move_node(node_id, xyz, remote_instance):
+    remote_instance.fetch(remote_instance._update_node_url(),
+                          post={'t[0][0]': node_id, 't[0][1]': xyz[0],
+                                't[0][2]': xyz[1], 't[0][3]': xyz[2]})
+
+
+def test_edition_states_take_five_requests(fake_server, request_counts):
+    skids = get_skids(20)
+    request_counts.clear()
+    states = pu.get_edition_states(skids)
+    assert set(states) == set(skids)
+    assert all(state is not None and state['n_nodes'] > 0 for state in states.values())
+    assert sum(request_counts.values()) <= 5
+    assert 'GET skeletons/{id}/node-overview' not in request_counts
+    # Tags come only from the requested skeletons' tagged nodes, not from the
+    # whole project's label list
+    assert 'GET labels/stats' not in request_counts
+    assert 'GET skeletons/{id}/compact-detail' not in request_counts
+
+
+def test_edition_states_ignore_other_skeletons_tags(fake_server, store_dir):
+    skids = get_skids(6)
+    pu.sync(skids[:5], store_dir=store_dir)
+    states = pu.get_edition_states(skids[:5])
+    other = pymaid.get_neuron(skids[5], remote_instance=pu.source_project)
+    pu.source_project.fetch(
+        pu.source_project._node_add_tag_url(int(other.nodes.node_id.iloc[0])),
+        post={'tags': 'other skeleton tag', 'delete_existing': 'false'})
+    assert pu.get_edition_states(skids[:5]) == states
+    assert pu.find_changed_skeletons(skids[:5], store_dir=store_dir) == []
+
+
+def test_edition_states_fall_back_only_on_404(fake_server, monkeypatch):
+    def fail(status_code):
+        def get_summaries(skids, remote_instance):
+            response = Response()
+            response.status_code = status_code
+            raise HTTPError(response=response)
+        return get_summaries
+
+    skids = get_skids(2)
+    monkeypatch.setattr(skeleton_store, '_get_skeleton_summaries', fail(404))
+    assert set(pu.get_edition_states(skids)) == set(skids)
+    monkeypatch.setattr(skeleton_store, '_get_skeleton_summaries', fail(500))
+    with pytest.raises(HTTPError):
+        pu.get_edition_states(skids)
+
+
+def test_sync_writes_the_index_once(fake_server, store_dir, monkeypatch):
+    writes = []
+    save_index = skeleton_store.SkeletonStore.save_index
+    def count_writes(self):
+        writes.append(len(self.index))
+        save_index(self)
+    monkeypatch.setattr(skeleton_store.SkeletonStore, 'save_index', count_writes)
+    pu.sync(get_skids(), store_dir=store_dir)
+    assert writes == [5]
+
+
+def test_edition_states_of_missing_skeleton(fake_server):
+    assert pu.get_edition_states([99999999]) == {99999999: None}
+
+
+def test_sync_downloads_only_changed_skeletons(fake_server, request_counts, store_dir):
+    skids = get_skids()
+    neurons = pu.sync(skids, store_dir=store_dir)
+    assert [int(skid) for skid in neurons.skeleton_id] == skids
+
+    request_counts.clear()
+    pu.sync(skids, store_dir=store_dir)
+    assert pu.find_changed_skeletons(skids, store_dir=store_dir) == []
+    assert 'GET skeletons/{id}/compact-detail' not in request_counts
+    assert 'GET skeletons/{id}/node-overview' not in request_counts
+
+    # Moving one node of one skeleton makes only that skeleton out of date
+    node = neurons[0].nodes.iloc[3]
+    move_node(int(node.node_id), [node.x + 100, node.y, node.z], pu.source_project)
+    assert pu.find_changed_skeletons(skids, store_dir=store_dir) == [skids[0]]
+    request_counts.clear()
+    synced = pu.sync(skids, store_dir=store_dir)
+    assert request_counts['GET skeletons/{id}/compact-detail'] == 1
+    moved = synced[0].nodes.set_index('node_id').loc[int(node.node_id)]
+    assert moved.x == node.x + 100
+    move_node(int(node.node_id), [node.x, node.y, node.z], pu.source_project)
+
+
+def test_tag_and_name_changes_are_detected(fake_server, store_dir):
+    skids = get_skids()
+    neurons = pu.sync(skids, store_dir=store_dir)
+    node_id = int(neurons[1].nodes.node_id.iloc[0])
+    pu.source_project.fetch(pu.source_project._node_add_tag_url(node_id),
+                            post={'tags': 'test tag', 'delete_existing': 'false'})
+    assert pu.find_changed_skeletons(skids, store_dir=store_dir) == [skids[1]]
+    assert 'test tag' in pu.sync(skids, store_dir=store_dir)[1].tags
+
+    name = neurons[2].neuron_name
+    pymaid.rename_neurons(skids[2], name + ' renamed', no_prompt=True,
+                          remote_instance=pu.source_project)
+    assert pu.find_changed_skeletons(skids, store_dir=store_dir) == [skids[2]]
+    pymaid.rename_neurons(skids[2], name, no_prompt=True,
+                          remote_instance=pu.source_project)
+
+
+def test_deleting_a_node_is_detected(fake_server, store_dir):
+    skids = get_skids()
+    neurons = pu.sync(skids, store_dir=store_dir)
+    nodes = neurons[3].nodes
+    leaf = int(nodes.node_id[~nodes.node_id.isin(nodes.parent_id)].iloc[0])
+    pu.source_project.fetch(pu.source_project._delete_node_url(),
+                            post={'treenode_id': leaf})
+    assert pu.find_changed_skeletons(skids, store_dir=store_dir) == [skids[3]]
+    assert pu.sync(skids, store_dir=store_dir)[3].n_nodes == len(nodes) - 1
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# Times warp_points_template_to_FANC on the same random points with 1, 2, 4,
+# ... worker processes (up to the number of CPU cores), to show how the
+# elastix transform step scales across cores. Random points are drawn from
+# within the VNC template, and every worker count must give the same result.
+# (warp_points_FANC_to_template scales the same way, but needs
+# TransformParameters.FixedFANC.txt, which isn't in this repository.)
+#
+# Usage: python3 benchmark_warp_points_workers.py [n_points] [max_workers]
+# e.g.:  python3 benchmark_warp_points_workers.py 2000000 8
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'register_EM_dataset_to_template'))
+import warp_points_between_FANC_and_template as warp
+
+# The VNC template is 660 x 1342 x 358 voxels of 400nm
+TEMPLATE_SIZE_NM = np.array([660, 1342, 358]) * 400
+
+
+def main():
+    n_points = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+
+    points = np.random.default_rng(0).uniform(0, TEMPLATE_SIZE_NM, (n_points, 3))
+    worker_counts = [1]
+    while worker_counts[-1] * 2 <= max_workers:
+        worker_counts.append(worker_counts[-1] * 2)
+    if worker_counts[-1] != max_workers:
+        worker_counts.append(max_workers)
+
+    print(f'Warping {n_points} points, {os.cpu_count()} CPU cores available')
+    print(f'{"workers":>8} {"seconds":>9} {"points/s":>11} {"speedup":>8}')
+    # Read the transform file before timing anything
+    warp.warp_points_template_to_FANC(points[:10].copy())
+    reference = None
+    for workers in worker_counts:
+        start = time.perf_counter()
+        warped = warp.warp_points_template_to_FANC(points.copy(), workers=workers)
+        seconds = time.perf_counter() - start
+        if reference is None:
+            reference, reference_seconds = warped, seconds
+        assert np.allclose(warped, reference), f'{workers} workers gave different results'
+        print(f'{workers:>8} {seconds:>9.2f} {n_points / seconds:>11.0f}'
+              f' {reference_seconds / seconds:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+
+# Applies transforms made by elastix to points, in-process with numpy,
+# without running elastix's transformix program. Reads elastix's
+# TransformParameters.*.txt files, including chains of them (a file's
+# InitialTransformParametersFileName is applied before the file itself), and
+# supports the transforms used in this repository:
+#   AffineTransform
+#   TranslationTransform
+#   BSplineTransform / RecursiveBSplineTransform (cubic, non-cyclic)
+# Points are transformed in vectorized batches, and parameter files are only
+# read once per session, so transforming many neurons costs a few array
+# operations each instead of a transformix process and its temp files.
+#
+# transformix(points, parameter_file) is a drop-in replacement for running the
+# transformix binary on a list of points, and can still run the binary with
+# use_binary=True. transformix_many does the same for several arrays of points
+# at once (e.g. many neurons), with a single transformix call. Both can split
+# the points across several processes with workers=N.
+#
+# make_displacement_grid precomputes a transform, or its inverse, on a regular
+# grid saved to disk. A DisplacementGrid then transforms points by trilinear
+# interpolation, which is several times faster again, with the interpolation
+# error measured when the grid is made.
+#
+# To check this module against the binary, run
+#   python3 elastix_transform.py TransformParameters.txt [n_points]
+# which transforms random points within the transform's fixed image with both
+# and prints how far apart the results are.
+
+import os
+import re
+import json
+import sys
+import site
+import time
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Points are transformed this many at a time to bound memory use
+BATCH_SIZE = 500000
+# Fewer points than this per worker process aren't worth starting it for
+MIN_POINTS_PER_WORKER = 20000
+
+_transform_cache = {}
+
+
+def read_parameter_file(parameter_file):
+    """
+    Read an elastix parameter file into a dict of parameter name -> list of
+    values. Numbers are returned as floats, quoted values as strings, and
+    TransformParameters as a numpy array.
+    """
+    parameters = {}
+    with open(parameter_file, 'r') as f:
+        for line in f:
+            line = line.split('//')[0].strip()
+            if not line.startswith('(') or not line.endswith(')'):
+                continue
+            name, _, values = line[1:-1].partition(' ')
+            if name == 'TransformParameters':
+                parameters[name] = np.array(values.split(), dtype=np.float64)
+            elif '"' in values:
+                parameters[name] = re.findall(r'"([^"]*)"', values)
+            else:
+                parameters[name] = [float(v) for v in values.split()]
+    return parameters
+
+
+class ElastixTransform:
+    """
+    The transform described by an elastix parameter file, including the
+    transforms it's combined with through InitialTransformParametersFileName.
+    transform_points(points) maps an (N, 3) array of points in the fixed
+    image's physical space to the moving image's, exactly like transformix.
+    """
+    def __init__(self, parameter_file):
+        self.parameter_file = os.path.abspath(parameter_file)
+        p = read_parameter_file(self.parameter_file)
+        self.parameters = p
+        self.kind = p['Transform'][0]
+        self.combination = p.get('HowToCombineTransforms', ['Compose'])[0]
+        if self.combination not in ('Compose', 'Add'):
+            raise NotImplementedError('Unknown HowToCombineTransforms'
+                                      f' "{self.combination}"')
+        if p.get('UseBinaryFormatForTransformationParameters', ['false'])[0] == 'true':
+            raise NotImplementedError('Binary TransformParameters are not supported')
+
+        dim = int(p.get('FixedImageDimension', [3])[0])
+        if dim != 3:
+            raise NotImplementedError('Only 3D transforms are supported')
+        params = p.get('TransformParameters', np.zeros(0))
+        if self.kind == 'AffineTransform':
+            self.matrix = params[:9].reshape(3, 3)
+            self.translation = params[9:12]
+            self.center = np.array(p.get('CenterOfRotationPoint', [0, 0, 0]))
+        elif self.kind == 'TranslationTransform':
+            self.matrix = np.eye(3)
+            self.translation = params[:3]
+            self.center = np.zeros(3)
+        elif self.kind in ('BSplineTransform', 'RecursiveBSplineTransform'):
+            if int(p.get('BSplineTransformSplineOrder', [3])[0]) != 3:
+                raise NotImplementedError('Only cubic B-splines are supported')
+            if p.get('UseCyclicTransform', ['false'])[0] == 'true':
+                raise NotImplementedError('Cyclic B-splines are not supported')
+            self.grid_size = np.array(p['GridSize'], dtype=int)
+            self.grid_origin = np.array(p['GridOrigin'])
+            spacing = np.array(p['GridSpacing'])
+            direction = np.array(p.get('GridDirection', np.eye(3).ravel())
+                                 ).reshape(3, 3).T
+            # Maps a physical point (relative to the grid origin) to its
+            # continuous index in the control point grid
+            self.point_to_index = np.linalg.inv(direction * spacing)
+            # One row per control point, x varying fastest, then y, then z.
+            # elastix lists all x displacements, then all y, then all z.
+            self.coefficients = np.ascontiguousarray(params.reshape(3, -1).T)
+            if len(self.coefficients) != self.grid_size.prod():
+                raise ValueError(f'{parameter_file} has {len(params)}'
+                                 ' TransformParameters but its GridSize'
+                                 f' needs {self.grid_size.prod() * 3}')
+        else:
+            raise NotImplementedError(f'{self.kind} is not supported')
+
+        # Like transformix, look for the initial transform's file relative to
+        # the working directory, and then next to this file
+        initial = p.get('InitialTransformParametersFileName', ['NoInitialTransform'])[0]
+        self.initial = None
+        if initial != 'NoInitialTransform':
+            if not os.path.exists(initial):
+                initial = os.path.join(os.path.dirname(self.parameter_file),
+                                       os.path.basename(initial))
+            self.initial = load_transform(initial)
+
+    def transform_points(self, points, batch_size=BATCH_SIZE):
+        points = np.asarray(points, dtype=np.float64)
+        if len(points) > batch_size:
+            return np.concatenate([
+                self.transform_points(points[i:i+batch_size], batch_size)
+                for i in range(0, len(points), batch_size)])
+        if self.initial is None:
+            return self._transform(points)
+        if self.combination == 'Compose':
+            return self._transform(self.initial.transform_points(points))
+        # 'Add'
+        return self.initial.transform_points(points) + self._transform(points) - points
+
+    def _transform(self, points):
+        if self.kind in ('AffineTransform', 'TranslationTransform'):
+            return ((points - self.center) @ self.matrix.T
+                    + self.center + self.translation)
+        return points + self.displacements(points)
+
+    def displacements(self, points):
+        """
+        The B-spline's displacement at each point. Like elastix, points
+        whose support region isn't entirely inside the control point grid
+        aren't displaced.
+        """
+        index = (points - self.grid_origin) @ self.point_to_index.T
+        inside = ((index >= 1) & (index < self.grid_size - 2)).all(axis=1)
+        index[~inside] = 1
+        start = np.floor(index).astype(np.int64) - 1
+        # Cubic B-spline weights of the 4 control points along each axis
+        u = index - np.floor(index)
+        weights = np.stack([
+            (1 - u) ** 3 / 6,
+            (3 * u ** 3 - 6 * u ** 2 + 4) / 6,
+            (-3 * u ** 3 + 3 * u ** 2 + 3 * u + 1) / 6,
+            u ** 3 / 6
+        ], axis=-1)  # (N, 3, 4)
+
+        nx, ny = self.grid_size[:2]
+        displacements = np.zeros_like(points)
+        for k in range(4):
+            z_offset = (start[:, 2] + k) * nx * ny
+            for j in range(4):
+                yz_offset = z_offset + (start[:, 1] + j) * nx
+                yz_weight = weights[:, 2, k] * weights[:, 1, j]
+                for i in range(4):
+                    w = yz_weight * weights[:, 0, i]
+                    c = self.coefficients[yz_offset + start[:, 0] + i]
+                    displacements += w[:, np.newaxis] * c
+        displacements[~inside] = 0
+        return displacements
+
+    def fixed_image_bounds(self):
+        """The (min, max) corners of the fixed image the transform was made for."""
+        p = self.parameters
+        origin = np.array(p['Origin'])
+        spacing = np.array(p['Spacing'])
+        size = np.array(p['Size'])
+        return origin, origin + (size - 1) * spacing
+
+    def inverse_transform_points(self, points, tolerance=1e-4,
+                                 max_iterations=20, step=0.01):
+        """
+        Map points from the moving image's space back to the fixed image's,
+        by solving transform_points(x) = point for x with Newton's method
+        (using a finite difference Jacobian with the given step size).
+        Points that don't converge to within tolerance are returned as NaN.
+        """
+        targets = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        x = targets.copy()
+        todo = np.arange(len(x))
+        for i in range(max_iterations):
+            current = self.transform_points(x[todo])
+            residuals = current - targets[todo]
+            converged = np.linalg.norm(residuals, axis=1) < tolerance
+            todo, current, residuals = todo[~converged], current[~converged], residuals[~converged]
+            if len(todo) == 0:
+                break
+            jacobian = np.stack([
+                (self.transform_points(x[todo] + offset) - current) / step
+                for offset in np.eye(3) * step
+            ], axis=-1)
+            # There's no Newton step from where the Jacobian is singular (e.g.
+            # where the transform folds space), so give up on those points
+            singular = ~(np.abs(np.linalg.det(jacobian)) > 1e-12)
+            if singular.any():
+                x[todo[singular]] = np.nan
+                todo, jacobian, residuals = (todo[~singular], jacobian[~singular],
+                                             residuals[~singular])
+            x[todo] -= np.linalg.solve(jacobian, residuals[..., np.newaxis])[..., 0]
+        else:
+            todo = todo[np.linalg.norm(self.transform_points(x[todo])
+                                       - targets[todo], axis=1) >= tolerance]
+            x[todo] = np.nan
+        return x
+
+
+def load_transform(parameter_file):
+    """
+    The ElastixTransform for parameter_file. Each file is only read once per
+    session, unless it changes.
+    """
+    parameter_file = os.path.abspath(parameter_file)
+    key = (parameter_file, os.path.getmtime(parameter_file))
+    if key not in _transform_cache:
+        _transform_cache[key] = ElastixTransform(parameter_file)
+    return _transform_cache[key]
+
+
+def transformix(points, parameter_file, use_binary=False, workers=1):
+    """
+    Transform an (N, 3) array of points with an elastix parameter file and
+    return the transformed points as an (N, 3) array. Done in-process unless
+    use_binary=True, in which case the transformix binary (which must be on
+    the shell PATH) is run on the points in a temporary folder.
+    With workers > 1, the points are split into that many shards which are
+    transformed in parallel by a pool of processes, each running transformix
+    in its own temporary folder if use_binary=True.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    workers = max(1, min(workers, len(points) // MIN_POINTS_PER_WORKER))
+    if workers > 1:
+        if not use_binary:
+            # Where processes are forked, the workers inherit the parsed file
+            load_transform(parameter_file)
+        shards = np.array_split(points, workers)
+        # Spawned (rather than forked) workers import this file by name, so
+        # let them find it even if it was loaded by its path (see
+        # transform_chain.load_module_from_folder)
+        with ProcessPoolExecutor(max_workers=workers, initializer=site.addsitedir,
+                                 initargs=(os.path.dirname(os.path.abspath(__file__)),)) as pool:
+            transformed = pool.map(transformix, shards,
+                                   [parameter_file] * workers,
+                                   [use_binary] * workers)
+            return np.concatenate(list(transformed))
+
+    if not use_binary:
+        return load_transform(parameter_file).transform_points(points)
+
+    parameter_file = os.path.abspath(parameter_file)
+    with tempfile.TemporaryDirectory(prefix='transformix_') as temp_dir:
+        input_fn = os.path.join(temp_dir, 'transformix_input.txt')
+        with open(input_fn, 'w') as f:
+            f.write(f'point\n{len(points)}\n')
+            np.savetxt(f, points, fmt='%f')
+        transformix_cmd = ['transformix', '-out', temp_dir,
+                           '-tp', parameter_file, '-def', input_fn]
+        # transformix looks for initial transforms relative to its working
+        # directory, so run it next to the parameter file
+        result = subprocess.run(transformix_cmd,
+                                cwd=os.path.dirname(parameter_file),
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                text=True)
+        output_fn = os.path.join(temp_dir, 'outputpoints.txt')
+        if not os.path.exists(output_fn):
+            print(result.stdout)
+            raise Exception('transformix failed, see output above for details')
+        with open(output_fn, 'r') as f:
+            output = re.findall(r'OutputPoint = \[ ([^\]]*) \]', f.read())
+    return np.array([line.split() for line in output], dtype=np.float64)
+
+
+def transformix_many(point_arrays, parameter_file, use_binary=False, workers=1):
+    """
+    Transform several arrays of points (e.g. one per neuron) with a single
+    transformix call, by stacking them into one array and splitting the
+    result back up. point_arrays is a dict of key -> (N, 3) array, and the
+    transformed arrays are returned under the same keys.
+    """
+    keys = list(point_arrays)
+    arrays = [np.asarray(point_arrays[key], dtype=np.float64).reshape(-1, 3)
+              for key in keys]
+    # Row offset of each array within the stacked array
+    offsets = np.cumsum([0] + [len(points) for points in arrays])
+    if offsets[-1] == 0:
+        return {key: points.copy() for key, points in zip(keys, arrays)}
+    transformed = transformix(np.concatenate(arrays), parameter_file,
+                              use_binary=use_binary, workers=workers)
+    return {key: transformed[offsets[i]:offsets[i+1]]
+            for i, key in enumerate(keys)}
+
+
+class DisplacementGrid:
+    """
+    A transform (or its inverse) precomputed by make_displacement_grid:
+    displacements sampled on a regular grid, stored as a float32 .npy file
+    that's memory-mapped rather than read, plus a .json file describing the
+    grid. transform_points(points) interpolates the displacements
+    trilinearly, which is far faster than evaluating the transform itself.
+    Points outside the grid, or next to a grid point where the inverse
+    couldn't be found (left as NaN), are transformed exactly instead (or
+    inverted exactly, for an inverse grid).
+    """
+    def __init__(self, grid_file):
+        grid_file = _strip_grid_extension(grid_file)
+        with open(grid_file + '.json', 'r') as f:
+            self.info = json.load(f)
+        self.displacements = np.load(grid_file + '.npy', mmap_mode='r')
+        self.origin = np.array(self.info['origin'])
+        self.spacing = np.array(self.info['spacing'])
+        self.shape = np.array(self.displacements.shape[:3])
+        self.parameter_file = os.path.join(os.path.dirname(os.path.abspath(grid_file)),
+                                           self.info['parameter_file'])
+
+    def transform_points(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        index = (points - self.origin) / self.spacing
+        inside = ((index >= 0) & (index < self.shape - 1)).all(axis=1)
+        index[~inside] = 0
+        start = np.floor(index).astype(np.int64)
+        u = index - start
+
+        ny, nz = self.shape[1:]
+        flat_displacements = self.displacements.reshape(-1, 3)
+        base_index = (start[:, 0] * ny + start[:, 1]) * nz + start[:, 2]
+        weights = np.stack([1 - u, u])  # (2, N, 3)
+        displacements = np.zeros_like(points)
+        for i, j, k in np.ndindex(2, 2, 2):
+            weight = weights[i, :, 0] * weights[j, :, 1] * weights[k, :, 2]
+            corner = flat_displacements[base_index + ((i * ny + j) * nz + k)]
+            displacements += weight[:, np.newaxis] * corner
+        transformed = points + displacements
+
+        exact = ~inside | np.isnan(transformed).any(axis=1)
+        if exact.any():
+            transform = load_transform(self.parameter_file)
+            if self.info['inverse']:
+                transformed[exact] = transform.inverse_transform_points(points[exact])
+            else:
+                transformed[exact] = transform.transform_points(points[exact])
+        return transformed
+
+
+def make_displacement_grid(parameter_file, grid_file, spacing=2, bounds=None,
+                           inverse=False, n_test_points=100000, reference=None):
+    """
+    Precompute the transform in parameter_file (or its inverse, if
+    inverse=True) on a regular grid with the given spacing, and save it as
+    grid_file.npy and grid_file.json for DisplacementGrid. bounds gives the
+    (min, max) corners of the grid. By default it covers the transform's
+    fixed image, or for inverse=True, where the fixed image is transformed to.
+    The grid's error is measured on n_test_points random points within the
+    grid, printed and saved in the .json file: for a forward grid as the
+    distance from the exact transform, and for an inverse grid as how far
+    transforming the grid's result misses the point it started from. If the
+    grid is used in place of a different transform (e.g. one fitted in the
+    opposite direction, when the grid inverts this one), give that
+    transform's parameter file as reference, and the error is instead the
+    distance from what reference gives. Test points next to a grid point
+    where the inverse couldn't be found are inverted exactly by
+    DisplacementGrid, and are counted separately.
+    """
+    transform = load_transform(parameter_file)
+    grid_file = _strip_grid_extension(grid_file)
+    if bounds is None:
+        low, high = transform.fixed_image_bounds()
+        if inverse:
+            corners = np.stack(np.meshgrid(*np.linspace(low, high, 20).T,
+                                           indexing='ij'), axis=-1).reshape(-1, 3)
+            corners = transform.transform_points(corners)
+            low, high = corners.min(axis=0), corners.max(axis=0)
+        bounds = (low, high)
+    origin = np.array(bounds[0], dtype=np.float64)
+    spacing = np.broadcast_to(np.array(spacing, dtype=np.float64), 3)
+    shape = np.ceil((np.array(bounds[1]) - origin) / spacing).astype(int) + 1
+
+    start = time.time()
+    displacements = np.lib.format.open_memmap(grid_file + '.npy', mode='w+',
+                                              dtype=np.float32,
+                                              shape=(*shape.tolist(), 3))
+    # One x-slice of the grid at a time, to bound memory use
+    y, z = np.meshgrid(origin[1] + np.arange(shape[1]) * spacing[1],
+                       origin[2] + np.arange(shape[2]) * spacing[2], indexing='ij')
+    for i in range(shape[0]):
+        points = np.stack([np.full(y.size, origin[0] + i * spacing[0]),
+                           y.ravel(), z.ravel()], axis=1)
+        if inverse:
+            transformed = transform.inverse_transform_points(points)
+        else:
+            transformed = transform.transform_points(points)
+        displacements[i] = (transformed - points).reshape(shape[1], shape[2], 3)
+    displacements.flush()
+    n_unsolved = int(np.isnan(displacements).any(axis=-1).sum())
+    del displacements
+    info = {
+        'parameter_file': os.path.relpath(transform.parameter_file,
+                                          os.path.dirname(os.path.abspath(grid_file))),
+        'inverse': inverse,
+        'reference': None if reference is None else os.path.relpath(
+            os.path.abspath(reference), os.path.dirname(os.path.abspath(grid_file))),
+        'origin': origin.tolist(),
+        'spacing': spacing.tolist(),
+        'n_unsolved_grid_points': n_unsolved,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S')
+    }
+    with open(grid_file + '.json', 'w') as f:
+        json.dump(info, f, indent=2)
+    print(f'Computed {shape.prod()} grid points ({" x ".join(map(str, shape))})'
+          f' in {time.time() - start:.0f}s')
+    if n_unsolved > 0:
+        print(f'WARNING: The inverse could not be found at {n_unsolved} grid'
+              ' points, which are left as NaN. These are usually outside'
+              " of where the transform maps the fixed image to, near the"
+              " edge of the B-spline's control point grid.")
+
+    # Measure the interpolation error
+    grid = DisplacementGrid(grid_file)
+    test_points = np.random.default_rng(0).uniform(
+        origin, origin + (shape - 1) * spacing, (n_test_points, 3))
+    index = np.floor((test_points - origin) / spacing).astype(np.int64)
+    unsolved_cells = np.zeros(len(test_points), dtype=bool)
+    if n_unsolved > 0:
+        unsolved_points = np.isnan(grid.displacements).any(axis=-1)
+        for corner in np.ndindex(2, 2, 2):
+            corners = np.minimum(index + corner, shape - 1)
+            unsolved_cells |= unsolved_points[tuple(corners.T)]
+    if reference is not None:
+        errors = np.linalg.norm(grid.transform_points(test_points)
+                                - transformix(test_points, reference), axis=1)
+    elif inverse:
+        errors = np.linalg.norm(transform.transform_points(
+            grid.transform_points(test_points)) - test_points, axis=1)
+    else:
+        errors = np.linalg.norm(grid.transform_points(test_points)
+                                - transform.transform_points(test_points), axis=1)
+    n_no_inverse = int(np.isnan(errors).sum())
+    interpolated = ~unsolved_cells & ~np.isnan(errors)
+    info['max_error'] = float(errors[interpolated].max())
+    info['mean_error'] = float(errors[interpolated].mean())
+    info['n_test_points_in_unsolved_cells'] = int(unsolved_cells.sum())
+    info['n_test_points_without_inverse'] = n_no_inverse
+    with open(grid_file + '.json', 'w') as f:
+        json.dump(info, f, indent=2)
+    grid.info = info
+    compared_with = ('' if reference is None else
+                     f' (compared with {os.path.basename(reference)})')
+    print(f'Interpolation error{compared_with} on {interpolated.sum()} random'
+          f' points: max {info["max_error"]:.6f}, mean {info["mean_error"]:.6f}')
+    if unsolved_cells.any():
+        print(f'{unsolved_cells.sum()} of the {n_test_points} random points are'
+              f' in grid cells with an unsolved grid point ({n_unsolved} grid'
+              ' points in all), and are inverted exactly instead of'
+              f' interpolated. {n_no_inverse} of them have no inverse at all'
+              ' and are returned as NaN.')
+    return grid
+
+
+def load_displacement_grid(grid_file):
+    """
+    The DisplacementGrid in grid_file. Each grid is only loaded once per
+    session, unless it's remade.
+    """
+    grid_file = os.path.abspath(_strip_grid_extension(grid_file))
+    key = (grid_file, os.path.getmtime(grid_file + '.npy'),
+           os.path.getmtime(grid_file + '.json'))
+    if key not in _transform_cache:
+        _transform_cache[key] = DisplacementGrid(grid_file)
+    return _transform_cache[key]
+
+
+def _strip_grid_extension(grid_file):
+    # A grid can be referred to by either of its files, or by their shared name
+    for extension in ('.npy', '.json'):
+        if grid_file.endswith(extension):
+            return grid_file[:-len(extension)]
+    return grid_file
+
+
+def compare_with_transformix(parameter_file, points=None, n_points=10000, seed=0):
+    """
+    Transform points (by default, n_points random points within the
+    transform's fixed image) both in-process and with the transformix binary,
+    and print how long each took and how far apart their results are.
+    """
+    if points is None:
+        low, high = load_transform(parameter_file).fixed_image_bounds()
+        points = np.random.default_rng(seed).uniform(low, high, (n_points, 3))
+    start = time.time()
+    ours = transformix(points, parameter_file)
+    our_time = time.time() - start
+    start = time.time()
+    theirs = transformix(points, parameter_file, use_binary=True)
+    their_time = time.time() - start
+    distances = np.linalg.norm(ours - theirs, axis=1)
+    print(f'{len(points)} points. In-process: {our_time:.2f}s,'
+          f' transformix: {their_time:.2f}s')
+    print(f'Distance between results: max {distances.max():.6f},'
+          f' mean {distances.mean():.6f}, median {np.median(distances):.6f}')
+    return distances
+
+
+def main():
+    if len(sys.argv) == 1:
+        print('Usage: elastix_transform.py parameter_file [n_points=10000]')
+        print('Compares this module with the transformix binary on random'
+              ' points within the fixed image of parameter_file.')
+        return
+    n_points = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    compare_with_transformix(sys.argv[1], n_points=n_points)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,40 @@
 #!/usr/bin/env python3
 
-# Wrappers for the program transformix, part of the library elastix
+# Wrappers for the program transformix, part of the library elastix.
+# The steps between the two coordinate spaces are the transform chains in
+# transform_chains.json (see ../transform_chain.py), and their elastix
+# transforms are applied in-process by ../elastix_transform.py, which gives
+# the same results as transformix without running it. With
+# use_grid=True, points are instead warped by interpolating grids precomputed
+# by make_displacement_grids(), which is faster and makes the two directions
+# inverses of each other. Both grids come from the template to FANC
+# transform, so FANC to template with use_grid=True doesn't give the same
+# points as without it (see make_displacement_grids).
 
 import os
-import subprocess
+import sys
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import elastix_transform
+import transform_chain
+
 template_plane_of_symmetry_x_voxel = 329
 template_plane_of_symmetry_x_microns = 329 * 0.400
 
+_warned_about_grid = False
+
 def warp_points_FANC_to_template(points,
                                  input_units='nm',
                                  output_units='microns',
-                                 reflect=False):
+                                 reflect=False,
+                                 workers=1,
+                                 use_grid=False):
     points = np.array(points, dtype=np.float64)
     if len(points.shape) == 1:
         return warp_points_FANC_to_template(np.expand_dims(points, 0),
-                                            input_units, output_units)[0]
+                                            input_units, output_units,
+                                            reflect, workers, use_grid)[0]
     if input_units == 'nm' and (points < 1000).all():
         resp = input('Your points appear to be in microns, not nm. Want to'
                      ' change input_units from nm to microns? [y/n] ')
@@ -25,20 +43,25 @@ def warp_points_FANC_to_template(points,
     if input_units in ['um', 'microns']:
         points *= 1000  # Convert microns to nm
 
-    points -= (533.2, 533.2, 945)  # (1.24, 1.24, 2.1) vox at (430, 430, 450)nm/vox
-    points /= (430, 430, 450)
-    points *= (300, 300, 400)
-    points[:, 2] = 435*400 - points[:, 2]  # z flipping a stack with 436 slices
+    # Offset, rescaling, z flip, elastic transformation and mirroring, as
+    # described in README.md. See transform_chains.json for the details.
+    chain = transform_chain.load_transform_chain('FANC_to_template')
+    if reflect:
+        chain = chain.without('mirror')
+    if use_grid:
+        grid = load_displacement_grid('FANC_to_template')
+        global _warned_about_grid
+        if not _warned_about_grid:
+            _warned_about_grid = True
+            print('WARNING: use_grid=True inverts'
+                  ' TransformParameters.FixedTemplate.Bspline.txt instead of'
+                  ' applying TransformParameters.FixedFANC.txt, which moves'
+                  f' points by up to {grid.info["max_error"]:.3f} microns'
+                  f' (mean {grid.info["mean_error"]:.3f}) from where'
+                  ' use_grid=False puts them.')
+    points = chain.transform_points(points, use_grid=use_grid, workers=workers)
     points /= 1000  # Convert nm to microns
 
-    transform_params = os.path.join(
-        os.path.dirname(__file__),
-        'TransformParameters.FixedFANC.txt'
-    )
-    points = transformix(points, transform_params)
-
-    if not reflect:
-        points[:, 0] = template_plane_of_symmetry_x_microns * 2 - points[:, 0]
     if output_units == 'nm':
         points *= 1000  # Convert microns to nm
 
@@ -48,11 +71,14 @@ def warp_points_FANC_to_template(points,
 def warp_points_template_to_FANC(points,
                                  input_units='nm',
                                  output_units='microns',
-                                 reflect=False):
-    points = np.array(points)
+                                 reflect=False,
+                                 workers=1,
+                                 use_grid=False):
+    points = np.array(points, dtype=np.float64)
     if len(points.shape) == 1:
         return warp_points_template_to_FANC(np.expand_dims(points, 0),
-                                            input_units, output_units)[0]
+                                            input_units, output_units,
+                                            reflect, workers, use_grid)[0]
     if input_units == 'nm' and (points < 1000).all():
         resp = input('Your points appear to be in microns, not nm. Want to'
                      ' change input_units from nm to microns? [y/n] ')
@@ -61,64 +87,66 @@ def warp_points_template_to_FANC(points,
     if input_units == 'nm':
         points /= 1000  # Convert nm to microns
 
-    if not reflect:
-        points[:, 0] = template_plane_of_symmetry_x_microns * 2 - points[:, 0]
-    transform_params = os.path.join(
-        os.path.dirname(__file__),
-        'TransformParameters.FixedTemplate.Bspline.txt'
-    )
-    points = transformix(points, transform_params)
-
-    points *= 1000  # Convert microns to nm
-    points[:, 2] = 435*400- points[:, 2]  # z flipping a stack with 436 slices
-    points /= (300, 300, 400)
-    points *= (430, 430, 450)
-    points += (533.2, 533.2, 945)  # (1.24, 1.24, 2.1) vox at (430, 430, 450)nm/vox
+    # Mirroring, elastic transformation, z flip, rescaling and offset, as
+    # described in README.md. See transform_chains.json for the details.
+    chain = transform_chain.load_transform_chain('template_to_FANC')
+    if reflect:
+        chain = chain.without('mirror')
+    if use_grid:
+        load_displacement_grid('template_to_FANC')
+    points = chain.transform_points(points, use_grid=use_grid, workers=workers)
 
     if output_units in ['um', 'microns']:
         points /= 1000  # Convert nm to microns
     return points
 
 
-def transformix(points, transformation_file):
-    def write_points_as_transformix_input_file(points, fn):
-        with open(fn, 'w') as f:
-            f.write('point\n{}\n'.format(len(points)))
-            for x, y, z in points:
-                f.write('%f %f %f\n'%(x, y, z))
-
-    starting_dir = os.getcwd()
-    if '/' in transformation_file:
-        os.chdir(os.path.dirname(transformation_file))
-
-    try:
-        fn = 'transformix_input.txt'
-        write_points_as_transformix_input_file(points, fn)
-        transformix_cmd = 'transformix -out ./ -tp {} -def {}'.format(
-            transformation_file,
-            fn
-        )
-        subprocess.run(transformix_cmd.split(' '), stdout=subprocess.DEVNULL)
-        if not os.path.exists('outputpoints.txt'):
-            # Run again but this time let the error message print
-            subprocess.run(transformix_cmd.split(' '))
-            raise Exception('transformix failed, see output above for details')
-
-        new_pts = []
-        with open('outputpoints.txt', 'r') as transformix_out:
-            for line in transformix_out.readlines():
-                output = line.split('OutputPoint = [ ')[1].split(' ]')[0]
-                new_pts.append([float(i) for i in output.split(' ')])
-    finally:
-        try: os.remove('transformix_input.txt')
-        except: pass
-        try: os.remove('outputpoints.txt')
-        except: pass
-        try: os.remove('transformix.log')
-        except: pass
-        os.chdir(starting_dir)
-
-    return np.array(new_pts)
+def transformix(points, transformation_file, use_binary=False, workers=1):
+    # Done in-process by elastix_transform.py unless use_binary=True. With
+    # workers > 1, the points are split across that many processes.
+    return elastix_transform.transformix(points, transformation_file,
+                                         use_binary=use_binary,
+                                         workers=workers)
+
+
+def make_displacement_grids(spacing=2):
+    """
+    Precompute the warps in both directions on grids with the given spacing
+    (in microns), for use_grid=True. Both come from
+    TransformParameters.FixedTemplate.Bspline.txt: template_to_FANC evaluates
+    it, and FANC_to_template inverts it numerically, so the two directions
+    are inverses of each other up to the interpolation error (unlike
+    TransformParameters.FixedFANC.txt, which was fitted separately). Each
+    grid's error is printed and saved with it, as the distance from where
+    use_grid=False puts points, i.e. for FANC_to_template, from
+    TransformParameters.FixedFANC.txt.
+    """
+    transform_params = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        'TransformParameters.FixedTemplate.Bspline.txt'
+    )
+    for direction, inverse in [('template_to_FANC', False),
+                               ('FANC_to_template', True)]:
+        print(f'Making {direction} grid')
+        chain = transform_chain.load_transform_chain(direction)
+        elastix_step, = [step for step in chain.steps if step['type'] == 'elastix']
+        elastix_transform.make_displacement_grid(
+            transform_params, displacement_grid_filename(direction),
+            spacing=spacing, inverse=inverse,
+            reference=chain.path(elastix_step['parameter_file']))
+
+
+def displacement_grid_filename(direction):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        f'displacement_grid.{direction}')
+
+
+def load_displacement_grid(direction):
+    grid_file = displacement_grid_filename(direction)
+    if not os.path.exists(grid_file + '.npy'):
+        raise FileNotFoundError(f'{grid_file}.npy not found. Run'
+                                ' make_displacement_grids() once to make it.')
+    return elastix_transform.load_displacement_grid(grid_file)
 
 
 if __name__ == "__main__":
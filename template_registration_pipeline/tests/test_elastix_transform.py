@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# Checks elastix_transform.py against transforms small enough to work out by
+# hand, written as elastix parameter files in a temporary folder.
+#
+# Run with: python3 -m pytest template_registration_pipeline/tests
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import elastix_transform
+
+# A B-spline control point grid of 8 x 7 x 6 points, 10 apart, from the origin
+GRID_SIZE = np.array([8, 7, 6])
+GRID_SPACING = 10.0
+
+
+def write_parameters(path, initial=None, **parameters):
+    """Write an elastix parameter file with the given parameters."""
+    parameters.setdefault('FixedImageDimension', 3)
+    parameters['InitialTransformParametersFileName'] = (
+        'NoInitialTransform' if initial is None else str(initial))
+    with open(path, 'w') as f:
+        for name, values in parameters.items():
+            if isinstance(values, str):
+                values = f'"{values}"'
+            else:
+                values = ' '.join(str(v) for v in np.ravel(values))
+            f.write(f'({name} {values})\n')
+    return str(path)
+
+
+def write_affine(path, matrix, translation, center=(0, 0, 0), **parameters):
+    return write_parameters(path, Transform='AffineTransform',
+                            TransformParameters=np.concatenate(
+                                [np.ravel(matrix), translation]),
+                            CenterOfRotationPoint=center, **parameters)
+
+
+def write_bspline(path, coefficients, direction=np.eye(3), **parameters):
+    """coefficients is an array of shape GRID_SIZE[::-1] + (3,), indexed [z, y, x]."""
+    # elastix lists all x displacements, then all y, then all z, each with x
+    # varying fastest. Directions are listed column by column.
+    return write_parameters(path, Transform='BSplineTransform',
+                            TransformParameters=np.moveaxis(coefficients, -1, 0),
+                            GridSize=GRID_SIZE, GridSpacing=[GRID_SPACING] * 3,
+                            GridOrigin=[0, 0, 0],
+                            GridDirection=np.ravel(direction, order='F'),
+                            **parameters)
+
+
+def control_point(index):
+    return np.array(index, dtype=np.float64) * GRID_SPACING
+
+
+def test_affine_about_a_center(tmp_path):
+    matrix = np.array([[0.9, 0.1, 0], [-0.2, 1.1, 0.05], [0, 0.3, 1.2]])
+    translation = np.array([5, -3, 2])
+    center = np.array([100, 200, 300])
+    parameter_file = write_affine(tmp_path / 'affine.txt', matrix, translation, center)
+    points = np.random.default_rng(0).uniform(0, 500, (20, 3))
+    assert np.allclose(elastix_transform.transformix(points, parameter_file),
+                       (points - center) @ matrix.T + center + translation)
+
+
+def test_bspline_displacement_at_a_control_point(tmp_path):
+    coefficients = np.zeros((*GRID_SIZE[::-1], 3))
+    coefficients[3, 2, 4] = [6, -3, 1.5]  # z, y, x
+    parameter_file = write_bspline(tmp_path / 'bspline.txt', coefficients)
+    transform = elastix_transform.load_transform(parameter_file)
+    # A control point's own weight at its position is (4/6)^3
+    point = control_point([4, 2, 3])
+    assert np.allclose(transform.displacements(point[np.newaxis]),
+                       (4 / 6) ** 3 * np.array([6, -3, 1.5]))
+    # Halfway to a neighbour along x, the weights are 23/48 and 1/48 each side
+    halfway = point + [GRID_SPACING / 2, 0, 0]
+    assert np.allclose(transform.displacements(halfway[np.newaxis]),
+                       23 / 48 * (4 / 6) ** 2 * np.array([6, -3, 1.5]))
+    # Further away than 2 control points, the control point has no effect
+    far = point + [2 * GRID_SPACING, 0, 0]
+    assert np.allclose(transform.displacements(far[np.newaxis]), 0)
+
+
+def test_bspline_displaces_only_points_with_full_support(tmp_path):
+    # Constant coefficients give a constant displacement wherever a point's
+    # 4 x 4 x 4 control points are all in the grid, i.e. index in [1, size-2)
+    coefficients = np.tile([1.0, 2.0, 3.0], (*GRID_SIZE[::-1], 1))
+    parameter_file = write_bspline(tmp_path / 'bspline.txt', coefficients)
+    inside_low = control_point([1, 1, 1])
+    inside_high = control_point(GRID_SIZE - 2) - 1e-6
+    points = np.array([
+        inside_low,
+        inside_high,
+        control_point([1, 1, 1]) - [1e-6, 0, 0],
+        control_point(GRID_SIZE - 2),
+        control_point([3, GRID_SIZE[1] - 2, 3])
+    ])
+    transformed = elastix_transform.transformix(points, parameter_file)
+    assert np.allclose(transformed - points, [[1, 2, 3], [1, 2, 3],
+                                              [0, 0, 0], [0, 0, 0], [0, 0, 0]])
+
+
+def test_grid_direction_is_read_column_by_column(tmp_path):
+    # Index x runs along physical y, and index y along physical -x
+    direction = np.array([[0, -1, 0], [1, 0, 0], [0, 0, 1]])
+    coefficients = np.zeros((*GRID_SIZE[::-1], 3))
+    coefficients[2, 3, 4] = [6, 0, 0]  # z, y, x
+    parameter_file = write_bspline(tmp_path / 'bspline.txt', coefficients,
+                                   direction=direction)
+    transform = elastix_transform.load_transform(parameter_file)
+    point = direction @ control_point([4, 3, 2])
+    assert np.allclose(transform.displacements(point[np.newaxis]),
+                       [(4 / 6) ** 3 * 6, 0, 0])
+    assert np.allclose(transform.displacements(
+        (direction.T @ control_point([4, 3, 2]))[np.newaxis]), 0)
+
+
+@pytest.mark.parametrize('combination, expected_scale', [('Compose', 6), ('Add', 4)])
+def test_initial_transforms(tmp_path, combination, expected_scale):
+    initial = write_affine(tmp_path / 'initial.txt', 2 * np.eye(3), [0, 0, 0])
+    parameter_file = write_affine(tmp_path / 'affine.txt', 3 * np.eye(3), [0, 0, 0],
+                                  initial=initial, HowToCombineTransforms=combination)
+    points = np.random.default_rng(0).uniform(0, 100, (10, 3))
+    # Compose: 3 * (2 * p). Add: 2 * p + 3 * p - p
+    assert np.allclose(elastix_transform.transformix(points, parameter_file),
+                       expected_scale * points)
+
+
+def test_initial_transform_is_found_next_to_the_parameter_file(tmp_path):
+    os.mkdir(tmp_path / 'elsewhere')
+    write_affine(tmp_path / 'initial.txt', np.eye(3), [10, 0, 0])
+    parameter_file = write_affine(tmp_path / 'affine.txt', np.eye(3), [0, 5, 0],
+                                  initial=tmp_path / 'elsewhere' / 'initial.txt')
+    assert np.allclose(elastix_transform.transformix([[1, 2, 3]], parameter_file),
+                       [[11, 7, 3]])
+
+
+def test_inverse_round_trip(tmp_path):
+    coefficients = np.random.default_rng(0).normal(0, 1, (*GRID_SIZE[::-1], 3))
+    initial = write_affine(tmp_path / 'initial.txt',
+                           [[1.05, 0.02, 0], [0, 0.95, 0.03], [0.01, 0, 1]],
+                           [1, -2, 0.5], center=[30, 30, 30])
+    parameter_file = write_bspline(tmp_path / 'bspline.txt', coefficients,
+                                   initial=initial)
+    transform = elastix_transform.load_transform(parameter_file)
+    # Away from the edges of the B-spline, where points jump from displaced to
+    # not, so have more than one inverse
+    points = np.random.default_rng(1).uniform(control_point([1.5, 1.5, 1.5]),
+                                              control_point(GRID_SIZE - 2.5), (200, 3))
+    transformed = transform.transform_points(points)
+    assert np.abs(transformed - points).max() > 1  # Not the identity
+    inverted = transform.inverse_transform_points(transformed)
+    assert np.allclose(inverted, points, atol=1e-3)
+
+
+def test_inverse_gives_nan_where_the_transform_is_singular(tmp_path):
+    # Cubic B-splines reproduce linear functions, so these coefficients
+    # displace x by -x wherever all of a point's control points are in the
+    # grid, flattening that region onto x = 0. Elsewhere the transform is the
+    # initial translation.
+    coefficients = np.zeros((*GRID_SIZE[::-1], 3))
+    coefficients[..., 0] = -np.arange(GRID_SIZE[0]) * GRID_SPACING
+    initial = write_affine(tmp_path / 'initial.txt', np.eye(3), [1, 1, 1])
+    parameter_file = write_bspline(tmp_path / 'bspline.txt', coefficients,
+                                   initial=initial)
+    transform = elastix_transform.load_transform(parameter_file)
+    assert np.allclose(transform.transform_points([control_point([3, 3, 3])]),
+                       [[0, 31, 31]])
+    # Nothing maps to the first point. Looking for what does starts in the
+    # flattened region, where the Jacobian is singular.
+    outside = control_point(GRID_SIZE + 3)
+    inverted = transform.inverse_transform_points(
+        [control_point([3.5, 3.5, 3.5]), transform.transform_points([outside])[0]])
+    assert np.isnan(inverted[0]).all()
+    assert np.allclose(inverted[1], outside, atol=1e-3)
+
+
+def make_grid(tmp_path, parameter_file, name='grid', **kwargs):
+    kwargs.setdefault('bounds', (control_point([0, 0, 0]), control_point(GRID_SIZE - 1)))
+    return elastix_transform.make_displacement_grid(
+        parameter_file, str(tmp_path / name), spacing=2, n_test_points=2000, **kwargs)
+
+
+def test_displacement_grid_of_an_affine_is_exact(tmp_path):
+    parameter_file = write_affine(tmp_path / 'affine.txt',
+                                  [[1.1, 0.1, 0], [0, 0.9, 0], [0.05, 0, 1]],
+                                  [1, 2, 3], center=[30, 30, 30])
+    grid = make_grid(tmp_path, parameter_file)
+    assert grid.info['max_error'] < 1e-4
+    # Displacements of an affine transform are linear, so interpolating them
+    # is exact, including between grid points
+    points = np.random.default_rng(0).uniform(0, control_point(GRID_SIZE - 1), (100, 3))
+    assert np.allclose(grid.transform_points(points),
+                       elastix_transform.transformix(points, parameter_file), atol=1e-4)
+
+
+def test_displacement_grid_interpolates_a_bspline(tmp_path):
+    coefficients = np.random.default_rng(0).normal(0, 1, (*GRID_SIZE[::-1], 3))
+    parameter_file = write_bspline(tmp_path / 'bspline.txt', coefficients)
+    # Where the B-spline is smooth
+    bounds = (control_point([1, 1, 1]), control_point(GRID_SIZE - 2) - 2)
+    grid = make_grid(tmp_path, parameter_file, bounds=bounds)
+    points = np.random.default_rng(1).uniform(*bounds, (100, 3))
+    exact = elastix_transform.transformix(points, parameter_file)
+    errors = np.linalg.norm(grid.transform_points(points) - exact, axis=1)
+    assert 0 < errors.max() <= grid.info['max_error'] < 0.1
+    # On grid points, and outside the grid, the grid gives the exact transform
+    grid_points = np.array([[10, 12, 14], [20, 30, 38], [200, 0, 0], [5, 20, 20]])
+    assert np.allclose(grid.transform_points(grid_points),
+                       elastix_transform.transformix(grid_points, parameter_file),
+                       atol=1e-4)
+
+
+def test_inverse_grid_inverts_next_to_unsolved_grid_points_exactly(tmp_path):
+    coefficients = np.random.default_rng(0).normal(0, 1, (*GRID_SIZE[::-1], 3))
+    parameter_file = write_bspline(tmp_path / 'bspline.txt', coefficients)
+    transform = elastix_transform.load_transform(parameter_file)
+    grid_file = str(tmp_path / 'inverse')
+    make_grid(tmp_path, parameter_file, name='inverse', inverse=True)
+    displacements = np.load(grid_file + '.npy', mmap_mode='r+')
+    displacements[10, 10, 10] = np.nan  # The grid point at (20, 20, 20)
+    displacements.flush()
+    del displacements
+    grid = elastix_transform.DisplacementGrid(grid_file)
+
+    next_to_unsolved = np.array([[19, 21, 20.5], [21.5, 18.5, 19]])
+    elsewhere = np.array([[31, 33, 35.5], [15.5, 40, 22]])
+    inverted = grid.transform_points(np.concatenate([next_to_unsolved, elsewhere]))
+    assert not np.isnan(inverted).any()
+    assert np.allclose(inverted[:2], transform.inverse_transform_points(next_to_unsolved))
+    assert not np.allclose(inverted[2:], transform.inverse_transform_points(elsewhere))
+    assert np.allclose(transform.transform_points(inverted), np.concatenate(
+        [next_to_unsolved, elsewhere]), atol=0.1)
+
+
+def test_grid_error_against_a_reference_transform(tmp_path):
+    parameter_file = write_affine(tmp_path / 'forward.txt', np.eye(3), [1, 0, 0])
+    reference = write_affine(tmp_path / 'reference.txt', np.eye(3), [-1.5, 0, 0])
+    grid = make_grid(tmp_path, parameter_file, inverse=True)
+    assert grid.info['max_error'] < 1e-4  # Transforming back misses by nothing
+    grid = make_grid(tmp_path, parameter_file, inverse=True, reference=reference)
+    assert grid.info['reference'] == 'reference.txt'
+    assert np.isclose(grid.info['max_error'], 0.5, atol=1e-4)
+    assert np.isclose(grid.info['mean_error'], 0.5, atol=1e-4)
+
+
+def test_displacement_grids_are_reloaded_when_remade(tmp_path):
+    parameter_file = write_affine(tmp_path / 'affine.txt', np.eye(3), [1, 0, 0])
+    make_grid(tmp_path, parameter_file)
+    grid = elastix_transform.load_displacement_grid(str(tmp_path / 'grid.npy'))
+    assert grid is elastix_transform.load_displacement_grid(str(tmp_path / 'grid'))
+    assert np.allclose(grid.transform_points([[10, 10, 10]]), [[11, 10, 10]])
+
+    write_affine(tmp_path / 'affine.txt', np.eye(3), [0, 2, 0])
+    make_grid(tmp_path, parameter_file)
+    for extension in ['.npy', '.json']:  # In case the file system's clock is coarse
+        modified = os.path.getmtime(tmp_path / f'grid{extension}')
+        os.utime(tmp_path / f'grid{extension}', (modified + 10, modified + 10))
+    grid = elastix_transform.load_displacement_grid(str(tmp_path / 'grid.json'))
+    assert np.allclose(grid.transform_points([[10, 10, 10]]), [[10, 12, 10]])
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+# Describes how to get from one coordinate space to another as a chain of
+# simple steps, applied in order:
+#   {"type": "translate", "offset": [x, y, z]}      p + offset
+#   {"type": "scale", "factors": [x, y, z]}         p * factors
+#   {"type": "flip", "axis": 2, "max": m}           p[axis] = m - p[axis]
+#   {"type": "mirror", "axis": 0, "plane": c}       p[axis] = 2 * c - p[axis]
+#   {"type": "elastix", "parameter_file": "TransformParameters.txt",
+#    "grid_file": "displacement_grid.name"}         (grid_file is optional)
+# The elastix step is applied with elastix_transform.py, or by interpolating
+# a precomputed displacement grid if grid_file is given and use_grid=True.
+# Any step can have a "note" explaining it, which is ignored.
+#
+# Chains are saved as json, and the chains used in this repository (e.g. from
+# the FANC EM dataset to the VNC template, in nm) are in
+# register_EM_dataset_to_template/transform_chains.json, where an entry is
+#   {"steps": [...], any other settings for the chain}
+# File names in a chain are relative to the json file they're in.
+#
+# Before a chain is applied, consecutive steps other than elastix ones are
+# fused into one affine transform, so each chain costs at most one matrix
+# multiplication per elastix step plus the elastix steps themselves, applied
+# to all the points at once.
+
+import os
+import sys
+import json
+import importlib.util
+
+import numpy as np
+
+
+def load_module_from_folder(name, folder=os.path.dirname(os.path.abspath(__file__))):
+    """
+    Import name.py from folder (by default this one) by its file path, so
+    code elsewhere in the repository can use these files without adding their
+    folder to sys.path. The module is registered in sys.modules under name,
+    so scripts that import it the usual way get the same one.
+    """
+    path = os.path.join(folder, name + '.py')
+    module = sys.modules.get(name, None)
+    if module is not None and os.path.abspath(getattr(module, '__file__', '')) == path:
+        return module
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except:
+        del sys.modules[name]
+        raise
+    return module
+
+
+elastix_transform = load_module_from_folder('elastix_transform')
+
+DEFAULT_CHAINS_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'register_EM_dataset_to_template', 'transform_chains.json')
+STEP_TYPES = ('translate', 'scale', 'flip', 'mirror', 'elastix')
+
+
+def step_to_affine(step):
+    """A 4x4 matrix that does a translate, scale, flip or mirror step."""
+    affine = np.eye(4)
+    if step['type'] == 'translate':
+        affine[:3, 3] = step['offset']
+    elif step['type'] == 'scale':
+        affine[:3, :3] = np.diag(np.broadcast_to(np.array(step['factors'], dtype=np.float64), 3))
+    elif step['type'] == 'flip':
+        affine[step['axis'], step['axis']] = -1
+        affine[step['axis'], 3] = step['max']
+    elif step['type'] == 'mirror':
+        affine[step['axis'], step['axis']] = -1
+        affine[step['axis'], 3] = 2 * step['plane']
+    else:
+        raise ValueError(f'{step["type"]} steps are not affine')
+    return affine
+
+
+class TransformChain:
+    """
+    A list of steps (see the top of this file), plus any other settings that
+    came with it in its json entry, in info. base_dir is where the
+    file names in its steps are relative to.
+    """
+    def __init__(self, steps, base_dir=None, **info):
+        for step in steps:
+            if step['type'] not in STEP_TYPES:
+                raise ValueError(f'Unknown step type "{step["type"]}". Choose'
+                                 f' from {STEP_TYPES}')
+        self.steps = [dict(step) for step in steps]
+        self.base_dir = base_dir if base_dir is not None else os.getcwd()
+        self.info = info
+
+    @classmethod
+    def from_dict(cls, entry, base_dir=None):
+        entry = dict(entry)
+        return cls(entry.pop('steps'), base_dir=base_dir, **entry)
+
+    def to_dict(self):
+        return dict(self.info, steps=[dict(step) for step in self.steps])
+
+    def save(self, filename, name):
+        """
+        Add this chain to the json file filename under name, with its file
+        names made relative to that file.
+        """
+        chains = {}
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                chains = json.load(f)
+        entry = self.to_dict()
+        for step in entry['steps']:
+            for key in ('parameter_file', 'grid_file'):
+                if key in step:
+                    step[key] = os.path.relpath(self.path(step[key]),
+                                                os.path.dirname(os.path.abspath(filename)))
+        chains[name] = entry
+        with open(filename, 'w') as f:
+            json.dump(chains, f, indent=2)
+
+    def without(self, step_type):
+        """A copy of this chain without its steps of the given type."""
+        return TransformChain([step for step in self.steps
+                               if step['type'] != step_type],
+                              base_dir=self.base_dir, **self.info)
+
+    def then(self, *steps):
+        """A copy of this chain with the given steps added at the end."""
+        return TransformChain(self.steps + list(steps),
+                              base_dir=self.base_dir, **self.info)
+
+    def path(self, filename):
+        return os.path.join(self.base_dir, filename)
+
+    def fused(self):
+        """
+        The chain as a list of stages: ('affine', 4x4 matrix) for each run of
+        consecutive steps other than elastix steps, and ('elastix', step) for
+        each elastix step.
+        """
+        stages = []
+        for step in self.steps:
+            if step['type'] == 'elastix':
+                stages.append(('elastix', step))
+            elif len(stages) > 0 and stages[-1][0] == 'affine':
+                stages[-1] = ('affine', step_to_affine(step) @ stages[-1][1])
+            else:
+                stages.append(('affine', step_to_affine(step)))
+        return stages
+
+    def transform_points(self, points, use_grid=False, use_binary=False, workers=1):
+        """
+        Apply the chain to an (N, 3) array of points. use_binary and workers
+        are passed on to elastix_transform.transformix. With use_grid=True,
+        elastix steps that have a grid_file are done by interpolating it.
+        """
+        points = np.array(points, dtype=np.float64).reshape(-1, 3)
+        for kind, stage in self.fused():
+            if kind == 'affine':
+                points = points @ stage[:3, :3].T + stage[:3, 3]
+            elif use_grid and 'grid_file' in stage:
+                points = elastix_transform.load_displacement_grid(
+                    self.path(stage['grid_file'])).transform_points(points)
+            else:
+                points = elastix_transform.transformix(
+                    points, self.path(stage['parameter_file']),
+                    use_binary=use_binary, workers=workers)
+        return points
+
+    def transform_many(self, point_arrays, **kwargs):
+        """
+        Apply the chain to several arrays of points (e.g. the nodes and
+        connectors of many neurons) in one go, by stacking them and splitting
+        the result back up. point_arrays is a dict of key -> (N, 3) array,
+        and the transformed arrays are returned under the same keys. kwargs
+        are passed on to transform_points.
+        """
+        keys = list(point_arrays)
+        arrays = [np.asarray(point_arrays[key], dtype=np.float64).reshape(-1, 3)
+                  for key in keys]
+        offsets = np.cumsum([0] + [len(points) for points in arrays])
+        if offsets[-1] == 0:
+            return {key: points.copy() for key, points in zip(keys, arrays)}
+        transformed = self.transform_points(np.concatenate(arrays), **kwargs)
+        return {key: transformed[offsets[i]:offsets[i+1]]
+                for i, key in enumerate(keys)}
+
+
+def load_transform_chain(name, chains_file=DEFAULT_CHAINS_FILE):
+    """The chain saved under name in chains_file."""
+    with open(chains_file, 'r') as f:
+        chains = json.load(f)
+    if name not in chains:
+        raise KeyError(f'No transform chain named "{name}" in {chains_file}.'
+                       f' Choose from {list(chains)}')
+    return TransformChain.from_dict(chains[name],
+                                    base_dir=os.path.dirname(os.path.abspath(chains_file)))
+
+
+def get_transform_chain_names(chains_file=DEFAULT_CHAINS_FILE):
+    with open(chains_file, 'r') as f:
+        return list(json.load(f))